@@ -0,0 +1,200 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Admits pipeline jobs only when the VM resources they request fit a quota.
+
+Every pipelines worker runs on its own VM, whose cores, RAM and GPUs count
+against the project's regional quotas. Jobs submitted beyond the quota are
+queued by the Pipelines API, and their wait counts against their timeouts.
+An AdmissionController keeps track of the resources of the running jobs of a
+run, and a job is only started once its resources fit the remaining quota.
+
+Quotas are read from a QuotaSource. Unset limits are unbounded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import re
+import threading
+
+import gcs_client
+
+
+INSTANCES = 'instances'
+CPUS = 'cpus'
+MEMORY_GB = 'memory_gb'
+GPUS = 'gpus'
+RESOURCES = (INSTANCES, CPUS, MEMORY_GB, GPUS)
+
+_CUSTOM_MACHINE_TYPE_PATTERN = re.compile(
+    r'^(?:[a-z0-9]+-)?custom-(\d+)-(\d+)(?:-ext)?$')
+_PREDEFINED_MACHINE_TYPE_PATTERN = re.compile(r'^n1-([a-z]+)-(\d+)$')
+# RAM (in GB) per core of the predefined n1 machine types.
+_PREDEFINED_MEMORY_GB_PER_CPU = {
+    'standard': 3.75,
+    'highmem': 6.5,
+    'highcpu': 0.9,
+}
+
+
+def get_machine_type_resources(machine_type):
+  """Returns the (cpus, memory_gb) of a Compute Engine machine type.
+
+  Raises:
+    ValueError: if the machine type is not a custom or n1 machine type.
+  """
+  match = _CUSTOM_MACHINE_TYPE_PATTERN.match(machine_type)
+  if match:
+    return int(match.group(1)), int(match.group(2)) / 1024
+  match = _PREDEFINED_MACHINE_TYPE_PATTERN.match(machine_type)
+  if match and match.group(1) in _PREDEFINED_MEMORY_GB_PER_CPU:
+    cpus = int(match.group(2))
+    return cpus, cpus * _PREDEFINED_MEMORY_GB_PER_CPU[match.group(1)]
+  raise ValueError('Unsupported machine type: %s' % machine_type)
+
+
+def get_job_resources(run_args):
+  """Returns the resources of the VM of a pipelines job.
+
+  Args:
+    run_args: (list) arguments of the pipelines tool, with --machine-type and
+      optionally --gpus.
+
+  Returns:
+    A dict mapping each of RESOURCES to the amount the job uses.
+  """
+  def get_arg(name):
+    return run_args[run_args.index(name) + 1] if name in run_args else None
+
+  cpus, memory_gb = get_machine_type_resources(get_arg('--machine-type'))
+  return {
+      INSTANCES: 1,
+      CPUS: cpus,
+      MEMORY_GB: memory_gb,
+      GPUS: int(get_arg('--gpus') or 0),
+  }
+
+
+class QuotaSource(object):
+  """Provides the resource limits of a run."""
+
+  def get_limits(self):
+    """Returns a dict mapping resources (in RESOURCES) to their limit."""
+    raise NotImplementedError
+
+
+class StaticQuotaSource(QuotaSource):
+  """Quota source with fixed limits, e.g. from flags."""
+
+  def __init__(self, limits):
+    self._limits = dict(limits)
+
+  def get_limits(self):
+    return dict(self._limits)
+
+
+class FileQuotaSource(QuotaSource):
+  """Quota source reading a JSON object of limits from a local or GCS file.
+
+  For example: {"cpus": 2400, "memory_gb": 9000, "gpus": 8}.
+  """
+
+  def __init__(self, path):
+    self._path = path
+
+  def get_limits(self):
+    if self._path.startswith('gs://'):
+      content = gcs_client.download(self._path).decode('utf-8')
+    else:
+      with open(self._path) as f:
+        content = f.read()
+    limits = json.loads(content)
+    if not isinstance(limits, dict):
+      raise ValueError('Quota file %s must hold a JSON object.' % self._path)
+    return limits
+
+
+class AdmissionController(object):
+  """Keeps the total resources of running jobs within a quota."""
+
+  def __init__(self, quota_source):
+    """Keeps the total resources of running jobs within a quota.
+
+    Args:
+      quota_source: (QuotaSource) source of the limits, read once.
+
+    Raises:
+      ValueError: if a limit is of an unknown resource or negative.
+    """
+    self.limits = {
+        resource: limit
+        for resource, limit in quota_source.get_limits().items()
+        if limit is not None
+    }
+    for resource, limit in self.limits.items():
+      if resource not in RESOURCES:
+        raise ValueError('Unknown quota resource: %s' % resource)
+      if limit < 0:
+        raise ValueError('Quota of %s cannot be negative.' % resource)
+    self._in_use = dict.fromkeys(RESOURCES, 0)
+    self._lock = threading.Lock()
+
+  def check(self, resources):
+    """Raises ValueError if a job could never fit the quota on its own."""
+    for resource, limit in self.limits.items():
+      if resources.get(resource, 0) > limit:
+        raise ValueError('A job needs %s %s, more than the quota of %s.' %
+                         (resources[resource], resource, limit))
+
+  def try_acquire(self, resources):
+    """Reserves the resources of a job if they fit the remaining quota.
+
+    Returns:
+      Whether the resources were reserved.
+    """
+    with self._lock:
+      for resource, limit in self.limits.items():
+        if self._in_use[resource] + resources.get(resource, 0) > limit:
+          return False
+      for resource in RESOURCES:
+        self._in_use[resource] += resources.get(resource, 0)
+      return True
+
+  def release(self, resources):
+    """Releases the resources reserved by try_acquire."""
+    with self._lock:
+      for resource in RESOURCES:
+        self._in_use[resource] -= resources.get(resource, 0)
+
+  def get_in_use(self):
+    """Returns the resources reserved by running jobs."""
+    with self._lock:
+      return dict(self._in_use)
@@ -0,0 +1,133 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for admission_control.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python admission_control_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import admission_control
+import gcs_client
+import mock
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+  def test_get_machine_type_resources(self):
+    self.assertEqual(
+        admission_control.get_machine_type_resources('custom-8-30720'),
+        (8, 30))
+    self.assertEqual(
+        admission_control.get_machine_type_resources('n1-custom-2-2048-ext'),
+        (2, 2))
+    self.assertEqual(
+        admission_control.get_machine_type_resources('n1-highmem-4'), (4, 26))
+    with self.assertRaisesRegex(ValueError, 'Unsupported machine type'):
+      admission_control.get_machine_type_resources('e2-micro')
+
+  def test_get_job_resources(self):
+    self.assertEqual(
+        admission_control.get_job_resources([
+            'pipelines', 'run', '--machine-type', 'custom-4-16384',
+            '--gpu-type', 'nvidia-tesla-k80', '--gpus', '1'
+        ]), {
+            'instances': 1,
+            'cpus': 4,
+            'memory_gb': 16,
+            'gpus': 1
+        })
+
+  def test_file_quota_source(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    path = os.path.join(temp_dir, 'quota.json')
+    with open(path, 'w') as f:
+      json.dump({'cpus': 24, 'gpus': 2}, f)
+    self.assertEqual(
+        admission_control.FileQuotaSource(path).get_limits(), {
+            'cpus': 24,
+            'gpus': 2
+        })
+
+  @mock.patch.object(gcs_client, 'download', return_value=b'[1]')
+  def test_file_quota_source_not_an_object(self, mock_download):
+    with self.assertRaisesRegex(ValueError, 'must hold a JSON object'):
+      admission_control.FileQuotaSource('gs://bucket/quota.json').get_limits()
+    mock_download.assert_called_once_with('gs://bucket/quota.json')
+
+  def test_admission_controller(self):
+    controller = admission_control.AdmissionController(
+        admission_control.StaticQuotaSource({'cpus': 10, 'gpus': None}))
+    job = {'instances': 1, 'cpus': 4, 'memory_gb': 16, 'gpus': 1}
+    self.assertTrue(controller.try_acquire(job))
+    self.assertTrue(controller.try_acquire(job))
+    self.assertFalse(controller.try_acquire(job))
+    self.assertEqual(controller.get_in_use(), {
+        'instances': 2,
+        'cpus': 8,
+        'memory_gb': 32,
+        'gpus': 2
+    })
+    controller.release(job)
+    self.assertTrue(controller.try_acquire(job))
+
+  def test_admission_controller_check(self):
+    controller = admission_control.AdmissionController(
+        admission_control.StaticQuotaSource({'gpus': 0}))
+    controller.check({'cpus': 64, 'gpus': 0})
+    with self.assertRaisesRegex(ValueError, 'needs 1 gpus'):
+      controller.check({'cpus': 1, 'gpus': 1})
+
+  def test_admission_controller_invalid_limits(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown quota resource: tpus'):
+      admission_control.AdmissionController(
+          admission_control.StaticQuotaSource({'tpus': 1}))
+    with self.assertRaisesRegex(ValueError, 'cannot be negative'):
+      admission_control.AdmissionController(
+          admission_control.StaticQuotaSource({'cpus': -1}))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Reads the samples of a multi-sample run from a batch manifest.
+
+The manifest lists one sample per row, either as a JSON list of objects or as
+a TSV file with a header row, with the fields:
+  bam (required), bai, outfile (required), gvcf_outfile, sample_name.
+Empty fields are treated as unset.
+
+Each sample is identified by its sample_name or, if not set, by the name of its
+BAM file without the .bam suffix. Identifiers must be unique: they name the
+sample's staging folder and jobs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import io
+import json
+import posixpath
+import re
+
+
+_FIELDS = ('bam', 'bai', 'outfile', 'gvcf_outfile', 'sample_name')
+_REQUIRED_FIELDS = ('bam', 'outfile')
+_BAM_FILE_SUFFIX = '.bam'
+
+
+class Sample(object):
+  """A sample of a multi-sample run."""
+
+  def __init__(self, sample_id, bam, outfile, bai=None, gvcf_outfile=None,
+               sample_name=None):
+    self.sample_id = sample_id
+    self.bam = bam
+    self.outfile = outfile
+    self.bai = bai
+    self.gvcf_outfile = gvcf_outfile
+    self.sample_name = sample_name
+
+  def to_dict(self):
+    """Returns a JSON serializable description of the sample."""
+    return {
+        'sample_id': self.sample_id,
+        'bam': self.bam,
+        'bai': self.bai,
+        'outfile': self.outfile,
+        'gvcf_outfile': self.gvcf_outfile,
+        'sample_name': self.sample_name,
+    }
+
+
+def _get_sample_id(row):
+  if row.get('sample_name'):
+    name = row['sample_name']
+  else:
+    name = posixpath.basename(row['bam'])
+    if name.endswith(_BAM_FILE_SUFFIX):
+      name = name[:-len(_BAM_FILE_SUFFIX)]
+  # Identifiers are used in GCS paths and job names.
+  return re.sub(r'[^A-Za-z0-9._-]', '_', name)
+
+
+def parse(content, is_json):
+  """Returns the Samples listed in the content of a batch manifest.
+
+  Args:
+    content: (str) content of the manifest.
+    is_json: (bool) whether the manifest is JSON (or TSV).
+
+  Raises:
+    ValueError: if the manifest is invalid.
+  """
+  if is_json:
+    rows = json.loads(content)
+    if not isinstance(rows, list) or not all(
+        isinstance(row, dict) for row in rows):
+      raise ValueError('A JSON batch manifest must be a list of objects.')
+  else:
+    rows = list(csv.DictReader(io.StringIO(content), delimiter='\t'))
+  if not rows:
+    raise ValueError('The batch manifest has no samples.')
+
+  samples = []
+  sample_ids = set()
+  for i, row in enumerate(rows):
+    unknown_fields = sorted(set(row) - set(_FIELDS))
+    if unknown_fields:
+      raise ValueError('Unknown fields in batch manifest: %s' %
+                       ', '.join(unknown_fields))
+    row = {field: row.get(field) or None for field in _FIELDS}
+    for field in _REQUIRED_FIELDS:
+      if not row[field]:
+        raise ValueError('Sample %d of the batch manifest has no %s.' %
+                         (i, field))
+    sample_id = _get_sample_id(row)
+    if sample_id in sample_ids:
+      raise ValueError('Duplicate sample in batch manifest: %s' % sample_id)
+    sample_ids.add(sample_id)
+    samples.append(Sample(sample_id, **row))
+  return samples
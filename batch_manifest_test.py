@@ -0,0 +1,100 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for batch_manifest.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python batch_manifest_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import unittest
+
+import batch_manifest
+
+
+class BatchManifestTest(unittest.TestCase):
+
+  def test_parse_tsv(self):
+    samples = batch_manifest.parse(
+        'bam\toutfile\tsample_name\tgvcf_outfile\n'
+        'gs://bucket/a.bam\tgs://bucket/a.vcf\t\t\n'
+        'gs://bucket/b.bam\tgs://bucket/b.vcf\tNA 12878\tgs://bucket/b.g.vcf\n',
+        is_json=False)
+    self.assertEqual([sample.to_dict() for sample in samples], [{
+        'sample_id': 'a',
+        'bam': 'gs://bucket/a.bam',
+        'bai': None,
+        'outfile': 'gs://bucket/a.vcf',
+        'gvcf_outfile': None,
+        'sample_name': None,
+    }, {
+        'sample_id': 'NA_12878',
+        'bam': 'gs://bucket/b.bam',
+        'bai': None,
+        'outfile': 'gs://bucket/b.vcf',
+        'gvcf_outfile': 'gs://bucket/b.g.vcf',
+        'sample_name': 'NA 12878',
+    }])
+
+  def test_parse_json(self):
+    samples = batch_manifest.parse(
+        json.dumps([{
+            'bam': 'gs://bucket/a.bam',
+            'bai': 'gs://bucket/a.bai',
+            'outfile': 'gs://bucket/a.vcf'
+        }]),
+        is_json=True)
+    self.assertEqual(len(samples), 1)
+    self.assertEqual(samples[0].sample_id, 'a')
+    self.assertEqual(samples[0].bai, 'gs://bucket/a.bai')
+
+  def test_parse_invalid(self):
+    for content, is_json, error in [
+        ('{}', True, 'must be a list'),
+        ('bam\toutfile\n', False, 'no samples'),
+        ('bam\toutfile\tfoo\nx.bam\tx.vcf\t1\n', False, 'Unknown fields'),
+        ('bam\toutfile\nx.bam\t\n', False, 'Sample 0 .* has no outfile'),
+        ('bam\toutfile\nx.bam\tx.vcf\nd/x.bam\ty.vcf\n', False, 'Duplicate'),
+    ]:
+      with self.assertRaisesRegex(ValueError, error):
+        batch_manifest.parse(content, is_json)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,317 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Pool of warm GKE clusters shared by runs through leases.
+
+A ClusterPool leases out existing clusters of a given configuration (location
+and creation args, e.g. the TPU settings) that no other run is using, and only
+creates a new cluster when none is free. Runs release their clusters back to
+the pool instead of deleting them, and reap() deletes the clusters of the pool
+that stayed idle for longer than the idle TTL.
+
+Each cluster has a lease (named after the cluster) in a lease_store.LeaseStore,
+e.g. on GCS so that runners on different machines coordinate. A lease is
+renewed from when it is taken (i.e. also while its cluster is created or
+verified) until it is released, so the clusters of crashed runs are reused (or
+reaped) once their lease expires. The location of a cluster is kept in the
+data of its lease.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+import gke_cluster
+import process_util
+
+
+# Prefix of the names of all clusters of pools.
+CLUSTER_NAME_PREFIX = 'dvpool-'
+
+# Time (in seconds) after which the lease of a cluster expires unless renewed.
+_DEFAULT_LEASE_SEC = 10 * 60
+
+# Length of the (hex) key of a cluster configuration in cluster names.
+_CONFIG_KEY_LENGTH = 8
+
+# Number of new cluster names to try taking the lease of before giving up.
+_MAX_NEW_LEASE_TRIES = 3
+
+
+def get_config_key(cluster_region=None,
+                   cluster_zone=None,
+                   alpha_cluster=False,
+                   extra_create_args=None):
+  """Returns the key of a cluster configuration, as used in cluster names."""
+  config = [cluster_region, cluster_zone, alpha_cluster,
+            list(extra_create_args or [])]
+  return hashlib.sha256(
+      json.dumps(config).encode('utf-8')).hexdigest()[:_CONFIG_KEY_LENGTH]
+
+
+class _LeaseRenewer(threading.Thread):
+  """Renews the lease of a cluster until stopped."""
+
+  def __init__(self, pool, cluster_name):
+    super(_LeaseRenewer, self).__init__()
+    self.daemon = True
+    self._pool = pool
+    self._cluster_name = cluster_name
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.wait(self._pool.lease_sec / 3):
+      if not self._pool.renew(self._cluster_name):
+        logging.warning('Lost the lease of GKE cluster %s.',
+                        self._cluster_name)
+        return
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+
+class ClusterLease(object):
+  """A cluster leased from a ClusterPool, renewed until released."""
+
+  def __init__(self, pool, cluster_name, cluster, renewer):
+    self.cluster_name = cluster_name
+    # The gke_cluster.GkeCluster.
+    self.cluster = cluster
+    self._pool = pool
+    self._renewer = renewer
+
+  def release(self):
+    """Returns the cluster to the pool."""
+    self._renewer.stop()
+    self._pool.release(self.cluster_name)
+
+
+class ClusterPool(object):
+  """Pool of GKE clusters of one configuration, backed by a lease store."""
+
+  def __init__(self,
+               store,
+               owner,
+               cluster_region=None,
+               cluster_zone=None,
+               alpha_cluster=False,
+               extra_create_args=None,
+               use_kubernetes_api=False,
+               idle_ttl_sec=0,
+               lease_sec=_DEFAULT_LEASE_SEC):
+    """Pool of GKE clusters of one configuration, backed by a lease store.
+
+    Args:
+      store: (lease_store.LeaseStore) store of the cluster leases.
+      owner: (str) unique identifier of the caller.
+      cluster_region: (str) GCP region of the clusters.
+      cluster_zone: (str) GCP zone of the clusters.
+      alpha_cluster: (bool) whether the clusters are alpha clusters.
+      extra_create_args: (list) additional args (type str) used when creating
+        a cluster. See gke_cluster.GkeCluster.
+      use_kubernetes_api: (bool) see gke_cluster.GkeCluster.
+      idle_ttl_sec: (float) time (in seconds) a cluster may stay idle before
+        reap() deletes it.
+      lease_sec: (int) time (in seconds) after which the lease of a cluster
+        expires unless renewed.
+    """
+    self.lease_sec = lease_sec
+    self.idle_ttl_sec = idle_ttl_sec
+    self._store = store
+    self._owner = owner
+    self._cluster_region = cluster_region
+    self._cluster_zone = cluster_zone
+    self._alpha_cluster = alpha_cluster
+    self._extra_create_args = extra_create_args
+    self._use_kubernetes_api = use_kubernetes_api
+    self._name_prefix = CLUSTER_NAME_PREFIX + get_config_key(
+        cluster_region, cluster_zone, alpha_cluster, extra_create_args) + '-'
+
+  def _acquire(self, cluster_name, data=None):
+    """Takes the lease of a cluster, and starts renewing it.
+
+    Returns:
+      The started _LeaseRenewer, or None if the lease is held by another run.
+    """
+    if not self._store.try_acquire(cluster_name, self._owner, self.lease_sec,
+                                   data):
+      return None
+    renewer = _LeaseRenewer(self, cluster_name)
+    renewer.start()
+    return renewer
+
+  def _acquire_new(self):
+    """Takes the lease of a new cluster name, and starts renewing it.
+
+    Returns:
+      A tuple (cluster name, started _LeaseRenewer).
+
+    Raises:
+      RuntimeError: if another run holds the lease of every name tried.
+    """
+    for _ in range(_MAX_NEW_LEASE_TRIES):
+      cluster_name = self._name_prefix + uuid.uuid4().hex[:10]
+      renewer = self._acquire(
+          cluster_name, {
+              'cluster_region': self._cluster_region,
+              'cluster_zone': self._cluster_zone,
+          })
+      if renewer:
+        return cluster_name, renewer
+      logging.warning('GKE cluster %s of the pool was leased by another run.',
+                      cluster_name)
+    raise RuntimeError('Failed to lease a new GKE cluster of the pool after '
+                       '%d tries.' % _MAX_NEW_LEASE_TRIES)
+
+  def _remove(self, cluster_name, renewer):
+    """Deletes a leased cluster (if it exists) and its lease."""
+    renewer.stop()
+    args = ['gcloud', 'container', 'clusters', 'delete', cluster_name,
+            '--quiet', '--async']
+    if self._cluster_region:
+      args.extend(['--region', self._cluster_region])
+    if self._cluster_zone:
+      args.extend(['--zone', self._cluster_zone])
+    try:
+      process_util.run_command(args)
+    except RuntimeError as e:
+      logging.warning('Failed to delete GKE cluster %s (delete it manually if '
+                      'it exists): %s', cluster_name, str(e))
+    self._store.delete(cluster_name, self._owner)
+
+  def lease(self):
+    """Leases a free cluster of the pool, or creates one if none is free.
+
+    The lease is renewed from when it is taken, since verifying a provisioning
+    cluster or creating one may take longer than the lease time.
+
+    Returns:
+      A ClusterLease, which must be released once the cluster is not used.
+    """
+    for cluster_name in self._store.list_names():
+      if not cluster_name.startswith(self._name_prefix):
+        continue
+      renewer = self._acquire(cluster_name)
+      if not renewer:
+        continue
+      try:
+        cluster = gke_cluster.GkeCluster(
+            cluster_name,
+            self._cluster_region,
+            self._cluster_zone,
+            create_if_not_exist=False,
+            use_kubernetes_api=self._use_kubernetes_api)
+      except ValueError as e:
+        logging.warning('Removing GKE cluster %s from the pool: %s',
+                        cluster_name, str(e))
+        renewer.stop()
+        self._store.delete(cluster_name, self._owner)
+        continue
+      except RuntimeError as e:
+        logging.warning('Deleting unusable GKE cluster %s of the pool: %s',
+                        cluster_name, str(e))
+        self._remove(cluster_name, renewer)
+        continue
+      logging.info('Leased warm GKE cluster %s.', cluster_name)
+      return ClusterLease(self, cluster_name, cluster, renewer)
+
+    cluster_name, renewer = self._acquire_new()
+    try:
+      cluster = gke_cluster.GkeCluster(
+          cluster_name,
+          self._cluster_region,
+          self._cluster_zone,
+          alpha_cluster=self._alpha_cluster,
+          extra_create_args=self._extra_create_args,
+          use_kubernetes_api=self._use_kubernetes_api)
+    except Exception:
+      # The cluster may have been partly created (e.g. in an error state).
+      self._remove(cluster_name, renewer)
+      raise
+    return ClusterLease(self, cluster_name, cluster, renewer)
+
+  def renew(self, cluster_name):
+    """Extends the lease of a cluster. Returns False if it is not held."""
+    return self._store.renew(cluster_name, self._owner, self.lease_sec)
+
+  def release(self, cluster_name):
+    """Returns a leased cluster to the pool."""
+    self._store.release(cluster_name, self._owner)
+
+  def reap(self):
+    """Deletes the clusters of all pools of the store that stayed idle too long.
+
+    A cluster is idle from when it was released, or from when its lease
+    expired if it was not.
+
+    Returns:
+      The names of the deleted clusters.
+    """
+    reaped_cluster_names = []
+    for cluster_name in self._store.list_names():
+      if not cluster_name.startswith(CLUSTER_NAME_PREFIX):
+        continue
+      record = self._store.get_record(cluster_name)
+      if not record or record.get('done'):
+        continue
+      now = time.time()
+      if record['expiration_time'] > now:
+        continue
+      idle_since = record.get('release_time', record['expiration_time'])
+      if (now - idle_since < self.idle_ttl_sec or
+          not self._store.try_acquire(cluster_name, self._owner,
+                                      self.lease_sec)):
+        continue
+      data = record.get('data') or {}
+      try:
+        cluster = gke_cluster.GkeCluster(
+            cluster_name,
+            data.get('cluster_region'),
+            data.get('cluster_zone'),
+            create_if_not_exist=False)
+        logging.info('Deleting GKE cluster %s, idle for %d seconds.',
+                     cluster_name, now - idle_since)
+        cluster.delete_cluster(wait=False)
+      except ValueError:
+        pass  # The cluster does not exist anymore.
+      except RuntimeError as e:
+        logging.warning('Failed to delete idle GKE cluster %s: %s',
+                        cluster_name, str(e))
+        self._store.release(cluster_name, self._owner)
+        continue
+      self._store.delete(cluster_name, self._owner)
+      reaped_cluster_names.append(cluster_name)
+    return reaped_cluster_names
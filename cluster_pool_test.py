@@ -0,0 +1,253 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for cluster_pool.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+
+Then run:
+$ python cluster_pool_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import cluster_pool
+import lease_store
+import mock
+
+
+class ClusterPoolTest(unittest.TestCase):
+  """Tests ClusterPool with a local lease store and mock clusters."""
+
+  def setUp(self):
+    super(ClusterPoolTest, self).setUp()
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    self._store = lease_store.LocalLeaseStore(directory)
+    patcher = mock.patch('gke_cluster.GkeCluster')
+    self._mock_gke_cluster = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _get_pool(self, owner, zone='us-central1-c', **kwargs):
+    return cluster_pool.ClusterPool(
+        self._store,
+        owner,
+        cluster_zone=zone,
+        extra_create_args=['--enable-tpu'],
+        **kwargs)
+
+  def testLease_CreatesClusterWhenNoneIsFree(self):
+    lease1 = self._get_pool('owner1').lease()
+    lease2 = self._get_pool('owner2').lease()
+    self.assertNotEqual(lease1.cluster_name, lease2.cluster_name)
+    self.assertTrue(lease1.cluster_name.startswith(
+        cluster_pool.CLUSTER_NAME_PREFIX +
+        cluster_pool.get_config_key(None, 'us-central1-c', False,
+                                    ['--enable-tpu'])))
+    self._mock_gke_cluster.assert_called_with(
+        lease2.cluster_name,
+        None,
+        'us-central1-c',
+        alpha_cluster=False,
+        extra_create_args=['--enable-tpu'],
+        use_kubernetes_api=False)
+    self.assertEqual(
+        self._store.get_record(lease1.cluster_name)['data'], {
+            'cluster_region': None,
+            'cluster_zone': 'us-central1-c'
+        })
+    lease1.release()
+    lease2.release()
+
+  def testLease_ReusesReleasedCluster(self):
+    lease = self._get_pool('owner1').lease()
+    lease.release()
+    self._mock_gke_cluster.reset_mock()
+    reused_lease = self._get_pool('owner2').lease()
+    self.assertEqual(reused_lease.cluster_name, lease.cluster_name)
+    self._mock_gke_cluster.assert_called_once_with(
+        lease.cluster_name,
+        None,
+        'us-central1-c',
+        create_if_not_exist=False,
+        use_kubernetes_api=False)
+    self.assertEqual(self._store.get_owner(lease.cluster_name), 'owner2')
+    reused_lease.release()
+
+  def testLease_SkipsOtherConfigs(self):
+    self._get_pool('owner1', zone='us-central1-a').lease().release()
+    lease = self._get_pool('owner2').lease()
+    self.assertEqual(len(self._store.list_names()), 2)
+    lease.release()
+
+  def testLease_RemovesMissingCluster(self):
+    lease = self._get_pool('owner1').lease()
+    lease.release()
+    self._mock_gke_cluster.side_effect = [ValueError('does not exist'),
+                                          mock.Mock()]
+    new_lease = self._get_pool('owner2').lease()
+    self.assertNotEqual(new_lease.cluster_name, lease.cluster_name)
+    self.assertEqual(self._store.list_names(), [new_lease.cluster_name])
+    new_lease.release()
+
+  @mock.patch('process_util.run_command')
+  def testLease_DeletesUnusableCluster(self, mock_run_command):
+    lease = self._get_pool('owner1').lease()
+    lease.release()
+    self._mock_gke_cluster.side_effect = [RuntimeError('not reachable'),
+                                          mock.Mock()]
+    new_lease = self._get_pool('owner2').lease()
+    self.assertNotEqual(new_lease.cluster_name, lease.cluster_name)
+    mock_run_command.assert_called_once_with([
+        'gcloud', 'container', 'clusters', 'delete', lease.cluster_name,
+        '--quiet', '--async', '--zone', 'us-central1-c'
+    ])
+    self.assertEqual(self._store.list_names(), [new_lease.cluster_name])
+    new_lease.release()
+
+  @mock.patch('process_util.run_command')
+  def testLease_CreationFails(self, mock_run_command):
+    self._mock_gke_cluster.side_effect = RuntimeError('quota')
+    with self.assertRaises(RuntimeError):
+      self._get_pool('owner1').lease()
+    # The partly created cluster is deleted along with its lease.
+    cluster_name = self._mock_gke_cluster.call_args[0][0]
+    mock_run_command.assert_called_once_with([
+        'gcloud', 'container', 'clusters', 'delete', cluster_name, '--quiet',
+        '--async', '--zone', 'us-central1-c'
+    ])
+    self.assertEqual(self._store.list_names(), [])
+
+  def testLease_LosesCreateRace(self):
+    pool = self._get_pool('owner1')
+    config_key = cluster_pool.get_config_key(None, 'us-central1-c', False,
+                                             ['--enable-tpu'])
+    name_prefix = cluster_pool.CLUSTER_NAME_PREFIX + config_key + '-'
+    names = [name_prefix + c * 10 for c in 'ab']
+    # Another run takes the lease of the first new name.
+    self.assertTrue(self._store.try_acquire(names[0], 'owner2', 600))
+    with mock.patch(
+        'uuid.uuid4', side_effect=[mock.Mock(hex=c * 32) for c in 'ab']):
+      lease = pool.lease()
+    self.assertEqual(lease.cluster_name, names[1])
+    self._mock_gke_cluster.assert_called_once_with(
+        names[1],
+        None,
+        'us-central1-c',
+        alpha_cluster=False,
+        extra_create_args=['--enable-tpu'],
+        use_kubernetes_api=False)
+    self.assertEqual(self._store.get_owner(names[0]), 'owner2')
+    lease.release()
+
+  @mock.patch('process_util.run_command')
+  def testLease_LosesAllCreateRaces(self, mock_run_command):
+    pool = self._get_pool('owner1')
+    with mock.patch.object(self._store, 'try_acquire', return_value=False):
+      with self.assertRaisesRegex(RuntimeError, 'Failed to lease a new'):
+        pool.lease()
+    self._mock_gke_cluster.assert_not_called()
+    mock_run_command.assert_not_called()
+
+  def testLease_IsRenewedWhileCreating(self):
+    pool = self._get_pool('owner1', lease_sec=0.03)
+    renewed = threading.Event()
+
+    def create_cluster(cluster_name, *unused_args, **unused_kwargs):
+      self.assertTrue(renewed.wait(10))
+      self.assertEqual(self._store.get_owner(cluster_name), 'owner1')
+      return mock.Mock()
+
+    self._mock_gke_cluster.side_effect = create_cluster
+    renew = pool.renew
+    with mock.patch.object(pool, 'renew') as mock_renew:
+      mock_renew.side_effect = lambda cluster_name: (
+          renewed.set() or renew(cluster_name))
+      lease = pool.lease()
+    lease.release()
+
+  def testLease_IsRenewed(self):
+    pool = self._get_pool('owner1', lease_sec=0.03)
+    lease = pool.lease()
+    with mock.patch.object(pool, 'renew', wraps=pool.renew) as mock_renew:
+      while not mock_renew.called:
+        pass
+    self.assertEqual(self._store.get_owner(lease.cluster_name), 'owner1')
+    lease.release()
+
+  def testReap(self):
+    with mock.patch('time.time', return_value=1000):
+      idle_lease = self._get_pool('owner1').lease()
+      busy_lease = self._get_pool('owner2').lease()
+      idle_lease.release()
+      recent_lease = self._get_pool('owner3', zone='us-central1-a').lease()
+    with mock.patch('time.time', return_value=1500):
+      recent_lease.release()
+    self._store.renew(busy_lease.cluster_name, 'owner2', 10000)
+    with mock.patch('time.time', return_value=1700):
+      self.assertEqual(
+          self._get_pool('owner4', idle_ttl_sec=600).reap(),
+          [idle_lease.cluster_name])
+    self._mock_gke_cluster.assert_called_with(
+        idle_lease.cluster_name,
+        None,
+        'us-central1-c',
+        create_if_not_exist=False)
+    self._mock_gke_cluster.return_value.delete_cluster.assert_called_once_with(
+        wait=False)
+    self.assertEqual(
+        sorted(self._store.list_names()),
+        sorted([busy_lease.cluster_name, recent_lease.cluster_name]))
+    busy_lease.release()
+
+  def testReap_ExpiredLease(self):
+    with mock.patch('time.time', return_value=1000):
+      lease = self._get_pool('owner1', lease_sec=60).lease()
+    lease._renewer.stop()  # The run crashed.
+    with mock.patch('time.time', return_value=1100):
+      self.assertEqual(self._get_pool('owner2', idle_ttl_sec=60).reap(), [])
+    with mock.patch('time.time', return_value=1200):
+      self.assertEqual(
+          self._get_pool('owner2', idle_ttl_sec=60).reap(),
+          [lease.cluster_name])
+
+
+if __name__ == '__main__':
+  unittest.main()
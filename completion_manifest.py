@@ -0,0 +1,121 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Records which pipeline workers completed, so that a run can be resumed.
+
+The manifest lives under the staging folder and holds one object per completed
+worker:
+  <staging>/manifest/<stage>/<worker index>.json
+Each object stores a key of the worker's job arguments. A worker is only
+considered complete if its key matches, so changing an argument that affects a
+worker's output invalidates its entry.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import posixpath
+import threading
+import time
+import urllib
+
+import gcs_client
+
+
+_MANIFEST_FOLDER = 'manifest'
+_ENTRY_SUFFIX = '.json'
+
+
+def get_job_key(job_args):
+  """Returns a key that identifies the given (JSON serializable) job args."""
+  return hashlib.sha256(
+      json.dumps(job_args, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CompletionManifest(object):
+  """Completion manifest of the workers of a pipeline run."""
+
+  def __init__(self, staging, storage_client=None):
+    """Completion manifest of the workers of a pipeline run.
+
+    Args:
+      staging: (str) GCS staging folder of the run (gs://bucket/path).
+      storage_client: (storage.Client) client to use. The client shared by
+        gcs_client is used if not set.
+    """
+    parsed_staging = urllib.parse.urlparse(staging)
+    self._bucket_name = parsed_staging.netloc
+    self._prefix = posixpath.join(
+        parsed_staging.path.strip('/'), _MANIFEST_FOLDER) + '/'
+    self._storage_client = storage_client or gcs_client.get_client()
+    self._bucket = self._storage_client.bucket(self._bucket_name)
+    self._lock = threading.Lock()
+    self._entries = {}
+
+  def _get_entry_name(self, stage, worker_index):
+    return '%s%s/%d%s' % (self._prefix, stage, worker_index, _ENTRY_SUFFIX)
+
+  def load(self):
+    """Reads all existing entries of the manifest with a single listing."""
+    entries = {}
+    for blob in self._storage_client.list_blobs(
+        self._bucket_name, prefix=self._prefix):
+      if not blob.name.endswith(_ENTRY_SUFFIX):
+        continue
+      try:
+        entry = json.loads(blob.download_as_string())
+        entries[(entry['stage'], entry['worker_index'])] = entry['job_key']
+      except (ValueError, KeyError) as e:
+        logging.warning('Ignoring invalid manifest entry %s: %s', blob.name, e)
+    with self._lock:
+      self._entries = entries
+    logging.info('Loaded %d completed workers from the manifest.',
+                 len(entries))
+
+  def is_complete(self, stage, worker_index, job_key):
+    """Returns true if the worker completed with the same job key."""
+    with self._lock:
+      return self._entries.get((stage, worker_index)) == job_key
+
+  def mark_complete(self, stage, worker_index, job_key):
+    """Records that the worker completed successfully."""
+    entry = {
+        'stage': stage,
+        'worker_index': worker_index,
+        'job_key': job_key,
+        'completion_time': time.time(),
+    }
+    blob = self._bucket.blob(self._get_entry_name(stage, worker_index))
+    blob.upload_from_string(
+        json.dumps(entry, sort_keys=True), content_type='application/json')
+    with self._lock:
+      self._entries[(stage, worker_index)] = job_key
@@ -0,0 +1,120 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for completion_manifest.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python completion_manifest_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import unittest
+
+import completion_manifest
+import mock
+
+
+class _FakeBlob(object):
+  """Helper class that stores the content of a blob in a dict."""
+
+  def __init__(self, name, objects):
+    self.name = name
+    self._objects = objects
+
+  def upload_from_string(self, data, content_type=None):
+    del content_type  # Unused.
+    self._objects[self.name] = data
+
+  def download_as_string(self):
+    return self._objects[self.name]
+
+
+class CompletionManifestTest(unittest.TestCase):
+  """Tests for CompletionManifest class."""
+
+  def setUp(self):
+    super(CompletionManifestTest, self).setUp()
+    self._objects = {}
+    self._client = mock.Mock()
+    self._client.bucket.return_value.blob.side_effect = (
+        lambda name: _FakeBlob(name, self._objects))
+    self._client.list_blobs.side_effect = lambda bucket_name, prefix: [
+        _FakeBlob(name, self._objects)
+        for name in sorted(self._objects)
+        if name.startswith(prefix)
+    ]
+
+  def test_mark_complete(self):
+    manifest = completion_manifest.CompletionManifest(
+        'gs://bucket/staging', storage_client=self._client)
+    manifest.mark_complete('make_examples', 3, 'key')
+
+    self._client.bucket.assert_called_with('bucket')
+    entry = json.loads(self._objects['staging/manifest/make_examples/3.json'])
+    self.assertEqual((entry['stage'], entry['worker_index'], entry['job_key']),
+                     ('make_examples', 3, 'key'))
+    self.assertTrue(manifest.is_complete('make_examples', 3, 'key'))
+
+  def test_load(self):
+    completion_manifest.CompletionManifest(
+        'gs://bucket/staging/', storage_client=self._client).mark_complete(
+            'call_variants', 0, 'key')
+    self._objects['staging/manifest/call_variants/1.json'] = 'invalid'
+    self._objects['staging/manifest/README'] = 'ignored'
+
+    manifest = completion_manifest.CompletionManifest(
+        'gs://bucket/staging', storage_client=self._client)
+    self.assertFalse(manifest.is_complete('call_variants', 0, 'key'))
+    manifest.load()
+    self._client.list_blobs.assert_called_once_with(
+        'bucket', prefix='staging/manifest/')
+    self.assertTrue(manifest.is_complete('call_variants', 0, 'key'))
+    self.assertFalse(manifest.is_complete('call_variants', 0, 'other_key'))
+    self.assertFalse(manifest.is_complete('call_variants', 1, 'key'))
+
+  def test_get_job_key(self):
+    self.assertEqual(
+        completion_manifest.get_job_key(['a', {'b': 1, 'c': 2}]),
+        completion_manifest.get_job_key(['a', {'c': 2, 'b': 1}]))
+    self.assertNotEqual(
+        completion_manifest.get_job_key(['a', 'b']),
+        completion_manifest.get_job_key(['a', 'c']))
+
+
+if __name__ == '__main__':
+  unittest.main()
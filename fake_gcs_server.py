@@ -0,0 +1,270 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""A local, in-memory server for a subset of the GCS JSON API.
+
+It is meant for tests and benchmarks of code that uses google.cloud.storage:
+clients created while STORAGE_EMULATOR_HOST points to the server send their
+requests to it. Supported requests are object metadata, media downloads,
+multipart uploads, object listing (with pagination), bucket permission tests
+and batch requests of any of these.
+
+Sample usage:
+  with fake_gcs_server.FakeGcsServer() as server:
+    server.add_object('bucket', 'path/obj', b'content')
+    with mock.patch.dict(os.environ, {'STORAGE_EMULATOR_HOST': server.url}):
+      client = storage.Client()
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import email.parser
+import hashlib
+import http.server
+import json
+import threading
+import time
+import urllib
+import uuid
+
+
+_DEFAULT_PAGE_SIZE = 1000
+
+
+class FakeGcsServer(object):
+  """Serves objects kept in memory over the GCS JSON API."""
+
+  def __init__(self, latency_sec=0):
+    """Creates (but does not start) the server.
+
+    Args:
+      latency_sec: (float) time (in seconds) each HTTP request takes, to
+        simulate the round trip to GCS. A batch request takes it only once.
+    """
+    self.latency_sec = latency_sec
+    # Number of HTTP requests and of (batched or not) API calls received.
+    # Requests of bucket metadata are not counted: storage clients make them in
+    # the background, on their own schedule.
+    self.http_requests = 0
+    self.api_calls = 0
+    self._objects = {}
+    self._generation = 0
+    self._lock = threading.Lock()
+    self._httpd = None
+    self._thread = None
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+
+  def start(self):
+    self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  _get_handler_class(self))
+    self._httpd.daemon_threads = True
+    self._thread = threading.Thread(
+        target=self._httpd.serve_forever, kwargs={'poll_interval': 0.01})
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._httpd.shutdown()
+    self._httpd.server_close()
+    self._thread.join()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *unused_args):
+    self.stop()
+
+  def add_object(self, bucket, name, content):
+    """Creates or replaces an object and returns its metadata."""
+    with self._lock:
+      self._generation += 1
+      self._objects[(bucket, name)] = (content, self._generation)
+      return self._get_metadata(bucket, name)
+
+  def get_object(self, bucket, name):
+    """Returns the content of an object, or None if it does not exist."""
+    with self._lock:
+      content, _ = self._objects.get((bucket, name), (None, None))
+      return content
+
+  def _get_metadata(self, bucket, name):
+    content, generation = self._objects[(bucket, name)]
+    return {
+        'kind': 'storage#object',
+        'bucket': bucket,
+        'name': name,
+        'id': '%s/%s/%d' % (bucket, name, generation),
+        'generation': str(generation),
+        'metageneration': '1',
+        'size': str(len(content)),
+        'md5Hash': base64.b64encode(hashlib.md5(content).digest()).decode(),
+        'contentType': 'application/octet-stream',
+    }
+
+  def handle(self, method, url, headers, body):
+    """Handles an API call and returns its (status, content type, body)."""
+    parsed_url = urllib.parse.urlparse(url)
+    path = [urllib.parse.unquote(part) for part in parsed_url.path.split('/')]
+    query = dict(urllib.parse.parse_qsl(parsed_url.query))
+    if not _is_bucket_request(path):
+      with self._lock:
+        self.api_calls += 1
+    if method == 'POST' and path[1:] == ['batch', 'storage', 'v1']:
+      return self._handle_batch(headers, body)
+    if (method == 'POST' and path[1:5] == ['upload', 'storage', 'v1', 'b'] and
+        path[6:] == ['o']):
+      return self._handle_upload(path[5], headers, body)
+    if method != 'GET':
+      return _get_error(405, 'Method not allowed')
+    if path[1:2] == ['download']:
+      path = path[1:]
+    if path[1:4] != ['storage', 'v1', 'b'] or len(path) < 5:
+      return _get_error(404, 'Not found')
+    bucket = path[4]
+    if len(path) == 5:
+      return _get_json({'kind': 'storage#bucket', 'name': bucket, 'id': bucket})
+    if path[5:] == ['o']:
+      return self._handle_list(bucket, query)
+    if path[5:] == ['iam', 'testPermissions']:
+      return _get_json({
+          'permissions': urllib.parse.parse_qs(
+              parsed_url.query).get('permissions', [])
+      })
+    if path[5] != 'o' or len(path) < 7:
+      return _get_error(404, 'Not found')
+    name = '/'.join(path[6:])
+    with self._lock:
+      if (bucket, name) not in self._objects:
+        return _get_error(404, 'No such object: %s/%s' % (bucket, name))
+      if query.get('alt') == 'media':
+        return 200, 'application/octet-stream', self._objects[(bucket,
+                                                                name)][0]
+      return _get_json(self._get_metadata(bucket, name))
+
+  def _handle_list(self, bucket, query):
+    prefix = query.get('prefix', '')
+    page_size = int(query.get('maxResults', _DEFAULT_PAGE_SIZE))
+    with self._lock:
+      names = sorted(name for object_bucket, name in self._objects
+                     if object_bucket == bucket and name.startswith(prefix) and
+                     name > query.get('pageToken', ''))
+      response = {
+          'kind': 'storage#objects',
+          'items': [self._get_metadata(bucket, name)
+                    for name in names[:page_size]],
+      }
+    if len(names) > page_size:
+      response['nextPageToken'] = names[page_size - 1]
+    return _get_json(response)
+
+  def _handle_upload(self, bucket, headers, body):
+    message = _parse_message(headers, body)
+    metadata_part, media_part = message.get_payload()
+    name = json.loads(metadata_part.get_payload())['name']
+    return _get_json(
+        self.add_object(bucket, name, media_part.get_payload(decode=True)))
+
+  def _handle_batch(self, headers, body):
+    boundary = 'batch_%s' % uuid.uuid4().hex
+    parts = []
+    for part in _parse_message(headers, body).get_payload():
+      request_line, rest = part.get_payload().split('\n', 1)
+      method, url, _ = request_line.split(' ', 2)
+      sub_request = email.parser.Parser().parsestr(rest)
+      status, content_type, content = self.handle(
+          method, url, dict(sub_request.items()),
+          sub_request.get_payload().encode('utf-8'))
+      parts.append(
+          '--%s\r\nContent-Type: application/http\r\n'
+          'Content-ID: <response-%s>\r\n\r\n'
+          'HTTP/1.1 %d %s\r\nContent-Type: %s\r\n\r\n%s\r\n' %
+          (boundary, part.get('Content-ID', ''), status,
+           http.server.BaseHTTPRequestHandler.responses[status][0],
+           content_type, content.decode('utf-8')))
+    parts.append('--%s--\r\n' % boundary)
+    return (200, 'multipart/mixed; boundary=%s' % boundary,
+            ''.join(parts).encode('utf-8'))
+
+
+def _is_bucket_request(path):
+  return len(path) == 5 and path[1:4] == ['storage', 'v1', 'b']
+
+
+def _get_json(value, status=200):
+  return status, 'application/json', json.dumps(value).encode('utf-8')
+
+
+def _get_error(status, message):
+  return _get_json({'error': {'code': status, 'message': message}}, status)
+
+
+def _parse_message(headers, body):
+  """Parses a multipart HTTP body into an email.message.Message."""
+  return email.parser.BytesParser().parsebytes(
+      b'Content-Type: ' + headers['Content-Type'].encode('utf-8') +
+      b'\r\nMIME-Version: 1.0\r\n\r\n' + body)
+
+
+def _get_handler_class(server):
+  """Returns a request handler class that forwards requests to server."""
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+    """Forwards HTTP requests to the FakeGcsServer."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+      if not _is_bucket_request(
+          urllib.parse.urlparse(self.path).path.split('/')):
+        with server._lock:  # pylint: disable=protected-access
+          server.http_requests += 1
+      if server.latency_sec:
+        time.sleep(server.latency_sec)
+      body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      status, content_type, content = server.handle(
+          self.command, self.path, self.headers, body)
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(content)))
+      self.end_headers()
+      self.wfile.write(content)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, *unused_args):
+      pass
+
+  return Handler
@@ -0,0 +1,374 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""A local, in-memory server for the pod subset of the Kubernetes API.
+
+It is meant for tests and benchmarks of kubernetes_client.KubernetesClient
+(and of kubectl, with --server). Supported requests are the server version,
+and creating, getting, listing, deleting and watching pods.
+
+Created pods go through a sequence of phases (Pending, Running, Succeeded by
+default), one every phase_sec seconds, or stay in their first phase until
+set_pod_status is called.
+
+Sample usage:
+  with fake_kubernetes_server.FakeKubernetesServer() as server:
+    client = kubernetes_client.KubernetesClient(server.url)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import http.server
+import json
+import threading
+import time
+import urllib
+import uuid
+
+
+_VERSION = {'major': '1', 'minor': '11', 'gitVersion': 'v1.11.0-fake'}
+
+
+class FakeKubernetesServer(object):
+  """Serves pods kept in memory over the Kubernetes API."""
+
+  def __init__(self,
+               latency_sec=0,
+               pod_phases=('Pending', 'Running', 'Succeeded'),
+               phase_sec=None):
+    """Creates (but does not start) the server.
+
+    Args:
+      latency_sec: (float) time (in seconds) each HTTP request takes, to
+        simulate the round trip to the API server. Events of a watch are sent
+        without latency.
+      pod_phases: (tuple) phases a created pod goes through.
+      phase_sec: (float) time (in seconds) a pod spends in each phase. If None,
+        pods stay in their first phase.
+    """
+    self.latency_sec = latency_sec
+    self.pod_phases = pod_phases
+    self.phase_sec = phase_sec
+    # Number of HTTP requests and of connections received.
+    self.http_requests = 0
+    self.connections = 0
+    # Number of watches being served.
+    self.watches = 0
+    self._pods = {}
+    # (resource version, event type, namespace, pod object) of each change.
+    self._events = []
+    self._resource_version = 0
+    self._stopped = False
+    self._timers = []
+    self._condition = threading.Condition()
+    self._httpd = None
+    self._thread = None
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+
+  def start(self):
+    self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  _get_handler_class(self))
+    self._httpd.daemon_threads = True
+    self._thread = threading.Thread(
+        target=self._httpd.serve_forever, kwargs={'poll_interval': 0.01})
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    with self._condition:
+      self._stopped = True
+      self._condition.notify_all()
+      timers = list(self._timers)
+    for timer in timers:
+      timer.cancel()
+    self._httpd.shutdown()
+    self._httpd.server_close()
+    self._thread.join()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *unused_args):
+    self.stop()
+
+  def get_pod(self, pod_name, namespace='default'):
+    """Returns a copy of a pod's object, or None if it does not exist."""
+    with self._condition:
+      return copy.deepcopy(self._pods.get((namespace, pod_name)))
+
+  def get_pod_names(self, namespace='default'):
+    """Returns the sorted names of the pods of a namespace."""
+    with self._condition:
+      return sorted(name for pod_namespace, name in self._pods
+                    if pod_namespace == namespace)
+
+  def set_pod_status(self,
+                     pod_name,
+                     phase,
+                     waiting_reason=None,
+                     namespace='default'):
+    """Sets the phase (and container waiting reason) of a pod."""
+    with self._condition:
+      pod = self._pods[(namespace, pod_name)]
+      pod['status'] = {'phase': phase}
+      if waiting_reason:
+        pod['status']['containerStatuses'] = [{
+            'name': container['name'],
+            'ready': False,
+            'state': {'waiting': {'reason': waiting_reason}}
+        } for container in pod['spec'].get('containers', [])]
+      self._add_event('MODIFIED', namespace, pod)
+
+  def _add_event(self, event_type, namespace, pod):
+    """Records a change of a pod. Must be called with the lock held."""
+    self._resource_version += 1
+    pod['metadata']['resourceVersion'] = str(self._resource_version)
+    self._events.append((self._resource_version, event_type, namespace,
+                         copy.deepcopy(pod)))
+    self._condition.notify_all()
+
+  def _schedule_next_phase(self, namespace, pod_name, phase_index):
+    """Moves the pod to the next phase after phase_sec."""
+    if self.phase_sec is None or phase_index + 1 >= len(self.pod_phases):
+      return
+
+    def next_phase():
+      with self._condition:
+        pod = self._pods.get((namespace, pod_name))
+        if (pod is None or
+            pod['status']['phase'] != self.pod_phases[phase_index]):
+          return
+      self.set_pod_status(pod_name, self.pod_phases[phase_index + 1],
+                          namespace=namespace)
+      self._schedule_next_phase(namespace, pod_name, phase_index + 1)
+
+    timer = threading.Timer(self.phase_sec, next_phase)
+    timer.daemon = True
+    with self._condition:
+      if self._stopped:
+        return
+      self._timers = [t for t in self._timers if t.is_alive()] + [timer]
+    timer.start()
+
+  def handle(self, method, url, body):
+    """Handles a request (other than a watch) and returns (status, body)."""
+    parsed_url = urllib.parse.urlparse(url)
+    path = [urllib.parse.unquote(part) for part in parsed_url.path.split('/')]
+    query = dict(urllib.parse.parse_qsl(parsed_url.query))
+    if path[1:] == ['version'] and method == 'GET':
+      return 200, _VERSION
+    if path[1:4] != ['api', 'v1', 'namespaces'] or path[5:6] != ['pods']:
+      return _get_status(404, 'NotFound', 'the server could not find the '
+                         'requested resource')
+    namespace = path[4]
+    if len(path) == 6:
+      if method == 'POST':
+        return self._create_pod(namespace, json.loads(body.decode('utf-8')))
+      if method == 'GET':
+        return self._list_pods(namespace, query)
+    elif len(path) == 7:
+      if method == 'GET':
+        pod = self.get_pod(path[6], namespace)
+        if pod is None:
+          return _get_status(404, 'NotFound',
+                             'pods "%s" not found' % path[6])
+        return 200, pod
+      if method == 'DELETE':
+        return self._delete_pod(namespace, path[6])
+    return _get_status(405, 'MethodNotAllowed', 'method not allowed')
+
+  def _create_pod(self, namespace, pod):
+    name = pod['metadata']['name']
+    with self._condition:
+      if (namespace, name) in self._pods:
+        return _get_status(409, 'AlreadyExists',
+                           'pods "%s" already exists' % name)
+      pod['metadata'].update({'namespace': namespace, 'uid': str(uuid.uuid4())})
+      pod['status'] = {'phase': self.pod_phases[0]}
+      self._pods[(namespace, name)] = pod
+      self._add_event('ADDED', namespace, pod)
+      response = copy.deepcopy(pod)
+    self._schedule_next_phase(namespace, name, 0)
+    return 201, response
+
+  def _delete_pod(self, namespace, name):
+    with self._condition:
+      pod = self._pods.pop((namespace, name), None)
+      if pod is None:
+        return _get_status(404, 'NotFound', 'pods "%s" not found' % name)
+      self._add_event('DELETED', namespace, pod)
+      return 200, copy.deepcopy(pod)
+
+  def _list_pods(self, namespace, query):
+    pod_name = _get_selected_name(query)
+    with self._condition:
+      items = [
+          copy.deepcopy(pod) for (pod_namespace, name), pod in sorted(
+              self._pods.items())
+          if pod_namespace == namespace and pod_name in (None, name)
+      ]
+      return 200, {
+          'kind': 'PodList',
+          'apiVersion': 'v1',
+          'metadata': {'resourceVersion': str(self._resource_version)},
+          'items': items,
+      }
+
+  def watch(self, url):
+    """Yields the events of a watch request, until it times out."""
+    parsed_url = urllib.parse.urlparse(url)
+    namespace = urllib.parse.unquote(parsed_url.path.split('/')[4])
+    query = dict(urllib.parse.parse_qsl(parsed_url.query))
+    pod_name = _get_selected_name(query)
+    deadline = None
+    if 'timeoutSeconds' in query:
+      deadline = time.time() + int(query['timeoutSeconds'])
+
+    def matches(pod_namespace, pod):
+      return pod_namespace == namespace and pod_name in (
+          None, pod['metadata']['name'])
+
+    with self._condition:
+      self.watches += 1
+      if 'resourceVersion' in query:
+        version = int(query['resourceVersion'])
+        events = []
+      else:
+        version = self._resource_version
+        events = [{
+            'type': 'ADDED',
+            'object': copy.deepcopy(pod)
+        } for (pod_namespace, _), pod in sorted(self._pods.items())
+                  if matches(pod_namespace, pod)]
+    try:
+      while True:
+        for event in events:
+          yield event
+        with self._condition:
+          while True:
+            events = [{
+                'type': event_type,
+                'object': copy.deepcopy(pod)
+            } for event_version, event_type, pod_namespace, pod in self._events
+                      if event_version > version and
+                      matches(pod_namespace, pod)]
+            version = self._resource_version
+            if events:
+              break
+            remaining_sec = deadline - time.time() if deadline else None
+            if self._stopped or (remaining_sec is not None and
+                                 remaining_sec <= 0):
+              return
+            self._condition.wait(remaining_sec)
+    finally:
+      with self._condition:
+        self.watches -= 1
+
+def _get_selected_name(query):
+  """Returns the pod name of a metadata.name field selector, or None."""
+  field_selector = query.get('fieldSelector', '')
+  if field_selector.startswith('metadata.name='):
+    return field_selector[len('metadata.name='):]
+  return None
+
+
+def _get_status(code, reason, message):
+  return code, {
+      'kind': 'Status',
+      'apiVersion': 'v1',
+      'status': 'Failure',
+      'message': message,
+      'reason': reason,
+      'code': code,
+  }
+
+
+def _get_handler_class(server):
+  """Returns a request handler class that forwards requests to server."""
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+    """Forwards HTTP requests to the FakeKubernetesServer."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+      http.server.BaseHTTPRequestHandler.setup(self)
+      with server._condition:  # pylint: disable=protected-access
+        server.connections += 1
+
+    def _handle(self):
+      with server._condition:  # pylint: disable=protected-access
+        server.http_requests += 1
+      if server.latency_sec:
+        time.sleep(server.latency_sec)
+      body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(
+          self.path).query))
+      if self.command == 'GET' and query.get('watch') == 'true':
+        self._send_watch()
+        return
+      status, value = server.handle(self.command, self.path, body)
+      content = json.dumps(value).encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(content)))
+      self.end_headers()
+      self.wfile.write(content)
+
+    def _send_watch(self):
+      """Streams the events of a watch as chunks of JSON lines."""
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.end_headers()
+      try:
+        for event in server.watch(self.path):
+          line = (json.dumps(event) + '\n').encode('utf-8')
+          self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+          self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+      except (BrokenPipeError, ConnectionResetError):
+        self.close_connection = True
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+    def log_message(self, *unused_args):
+      pass
+
+  return Handler
@@ -51,21 +51,39 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import copy
 import datetime
+import functools
+import io
 import json
 import logging
-import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import signal
 import subprocess
 import tempfile
+import threading
 import time
 import urllib
 import uuid
 
+import admission_control
+import batch_manifest
+import cluster_pool
+import completion_manifest
+import gcs_client
 import gke_cluster
+import job_scheduler
+import lease_store
+import metadata_cache
+import preemption_policy
+import process_util
+import region_partitioner
+import resource_planner
+import shard_queue
+import zone_health
 from google.api_core import exceptions as google_exceptions
-from google.cloud import storage
 
 
 _BAI_FILE_SUFFIX = '.bai'
@@ -80,6 +98,13 @@ _CALL_VARIANTS_JOB_NAME = 'call_variants'
 _POSTPROCESS_VARIANTS_JOB_NAME = 'postprocess_variants'
 _DEFAULT_BOOT_DISK_SIZE_GB = '50'
 _ROLE_STORAGE_OBJ_CREATOR = ['storage.objects.create']
+# Maximum number of files uploaded to the staging folder at the same time.
+_MAX_UPLOAD_THREADS = 16
+# Maximum number of samples of a batch run validated or prepared at a time.
+_MAX_SAMPLE_THREADS = 16
+# Time (in seconds) between claims of a make_examples queue worker waiting on
+# tasks leased by other workers.
+_SHARD_QUEUE_POLL_SEC = 30
 
 _GCSFUSE_IMAGE = 'gcr.io/cloud-genomics-pipelines/gcsfuse'
 _GCSFUSE_LOCAL_DIR_TEMPLATE = '/mnt/google/input-gcsfused-{SHARD_INDEX}/'
@@ -93,15 +118,31 @@ _GCSFUSE_VERIFY_COMMAND_TEMPLATE = r"""
 /usr/local/bin/entrypoint.sh wait {LOCAL_DIR}
 """
 
+# Shards are run independently, and a failing shard is retried on its own.
+# Shards that still fail are recorded in "$FAILED_SHARDS"/failed_shards (and
+# their partial outputs removed), so that only they are rerun in a follow-up
+# job while the outputs of completed shards are kept. GNU parallel's --retries
+# is the total number of tries of a shard.
 _MAKE_EXAMPLES_COMMAND = r"""
-seq {{SHARD_START_INDEX}} {{SHARD_END_INDEX}} | parallel --halt 2 \
+mkdir -p /tmp/completed_shards
+touch "$FAILED_SHARDS"/failed_shards
+printf '%s\n' {{SHARD_INDICES}} | parallel --retries {SHARD_TRIES} \
   /opt/deepvariant/bin/make_examples \
     --mode calling \
-    --examples "$EXAMPLES"/examples_output.tfrecord@{NUM_SHARDS}.gz \
+    --examples "$EXAMPLES"/{EXAMPLES_OUTPUT} \
     --reads "{{INPUT_BAM}}" \
     --ref "$INPUT_REF" \
-    --task {{TASK_INDEX}} \
-    {EXTRA_ARGS}
+    {SHARDING_ARGS} {EXTRA_ARGS} '&&' touch /tmp/completed_shards/{{TASK_INDEX}}
+for shard in {{SHARD_INDICES}}; do
+  if [[ ! -f /tmp/completed_shards/"$shard" ]]; then
+    echo "$shard" >> "$FAILED_SHARDS"/failed_shards
+    shard_suffix="$(printf "%05d" "$shard")"-of-"$(printf "%05d" {NUM_SHARDS})".gz
+    rm -f "$EXAMPLES"/examples_output.tfrecord-"$shard_suffix"
+    if [[ -n "${{{{GVCF:-}}}}" ]]; then
+      rm -f "$GVCF"/gvcf_output.tfrecord-"$shard_suffix"
+    fi
+  fi
+done
 """
 
 _CALL_VARIANTS_COMMAND = r"""
@@ -120,8 +161,22 @@ _POSTPROCESS_VARIANTS_COMMAND = r"""
     {EXTRA_ARGS}
 """
 
+# Length of the (hex) key naming a content-addressed stage folder.
+_STAGE_KEY_LENGTH = 16
+_STAGE_COMPLETE_MARKER = 'COMPLETE'
+
 _NOW_STR = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 
+# zone_health.ZoneHealth that pipelines jobs are routed by (and report their
+# outcomes to) with --adaptive_zones.
+_zone_health = None
+# preemption_policy.DeadlinePolicy of pipelines jobs with --deadline_hours.
+_deadline_policy = None
+# _CallVariantsCluster of each job graph built with --tpu. Clusters leased or
+# created for the run that are left (e.g. after a failure) are closed when it
+# ends.
+_call_variants_clusters = []
+
 # This is used by the cancel script and must not be changed unless it is updated
 # there as well.
 _DEEPVARIANT_LABEL_KEY = 'deepvariant-operation-label'
@@ -162,37 +217,79 @@ _POD_CONFIG_TEMPLATE = r"""
 """
 
 
-def _get_staging_examples_folder_to_write(pipeline_args,
-                                          make_example_worker_index):
-  """Returns the folder to store examples from make_examples job."""
-  # call_variants_workers is less than or equal to make_examples_workers.
-  folder_index = int(
-      make_example_worker_index * pipeline_args.call_variants_workers /
-      pipeline_args.make_examples_workers)
-  return os.path.join(*[pipeline_args.staging, 'examples', str(folder_index)])
+def _get_examples_folder_index(pipeline_args, shard_index):
+  """Returns the index of the examples folder a make_examples shard goes to.
+
+  Each examples folder holds a contiguous range of shards, and is read by
+  exactly one call_variants worker with the same index.
+  """
+  return (shard_index * pipeline_args.call_variants_workers //
+          pipeline_args.shards)
+
+
+def _get_stage_staging_folder(pipeline_args, stage):
+  """Returns the staging folder holding the outputs of a stage.
+
+  With --content_addressed_staging, the folder is named after the key of the
+  stage's inputs (see _get_stage_keys), so that runs with the same inputs
+  share it.
+  """
+  if not pipeline_args.content_addressed_staging:
+    return pipeline_args.staging
+  return os.path.join(pipeline_args.staging, 'stages', stage,
+                      pipeline_args.stage_keys[stage])
+
+
+def _get_staging_examples_folder_to_write(pipeline_args, shard_index):
+  """Returns the folder to store examples of a make_examples shard."""
+  folder_index = _get_examples_folder_index(pipeline_args, shard_index)
+  return os.path.join(
+      *[_get_stage_staging_folder(pipeline_args, _MAKE_EXAMPLES_JOB_NAME),
+        'examples', str(folder_index)])
 
 
 def _get_staging_examples_folder_to_read(pipeline_args,
                                          call_variants_worker_index):
   """Returns the folder to read examples from make_examples job."""
   return os.path.join(
-      *[pipeline_args.staging, 'examples',
-        str(call_variants_worker_index)])
+      *[_get_stage_staging_folder(pipeline_args, _MAKE_EXAMPLES_JOB_NAME),
+        'examples', str(call_variants_worker_index)])
+
+
+def _get_staging_failed_shards_folder(pipeline_args, task_name):
+  """Returns the folder to store failed shards of a make_examples task."""
+  return os.path.join(pipeline_args.staging, 'failed_shards', task_name)
+
+
+def _get_staging_shard_regions_folder(pipeline_args):
+  """Returns the folder holding the BED file of each make_examples shard."""
+  return os.path.join(
+      _get_stage_staging_folder(pipeline_args, _MAKE_EXAMPLES_JOB_NAME),
+      'shard_regions')
 
 
 def _get_staging_gvcf_folder(pipeline_args):
   """Returns the folder to store gVCF TF records from make_examples job."""
-  return os.path.join(pipeline_args.staging, 'gvcf')
+  return os.path.join(
+      _get_stage_staging_folder(pipeline_args, _MAKE_EXAMPLES_JOB_NAME), 'gvcf')
 
 
 def _get_staging_called_variants_folder(pipeline_args):
   """Returns the folder to store called variants from call_variants job."""
-  return os.path.join(pipeline_args.staging, 'called_variants')
+  return os.path.join(
+      _get_stage_staging_folder(pipeline_args, _CALL_VARIANTS_JOB_NAME),
+      'called_variants')
 
 
-def _get_base_job_args(pipeline_args):
-  """Base arguments that are common among all jobs."""
-  if pipeline_args.preemptible:
+def _get_base_job_args(pipeline_args, stage=None):
+  """Base arguments that are common among all jobs (of a stage)."""
+  max_preemptions = (
+      getattr(pipeline_args, stage + '_max_preemptions') if stage else None)
+  if max_preemptions is not None:
+    # Workers start on preemptible VMs and fall back to regular VMs.
+    attempts_args = ['--attempts', str(pipeline_args.attempts),
+                     '--pvm-attempts', str(max_preemptions)]
+  elif pipeline_args.preemptible:
     attempts_args = ['--attempts', '0',
                      '--pvm-attempts', str(pipeline_args.attempts)]
   else:
@@ -218,13 +315,12 @@ def _get_base_job_args(pipeline_args):
 
 
 def _generate_actions_for_make_example(
-    shard_start_index, shard_end_index, input_bam_file, is_gcsfuse_activated,
-    deep_variant_image, make_example_command_template):
+    shard_indices, input_bam_file, is_gcsfuse_activated, deep_variant_image,
+    make_example_command_template):
   """Returns a dictionary of actions for execution of make_examples stage.
 
   Args:
-    shard_start_index: Index of first assigned shard to this worker (inclusive).
-    shard_end_index: Index of last assigned shard to this worker (inclusive).
+    shard_indices: Indices of the shards assigned to this worker.
     input_bam_file: full path of bam file on gcs (gs://bucket/path/file.bam).
     is_gcsfuse_activated: whether or not read input bam file using gcsfuse.
     deep_variant_image: DeepVariant image given using --docker_image flag.
@@ -235,7 +331,7 @@ def _generate_actions_for_make_example(
 
   actions = []
   if is_gcsfuse_activated:
-    for shard_index in range(shard_start_index, shard_end_index + 1):
+    for shard_index in shard_indices:
       local_dir = _GCSFUSE_LOCAL_DIR_TEMPLATE.format(SHARD_INDEX=shard_index)
       gcsfuse_create_command = _GCSFUSE_CREATE_COMMAND_TEMPLATE.format(
           BUCKET=gcs_bucket, LOCAL_DIR=local_dir)
@@ -257,7 +353,7 @@ def _generate_actions_for_make_example(
     local_bam_template = '$INPUT_BAM'
 
   make_example_command = make_example_command_template.format(
-      SHARD_START_INDEX=shard_start_index, SHARD_END_INDEX=shard_end_index,
+      SHARD_INDICES=' '.join(str(shard_index) for shard_index in shard_indices),
       TASK_INDEX='{}', INPUT_BAM=local_bam_template)
   actions.append(
       {'imageUri': deep_variant_image,
@@ -275,29 +371,93 @@ def _write_actions_to_temp_file(actions):
   return temp_file.name
 
 
+def _route_to_healthy_zones(run_args):
+  """Returns run_args with --zones restricted to the healthiest zones."""
+  if '--zones' not in run_args:
+    return run_args
+  start = run_args.index('--zones') + 1
+  end = start
+  while end < len(run_args) and not run_args[end].startswith('--'):
+    end += 1
+  zones = _zone_health.select_zones(run_args[start:end])
+  if zones != run_args[start:end]:
+    logging.debug('Routing job to zones %s.', zones)
+  return run_args[:start] + zones + run_args[end:]
+
+
+def _communicate_with_times(process, start_time):
+  """Waits for a process and returns its output lines and output.
+
+  The process' stderr must be redirected to its stdout, so that lines are kept
+  in the order they were printed in, e.g. a preemption after the zone it
+  happened in.
+
+  Returns:
+    A tuple ([(elapsed_sec, line)], output), where elapsed_sec is the time from
+    start_time until the line was printed.
+  """
+  lines = []
+  chunks = []
+  for line in iter(process.stdout.readline, b''):
+    chunks.append(line)
+    lines.append((time.time() - start_time, line.decode('utf-8', 'replace')))
+  process.wait()
+  return lines, b''.join(chunks)
+
+
+def _interrupt_process(process):
+  if process.poll() is None:
+    process.send_signal(signal.SIGINT)
+
+
 def _run_job(run_args, log_path):
   """Runs a job using the pipelines CLI tool.
 
+  With --adaptive_zones, the job is routed to the healthiest of its zones, and
+  the outcomes of its worker launches are recorded. With --deadline_hours, the
+  job only runs on regular VMs if the deadline is at risk.
+
   Args:
     run_args: A list of arguments (type string) to pass to the pipelines tool.
     log_path: Path to which pipelines API worker writes its log into.
   Raises:
     RuntimeError: if there was an error running the pipeline.
   """
-
+  zone_health_tracker = _zone_health
+  if zone_health_tracker:
+    run_args = _route_to_healthy_zones(run_args)
+  deadline_policy = _deadline_policy
+  if deadline_policy:
+    run_args = deadline_policy.apply(run_args)
+  start_time = time.time()
   process = subprocess.Popen(
       run_args,
       stdin=subprocess.PIPE,
       stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
+      stderr=subprocess.STDOUT if zone_health_tracker else subprocess.PIPE,
       env={'PATH': os.environ['PATH']})
+  # Cancels the job if it loses to a speculative attempt: on interrupt, the
+  # pipelines tool cancels its operation.
+  unregister_cancel_callback = job_scheduler.add_cancel_callback(
+      functools.partial(_interrupt_process, process))
 
   try:
-    stdout, stderr = process.communicate()
+    if zone_health_tracker:
+      process.stdin.close()
+      # The merged output holds the errors printed to stderr.
+      lines, stderr = _communicate_with_times(process, start_time)
+      stdout = b''
+      zone_health_tracker.record(zone_health.parse_events(lines))
+    else:
+      stdout, stderr = process.communicate()
     if process.returncode == 0:
+      if deadline_policy:
+        deadline_policy.record_duration(run_args, time.time() - start_time)
       return
   except KeyboardInterrupt:
     raise RuntimeError('Job cancelled by user')
+  finally:
+    unregister_cancel_callback()
 
   logging.error('Job failed with error %s \n %s. Job args: %s', stdout, stderr,
                 run_args)
@@ -315,22 +475,19 @@ def _is_valid_gcs_path(gcs_path):
           urllib.parse.urlparse(gcs_path).netloc != '')
 
 
-def _gcs_object_exist(gcs_obj_path):
-  """Returns true if the given path is a valid object on GCS.
+def _gcs_objects_exist(gcs_obj_paths):
+  """Returns a dict of whether each path is a valid object on GCS, by path.
+
+  Objects are checked with batch requests, unless in the metadata cache.
 
   Args:
-    gcs_obj_path: (str) a path to an obj on GCS.
+    gcs_obj_paths: (list) paths to objs on GCS.
   """
   try:
-    storage_client = storage.Client()
-    bucket_name = _get_gcs_bucket(gcs_obj_path)
-    obj_name = _get_gcs_relative_path(gcs_obj_path)
-    bucket = storage_client.bucket(bucket_name)
-    obj = bucket.blob(obj_name)
-    return obj.exists()
+    return gcs_client.objects_exist(gcs_obj_paths, use_cache=True)
   except google_exceptions.Forbidden as e:
     logging.error('Missing GCS object: %s', str(e))
-    return False
+    return dict.fromkeys(gcs_obj_paths, False)
 
 
 def _can_write_to_bucket(bucket_name):
@@ -342,8 +499,7 @@ def _can_write_to_bucket(bucket_name):
   if not bucket_name:
     return False
   try:
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = gcs_client.get_client().bucket(bucket_name)
     return (bucket.test_iam_permissions(_ROLE_STORAGE_OBJ_CREATOR) ==
             _ROLE_STORAGE_OBJ_CREATOR)
   except google_exceptions.Forbidden as e:
@@ -388,8 +544,47 @@ def _meets_gcp_label_restrictions(label):
                   label) is not None
 
 
-def _run_make_examples(pipeline_args):
-  """Runs the make_examples job."""
+def _get_make_examples_worker_shards(pipeline_args):
+  """Returns the shard indices statically assigned to each worker."""
+  num_workers = min(pipeline_args.make_examples_workers, pipeline_args.shards)
+  shards_per_worker = pipeline_args.shards / num_workers
+  worker_shards = []
+  for i in range(num_workers):
+    shard_start_index = int(i * shards_per_worker)
+    shard_end_index = int((i + 1) * shards_per_worker - 1)
+    worker_shards.append(list(range(shard_start_index, shard_end_index + 1)))
+  return worker_shards
+
+
+def _get_make_examples_output(pipeline_args, basename):
+  """Returns the name of the file a make_examples shard writes an output to.
+
+  By default, shards are selected with --task and write to their part of a
+  sharded output. With --coverage_balanced_regions, each shard runs unsharded
+  on its own regions, so the file name of its part is spelled out (and the
+  shard index formatted by the shell).
+
+  Args:
+    pipeline_args: pipeline arguments.
+    basename: (str) name of the output without the shard suffix.
+  """
+  if pipeline_args.coverage_balanced_regions:
+    return "%s-'$(printf %%05d {TASK_INDEX})'-of-%05d.gz" % (
+        basename, pipeline_args.shards)
+  return '%s@%d.gz' % (basename, pipeline_args.shards)
+
+
+def _get_make_examples_job(pipeline_args, task_name, shard_indices):
+  """Returns the [run_args, log_path] of a make_examples task.
+
+  A task is either a worker with statically assigned shards or a task of the
+  shard queue. All of its shards must belong to the same examples folder.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    task_name: (str) name of the task, unique within the run.
+    shard_indices: (list) indices of the shards to run.
+  """
 
   def get_region_paths(regions):
     return [
@@ -405,9 +600,10 @@ def _run_make_examples(pipeline_args):
     """Optional arguments that are specific to make_examples binary."""
     extra_args = []
     if pipeline_args.gvcf_outfile:
-      extra_args.extend(
-          ['--gvcf', '"$GVCF"/gvcf_output.tfrecord@{NUM_SHARDS}.gz'.format(
-              NUM_SHARDS=pipeline_args.shards)])
+      extra_args.extend([
+          '--gvcf', '"$GVCF"/' + _get_make_examples_output(
+              pipeline_args, 'gvcf_output.tfrecord')
+      ])
     if pipeline_args.gvcf_gq_binsize:
       extra_args.extend(
           ['--gvcf_gq_binsize',
@@ -427,85 +623,396 @@ def _run_make_examples(pipeline_args):
       extra_args.extend(['--hts_block_size', str(pipeline_args.hts_block_size)])
     return extra_args
 
+  if pipeline_args.coverage_balanced_regions:
+    sharding_args = '--regions "$SHARD_REGIONS"/{TASK_INDEX}.bed'
+  else:
+    sharding_args = '--task {TASK_INDEX}'
   command = _MAKE_EXAMPLES_COMMAND.format(
       NUM_SHARDS=pipeline_args.shards,
+      SHARD_TRIES=pipeline_args.make_examples_shard_retries + 1,
+      EXAMPLES_OUTPUT=_get_make_examples_output(pipeline_args,
+                                                'examples_output.tfrecord'),
+      SHARDING_ARGS=sharding_args,
       EXTRA_ARGS=' '.join(get_extra_args()))
 
   machine_type = 'custom-{0}-{1}'.format(
       pipeline_args.make_examples_cores_per_worker,
       pipeline_args.make_examples_ram_per_worker_gb * 1024)
 
-  num_workers = min(pipeline_args.make_examples_workers, pipeline_args.shards)
-  shards_per_worker = pipeline_args.shards / num_workers
-  threads = multiprocessing.Pool(num_workers)
-  results = []
-  for i in range(num_workers):
-    outputs = [
-        'EXAMPLES=' + _get_staging_examples_folder_to_write(pipeline_args, i) +
+  outputs = [
+      'EXAMPLES=' +
+      _get_staging_examples_folder_to_write(pipeline_args, shard_indices[0]) +
+      '/*',
+      'FAILED_SHARDS=' +
+      _get_staging_failed_shards_folder(pipeline_args, task_name) + '/*'
+  ]
+  if pipeline_args.gvcf_outfile:
+    outputs.extend(['GVCF=' + _get_staging_gvcf_folder(pipeline_args) + '/*'])
+  inputs = [
+      'INPUT_BAI=' + pipeline_args.bai,
+      'INPUT_REF=' + pipeline_args.ref,
+      'INPUT_REF_FAI=' + pipeline_args.ref_fai,
+  ] + [
+      'INPUT_REGIONS_%s=%s' % (k, region_path)
+      for k, region_path in enumerate(get_region_paths(pipeline_args.regions))
+  ]
+  if pipeline_args.coverage_balanced_regions:
+    inputs.extend([
+        'SHARD_REGIONS=' + _get_staging_shard_regions_folder(pipeline_args) +
         '/*'
-    ]
-    if pipeline_args.gvcf_outfile:
-      outputs.extend(['GVCF=' + _get_staging_gvcf_folder(pipeline_args) + '/*'])
-    inputs = [
-        'INPUT_BAI=' + pipeline_args.bai,
-        'INPUT_REF=' + pipeline_args.ref,
-        'INPUT_REF_FAI=' + pipeline_args.ref_fai,
-    ] + [
-        'INPUT_REGIONS_%s=%s' % (k, region_path)
-        for k, region_path in enumerate(
-            get_region_paths(pipeline_args.regions))
-    ]
-    if not pipeline_args.gcsfuse:
-      # Without gcsfuse, BAM file must be copied as one of the input files.
-      inputs.extend(['INPUT_BAM=' + pipeline_args.bam])
+    ])
+  if not pipeline_args.gcsfuse:
+    # Without gcsfuse, BAM file must be copied as one of the input files.
+    inputs.extend(['INPUT_BAM=' + pipeline_args.bam])
 
-    if pipeline_args.ref_gzi:
-      inputs.extend([pipeline_args.ref_gzi])
-    shard_start_index = int(i * shards_per_worker)
-    shard_end_index = int((i + 1) * shards_per_worker - 1)
+  if pipeline_args.ref_gzi:
+    inputs.extend([pipeline_args.ref_gzi])
 
-    job_name = pipeline_args.job_name_prefix + _MAKE_EXAMPLES_JOB_NAME
-    output_path = os.path.join(pipeline_args.logging, _MAKE_EXAMPLES_JOB_NAME,
-                               str(i))
+  job_name = pipeline_args.job_name_prefix + _MAKE_EXAMPLES_JOB_NAME
+  output_path = os.path.join(pipeline_args.logging, _MAKE_EXAMPLES_JOB_NAME,
+                             task_name)
+
+  actions_array = _generate_actions_for_make_example(
+      shard_indices, pipeline_args.bam, pipeline_args.gcsfuse,
+      pipeline_args.docker_image, command)
+  actions_filename = _write_actions_to_temp_file(actions_array)
+
+  run_args = _get_base_job_args(pipeline_args, _MAKE_EXAMPLES_JOB_NAME) + [
+      '--name', job_name, '--vm-labels', 'dv-job-name=' + job_name, '--image',
+      pipeline_args.docker_image, '--output', output_path, '--inputs',
+      ','.join(inputs), '--outputs', ','.join(outputs), '--machine-type',
+      machine_type, '--disk-size',
+      str(pipeline_args.make_examples_disk_per_worker_gb), actions_filename]
+  return [run_args, output_path]
 
-    actions_array = _generate_actions_for_make_example(
-        shard_start_index, shard_end_index, pipeline_args.bam,
-        pipeline_args.gcsfuse, pipeline_args.docker_image, command)
-    actions_filename = _write_actions_to_temp_file(actions_array)
 
-    run_args = _get_base_job_args(pipeline_args) + [
-        '--name', job_name, '--vm-labels', 'dv-job-name=' + job_name, '--image',
-        pipeline_args.docker_image, '--output', output_path, '--inputs',
-        ','.join(inputs), '--outputs', ','.join(outputs), '--machine-type',
-        machine_type, '--disk-size',
-        str(pipeline_args.make_examples_disk_per_worker_gb), actions_filename]
-    results.append(threads.apply_async(_run_job, [run_args, output_path]))
+def _get_docker_image_digest(image):
+  """Returns the digest (sha256:...) of a docker image.
+
+  Raises:
+    ValueError: if the image is given by tag and its digest cannot be resolved.
+  """
+  if '@' in image:
+    return image.split('@', 1)[1]
+  try:
+    digest = process_util.run_command([
+        'gcloud', 'container', 'images', 'describe', image,
+        '--format=value(image_summary.digest)'
+    ]).strip()
+  except RuntimeError as e:
+    raise ValueError(
+        'Cannot resolve the digest of %s (%s). Pass the image by digest '
+        '(image@sha256:...) with --content_addressed_staging.' % (image, e))
+  if not digest:
+    raise ValueError('Cannot resolve the digest of %s.' % image)
+  return digest
 
-  _wait_for_results(threads, results)
 
+def _get_stage_keys(pipeline_args):
+  """Returns the key of the inputs of make_examples and call_variants by stage.
 
-def _wait_for_results(threads, results):
-  threads.close()
+  The make_examples key covers the generations of the BAM, reference and
+  region files, the flags that affect the examples and their layout, and the
+  digest of the docker image. The call_variants key covers the make_examples
+  key, the generations of the model files and the digest of its docker image.
+  """
+  input_paths = [
+      pipeline_args.bam, pipeline_args.bai, pipeline_args.ref,
+      pipeline_args.ref_fai
+  ] + [
+      region for region in pipeline_args.regions or []
+      if _is_valid_gcs_path(region)
+  ]
+  if pipeline_args.ref_gzi:
+    input_paths.append(pipeline_args.ref_gzi)
+  # Cached generations may be stale, which would reuse the outputs of inputs
+  # that have since been overwritten.
+  metadata = gcs_client.get_metadata(input_paths, use_cache=False)
+  missing_paths = sorted(path for path in input_paths if not metadata[path])
+  if missing_paths:
+    raise ValueError('Missing inputs: %s' % ', '.join(missing_paths))
+  make_examples_key = completion_manifest.get_job_key({
+      'image': _get_docker_image_digest(pipeline_args.docker_image),
+      'inputs': {path: metadata[path].generation for path in input_paths},
+      'regions': pipeline_args.regions,
+      'coverage_balanced_regions': pipeline_args.coverage_balanced_regions,
+      'shards': pipeline_args.shards,
+      'call_variants_workers': pipeline_args.call_variants_workers,
+      'gvcf': bool(pipeline_args.gvcf_outfile),
+      'gvcf_gq_binsize': pipeline_args.gvcf_gq_binsize,
+      'sample_name': pipeline_args.sample_name,
+      'hts_block_size': pipeline_args.hts_block_size,
+  })
+
+  model_blobs = gcs_client.list_blobs(pipeline_args.model.rstrip('/') + '/')
+  if not model_blobs:
+    raise ValueError('Missing model: %s' % pipeline_args.model)
+  call_variants_image = (
+      pipeline_args.docker_image_gpu
+      if pipeline_args.gpu else pipeline_args.docker_image)
+  call_variants_key = completion_manifest.get_job_key({
+      'make_examples': make_examples_key,
+      'image': _get_docker_image_digest(call_variants_image),
+      'model': {blob.name: blob.generation for blob in model_blobs},
+  })
+  return {
+      _MAKE_EXAMPLES_JOB_NAME: make_examples_key[:_STAGE_KEY_LENGTH],
+      _CALL_VARIANTS_JOB_NAME: call_variants_key[:_STAGE_KEY_LENGTH],
+  }
+
+
+def _get_stage_complete_marker(pipeline_args, stage):
+  """Returns the path of the object marking the outputs of a stage complete."""
+  return os.path.join(
+      _get_stage_staging_folder(pipeline_args, stage), _STAGE_COMPLETE_MARKER)
+
+
+def _mark_stage_complete(pipeline_args, stage):
+  """Records that all outputs of a content-addressed stage were written."""
+  gcs_client.upload(
+      _get_stage_complete_marker(pipeline_args, stage),
+      json.dumps({'completion_time': time.time()}),
+      content_type='application/json')
+
+
+def _skip_complete_stages(pipeline_args):
+  """Removes stages whose content-addressed outputs exist from --jobs_to_run."""
+  stages = [
+      stage for stage in (_MAKE_EXAMPLES_JOB_NAME, _CALL_VARIANTS_JOB_NAME)
+      if stage in pipeline_args.jobs_to_run
+  ]
+  markers = gcs_client.objects_exist(
+      [_get_stage_complete_marker(pipeline_args, stage) for stage in stages])
+  complete_stages = [
+      stage for stage in stages
+      if markers[_get_stage_complete_marker(pipeline_args, stage)]
+  ]
+  for stage in complete_stages:
+    logging.info('Reusing the outputs of %s in %s.', stage,
+                 _get_stage_staging_folder(pipeline_args, stage))
+  pipeline_args.jobs_to_run = [
+      job for job in pipeline_args.jobs_to_run if job not in complete_stages
+  ]
+
+
+def _write_shard_regions(pipeline_args):
+  """Writes a BED file of coverage-balanced regions for each shard.
+
+  The regions are computed from the linear index of --bai and the reference
+  lengths in --ref_fai (see region_partitioner), and written to
+  <staging>/shard_regions/<shard_index>.bed.
+  """
+  references = region_partitioner.read_fai(
+      io.StringIO(gcs_client.download(pipeline_args.ref_fai).decode('utf-8')))
+  window_work = region_partitioner.read_bai_window_work(
+      io.BytesIO(gcs_client.download(pipeline_args.bai)))
+  partitions = region_partitioner.partition_regions(references, window_work,
+                                                    pipeline_args.shards)
+  partition_work = region_partitioner.get_partition_work(
+      references, window_work, partitions)
+  logging.info('Partitioned regions into %d shards (max/mean work: %.2f).',
+               len(partitions),
+               max(partition_work) * len(partition_work) /
+               max(sum(partition_work), 1))
+
+  folder = _get_staging_shard_regions_folder(pipeline_args)
+
+  def upload(shard_index):
+    gcs_client.upload(
+        os.path.join(folder, '%d.bed' % shard_index),
+        region_partitioner.to_bed(partitions[shard_index]))
+
+  threads = multiprocessing.pool.ThreadPool(_MAX_UPLOAD_THREADS)
   try:
+    threads.map(upload, range(len(partitions)))
+  finally:
+    threads.close()
     threads.join()
-  except KeyboardInterrupt:
-    raise RuntimeError('Cancelled')
 
-  for result in results:
-    if result:
-      result.get()
 
+def _get_resource_plan(pipeline_args):
+  """Returns the resource_planner.Plan of the run.
 
-def _deploy_call_variants_pod(pod_name, cluster, pipeline_args):
-  """Deploys a pod into Kubernetes cluster, and waits on completion."""
-  # TODO(b/112042350): Add support for custom network and subnetwork.
+  The plan is based on the size of --bam, the fraction of the genome covered
+  by --regions (if set), and the --plan_* flags.
+
+  Args:
+    pipeline_args: pipeline arguments.
+  """
+  bam_metadata = gcs_client.get_metadata([pipeline_args.bam])
+  bam_bytes = bam_metadata[pipeline_args.bam].size
+  region_fraction = 1.0
+  if pipeline_args.regions:
+    references = region_partitioner.read_fai(
+        io.StringIO(
+            gcs_client.download(pipeline_args.ref_fai).decode('utf-8')))
+    bed_contents = [
+        gcs_client.download(region).decode('utf-8')
+        for region in pipeline_args.regions
+        if _is_valid_gcs_path(region)
+    ]
+    region_bases = resource_planner.get_region_bases(
+        [region for region in pipeline_args.regions
+         if not _is_valid_gcs_path(region)], references, bed_contents)
+    region_fraction = min(
+        1.0, region_bases / sum(reference.length for reference in references))
+
+  model_config = {}
+  if pipeline_args.plan_model:
+    with open(pipeline_args.plan_model) as f:
+      model_config = json.load(f)
+  model = resource_planner.LinearThroughputModel(
+      model_config.get('parameters'))
+  if pipeline_args.plan_calibration_runs:
+    with open(pipeline_args.plan_calibration_runs) as f:
+      model = model.calibrate(json.load(f))
+
+  planner = resource_planner.ResourcePlanner(
+      model,
+      prices=model_config.get('prices'),
+      preemptible=pipeline_args.preemptible,
+      gpu=pipeline_args.gpu,
+      max_workers=pipeline_args.plan_max_workers)
+  return planner.plan(
+      bam_bytes,
+      region_fraction,
+      target_hours=pipeline_args.plan_target_hours,
+      budget_usd=pipeline_args.plan_budget_usd,
+      disk_gb={
+          _MAKE_EXAMPLES_JOB_NAME:
+              pipeline_args.make_examples_disk_per_worker_gb,
+          _CALL_VARIANTS_JOB_NAME:
+              pipeline_args.call_variants_disk_per_worker_gb,
+          _POSTPROCESS_VARIANTS_JOB_NAME:
+              pipeline_args.postprocess_variants_disk_gb,
+      },
+      postprocess_cores=pipeline_args.postprocess_variants_cores,
+      postprocess_ram_gb=pipeline_args.postprocess_variants_ram_gb)
+
+
+def _get_failed_shards(pipeline_args, task_name):
+  """Returns the shards that failed in the last run of a make_examples task.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    task_name: (str) name of the make_examples task.
+  """
+  failed_shards_path = os.path.join(
+      _get_staging_failed_shards_folder(pipeline_args, task_name),
+      'failed_shards')
+  try:
+    content = gcs_client.download(failed_shards_path)
+  except google_exceptions.NotFound:
+    return []
+  return sorted(set(int(shard) for shard in content.split()))
+
+
+def _run_make_examples_task(pipeline_args, task_name, run_args, log_path):
+  """Runs a make_examples task, and reruns the shards that failed in it.
+
+  Each failed shard has already been retried on the task's VM. Shards that
+  still failed are rerun in up to --make_examples_followup_jobs follow-up jobs.
+  A speculative attempt of the task records its failed shards, logs and
+  follow-up jobs under its own task name, so that it cannot overwrite those of
+  the first attempt.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    task_name: (str) name of the make_examples task.
+    run_args: A list of arguments (type string) to pass to the pipelines tool.
+    log_path: Path to which pipelines API worker writes its log into.
+  Raises:
+    RuntimeError: if there was an error running the pipeline, or if some shards
+      still failed after all follow-up jobs.
+  """
+  attempt_index = job_scheduler.get_attempt_index()
+  if attempt_index:
+    attempt_task_name = '%s-attempt-%d' % (task_name, attempt_index)
+    failed_shards_folder = _get_staging_failed_shards_folder(
+        pipeline_args, task_name) + '/'
+    attempt_log_path = log_path + '-attempt-%d' % attempt_index
+    run_args = [
+        attempt_log_path if arg == log_path else arg.replace(
+            failed_shards_folder,
+            _get_staging_failed_shards_folder(pipeline_args,
+                                              attempt_task_name) + '/')
+        for arg in run_args
+    ]
+    task_name, log_path = attempt_task_name, attempt_log_path
+  _run_job(run_args, log_path)
+  failed_shards = _get_failed_shards(pipeline_args, task_name)
+  for attempt in range(1, pipeline_args.make_examples_followup_jobs + 1):
+    if not failed_shards:
+      return
+    logging.warning(
+        'make_examples task %s failed on shards %s. Rerunning them in a '
+        'follow-up job (attempt %d/%d).', task_name, failed_shards, attempt,
+        pipeline_args.make_examples_followup_jobs)
+    _run_job(*_get_make_examples_job(
+        pipeline_args, '%s-followup-%d' % (task_name, attempt), failed_shards))
+    failed_shards = _get_failed_shards(
+        pipeline_args, '%s-followup-%d' % (task_name, attempt))
+  if failed_shards:
+    raise RuntimeError('make_examples task %s failed on shards %s' %
+                       (task_name, failed_shards))
+
+
+def _get_shard_queue(pipeline_args):
+  """Returns the shard queue of the run, kept under --staging."""
+  return shard_queue.ShardQueue(
+      lease_store.GcsLeaseStore(
+          os.path.join(pipeline_args.staging, 'shard_queue')),
+      pipeline_args.shards, pipeline_args.shard_queue_batch_size)
+
+
+def _run_make_examples_queue_worker(pipeline_args, queue, worker_index):
+  """Runs make_examples tasks pulled from the shard queue until all are done.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    queue: (shard_queue.ShardQueue) queue to pull tasks from.
+    worker_index: (int) index of the make_examples worker.
+  """
+  owner = '%s-%d-%s' % (_MAKE_EXAMPLES_JOB_NAME, worker_index,
+                        uuid.uuid4().hex[:8])
+  while True:
+    task_index = queue.claim(owner)
+    if task_index is None:
+      if queue.is_done():
+        return
+      # The remaining tasks are leased by other workers. These may be dead
+      # (e.g. those of a crashed run resumed within the lease time), in which
+      # case their tasks become claimable once the leases expire.
+      time.sleep(_SHARD_QUEUE_POLL_SEC)
+      continue
+    task_name = 'task-%d' % task_index
+    logging.debug('make_examples worker %d claimed %s.', worker_index,
+                  task_name)
+    queue.run_task(
+        task_index, owner, _run_make_examples_task, pipeline_args, task_name,
+        *_get_make_examples_job(pipeline_args, task_name,
+                                queue.get_shards(task_index)))
+
+
+def _get_num_call_variants_workers(pipeline_args):
+  """Returns the number of call_variants workers (or pods with --tpu)."""
+  return min(pipeline_args.call_variants_workers, pipeline_args.shards)
+
+
+def _get_call_variants_pod_config(pod_name, pipeline_args, worker_index=0):
+  """Returns the config of a call_variants pod.
+
+  Like call_variants workers without --tpu, each pod reads one examples folder
+  and writes one shard of the call_variants output.
+  """
   infile = os.path.join(
-      _get_staging_examples_folder_to_read(pipeline_args, 0),
+      _get_staging_examples_folder_to_read(pipeline_args, worker_index),
       'examples_output.tfrecord@{}.gz'.format(str(pipeline_args.shards)))
   outfile = os.path.join(
       _get_staging_called_variants_folder(pipeline_args),
-      'call_variants_output.tfrecord-00000-of-00001.gz')
-  pod_config = _POD_CONFIG_TEMPLATE.format(
+      'call_variants_output.tfrecord-{:05d}-of-{:05d}.gz'.format(
+          worker_index, _get_num_call_variants_workers(pipeline_args)))
+  return _POD_CONFIG_TEMPLATE.format(
       POD_NAME=pod_name,
       DOCKER_IMAGE=pipeline_args.docker_image,
       EXAMPLES=infile,
@@ -515,54 +1022,211 @@ def _deploy_call_variants_pod(pod_name, cluster, pipeline_args):
                     pipeline_args.preemptible else 'cloud-tpus.google.com/v2'),
       BATCH_SIZE=pipeline_args.call_variants_batch_size)
 
+
+def _deploy_call_variants_pod(pod_name, cluster, pipeline_args,
+                              worker_index=0):
+  """Deploys a pod into Kubernetes cluster, and waits on completion."""
+  # TODO(b/112042350): Add support for custom network and subnetwork.
   cluster.deploy_pod(
-      pod_config=pod_config,
+      pod_config=_get_call_variants_pod_config(pod_name, pipeline_args,
+                                               worker_index),
       pod_name=pod_name,
       retries=pipeline_args.attempts - 1,
       wait=True)
 
 
-def _run_call_variants_with_kubernetes(pipeline_args):
-  """Runs call_variants step with kubernetes."""
-  # Setup Kubernetes cluster.
-  if pipeline_args.gke_cluster_name:
-    # Reuse provided GKE cluster.
-    new_cluster_created = False
-    cluster = gke_cluster.GkeCluster(pipeline_args.gke_cluster_name,
-                                     pipeline_args.gke_cluster_region,
-                                     pipeline_args.gke_cluster_zone)
+def _get_call_variants_cluster_args(pipeline_args):
+  """Returns the extra args of creating a GKE cluster for call_variants."""
+  job_name_label = pipeline_args.job_name_prefix + _CALL_VARIANTS_JOB_NAME
+  return [
+      '--num-nodes=1', '--enable-kubernetes-alpha', '--enable-ip-alias',
+      '--create-subnetwork=', '--node-labels=job_name=' + job_name_label,
+      '--scopes=cloud-platform', '--enable-tpu', '--no-enable-autorepair',
+      '--project', pipeline_args.project, '--quiet'
+  ]
+
+
+def _create_call_variants_cluster(pipeline_args, cluster_name):
+  """Creates a new GKE cluster with TPUs for call_variants."""
+  return gke_cluster.GkeCluster(
+      cluster_name,
+      pipeline_args.gke_cluster_region,
+      pipeline_args.gke_cluster_zone,
+      alpha_cluster=False,
+      extra_create_args=_get_call_variants_cluster_args(pipeline_args),
+      use_kubernetes_api=pipeline_args.kubernetes_api)
+
+
+def _get_cluster_pool(pipeline_args):
+  """Returns the cluster_pool.ClusterPool of --gke_cluster_pool."""
+  if _is_valid_gcs_path(pipeline_args.gke_cluster_pool):
+    store = lease_store.GcsLeaseStore(pipeline_args.gke_cluster_pool)
   else:
-    # Create a new GKE cluster.
-    job_name_label = pipeline_args.job_name_prefix + _CALL_VARIANTS_JOB_NAME
-    extra_args = [
-        '--num-nodes=1', '--enable-kubernetes-alpha', '--enable-ip-alias',
-        '--create-subnetwork=', '--node-labels=job_name=' + job_name_label,
-        '--scopes=cloud-platform', '--enable-tpu', '--no-enable-autorepair',
-        '--project', pipeline_args.project, '--quiet'
-    ]
-    cluster_name = 'deepvariant-' + _NOW_STR + uuid.uuid4().hex[:5]
-    cluster = gke_cluster.GkeCluster(
-        cluster_name,
-        pipeline_args.gke_cluster_region,
-        pipeline_args.gke_cluster_zone,
-        alpha_cluster=False,
-        extra_create_args=extra_args)
-    new_cluster_created = True
-
-  # Deploy call_variants pod.
-  pod_name = 'deepvariant-' + _NOW_STR + '-' + uuid.uuid4().hex[:5]
+    store = lease_store.LocalLeaseStore(pipeline_args.gke_cluster_pool)
+  return cluster_pool.ClusterPool(
+      store,
+      'deepvariant-' + _NOW_STR + '-' + uuid.uuid4().hex,
+      pipeline_args.gke_cluster_region,
+      pipeline_args.gke_cluster_zone,
+      alpha_cluster=False,
+      extra_create_args=_get_call_variants_cluster_args(pipeline_args),
+      use_kubernetes_api=pipeline_args.kubernetes_api,
+      idle_ttl_sec=pipeline_args.gke_cluster_idle_ttl_hours * 3600)
+
+
+class _CallVariantsCluster(object):
+  """The GKE cluster shared by the call_variants pods of a run.
+
+  The cluster is reused (with --gke_cluster_name), leased from the pool (with
+  --gke_cluster_pool) or created in the background once started, or else when
+  it is first needed. It is closed (i.e. a leased cluster is returned to the
+  pool, and a created one deleted) once all pods registered with add_pod are
+  released.
+  """
+
+  def __init__(self, pipeline_args, cluster_name):
+    self._pipeline_args = pipeline_args
+    self._lock = threading.Lock()
+    self._num_pods = 0
+    self._pool = None
+    self._lease = None
+    # Thread provisioning the cluster in the background, once started.
+    self._provisioning = None
+    # Error raised by the background provisioning, if any.
+    self._error = None
+    # Name of the cluster, which is known once leased with --gke_cluster_pool.
+    self.cluster_name = cluster_name
+    # The gke_cluster.GkeCluster, once reused, leased or created.
+    self.cluster = None
+
+  def add_pod(self):
+    """Registers a pod that will run on the cluster."""
+    with self._lock:
+      self._num_pods += 1
+
+  def start(self):
+    """Starts reusing, leasing or creating the cluster in the background.
+
+    Does nothing if no pods are registered (e.g. all of them completed in a
+    previous run), or if the cluster is already started.
+    """
+    with self._lock:
+      if (not self._num_pods or self._provisioning or
+          self.cluster is not None):
+        return
+      self._provisioning = threading.Thread(target=self._provision_async)
+      self._provisioning.daemon = True
+      self._provisioning.start()
+
+  def _provision(self):
+    if self._pipeline_args.gke_cluster_name:
+      return gke_cluster.GkeCluster(
+          self._pipeline_args.gke_cluster_name,
+          self._pipeline_args.gke_cluster_region,
+          self._pipeline_args.gke_cluster_zone,
+          use_kubernetes_api=self._pipeline_args.kubernetes_api)
+    if self._pipeline_args.gke_cluster_pool:
+      self._pool = _get_cluster_pool(self._pipeline_args)
+      self._lease = self._pool.lease()
+      self.cluster_name = self._lease.cluster_name
+      return self._lease.cluster
+    return _create_call_variants_cluster(self._pipeline_args,
+                                         self.cluster_name)
+
+  def _provision_async(self):
+    try:
+      cluster = self._provision()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error('Failed to provision the call_variants cluster: %s', e)
+      with self._lock:
+        self._error = e
+      return
+    with self._lock:
+      self.cluster = cluster
+
+  def _wait_until_provisioned(self):
+    provisioning = self._provisioning
+    if provisioning:
+      provisioning.join()
+
+  def get(self):
+    """Returns the GkeCluster, reusing, leasing or creating it if needed.
+
+    If the cluster was started, waits until it is ready instead.
+
+    Raises:
+      ValueError, RuntimeError: if the cluster could not be provisioned.
+    """
+    self._wait_until_provisioned()
+    with self._lock:
+      if self._error:
+        raise self._error
+      if self.cluster is None:
+        self.cluster = self._provision()
+      return self.cluster
+
+  def release_pod(self):
+    """Releases a pod, and closes the cluster after the last one."""
+    with self._lock:
+      self._num_pods -= 1
+      if self._num_pods > 0:
+        return
+    self.close()
+
+  def close(self):
+    """Returns a leased cluster to the pool, or deletes a created one.
+
+    The pool's clusters that stayed idle for --gke_cluster_idle_ttl_hours are
+    deleted too. A cluster still being provisioned in the background (e.g.
+    when make_examples failed) is closed once it is ready.
+    """
+    self._wait_until_provisioned()
+    with self._lock:
+      if self.cluster is None or self._pipeline_args.gke_cluster_name:
+        return
+      cluster, self.cluster = self.cluster, None
+      lease, self._lease = self._lease, None
+    if lease:
+      lease.release()
+      self._pool.reap()
+    else:
+      cluster.delete_cluster(wait=False)
+
+
+def _run_call_variants_with_kubernetes(pipeline_args, call_variants_cluster,
+                                       pod_name, worker_index):
+  """Runs a call_variants pod with kubernetes."""
   try:
-    _deploy_call_variants_pod(pod_name, cluster, pipeline_args)
-  except KeyboardInterrupt:
-    cluster.delete_pod(pod_name)
-    raise RuntimeError('Job cancelled by user.')
+    _deploy_call_variants_pod(pod_name, call_variants_cluster.get(),
+                              pipeline_args, worker_index)
   finally:
-    if new_cluster_created:
-      cluster.delete_cluster(wait=False)
+    call_variants_cluster.release_pod()
 
 
-def _run_call_variants_with_pipelines_api(pipeline_args):
-  """Runs call_variants step with pipelines API."""
+def _cancel_call_variants_with_kubernetes(unused_pipeline_args,
+                                          call_variants_cluster, pod_name,
+                                          unused_worker_index):
+  """Deletes a call_variants pod.
+
+  A cluster leased or created for this run is closed once all pods are
+  released, or when the run ends.
+  """
+  cluster = call_variants_cluster.cluster
+  if cluster:
+    cluster.delete_pod(pod_name)
+
+
+def _close_call_variants_clusters():
+  """Closes the clusters leased or created for this run that are left."""
+  while _call_variants_clusters:
+    try:
+      _call_variants_clusters.pop().close()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error('Failed to close the call_variants cluster: %s', e)
+
+
+def _get_call_variants_jobs(pipeline_args):
+  """Returns the [run_args, log_path] of each call_variants worker."""
 
   def get_extra_args():
     """Optional arguments that are specific to call_variants binary."""
@@ -574,9 +1238,8 @@ def _run_call_variants_with_pipelines_api(pipeline_args):
       pipeline_args.call_variants_cores_per_worker,
       pipeline_args.call_variants_ram_per_worker_gb * 1024)
 
-  num_workers = min(pipeline_args.call_variants_workers, pipeline_args.shards)
-  threads = multiprocessing.Pool(processes=num_workers)
-  results = []
+  num_workers = _get_num_call_variants_workers(pipeline_args)
+  jobs = []
   for i in range(num_workers):
     inputs = [
         'EXAMPLES=' + _get_staging_examples_folder_to_read(pipeline_args, i) +
@@ -590,7 +1253,7 @@ def _run_call_variants_with_pipelines_api(pipeline_args):
     job_name = pipeline_args.job_name_prefix + _CALL_VARIANTS_JOB_NAME
     output_path = os.path.join(pipeline_args.logging, _CALL_VARIANTS_JOB_NAME,
                                str(i))
-    run_args = _get_base_job_args(pipeline_args) + [
+    run_args = _get_base_job_args(pipeline_args, _CALL_VARIANTS_JOB_NAME) + [
         '--name', job_name, '--vm-labels', 'dv-job-name=' + job_name,
         '--output', output_path, '--image',
         (pipeline_args.docker_image_gpu if pipeline_args.gpu else
@@ -604,21 +1267,12 @@ def _run_call_variants_with_pipelines_api(pipeline_args):
     if pipeline_args.gpu:
       run_args.extend(
           ['--gpu-type', pipeline_args.accelerator_type, '--gpus', '1'])
-    results.append(threads.apply_async(_run_job, [run_args, output_path]))
-
-  _wait_for_results(threads, results)
-
-
-def _run_call_variants(pipeline_args):
-  """Runs the call_variants job."""
-  if pipeline_args.tpu:
-    _run_call_variants_with_kubernetes(pipeline_args)
-  else:
-    _run_call_variants_with_pipelines_api(pipeline_args)
+    jobs.append([run_args, output_path])
+  return jobs
 
 
-def _run_postprocess_variants(pipeline_args):
-  """Runs the postprocess_variants job."""
+def _get_postprocess_variants_job(pipeline_args):
+  """Returns the [run_args, log_path] of the postprocess_variants worker."""
 
   def get_extra_args():
     """Optional arguments that are specific to postprocess_variants binary."""
@@ -651,12 +1305,12 @@ def _run_postprocess_variants(pipeline_args):
     inputs.extend(['GVCF=' + _get_staging_gvcf_folder(pipeline_args) + '/*'])
     outputs.extend(['GVCF_OUTFILE=' + pipeline_args.gvcf_outfile])
 
-  call_variants_shards = 1 if pipeline_args.tpu else min(
-      pipeline_args.call_variants_workers, pipeline_args.shards)
+  call_variants_shards = _get_num_call_variants_workers(pipeline_args)
   job_name = pipeline_args.job_name_prefix + _POSTPROCESS_VARIANTS_JOB_NAME
   output_path = os.path.join(pipeline_args.logging,
                              _POSTPROCESS_VARIANTS_JOB_NAME)
-  run_args = _get_base_job_args(pipeline_args) + [
+  run_args = _get_base_job_args(pipeline_args,
+                                _POSTPROCESS_VARIANTS_JOB_NAME) + [
       '--name', job_name, '--vm-labels', 'dv-job-name=' + job_name, '--output',
       output_path, '--image', pipeline_args.docker_image, '--inputs',
       ','.join(inputs), '--outputs', ','.join(outputs), '--machine-type',
@@ -667,12 +1321,320 @@ def _run_postprocess_variants(pipeline_args):
       _POSTPROCESS_VARIANTS_COMMAND.format(
           EXTRA_ARGS=' '.join(get_extra_args()))
   ]
-  _run_job(run_args, output_path)
+  return [run_args, output_path]
+
+
+def _get_pipelines_job_key(pipeline_args, run_args):
+  """Returns the completion manifest key of a pipelines job.
+
+  Base job args only affect where and how a job runs (e.g. zones or attempts),
+  so they are left out. Actions files have random names and are replaced by
+  their content.
+  """
+  key_args = []
+  for arg in run_args[len(_get_base_job_args(pipeline_args)):]:
+    if arg.endswith('.json') and os.path.isfile(arg):
+      with open(arg) as actions_file:
+        key_args.append(json.load(actions_file))
+    else:
+      key_args.append(arg)
+  return completion_manifest.get_job_key(key_args)
+
+
+def _run_and_mark_complete(manifest, stage, worker_index, job_key, func,
+                           *args):
+  """Runs func and records the worker as complete in the manifest."""
+  func(*args)
+  manifest.mark_complete(stage, worker_index, job_key)
+
+
+def _add_worker_job(graph, pipeline_args, manifest, stage, worker_index,
+                    job_key, func, args, dependencies=None, cancel_func=None,
+                    run_args=None, speculative=False):
+  """Adds the job of a single worker to the graph.
+
+  If a manifest is given, the worker is recorded in it once it succeeds. With
+  --resume, the worker is skipped if it is already complete in the manifest
+  and all of its dependencies were skipped too. If run_args (of the pipelines
+  tool) are given, the job is admitted by the resources of their VM.
+  Speculative workers may be run twice if they straggle (see
+  --speculation_factor).
+
+  Returns:
+    The added Job.
+  """
+  name = stage if worker_index is None else stage + '/' + str(worker_index)
+  worker_index = worker_index or 0
+  if manifest:
+    func = functools.partial(_run_and_mark_complete, manifest, stage,
+                             worker_index, job_key, func)
+  job = graph.add_job(
+      name,
+      func,
+      args,
+      dependencies=dependencies,
+      stage=stage,
+      cancel_func=cancel_func,
+      resources=(admission_control.get_job_resources(run_args)
+                 if run_args else None),
+      speculative=speculative)
+  if (manifest and pipeline_args.resume and
+      manifest.is_complete(stage, worker_index, job_key) and all(
+          graph.get_job(dependency).state == job_scheduler.JobState.SUCCEEDED
+          for dependency in job.dependencies)):
+    logging.info('Skipping %s: already complete.', name)
+    job.state = job_scheduler.JobState.SUCCEEDED
+  return job
+
+
+def _add_stage_complete_job(graph, pipeline_args, stage, dependencies):
+  """Adds a job marking a content-addressed stage complete to the graph."""
+  graph.add_job(
+      stage + '/complete',
+      _mark_stage_complete, [pipeline_args, stage],
+      dependencies=dependencies,
+      stage=stage)
+
+
+def _write_dry_run(pipeline_args, validate_args_sec):
+  """Writes the specs of all jobs in --jobs_to_run to the --dry_run folder.
+
+  The pipelines argv of each job is written to <stage>/<name>.argv.json, with
+  its actions file (if any) written to <stage>/<name>.actions.json. With
+  --tpu, the call_variants pod is written to call_variants/pod.json instead
+  (or each of several pods to call_variants/pod-<i>.json).
+  The time taken to generate the specs of each stage is written to
+  timings.json.
+
+  Follow-up make_examples jobs only run after failures, and are not written.
+  With --coverage_balanced_regions, the regions of the shards are not
+  computed.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    validate_args_sec: (float) time taken to validate the arguments.
+  """
+
+  def get_make_examples_specs():
+    if pipeline_args.make_examples_shard_queue:
+      queue = shard_queue.ShardQueue(None, pipeline_args.shards,
+                                     pipeline_args.shard_queue_batch_size)
+      tasks = [('task-%d' % k, queue.get_shards(k))
+               for k in range(queue.num_tasks)]
+    else:
+      tasks = [(str(i), shard_indices) for i, shard_indices in enumerate(
+          _get_make_examples_worker_shards(pipeline_args))]
+    return [(task_name,
+             _get_make_examples_job(pipeline_args, task_name, shard_indices)[0])
+            for task_name, shard_indices in tasks]
+
+  def get_call_variants_specs():
+    if pipeline_args.tpu:
+      num_pods = _get_num_call_variants_workers(pipeline_args)
+      return [('pod' if num_pods == 1 else 'pod-%d' % i,
+               _get_call_variants_pod_config(
+                   'deepvariant-dry-run' if num_pods == 1 else
+                   'deepvariant-dry-run-%d' % i, pipeline_args, i))
+              for i in range(num_pods)]
+    return [(str(i), job[0])
+            for i, job in enumerate(_get_call_variants_jobs(pipeline_args))]
+
+  def get_postprocess_variants_specs():
+    return [('0', _get_postprocess_variants_job(pipeline_args)[0])]
+
+  def write_json(path, content):
+    with open(path, 'w') as f:
+      json.dump(content, f, indent=2, sort_keys=True)
+
+  timings = {'validate_args_sec': round(validate_args_sec, 6), 'stages': {}}
+  for stage, get_specs in ((_MAKE_EXAMPLES_JOB_NAME, get_make_examples_specs),
+                           (_CALL_VARIANTS_JOB_NAME, get_call_variants_specs),
+                           (_POSTPROCESS_VARIANTS_JOB_NAME,
+                            get_postprocess_variants_specs)):
+    if stage not in pipeline_args.jobs_to_run:
+      continue
+    start_time = time.time()
+    specs = get_specs()
+    spec_sec = time.time() - start_time
+    timings['stages'][stage] = {
+        'jobs': len(specs),
+        'spec_sec': round(spec_sec, 6)
+    }
+    logging.info('Generated %d %s job specs in %.3f seconds.', len(specs),
+                 stage, spec_sec)
+
+    stage_dir = os.path.join(pipeline_args.dry_run, stage)
+    if not os.path.isdir(stage_dir):
+      os.makedirs(stage_dir)
+    for name, spec in specs:
+      if isinstance(spec, str):
+        write_json(os.path.join(stage_dir, name + '.json'), json.loads(spec))
+        continue
+      argv = []
+      for arg in spec:
+        # Actions files have random names, and are moved next to the argv.
+        if arg.endswith('.json') and os.path.isfile(arg):
+          actions_path = os.path.join(stage_dir, name + '.actions.json')
+          with open(arg) as actions_file:
+            write_json(actions_path, json.load(actions_file))
+          os.remove(arg)
+          arg = actions_path
+        argv.append(arg)
+      write_json(os.path.join(stage_dir, name + '.argv.json'), argv)
+  write_json(os.path.join(pipeline_args.dry_run, 'timings.json'), timings)
+
+
+def _build_job_graph(pipeline_args,
+                     manifest=None,
+                     queue=None,
+                     call_variants_cluster=None):
+  """Returns the JobGraph of all workers in --jobs_to_run.
+
+  Every worker is a separate job. A call_variants worker depends on the
+  make_examples workers that write into its examples folder (or on all of them
+  unless --overlap_stages is set), and postprocess_variants depends on all
+  other workers.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    manifest: (completion_manifest.CompletionManifest) if set, workers record
+      their completion in it (and complete workers are skipped with --resume).
+    queue: (shard_queue.ShardQueue) queue make_examples workers pull their
+      shards from. Required if --make_examples_shard_queue is set.
+    call_variants_cluster: (_CallVariantsCluster) cluster the call_variants
+      pods run on with --tpu, e.g. one shared by the samples of a batch. A new
+      one is used if None.
+  """
+  graph = job_scheduler.JobGraph()
+  jobs_to_run = pipeline_args.jobs_to_run
+
+  make_examples_job_names = []
+  # Examples folder written by each make_examples job that only writes to one.
+  make_examples_folder_indices = {}
+  if _MAKE_EXAMPLES_JOB_NAME in jobs_to_run:
+    if pipeline_args.make_examples_shard_queue:
+      # All queue workers run the same kind of tasks, and are keyed by the
+      # first one.
+      first_task_job = _get_make_examples_job(pipeline_args, 'task-0',
+                                              queue.get_shards(0))
+      job_key = completion_manifest.get_job_key([
+          _get_pipelines_job_key(pipeline_args, first_task_job[0]),
+          queue.batch_size
+      ])
+      num_workers = min(pipeline_args.make_examples_workers, queue.num_tasks)
+      for i in range(num_workers):
+        make_examples_job_names.append(
+            _add_worker_job(graph, pipeline_args, manifest,
+                            _MAKE_EXAMPLES_JOB_NAME, i, job_key,
+                            _run_make_examples_queue_worker,
+                            [pipeline_args, queue, i],
+                            run_args=first_task_job[0]).name)
+    else:
+      for i, shard_indices in enumerate(
+          _get_make_examples_worker_shards(pipeline_args)):
+        job = _get_make_examples_job(pipeline_args, str(i), shard_indices)
+        job_name = _add_worker_job(
+            graph, pipeline_args, manifest, _MAKE_EXAMPLES_JOB_NAME, i,
+            _get_pipelines_job_key(pipeline_args, job[0]),
+            _run_make_examples_task, [pipeline_args, str(i)] + job,
+            run_args=job[0],
+            speculative=True).name
+        make_examples_job_names.append(job_name)
+        make_examples_folder_indices[job_name] = _get_examples_folder_index(
+            pipeline_args, shard_indices[0])
+    if pipeline_args.content_addressed_staging:
+      _add_stage_complete_job(graph, pipeline_args, _MAKE_EXAMPLES_JOB_NAME,
+                              make_examples_job_names)
+
+  call_variants_job_names = []
+  if _CALL_VARIANTS_JOB_NAME in jobs_to_run:
+    if pipeline_args.tpu:
+      if not call_variants_cluster:
+        call_variants_cluster = _CallVariantsCluster(
+            pipeline_args, pipeline_args.gke_cluster_name or
+            'deepvariant-' + _NOW_STR + uuid.uuid4().hex[:5])
+        _call_variants_clusters.append(call_variants_cluster)
+      pod_name = 'deepvariant-' + _NOW_STR + '-' + uuid.uuid4().hex[:5]
+      call_variants_jobs = [
+          (completion_manifest.get_job_key(
+              _get_call_variants_pod_config('', pipeline_args, i)),
+           _run_call_variants_with_kubernetes,
+           [pipeline_args, call_variants_cluster, pod_name + '-' + str(i), i],
+           _cancel_call_variants_with_kubernetes, None)
+          for i in range(_get_num_call_variants_workers(pipeline_args))
+      ]
+    else:
+      call_variants_jobs = [
+          (_get_pipelines_job_key(pipeline_args, job[0]), _run_job, job, None,
+           job[0]) for job in _get_call_variants_jobs(pipeline_args)
+      ]
+    for i, (job_key, func, args, cancel_func,
+            run_args) in enumerate(call_variants_jobs):
+      if pipeline_args.overlap_stages:
+        dependencies = [
+            name for name in make_examples_job_names
+            if make_examples_folder_indices.get(name, i) == i
+        ]
+      else:
+        dependencies = make_examples_job_names
+      job = _add_worker_job(
+          graph,
+          pipeline_args,
+          manifest,
+          _CALL_VARIANTS_JOB_NAME,
+          i,
+          job_key,
+          func,
+          args,
+          dependencies=dependencies,
+          cancel_func=cancel_func,
+          run_args=run_args,
+          speculative=not pipeline_args.tpu)
+      if (pipeline_args.tpu and
+          job.state != job_scheduler.JobState.SUCCEEDED):
+        call_variants_cluster.add_pod()
+      call_variants_job_names.append(job.name)
+    if pipeline_args.content_addressed_staging:
+      _add_stage_complete_job(graph, pipeline_args, _CALL_VARIANTS_JOB_NAME,
+                              call_variants_job_names)
+
+  if _POSTPROCESS_VARIANTS_JOB_NAME in jobs_to_run:
+    job = _get_postprocess_variants_job(pipeline_args)
+    _add_worker_job(
+        graph,
+        pipeline_args,
+        manifest,
+        _POSTPROCESS_VARIANTS_JOB_NAME,
+        None,
+        _get_pipelines_job_key(pipeline_args, job[0]),
+        _run_job,
+        job,
+        dependencies=make_examples_job_names + call_variants_job_names,
+        run_args=job[0])
+  return graph
+
+
+def _get_default_shard_queue_batch_size(pipeline_args):
+  """Returns the default --shard_queue_batch_size.
+
+  This is the largest batch size of at most --shards / --make_examples_workers
+  that divides the number of shards of each examples folder. Every task of the
+  queue runs on a VM of its own, which localizes the whole BAM file, so tasks
+  should not be much smaller than the workers of the static layout.
+  """
+  folder_shards = pipeline_args.shards // pipeline_args.call_variants_workers
+  max_batch_size = max(
+      pipeline_args.shards // pipeline_args.make_examples_workers, 1)
+  return max(size for size in range(1, min(folder_shards, max_batch_size) + 1)
+             if folder_shards % size == 0)
 
 
 def _validate_and_complete_args(pipeline_args):
   """Validates pipeline arguments and fills some missing args (if any)."""
   # Basic validation logic. More detailed validation is done by pipelines API.
+  if not pipeline_args.bam or not pipeline_args.outfile:
+    raise ValueError('--bam and --outfile are required unless '
+                     '--batch_manifest is set.')
   if (pipeline_args.job_name_prefix and
       not _meets_gcp_label_restrictions(pipeline_args.job_name_prefix)):
     raise ValueError(
@@ -707,18 +1669,67 @@ def _validate_and_complete_args(pipeline_args):
     raise ValueError('--make_examples_workers must be greater than zero.')
   if pipeline_args.call_variants_workers <= 0:
     raise ValueError('--call_variants_workers must be greater than zero.')
+  if pipeline_args.max_concurrent_jobs < 0:
+    raise ValueError('--max_concurrent_jobs cannot be negative.')
+  for stage in (_MAKE_EXAMPLES_JOB_NAME, _CALL_VARIANTS_JOB_NAME,
+                _POSTPROCESS_VARIANTS_JOB_NAME):
+    if (getattr(pipeline_args, stage + '_max_preemptions') or 0) < 0:
+      raise ValueError('--%s_max_preemptions cannot be negative.' % stage)
+  if pipeline_args.deadline_hours is not None and (
+      pipeline_args.deadline_hours <= 0):
+    raise ValueError('--deadline_hours must be positive.')
+  if pipeline_args.speculation_factor < 0:
+    raise ValueError('--speculation_factor cannot be negative.')
+  if pipeline_args.zone_health_half_life_hours <= 0:
+    raise ValueError('--zone_health_half_life_hours must be positive.')
+  for resource in admission_control.RESOURCES:
+    if (getattr(pipeline_args, 'quota_' + resource) or 0) < 0:
+      raise ValueError('--quota_%s cannot be negative.' % resource)
+  if pipeline_args.make_examples_shard_retries < 0:
+    raise ValueError('--make_examples_shard_retries cannot be negative.')
+  if pipeline_args.make_examples_followup_jobs < 0:
+    raise ValueError('--make_examples_followup_jobs cannot be negative.')
   if pipeline_args.shards <= 0:
     raise ValueError('--shards must be greater than zero.')
-  if pipeline_args.shards % pipeline_args.make_examples_workers != 0:
+  if (not pipeline_args.make_examples_shard_queue and
+      pipeline_args.shards % pipeline_args.make_examples_workers != 0):
     raise ValueError('--shards must be divisible by --make_examples_workers')
-  if pipeline_args.shards % pipeline_args.call_variants_workers != 0:
-    raise ValueError('--shards must be divisible by --call_variants_workers')
   if pipeline_args.call_variants_workers > pipeline_args.make_examples_workers:
     logging.warning(
         '--call_variants_workers cannot be greather than '
         '--make_examples_workers. Setting call_variants_workers to  %d',
         pipeline_args.make_examples_workers)
     pipeline_args.call_variants_workers = pipeline_args.make_examples_workers
+  if pipeline_args.shards % pipeline_args.call_variants_workers != 0:
+    raise ValueError('--shards must be divisible by --call_variants_workers')
+  if pipeline_args.make_examples_shard_queue:
+    if pipeline_args.shard_queue_batch_size is None:
+      pipeline_args.shard_queue_batch_size = (
+          _get_default_shard_queue_batch_size(pipeline_args))
+    if pipeline_args.shard_queue_batch_size <= 0:
+      raise ValueError('--shard_queue_batch_size must be greater than zero.')
+    if (pipeline_args.shards // pipeline_args.call_variants_workers %
+        pipeline_args.shard_queue_batch_size != 0):
+      raise ValueError('--shards / --call_variants_workers must be divisible '
+                       'by --shard_queue_batch_size')
+
+  if pipeline_args.coverage_balanced_regions and pipeline_args.regions:
+    raise ValueError(
+        '--coverage_balanced_regions cannot be used with --regions.')
+  if pipeline_args.content_addressed_staging and pipeline_args.dry_run:
+    # Stage keys depend on the generations of the inputs on GCS.
+    raise ValueError(
+        '--content_addressed_staging cannot be used with --dry_run.')
+
+  if pipeline_args.plan:
+    if (pipeline_args.plan_target_hours is None and
+        pipeline_args.plan_budget_usd is None):
+      raise ValueError('--plan requires --plan_target_hours or '
+                       '--plan_budget_usd.')
+    if pipeline_args.tpu:
+      raise ValueError('--plan cannot be used with --tpu.')
+    if pipeline_args.plan_max_workers <= 0:
+      raise ValueError('--plan_max_workers must be greater than zero.')
 
   if pipeline_args.gpu and not pipeline_args.docker_image_gpu:
     raise ValueError('--docker_image_gpu must be provided with --gpu')
@@ -730,18 +1741,19 @@ def _validate_and_complete_args(pipeline_args):
     raise ValueError('--gvcf_gq_binsize must be greater or equal to 1')
   if pipeline_args.gpu and pipeline_args.tpu:
     raise ValueError('Both --gpu and --tpu cannot be set.')
-  # TODO(nmousavi): Support multiple TPUs for call_variants if there is an
-  # interest.
-  if pipeline_args.tpu and pipeline_args.call_variants_workers != 1:
-    raise ValueError(
-        '--call_variants_workers must be equal to one when --tpu is set.')
   if pipeline_args.tpu and bool(pipeline_args.gke_cluster_region) == bool(
       pipeline_args.gke_cluster_zone):
     raise ValueError('Exactly one of --gke_cluster_region or '
                      '--gke_cluster_zone must be specified if --tpu is set.')
 
+  if pipeline_args.gke_cluster_pool and pipeline_args.gke_cluster_name:
+    raise ValueError(
+        '--gke_cluster_pool cannot be used with --gke_cluster_name.')
+  if pipeline_args.gke_cluster_idle_ttl_hours < 0:
+    raise ValueError('--gke_cluster_idle_ttl_hours cannot be negative.')
+
   # Verify the existing gke cluster is up and running.
-  if pipeline_args.gke_cluster_name:
+  if pipeline_args.gke_cluster_name and not pipeline_args.dry_run:
     try:
       _ = gke_cluster.GkeCluster(
           pipeline_args.gke_cluster_name,
@@ -759,32 +1771,57 @@ def _validate_and_complete_args(pipeline_args):
     pipeline_args.ref_fai = pipeline_args.ref + _FAI_FILE_SUFFIX
   if not pipeline_args.ref_gzi and pipeline_args.ref.endswith(_GZ_FILE_SUFFIX):
     pipeline_args.ref_gzi = pipeline_args.ref + _GZI_FILE_SUFFIX
-  if not pipeline_args.bai:
-    pipeline_args.bai = pipeline_args.bam + _BAI_FILE_SUFFIX
-    if not _gcs_object_exist(pipeline_args.bai):
-      pipeline_args.bai = pipeline_args.bam.replace(_BAM_FILE_SUFFIX,
-                                                    _BAI_FILE_SUFFIX)
+  # Without --bai, the first existing candidate is used.
+  bai_candidates = [pipeline_args.bai] if pipeline_args.bai else [
+      pipeline_args.bam + _BAI_FILE_SUFFIX,
+      pipeline_args.bam.replace(_BAM_FILE_SUFFIX, _BAI_FILE_SUFFIX)
+  ]
+
+  if pipeline_args.dry_run:
+    # Job specs do not depend on GCS, so inputs are assumed to exist and
+    # buckets to be writable.
+    pipeline_args.bai = bai_candidates[0]
+    return
+
+  # Output buckets are checked concurrently, and all input files at once.
+  objects_to_check = [pipeline_args.ref, pipeline_args.ref_fai,
+                      pipeline_args.bam] + bai_candidates
+  if pipeline_args.ref_gzi:
+    objects_to_check.append(pipeline_args.ref_gzi)
+  buckets_to_check = [_get_gcs_bucket(pipeline_args.staging),
+                      _get_gcs_bucket(pipeline_args.outfile)]
+  threads = multiprocessing.pool.ThreadPool(processes=len(buckets_to_check))
+  try:
+    buckets_writable = threads.map_async(_can_write_to_bucket,
+                                         buckets_to_check)
+    object_exists = _gcs_objects_exist(objects_to_check)
+    bucket_writable = dict(zip(buckets_to_check, buckets_writable.get()))
+  finally:
+    threads.close()
+    threads.join()
+  pipeline_args.bai = next(
+      (bai for bai in bai_candidates if object_exists[bai]), bai_candidates[-1])
 
   # Ensuring all input files exist...
-  if not _gcs_object_exist(pipeline_args.ref):
+  if not object_exists[pipeline_args.ref]:
     raise ValueError('Given reference file via --ref does not exist')
-  if not _gcs_object_exist(pipeline_args.ref_fai):
+  if not object_exists[pipeline_args.ref_fai]:
     raise ValueError('Given FAI index file via --ref_fai does not exist')
-  if (pipeline_args.ref_gzi and not _gcs_object_exist(pipeline_args.ref_gzi)):
+  if pipeline_args.ref_gzi and not object_exists[pipeline_args.ref_gzi]:
     raise ValueError('Given GZI index file via --ref_gzi does not exist')
-  if not _gcs_object_exist(pipeline_args.bam):
+  if not object_exists[pipeline_args.bam]:
     raise ValueError('Given BAM file via --bam does not exist')
-  if not _gcs_object_exist(pipeline_args.bai):
+  if not object_exists[pipeline_args.bai]:
     raise ValueError('Given BAM index file via --bai does not exist')
   # ...and we can write to output buckets.
-  if not _can_write_to_bucket(_get_gcs_bucket(pipeline_args.staging)):
+  if not bucket_writable[buckets_to_check[0]]:
     raise ValueError('Cannot write to staging bucket, change --staging value')
-  if not _can_write_to_bucket(_get_gcs_bucket(pipeline_args.outfile)):
+  if not bucket_writable[buckets_to_check[1]]:
     raise ValueError('Cannot write to output bucket, change --outfile value')
 
 
-def run(argv=None):
-  """Runs the DeepVariant pipeline."""
+def _parse_args(argv):
+  """Parses the command line arguments of the pipeline."""
   parser = argparse.ArgumentParser()
 
   # Required args.
@@ -802,9 +1839,9 @@ def run(argv=None):
             'supported, such as "us-central1-*" or "us-*".'))
   parser.add_argument(
       '--outfile',
-      required=True,
       help=('Destination path in Google Cloud Storage where the resulting '
-            'VCF file will be stored.'))
+            'VCF file will be stored. Required unless --batch_manifest is '
+            'set.'))
   parser.add_argument(
       '--staging',
       required=True,
@@ -818,8 +1855,8 @@ def run(argv=None):
             'the files to be prefixed with "model.ckpt".'))
   parser.add_argument(
       '--bam',
-      required=True,
-      help='Path in Google Cloud Storage that stores the BAM file.')
+      help=('Path in Google Cloud Storage that stores the BAM file. Required '
+            'unless --batch_manifest is set.'))
   parser.add_argument(
       '--ref',
       required=True,
@@ -861,6 +1898,48 @@ def run(argv=None):
       action='store_true',
       help=('Only affects make_example step. If set, gcsfuse is used to '
             'localize input bam file instead of copying it with gsutil. '))
+  parser.add_argument(
+      '--make_examples_shard_retries',
+      type=int,
+      default=1,
+      help=('Number of times a failed make_examples shard is retried on the '
+            'same worker. Other shards of the worker are not affected.'))
+  parser.add_argument(
+      '--make_examples_followup_jobs',
+      type=int,
+      default=1,
+      help=('Maximum number of follow-up jobs to run for a make_examples '
+            'worker if some of its shards still failed. Follow-up jobs only '
+            'rerun the failed shards.'))
+  parser.add_argument(
+      '--make_examples_shard_queue',
+      default=False,
+      action='store_true',
+      help=('If set, make_examples workers repeatedly pull batches of '
+            '--shard_queue_batch_size shards from a queue (kept under '
+            '--staging) until it is empty, instead of being assigned a fixed '
+            'range of shards. This balances load between workers, and '
+            '--shards does not need to be divisible by '
+            '--make_examples_workers.'))
+  parser.add_argument(
+      '--shard_queue_batch_size',
+      type=int,
+      help=('Number of shards a make_examples worker runs at once (on a VM of '
+            'its own) when --make_examples_shard_queue is set. --shards / '
+            '--call_variants_workers must be divisible by it. Smaller batches '
+            'balance load better, but each boots a VM and localizes the BAM '
+            'file. Defaults to the largest valid size of at most --shards / '
+            '--make_examples_workers.'))
+  parser.add_argument(
+      '--coverage_balanced_regions',
+      default=False,
+      action='store_true',
+      help=('If set, the genome is cut into one contiguous set of regions per '
+            'make_examples shard, such that shards have roughly equal amounts '
+            'of reads according to the BAM index. Each shard then only reads '
+            'its own part of the BAM file. The sequences in --ref_fai must be '
+            'in the same order as in the BAM header. Cannot be used with '
+            '--regions.'))
 
   # Optional call_variants args.
   # TODO(b/118876068): Use call_variants default batch_size if not specified.
@@ -924,6 +2003,25 @@ def run(argv=None):
       help=('WARNING: This flag is deprecated and will be removed in a future '
             'release. Use --attempts and --preemptible to control retry '
             'behaviour.'))
+  for stage, note in (
+      (_MAKE_EXAMPLES_JOB_NAME, ''),
+      (_CALL_VARIANTS_JOB_NAME, ' Does not apply to --tpu.'),
+      (_POSTPROCESS_VARIANTS_JOB_NAME, '')):
+    parser.add_argument(
+        '--%s_max_preemptions' % stage,
+        type=int,
+        help=('If set, each %s worker first runs on preemptible VMs, and '
+              'falls back to regular VMs (for --attempts more attempts) after '
+              'this many preemptible attempts, regardless of --preemptible. '
+              'Zero only uses regular VMs.%s' % (stage, note)))
+  parser.add_argument(
+      '--deadline_hours',
+      type=float,
+      help=('Optional time (in hours, from the start of the run) by which the '
+            'run should end. Workers launched once it is at risk, i.e. when '
+            'the time left is less than 1.5 times the longest run of a worker '
+            'of the same stage (or less than a quarter of the time budget '
+            'before one has succeeded), skip their preemptible attempts.'))
   parser.add_argument(
       '--network', help=('Optional. The VPC network on GCP to use.'))
   parser.add_argument(
@@ -970,6 +2068,29 @@ def run(argv=None):
       '--gke_cluster_zone',
       help=('GKE cluster zone used for searching an existing cluster or '
             'creating a new one. This is relevant only if --tpu is set.'))
+  parser.add_argument(
+      '--gke_cluster_pool',
+      help=('Local or GCS folder of the leases of a pool of warm GKE clusters '
+            'shared by runs. If set (and --gke_cluster_name is not), a free '
+            'cluster of the pool with the same location and TPU config is '
+            'leased instead of creating a new one, and returned to the pool '
+            'after the run. Use a GCS folder to share the pool between '
+            'machines. This is relevant only if --tpu is set.'))
+  parser.add_argument(
+      '--gke_cluster_idle_ttl_hours',
+      type=float,
+      default=1,
+      help=('Clusters of --gke_cluster_pool that stay idle for longer than '
+            'this are deleted at the end of a run.'))
+  parser.add_argument(
+      '--kubernetes_api',
+      default=False,
+      action='store_true',
+      help=('Manage the call_variants pod by sending requests to the GKE '
+            'cluster\'s Kubernetes API over reused connections, instead of '
+            'running kubectl for each request. Falls back to kubectl if the '
+            'API server cannot be reached. This is relevant only if --tpu is '
+            'set.'))
 
   # Optional pipeline sharding and machine shapes.
   parser.add_argument(
@@ -1005,7 +2126,8 @@ def run(argv=None):
       type=int,
       default=1,
       help=('Number of workers (machines) to use for running the call_variants '
-            'job.'))
+            'job. With --tpu, this is the number of pods (each using one TPU '
+            'device) deployed concurrently to the GKE cluster.'))
   parser.add_argument(
       '--call_variants_cores_per_worker',
       type=int,
@@ -1037,6 +2159,52 @@ def run(argv=None):
       default=30,
       help='Disk (in GB) to use for postprocess_variants.')
 
+  parser.add_argument(
+      '--dry_run',
+      help=('Optional local folder. If set, no job is run. Instead, the '
+            'pipelines argv and actions of every worker (and the call_variants '
+            'pod with --tpu) are written to this folder, along with the time '
+            'taken to generate them for each stage. GCS inputs are assumed to '
+            'exist and the GKE cluster is not checked.'))
+
+  # Optional resource planning args.
+  parser.add_argument(
+      '--plan',
+      default=False,
+      action='store_true',
+      help=('If set, no job is run. Instead, --shards, the number of workers '
+            'and the machine shapes of make_examples and call_variants are '
+            'planned from the size of --bam and --regions, to meet '
+            '--plan_target_hours at the lowest cost or to run as fast as '
+            'possible within --plan_budget_usd. The planned flags, and the '
+            'predicted time and cost of each stage, are printed as JSON. '
+            'Appending the planned flags to the command line overrides the '
+            'original ones.'))
+  parser.add_argument(
+      '--plan_target_hours',
+      type=float,
+      help='Maximum wall-clock time (in hours) of the planned run.')
+  parser.add_argument(
+      '--plan_budget_usd',
+      type=float,
+      help='Maximum cost (in USD) of the planned run.')
+  parser.add_argument(
+      '--plan_max_workers',
+      type=int,
+      default=128,
+      help='Maximum number of workers of a stage in the planned run.')
+  parser.add_argument(
+      '--plan_model',
+      help=('Optional local JSON file overriding the throughput model and '
+            'prices used for planning, with "parameters" (per stage, see '
+            'resource_planner.py) and "prices" keys.'))
+  parser.add_argument(
+      '--plan_calibration_runs',
+      help=('Optional local JSON file listing stages of past runs to calibrate '
+            'the throughput model with. Each item has keys: stage, bam_bytes, '
+            'region_fraction, workers, cores_per_worker, gpus_per_worker and '
+            'hours.'))
+
   # Optional misc args.
   parser.add_argument(
       '--job_name_prefix',
@@ -1064,23 +2232,393 @@ def run(argv=None):
             'jobs. By default, the pipeline runs all 3 jobs (make_examples, '
             'call_variants, postprocess_variants) in sequence. '
             'This option may be used to run parts of the pipeline.'))
+  parser.add_argument(
+      '--overlap_stages',
+      default=False,
+      action='store_true',
+      help=('If set, each call_variants worker starts as soon as all '
+            'make_examples workers writing to its examples folder have '
+            'finished, instead of waiting for all make_examples workers.'))
+  parser.add_argument(
+      '--max_concurrent_jobs',
+      type=int,
+      default=0,
+      help=('Maximum number of workers (across all jobs) to run at the same '
+            'time. Zero means no limit.'))
+  parser.add_argument(
+      '--quota_file',
+      help=('Optional path (local or GCS) of a JSON object with the maximum '
+            'resources used by the VMs of all running workers, with keys '
+            'instances, cpus, memory_gb and gpus (see admission_control.py). '
+            'Workers only start once their --machine-type and GPUs fit, e.g. '
+            'the regional quotas of the project, so that they do not wait '
+            'for quota within the Pipelines API.'))
+  parser.add_argument(
+      '--quota_instances',
+      type=int,
+      help='Maximum number of worker VMs. Overrides --quota_file.')
+  parser.add_argument(
+      '--quota_cpus',
+      type=int,
+      help='Maximum number of cores of all worker VMs. Overrides --quota_file.')
+  parser.add_argument(
+      '--quota_memory_gb',
+      type=float,
+      help='Maximum RAM (in GB) of all worker VMs. Overrides --quota_file.')
+  parser.add_argument(
+      '--quota_gpus',
+      type=int,
+      help='Maximum number of GPUs of all worker VMs. Overrides --quota_file.')
+  parser.add_argument(
+      '--speculation_factor',
+      type=float,
+      default=0,
+      help=('If positive, a make_examples (without '
+            '--make_examples_shard_queue) or call_variants (without --tpu) '
+            'worker running for longer than this many times the median '
+            'duration of the finished workers of its stage, once half of '
+            'them finished, is started a second time, e.g. in another zone. '
+            'The first of the two to finish is kept and the other cancelled. '
+            'Both write the same outputs, so they do not need to be merged. '
+            'Zero disables speculative workers.'))
+  parser.add_argument(
+      '--resume',
+      default=False,
+      action='store_true',
+      help=('If set, workers that already completed with the same arguments '
+            'in a previous run using the same --staging folder are skipped. '
+            'Completed workers are always recorded in a manifest under '
+            '--staging.'))
+  parser.add_argument(
+      '--batch_manifest',
+      help=('Optional path (local or GCS) of a manifest of samples to run '
+            'together, as a TSV file with a header row or a JSON list of '
+            'objects, with fields bam, outfile (both required), bai, '
+            'gvcf_outfile and sample_name (see batch_manifest.py). These '
+            'flags are then taken from the manifest, and all other flags '
+            'apply to every sample. Samples are staged under '
+            '--staging/samples/<sample>, share the GKE cluster (with --tpu) '
+            'and --max_concurrent_jobs, and a failed sample does not stop the '
+            'others. The status of each sample is written to '
+            '--staging/batch_summary.json.'))
+  parser.add_argument(
+      '--content_addressed_staging',
+      default=False,
+      action='store_true',
+      help=('If set, the outputs of make_examples and call_variants are '
+            'staged in folders named after a hash of the inputs that affect '
+            'them (input object generations, docker image digests and '
+            'flags), and a stage whose outputs were completed by a previous '
+            'run with the same --staging is not run again. E.g. rerunning '
+            'with a different --outfile only runs postprocess_variants. '
+            'Docker images given by tag are resolved with gcloud.'))
+  parser.add_argument(
+      '--gcs_metadata_cache',
+      default=False,
+      action='store_true',
+      help=('If set, the metadata of GCS inputs is cached in %s and shared '
+            'by all runs, so that inputs checked by a recent run are not '
+            'checked again.' % metadata_cache.DEFAULT_PATH))
+  parser.add_argument(
+      '--gcs_metadata_cache_ttl_sec',
+      type=int,
+      default=metadata_cache.DEFAULT_TTL_SEC,
+      help=('Time (in seconds) after which an input cached with '
+            '--gcs_metadata_cache is checked again.'))
+  parser.add_argument(
+      '--adaptive_zones',
+      default=False,
+      action='store_true',
+      help=('If set, the zone assignments, launch latencies, stockouts and '
+            'preemptions of workers are recorded per zone in %s and shared '
+            'by all runs, and each worker (including re-runs) is only '
+            'launched in the healthiest of --zones. Wildcard zones are '
+            'expanded to the zones seen in earlier runs.' %
+            zone_health.DEFAULT_PATH))
+  parser.add_argument(
+      '--zone_health_half_life_hours',
+      type=float,
+      default=zone_health.DEFAULT_HALF_LIFE_SEC / 3600,
+      help=('Age (in hours) at which a zone outcome recorded with '
+            '--adaptive_zones counts half as much.'))
+
+  return parser.parse_args(argv)
+
 
-  pipeline_args = parser.parse_args(argv)
+def run(argv=None):
+  """Runs the DeepVariant pipeline."""
+  global _zone_health, _deadline_policy
+  pipeline_args = _parse_args(argv)
+  if pipeline_args.deadline_hours:
+    _deadline_policy = preemption_policy.DeadlinePolicy(
+        time.time() + pipeline_args.deadline_hours * 3600)
+  cache = None
+  if pipeline_args.gcs_metadata_cache:
+    cache = metadata_cache.MetadataCache(
+        ttl_sec=pipeline_args.gcs_metadata_cache_ttl_sec)
+    gcs_client.set_metadata_cache(cache)
+  if pipeline_args.adaptive_zones:
+    _zone_health = zone_health.ZoneHealth(
+        half_life_sec=pipeline_args.zone_health_half_life_hours * 3600)
+  try:
+    _run(pipeline_args)
+  finally:
+    if cache:
+      gcs_client.set_metadata_cache(None)
+      cache.close()
+      logging.info('GCS metadata cache: %d hits, %d misses.', cache.hits,
+                   cache.misses)
+    if _zone_health:
+      _zone_health.close()
+      _zone_health = None
+    _deadline_policy = None
+    _close_call_variants_clusters()
+
+
+def _run(pipeline_args):
+  """Runs the DeepVariant pipeline with parsed arguments."""
+  if pipeline_args.batch_manifest:
+    _run_batch(pipeline_args)
+    return
+
+  start_time = time.time()
   _validate_and_complete_args(pipeline_args)
+  validate_args_sec = time.time() - start_time
+
+  if pipeline_args.plan:
+    plan = _get_resource_plan(pipeline_args)
+    logging.info('Planned run takes %.2f hours and costs %.2f USD.',
+                 plan.hours, plan.cost)
+    print(json.dumps(plan.to_dict(), indent=2))
+    return
+
+  if pipeline_args.dry_run:
+    _write_dry_run(pipeline_args, validate_args_sec)
+    return
+
+  _run_job_graph(_prepare_job_graph(pipeline_args), pipeline_args)
+
+
+def _prepare_job_graph(pipeline_args, call_variants_cluster=None):
+  """Prepares the staging folder of a validated run and returns its JobGraph.
+
+  Args:
+    pipeline_args: pipeline arguments.
+    call_variants_cluster: (_CallVariantsCluster) see _build_job_graph. It is
+      not started.
+  """
+  if pipeline_args.content_addressed_staging:
+    pipeline_args.stage_keys = _get_stage_keys(pipeline_args)
+    _skip_complete_stages(pipeline_args)
+
+  manifest = completion_manifest.CompletionManifest(pipeline_args.staging)
+  if pipeline_args.resume:
+    manifest.load()
+
+  queue = None
+  if pipeline_args.make_examples_shard_queue:
+    queue = _get_shard_queue(pipeline_args)
+    if not pipeline_args.resume:
+      queue.reset()
+
+  if (pipeline_args.coverage_balanced_regions and
+      _MAKE_EXAMPLES_JOB_NAME in pipeline_args.jobs_to_run):
+    _write_shard_regions(pipeline_args)
+
+  graph = _build_job_graph(pipeline_args, manifest, queue,
+                           call_variants_cluster)
+  # The call_variants cluster is verified, leased or created while
+  # make_examples runs, rather than once call_variants starts.
+  for cluster in list(_call_variants_clusters):
+    cluster.start()
+  return graph
+
+
+def _get_admission_controller(pipeline_args):
+  """Returns the AdmissionController of the --quota_* flags, if any."""
+  limits = {}
+  if pipeline_args.quota_file:
+    limits.update(
+        admission_control.FileQuotaSource(
+            pipeline_args.quota_file).get_limits())
+  for resource in admission_control.RESOURCES:
+    limit = getattr(pipeline_args, 'quota_' + resource)
+    if limit is not None:
+      limits[resource] = limit
+  if not limits:
+    return None
+  logging.info('Admitting workers within quota: %s', limits)
+  return admission_control.AdmissionController(
+      admission_control.StaticQuotaSource(limits))
+
+
+def _run_job_graph(graph, pipeline_args, fail_fast=True):
+  """Runs all jobs of a graph, at most --max_concurrent_jobs at a time."""
+  logging.debug('Job graph: %s', json.dumps(graph.to_dict()))
+  # Workers only block on their pipelines/kubectl subprocesses, so they are run
+  # by threads of this process rather than by one forked process each.
+  num_threads = max(graph.max_width(), 1)
+  if pipeline_args.max_concurrent_jobs > 0:
+    num_threads = min(num_threads, pipeline_args.max_concurrent_jobs)
+  threads = multiprocessing.pool.ThreadPool(processes=num_threads)
+  try:
+    job_scheduler.JobScheduler(graph, threads, fail_fast,
+                               _get_admission_controller(pipeline_args),
+                               pipeline_args.speculation_factor).run()
+  except:
+    threads.terminate()
+    raise
+  threads.close()
+  threads.join()
 
-  # TODO(b/112148076): Fail fast: validate GKE cluster early on in the pipeline.
-  if _MAKE_EXAMPLES_JOB_NAME in pipeline_args.jobs_to_run:
-    logging.info('Running make_examples...')
-    _run_make_examples(pipeline_args)
-    logging.info('make_examples is done!')
-  if _CALL_VARIANTS_JOB_NAME in pipeline_args.jobs_to_run:
-    logging.info('Running call_variants...')
-    _run_call_variants(pipeline_args)
-    logging.info('call_variants is done!')
-  if _POSTPROCESS_VARIANTS_JOB_NAME in pipeline_args.jobs_to_run:
-    logging.info('Running postprocess_variants...')
-    _run_postprocess_variants(pipeline_args)
-    logging.info('postprocess_variants is done!')
+
+def _read_batch_manifest(path):
+  """Returns the batch_manifest.Samples of a local or GCS manifest."""
+  if _is_valid_gcs_path(path):
+    content = gcs_client.download(path).decode('utf-8')
+  else:
+    with open(path) as f:
+      content = f.read()
+  return batch_manifest.parse(content, is_json=path.endswith('.json'))
+
+
+def _get_sample_args(pipeline_args, sample):
+  """Returns the pipeline arguments of a sample of a batch run."""
+  sample_args = copy.copy(pipeline_args)
+  sample_args.batch_manifest = None
+  sample_args.bam = sample.bam
+  sample_args.bai = sample.bai
+  sample_args.outfile = sample.outfile
+  sample_args.gvcf_outfile = sample.gvcf_outfile
+  sample_args.sample_name = sample.sample_name
+  sample_args.staging = os.path.join(pipeline_args.staging, 'samples',
+                                     sample.sample_id)
+  if pipeline_args.logging:
+    sample_args.logging = os.path.join(pipeline_args.logging,
+                                       sample.sample_id)
+  sample_args.jobs_to_run = list(pipeline_args.jobs_to_run)
+  return sample_args
+
+
+def _get_batch_summary(samples, graph, errors):
+  """Returns the status of each sample of a batch run.
+
+  Args:
+    samples: (list) batch_manifest.Sample of the run.
+    graph: (job_scheduler.JobGraph) jobs of the run, prefixed by sample.
+    errors: (dict) errors of the samples that could not be started, by id.
+  """
+  summary = []
+  for sample in samples:
+    jobs = [
+        job for job in graph.get_jobs()
+        if job.name.startswith(sample.sample_id + '/')
+    ]
+    failed_jobs = [
+        job for job in jobs if job.state == job_scheduler.JobState.FAILED
+    ]
+    if sample.sample_id in errors:
+      status, error = 'FAILED', errors[sample.sample_id]
+    elif failed_jobs:
+      status, error = 'FAILED', failed_jobs[0].error
+    elif all(job.state == job_scheduler.JobState.SUCCEEDED for job in jobs):
+      status, error = 'SUCCEEDED', None
+    else:
+      status, error = 'CANCELLED', None
+    sample_summary = sample.to_dict()
+    sample_summary.update({
+        'status': status,
+        'error': str(error) if error else None,
+        'failed_jobs': [job.name for job in failed_jobs],
+    })
+    summary.append(sample_summary)
+  return summary
+
+
+def _run_batch(pipeline_args):
+  """Runs the pipeline on all samples of --batch_manifest.
+
+  The jobs of all samples are run by a single JobGraph, so they share
+  --max_concurrent_jobs and the GCS client. A sample that fails validation or
+  whose jobs fail does not stop the others.
+
+  Raises:
+    ValueError: if flags set by the manifest are given.
+    RuntimeError: if any sample did not succeed.
+  """
+  for flag in ('bam', 'bai', 'outfile', 'gvcf_outfile', 'sample_name', 'plan',
+               'dry_run'):
+    if getattr(pipeline_args, flag):
+      raise ValueError('--%s cannot be used with --batch_manifest.' % flag)
+  samples = _read_batch_manifest(pipeline_args.batch_manifest)
+  logging.info('Running %d samples from %s.', len(samples),
+               pipeline_args.batch_manifest)
+  sample_args = {
+      sample.sample_id: _get_sample_args(pipeline_args, sample)
+      for sample in samples
+  }
+  errors = {}
+
+  def call_for_sample(func, sample):
+    """Returns func(sample args), or None if the sample failed."""
+    if sample.sample_id in errors:
+      return None
+    try:
+      return func(sample_args[sample.sample_id])
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error('Sample %s failed: %s', sample.sample_id, e)
+      errors[sample.sample_id] = e
+      return None
+
+  def map_samples(func):
+    threads = multiprocessing.pool.ThreadPool(
+        min(len(samples), _MAX_SAMPLE_THREADS))
+    try:
+      return threads.map_async(functools.partial(call_for_sample, func),
+                               samples).get()
+    finally:
+      threads.close()
+      threads.join()
+
+  map_samples(_validate_and_complete_args)
+  call_variants_cluster = None
+  if (pipeline_args.tpu and not pipeline_args.gke_cluster_name and
+      _CALL_VARIANTS_JOB_NAME in pipeline_args.jobs_to_run and
+      len(errors) < len(samples)):
+    # All samples share one cluster, leased or created while make_examples
+    # runs.
+    call_variants_cluster = _CallVariantsCluster(
+        pipeline_args, 'deepvariant-' + _NOW_STR + uuid.uuid4().hex[:5])
+  try:
+    graph = job_scheduler.JobGraph()
+    sample_graphs = map_samples(
+        functools.partial(
+            _prepare_job_graph, call_variants_cluster=call_variants_cluster))
+    for sample, sample_graph in zip(samples, sample_graphs):
+      if sample_graph:
+        graph.add_subgraph(sample_graph, sample.sample_id + '/')
+    if call_variants_cluster:
+      call_variants_cluster.start()
+    try:
+      _run_job_graph(graph, pipeline_args, fail_fast=False)
+    finally:
+      summary = _get_batch_summary(samples, graph, errors)
+      summary_path = os.path.join(pipeline_args.staging, 'batch_summary.json')
+      gcs_client.upload(
+          summary_path,
+          json.dumps(summary, indent=2, sort_keys=True),
+          content_type='application/json')
+      for sample_summary in summary:
+        logging.info('Sample %s: %s', sample_summary['sample_id'],
+                     sample_summary['status'])
+  finally:
+    if call_variants_cluster:
+      call_variants_cluster.close()
+  num_failed = sum(
+      sample_summary['status'] != 'SUCCEEDED' for sample_summary in summary)
+  if num_failed:
+    raise RuntimeError('%d of %d samples failed, see %s' %
+                       (num_failed, len(samples), summary_path))
 
 
 if __name__ == '__main__':
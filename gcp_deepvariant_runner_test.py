@@ -42,14 +42,28 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
 import json
-import multiprocessing
+import multiprocessing.pool
 import os
+import shutil
+import stat
+import struct
 import tempfile
+import threading
+import time
 import unittest
 
+import fake_kubernetes_server
 import gcp_deepvariant_runner
+import gcs_client
 import gke_cluster
+import job_scheduler
+import kubernetes_client
+import lease_store
+import metadata_cache
+import shard_queue
+import zone_health
 
 import mock
 from google.cloud import storage
@@ -94,10 +108,96 @@ class AnyStringWith(str):
     return self in other
 
 
+def _all_objects_exist(paths):
+  return dict.fromkeys(paths, True)
+
+
+class _SynchronousPool(object):
+  """Helper class that runs ThreadPool tasks in the calling thread."""
+
+  def __init__(self, *unused_args, **unused_kwargs):
+    pass
+
+  def apply_async(self, func, args=(), callback=None, error_callback=None):
+    try:
+      value = func(*args)
+    except Exception as e:  # pylint: disable=broad-except
+      if error_callback:
+        error_callback(e)
+      return
+    if callback:
+      callback(value)
+
+  def map_async(self, func, iterable):
+    return mock.Mock(get=mock.Mock(return_value=[func(x) for x in iterable]))
+
+  def close(self):
+    pass
+
+  def join(self):
+    pass
+
+  def terminate(self):
+    pass
+
+
+class _FakeCompletionManifest(object):
+  """Helper class that keeps a completion manifest in memory."""
+
+  def __init__(self):
+    self.entries = {}
+
+  def load(self):
+    pass
+
+  def is_complete(self, stage, worker_index, job_key):
+    return self.entries.get((stage, worker_index)) == job_key
+
+  def mark_complete(self, stage, worker_index, job_key):
+    self.entries[(stage, worker_index)] = job_key
+
+
+class _FakeStorageClient(object):
+  """Fake storage client that keeps blobs in a dict keyed by GCS path."""
+
+  def __init__(self, blobs):
+    self.blobs = blobs
+
+  def bucket(self, bucket_name):
+    return mock.Mock(
+        blob=lambda path: _FakeBlob(self.blobs, 'gs://%s/%s' %
+                                    (bucket_name, path)),
+        get_blob=lambda path: mock.Mock(
+            size=len(self.blobs['gs://%s/%s' % (bucket_name, path)])))
+
+
+class _FakeBlob(object):
+
+  def __init__(self, blobs, path):
+    self._blobs = blobs
+    self._path = path
+
+  def download_as_bytes(self):
+    return self._blobs[self._path]
+
+  def upload_from_string(self, content, content_type=None):
+    del content_type  # Unused.
+    self._blobs[self._path] = content
+
+
 class DeepvariantRunnerTest(unittest.TestCase):
 
   def setUp(self):
     super(DeepvariantRunnerTest, self).setUp()
+    self._manifest = _FakeCompletionManifest()
+    manifest_patcher = mock.patch(
+        'completion_manifest.CompletionManifest', return_value=self._manifest)
+    manifest_patcher.start()
+    self.addCleanup(manifest_patcher.stop)
+    failed_shards_patcher = mock.patch(
+        'gcp_deepvariant_runner._get_failed_shards', return_value=[])
+    self._mock_get_failed_shards = failed_shards_patcher.start()
+    self.addCleanup(failed_shards_patcher.stop)
     self._argv = [
         '--project',
         'project',
@@ -122,21 +222,19 @@ class DeepvariantRunnerTest(unittest.TestCase):
     ]
 
   @mock.patch('gcp_deepvariant_runner._run_job')
-  @mock.patch.object(multiprocessing, 'Pool')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
-  def testRunPipeline(self, mock_can_write_to_bucket, mock_obj_exist, mock_pool,
+  def testRunPipeline(self, mock_can_write_to_bucket, mock_obj_exist,
                       mock_run_job):
-    mock_apply_async = mock_pool.return_value.apply_async
-    mock_apply_async.return_value = None
-    mock_obj_exist.return_value = True
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend(
         ['--make_examples_workers', '1', '--call_variants_workers', '1'])
     gcp_deepvariant_runner.run(self._argv)
 
-    mock_apply_async.assert_has_calls([
-        mock.call(mock_run_job, [
+    mock_run_job.assert_has_calls([
+        mock.call(
             _HasAllOf('make_examples', 'gcr.io/dockerimage',
                       'INPUT_BAM=gs://bucket/bam',
                       'INPUT_BAI=gs://bucket/bam.bai',
@@ -145,36 +243,32 @@ class DeepvariantRunnerTest(unittest.TestCase):
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       '--attempts', '2', '--pvm-attempts', '0',
                       '--output-interval', '60s'),
-            'gs://bucket/staging/logs/make_examples/0'
-        ]),
-        mock.call(mock_run_job, [
+            'gs://bucket/staging/logs/make_examples/0'),
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage',
                       'MODEL=gs://bucket/model',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       'CALLED_VARIANTS=gs://bucket/staging/called_variants/*',
                       '--attempts', '2', '--pvm-attempts', '0',
                       '--output-interval', '60s'),
-            'gs://bucket/staging/logs/call_variants/0'
-        ]),
+            'gs://bucket/staging/logs/call_variants/0'),
+        mock.call(
+            _HasAllOf('postprocess_variants', 'gcr.io/dockerimage',
+                      'CALLED_VARIANTS=gs://bucket/staging/called_variants/*',
+                      '--attempts', '2', '--pvm-attempts', '0',
+                      'OUTFILE=gs://bucket/output.vcf', '--output-interval',
+                      '60s'),
+            'gs://bucket/staging/logs/postprocess_variants'),
     ])
-    self.assertEqual(mock_apply_async.call_count, 2)
-
-    mock_run_job.assert_called_once_with(
-        _HasAllOf('postprocess_variants', 'gcr.io/dockerimage',
-                  'CALLED_VARIANTS=gs://bucket/staging/called_variants/*',
-                  '--attempts', '2', '--pvm-attempts', '0',
-                  'OUTFILE=gs://bucket/output.vcf', '--output-interval', '60s'),
-        'gs://bucket/staging/logs/postprocess_variants')
+    self.assertEqual(mock_run_job.call_count, 3)
 
   @mock.patch('gcp_deepvariant_runner._run_job')
-  @mock.patch.object(multiprocessing, 'Pool')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunPipeline_WithGVCFOutFile(self, mock_can_write_to_bucket,
-                                      mock_obj_exist, mock_pool, mock_run_job):
-    mock_apply_async = mock_pool.return_value.apply_async
-    mock_apply_async.return_value = None
-    mock_obj_exist.return_value = True
+                                      mock_obj_exist, mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend([
         '--make_examples_workers',
@@ -188,8 +282,8 @@ class DeepvariantRunnerTest(unittest.TestCase):
     ])
     gcp_deepvariant_runner.run(self._argv)
 
-    mock_apply_async.assert_has_calls([
-        mock.call(mock_run_job, [
+    mock_run_job.assert_has_calls([
+        mock.call(
             _HasAllOf('make_examples', 'gcr.io/dockerimage',
                       'INPUT_BAM=gs://bucket/bam',
                       'INPUT_BAI=gs://bucket/bam.bai',
@@ -198,36 +292,228 @@ class DeepvariantRunnerTest(unittest.TestCase):
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'GVCF=gs://bucket/staging/gvcf/*'),
-            'gs://bucket/staging/logs/make_examples/0'
-        ]),
-        mock.call(mock_run_job, [
+            'gs://bucket/staging/logs/make_examples/0'),
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage',
                       'MODEL=gs://bucket/model',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'CALLED_VARIANTS=gs://bucket/staging/called_variants/*'),
-            'gs://bucket/staging/logs/call_variants/0'
-        ]),
+            'gs://bucket/staging/logs/call_variants/0'),
+        mock.call(
+            _HasAllOf('postprocess_variants', 'gcr.io/dockerimage',
+                      'CALLED_VARIANTS=gs://bucket/staging/called_variants/*',
+                      'OUTFILE=gs://bucket/output.vcf',
+                      'GVCF=gs://bucket/staging/gvcf/*',
+                      '--attempts', '2', '--pvm-attempts', '0',
+                      'GVCF_OUTFILE=gs://bucket/gvcf_output.vcf'),
+            'gs://bucket/staging/logs/postprocess_variants'),
     ])
-    self.assertEqual(mock_apply_async.call_count, 2)
+    self.assertEqual(mock_run_job.call_count, 3)
 
-    mock_run_job.assert_called_once_with(
-        _HasAllOf('postprocess_variants', 'gcr.io/dockerimage',
-                  'CALLED_VARIANTS=gs://bucket/staging/called_variants/*',
-                  'OUTFILE=gs://bucket/output.vcf',
-                  'GVCF=gs://bucket/staging/gvcf/*',
-                  '--attempts', '2', '--pvm-attempts', '0',
-                  'GVCF_OUTFILE=gs://bucket/gvcf_output.vcf'),
-        'gs://bucket/staging/logs/postprocess_variants')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_MakeExamplesFails(self, mock_can_write_to_bucket,
+                                        mock_obj_exist, mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    mock_run_job.side_effect = [None, RuntimeError('failed')]
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '8', '--overlap_stages'
+    ])
+    with self.assertRaisesRegex(RuntimeError, 'make_examples/1'):
+      gcp_deepvariant_runner.run(self._argv)
+
+    # No call_variants or postprocess_variants workers start after the failure.
+    self.assertEqual(mock_run_job.call_count, 4)
+    for call in mock_run_job.call_args_list:
+      self.assertIn('make_examples', call[0][1])
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(
+      multiprocessing.pool, 'ThreadPool', side_effect=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_MaxConcurrentJobs(self, mock_can_write_to_bucket,
+                                        mock_obj_exist, mock_thread_pool,
+                                        mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '8', '--max_concurrent_jobs', '3'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
 
-  @mock.patch.object(multiprocessing, 'Pool')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+    # The last pool is the one of the job scheduler; the first one checks the
+    # inputs.
+    mock_thread_pool.assert_called_with(processes=3)
+    self.assertEqual(mock_run_job.call_count, 7)
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_MaxPreemptionsPerStage(self, mock_can_write_to_bucket,
+                                             mock_obj_exist, mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--preemptible', '--make_examples_max_preemptions', '3',
+        '--call_variants_max_preemptions', '0'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+
+    def get_attempts(call):
+      run_args = call[0][0]
+      return (run_args[run_args.index('--attempts') + 1],
+              run_args[run_args.index('--pvm-attempts') + 1])
+
+    # postprocess_variants follows --preemptible.
+    self.assertEqual(
+        [get_attempts(call) for call in mock_run_job.call_args_list],
+        [('2', '3'), ('2', '0'), ('0', '2')])
+
+  def testValidateArgs_NegativeMaxPreemptions(self):
+    self._argv.extend(['--call_variants_max_preemptions', '-1'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError, 'cannot be negative'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
+  @mock.patch.object(gcs_client, 'set_metadata_cache')
+  @mock.patch('metadata_cache.MetadataCache')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_GcsMetadataCache(self, mock_can_write_to_bucket,
+                                       mock_obj_exist, mock_run_job,
+                                       mock_cache_class,
+                                       mock_set_metadata_cache):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    mock_cache = mock_cache_class.return_value
+    mock_cache.hits = 3
+    mock_cache.misses = 2
+    self._argv.extend([
+        '--jobs_to_run', 'postprocess_variants', '--gcs_metadata_cache',
+        '--gcs_metadata_cache_ttl_sec', '60'
+    ])
+    with self.assertLogs(level='INFO') as logs:
+      gcp_deepvariant_runner.run(self._argv)
+
+    mock_cache_class.assert_called_once_with(ttl_sec=60)
+    self.assertEqual(mock_set_metadata_cache.call_args_list,
+                     [mock.call(mock_cache), mock.call(None)])
+    mock_cache.close.assert_called_once_with()
+    self.assertIn('3 hits, 2 misses', '\n'.join(logs.output))
+    mock_run_job.assert_called_once()
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_Resume(self, mock_can_write_to_bucket, mock_obj_exist,
+                             mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '8', '--overlap_stages'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+    self.assertEqual(
+        sorted(self._manifest.entries),
+        [('call_variants', 0), ('call_variants', 1), ('make_examples', 0),
+         ('make_examples', 1), ('make_examples', 2), ('make_examples', 3),
+         ('postprocess_variants', 0)])
+
+    # Only the incomplete worker and the workers depending on it are rerun.
+    mock_run_job.reset_mock()
+    del self._manifest.entries[('make_examples', 3)]
+    gcp_deepvariant_runner.run(self._argv + ['--resume'])
+    self.assertEqual([call[0][1] for call in mock_run_job.call_args_list], [
+        'gs://bucket/staging/logs/make_examples/3',
+        'gs://bucket/staging/logs/call_variants/1',
+        'gs://bucket/staging/logs/postprocess_variants'
+    ])
+
+    # Nothing is rerun once all workers are complete.
+    mock_run_job.reset_mock()
+    gcp_deepvariant_runner.run(self._argv + ['--resume'])
+    self.assertEqual(mock_run_job.call_count, 0)
+
+    # Changing worker arguments invalidates their manifest entries, but base
+    # job arguments (e.g. zones) do not.
+    gcp_deepvariant_runner.run(self._argv + [
+        '--resume', '--call_variants_batch_size', '128', '--zones', 'zone-c'
+    ])
+    self.assertEqual(mock_run_job.call_count, 3)
+    for call in mock_run_job.call_args_list:
+      self.assertNotIn('make_examples', call[0][1])
+
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testBuildJobGraph(self, mock_can_write_to_bucket, mock_obj_exist):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '8'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    graph = gcp_deepvariant_runner._build_job_graph(pipeline_args)
+
+    make_examples_jobs = [
+        'make_examples/0', 'make_examples/1', 'make_examples/2',
+        'make_examples/3'
+    ]
+    self.assertEqual(len(graph), 7)
+    self.assertEqual(graph.max_width(), 4)
+    self.assertEqual(
+        graph.get_job('call_variants/0').dependencies, make_examples_jobs)
+    self.assertEqual(
+        graph.get_job('call_variants/1').dependencies, make_examples_jobs)
+    self.assertEqual(
+        graph.get_job('postprocess_variants').dependencies,
+        make_examples_jobs + ['call_variants/0', 'call_variants/1'])
+
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testBuildJobGraph_OverlapStages(self, mock_can_write_to_bucket,
+                                      mock_obj_exist):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '8', '--overlap_stages', '--jobs_to_run', 'make_examples',
+        'call_variants'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    graph = gcp_deepvariant_runner._build_job_graph(pipeline_args)
+
+    # call_variants worker k only waits for the make_examples workers writing
+    # into examples folder k.
+    self.assertEqual(len(graph), 6)
+    self.assertEqual(
+        graph.get_job('call_variants/0').dependencies,
+        ['make_examples/0', 'make_examples/1'])
+    self.assertEqual(
+        graph.get_job('call_variants/1').dependencies,
+        ['make_examples/2', 'make_examples/3'])
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunMakeExamples(self, mock_can_write_to_bucket, mock_obj_exist,
-                          mock_pool):
-    mock_apply_async = mock_pool.return_value.apply_async
-    mock_apply_async.return_value = None
-    mock_obj_exist.return_value = True
+                          mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend([
         '--jobs_to_run',
@@ -257,8 +543,8 @@ class DeepvariantRunnerTest(unittest.TestCase):
     new_json_files.sort()
     self.assertEqual(len(new_json_files), 3)  # One json file per worker
     # Verifying Pipeline's API commands
-    mock_apply_async.assert_has_calls([
-        mock.call(mock.ANY, [
+    mock_run_job.assert_has_calls([
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       'INPUT_BAM=gs://bucket/bam', 'INPUT_REF=gs://bucket/ref',
@@ -267,9 +553,8 @@ class DeepvariantRunnerTest(unittest.TestCase):
                       'INPUT_REGIONS_1=gs://bucket/region-2.bed',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[0]),
-            'gs://bucket/staging/logs/make_examples/0'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/make_examples/0'),
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       'INPUT_BAM=gs://bucket/bam', 'INPUT_REF=gs://bucket/ref',
@@ -278,9 +563,8 @@ class DeepvariantRunnerTest(unittest.TestCase):
                       'INPUT_REGIONS_1=gs://bucket/region-2.bed',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[1]),
-            'gs://bucket/staging/logs/make_examples/1'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/make_examples/1'),
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       'INPUT_BAM=gs://bucket/bam', 'INPUT_REF=gs://bucket/ref',
@@ -289,13 +573,14 @@ class DeepvariantRunnerTest(unittest.TestCase):
                       'INPUT_REGIONS_1=gs://bucket/region-2.bed',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[2]),
-            'gs://bucket/staging/logs/make_examples/2'
-        ]),
+            'gs://bucket/staging/logs/make_examples/2'),
     ])
-    self.assertEqual(mock_apply_async.call_count, 3)
+    self.assertEqual(mock_run_job.call_count, 3)
     # Verify json files contain correct actions_list.
     command_template = gcp_deepvariant_runner._MAKE_EXAMPLES_COMMAND.format(
-        NUM_SHARDS='15', EXTRA_ARGS=
+        NUM_SHARDS='15', SHARD_TRIES='2',
+        EXAMPLES_OUTPUT='examples_output.tfrecord@15.gz',
+        SHARDING_ARGS='--task {TASK_INDEX}', EXTRA_ARGS=
         '--regions \\\'chr1:10,000-10,010 chr2:10000-10010 '
         'chr3:1,000,000-2,000,000 "$INPUT_REGIONS_0" "$INPUT_REGIONS_1"\\\'')
 
@@ -305,8 +590,9 @@ class DeepvariantRunnerTest(unittest.TestCase):
         recieved_actions_list = json.load(json_file)
 
       expected_command = command_template.format(
-          SHARD_START_INDEX=worker_index * shards_per_worker,
-          SHARD_END_INDEX=(worker_index + 1) * shards_per_worker - 1,
+          SHARD_INDICES=' '.join(
+              str(k) for k in range(worker_index * shards_per_worker,
+                                    (worker_index + 1) * shards_per_worker)),
           TASK_INDEX='{}', INPUT_BAM='$INPUT_BAM')
       expected_actions_list = [
           {'commands':
@@ -319,14 +605,742 @@ class DeepvariantRunnerTest(unittest.TestCase):
         self.assertEqual(sorted(expected_actions_list[i].items()),
                          sorted(recieved_actions_list[i].items()))
 
-  @mock.patch.object(multiprocessing, 'Pool')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunMakeExamples_FollowupJob(self, mock_can_write_to_bucket,
+                                      mock_obj_exist, mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    # Shards 2 and 3 fail in the worker, and succeed in the follow-up job.
+    self._mock_get_failed_shards.side_effect = [[2, 3], []]
+    self._argv.extend([
+        '--jobs_to_run', 'make_examples', '--make_examples_workers', '1',
+        '--shards', '4', '--make_examples_shard_retries', '2'
+    ])
+    temp_dir = tempfile.gettempdir()
+    before_temp_files = os.listdir(temp_dir)
+    gcp_deepvariant_runner.run(self._argv)
+    new_json_files = sorted(
+        os.path.join(temp_dir, item)
+        for item in os.listdir(temp_dir)
+        if item not in before_temp_files)
+
+    mock_run_job.assert_has_calls([
+        mock.call(
+            _HasAllOf('make_examples',
+                      'EXAMPLES=gs://bucket/staging/examples/0/*',
+                      'FAILED_SHARDS=gs://bucket/staging/failed_shards/0/*'),
+            'gs://bucket/staging/logs/make_examples/0'),
+        mock.call(
+            _HasAllOf(
+                'make_examples', 'EXAMPLES=gs://bucket/staging/examples/0/*',
+                'FAILED_SHARDS=gs://bucket/staging/failed_shards/0-followup-1/*'
+            ), 'gs://bucket/staging/logs/make_examples/0-followup-1'),
+    ])
+    self.assertEqual(mock_run_job.call_count, 2)
+    self.assertEqual(len(new_json_files), 2)
+    for path, shard_indices in zip(new_json_files, ['0 1 2 3', '2 3']):
+      with open(path) as json_file:
+        command = json.load(json_file)[-1]['commands'][1]
+      self.assertIn("printf '%%s\\n' %s | parallel --retries 3" % shard_indices,
+                    command)
+      self.assertIn('for shard in %s; do' % shard_indices, command)
+
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist',
+              side_effect=_all_objects_exist)
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket', return_value=True)
+  def testGetMakeExamplesJob_ShardTries(self, unused_mock_can_write,
+                                        unused_mock_obj_exist):
+    # parallel --retries counts the first try, so it is shard retries + 1.
+    for shard_retries, tries in (('0', 1), ('1', 2), ('3', 4)):
+      pipeline_args = gcp_deepvariant_runner._parse_args(
+          self._argv + ['--make_examples_shard_retries', shard_retries])
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+      run_args, _ = gcp_deepvariant_runner._get_make_examples_job(
+          pipeline_args, '0', [0, 1])
+      self.addCleanup(os.remove, run_args[-1])
+      with open(run_args[-1]) as json_file:
+        command = json.load(json_file)[-1]['commands'][1]
+      self.assertIn("printf '%%s\\n' 0 1 | parallel --retries %d \\\n" %
+                    tries, command)
+
+  @mock.patch.object(job_scheduler, 'get_attempt_index', return_value=1)
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist',
+              side_effect=_all_objects_exist)
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket', return_value=True)
+  def testRunMakeExamples_SpeculativeAttempt(self, unused_mock_can_write,
+                                             unused_mock_obj_exist,
+                                             mock_run_job,
+                                             unused_mock_get_attempt_index):
+    self._mock_get_failed_shards.side_effect = [[3], []]
+    self._argv.extend(['--shards', '4', '--make_examples_followup_jobs', '1'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    job = gcp_deepvariant_runner._get_make_examples_job(
+        pipeline_args, '0', [0, 1, 2, 3])
+    gcp_deepvariant_runner._run_make_examples_task(pipeline_args, '0', *job)
+
+    mock_run_job.assert_has_calls([
+        mock.call(
+            _HasAllOf(
+                'EXAMPLES=gs://bucket/staging/examples/0/*',
+                'FAILED_SHARDS=gs://bucket/staging/failed_shards/0-attempt-1/*',
+                'gs://bucket/staging/logs/make_examples/0-attempt-1'),
+            'gs://bucket/staging/logs/make_examples/0-attempt-1'),
+        mock.call(
+            _HasAllOf('FAILED_SHARDS=gs://bucket/staging/failed_shards/'
+                      '0-attempt-1-followup-1/*'),
+            'gs://bucket/staging/logs/make_examples/0-attempt-1-followup-1'),
+    ])
+    self.assertEqual(
+        [call[0][1] for call in self._mock_get_failed_shards.call_args_list],
+        ['0-attempt-1', '0-attempt-1-followup-1'])
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testBuildJobGraph_SpeculativeJobs(self, mock_can_write_to_bucket,
+                                        mock_obj_exist, unused_mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend(['--make_examples_workers', '2'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    graph = gcp_deepvariant_runner._build_job_graph(pipeline_args)
+
+    self.assertEqual([(job.name, job.speculative) for job in graph.get_jobs()],
+                     [('make_examples/0', True), ('make_examples/1', True),
+                      ('call_variants/0', True),
+                      ('postprocess_variants', False)])
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunMakeExamples_ShardsFailAfterFollowupJobs(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._mock_get_failed_shards.return_value = [1]
+    self._argv.extend([
+        '--make_examples_workers', '1', '--shards', '4',
+        '--make_examples_followup_jobs', '2'
+    ])
+    with self.assertRaisesRegex(RuntimeError,
+                                r'task 0 failed on shards \[1\]'):
+      gcp_deepvariant_runner.run(self._argv)
+
+    # The worker and two follow-up jobs, but no call_variants.
+    self.assertEqual([call[0][1] for call in mock_run_job.call_args_list], [
+        'gs://bucket/staging/logs/make_examples/0',
+        'gs://bucket/staging/logs/make_examples/0-followup-1',
+        'gs://bucket/staging/logs/make_examples/0-followup-2'
+    ])
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._get_shard_queue')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_ShardQueue(self, mock_can_write_to_bucket,
+                                 mock_obj_exist, mock_get_shard_queue,
+                                 mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    queue_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, queue_dir)
+    mock_get_shard_queue.side_effect = lambda pipeline_args: (
+        shard_queue.ShardQueue(
+            lease_store.LocalLeaseStore(queue_dir), pipeline_args.shards,
+            pipeline_args.shard_queue_batch_size))
+    # --shards does not need to be divisible by --make_examples_workers.
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '6', '--make_examples_shard_queue', '--overlap_stages'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+
+    make_examples_calls = [
+        call for call in mock_run_job.call_args_list
+        if 'make_examples' in call[0][1]
+    ]
+    self.assertEqual([call[0][1] for call in make_examples_calls], [
+        'gs://bucket/staging/logs/make_examples/task-%d' % k for k in range(6)
+    ])
+    for k, call in enumerate(make_examples_calls):
+      self.assertEqual(
+          call,
+          mock.call(
+              _HasAllOf(
+                  'EXAMPLES=gs://bucket/staging/examples/%d/*' % (k // 3),
+                  'FAILED_SHARDS=gs://bucket/staging/failed_shards/task-%d/*' %
+                  k), mock.ANY))
+    self.assertEqual(mock_run_job.call_count, 9)
+
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testBuildJobGraph_ShardQueue(self, mock_can_write_to_bucket,
+                                   mock_obj_exist):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--make_examples_workers', '4', '--call_variants_workers', '2',
+        '--shards', '4', '--make_examples_shard_queue',
+        '--shard_queue_batch_size', '2', '--overlap_stages'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    queue_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, queue_dir)
+    queue = shard_queue.ShardQueue(lease_store.LocalLeaseStore(queue_dir), 4, 2)
+    graph = gcp_deepvariant_runner._build_job_graph(
+        pipeline_args, queue=queue)
+
+    # There are only 2 tasks, and queue workers may write to any folder.
+    self.assertEqual(
+        graph.get_job('call_variants/1').dependencies,
+        ['make_examples/0', 'make_examples/1'])
+
+  @mock.patch.object(gcp_deepvariant_runner, '_SHARD_QUEUE_POLL_SEC', 0.05)
+  @mock.patch('gcp_deepvariant_runner._run_make_examples_task')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist',
+              side_effect=_all_objects_exist)
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket', return_value=True)
+  def testRunMakeExamplesQueueWorker_StaleForeignLease(
+      self, unused_mock_can_write, unused_mock_obj_exist, mock_run_task):
+    self._argv.extend([
+        '--shards', '2', '--make_examples_shard_queue',
+        '--shard_queue_batch_size', '1'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    queue_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, queue_dir)
+    store = lease_store.LocalLeaseStore(queue_dir)
+    queue = shard_queue.ShardQueue(store, 2, 1, lease_sec=0.3)
+    # A crashed run still holds the lease of task 1.
+    self.assertTrue(store.try_acquire('task-1', 'crashed-worker', 0.3))
+
+    gcp_deepvariant_runner._run_make_examples_queue_worker(
+        pipeline_args, queue, 0)
+
+    # The worker waits for the stale lease to expire instead of returning.
+    self.assertEqual([call[0][1] for call in mock_run_task.call_args_list],
+                     ['task-0', 'task-1'])
+    self.assertTrue(queue.is_done())
+
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist',
+              side_effect=_all_objects_exist)
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket', return_value=True)
+  def testValidateArgs_ShardQueueDefaultBatchSize(self, unused_mock_can_write,
+                                                  unused_mock_obj_exist):
+    self._argv.extend([
+        '--call_variants_workers', '2', '--shards', '12',
+        '--make_examples_workers', '3', '--make_examples_shard_queue'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    # At most 12 / 3 shards per task, dividing the 6 shards of each folder.
+    self.assertEqual(pipeline_args.shard_queue_batch_size, 3)
+
+  def testValidateArgs_ShardQueueClampedCallVariantsWorkers(self):
+    # call_variants_workers is clamped to 4, which does not divide 6.
+    self._argv.extend([
+        '--call_variants_workers', '6', '--shards', '6',
+        '--make_examples_workers', '4', '--make_examples_shard_queue'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError,
+                                'divisible by --call_variants_workers'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
+  def testValidateArgs_ShardQueueBatchSize(self):
+    self._argv.extend([
+        '--call_variants_workers', '2', '--shards', '8',
+        '--make_examples_workers', '3', '--make_examples_shard_queue',
+        '--shard_queue_batch_size', '3'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError, 'divisible by --shard_queue'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
+  @mock.patch('gcp_deepvariant_runner._write_shard_regions')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunMakeExamples_CoverageBalancedRegions(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_run_job,
+      mock_write_shard_regions):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--jobs_to_run', 'make_examples', '--make_examples_workers', '1',
+        '--shards', '2', '--gvcf_outfile', 'gs://bucket/gvcf',
+        '--coverage_balanced_regions'
+    ])
+    temp_dir = tempfile.gettempdir()
+    before_temp_files = os.listdir(temp_dir)
+    gcp_deepvariant_runner.run(self._argv)
+    new_json_files = [
+        os.path.join(temp_dir, item)
+        for item in os.listdir(temp_dir)
+        if item not in before_temp_files
+    ]
+
+    self.assertEqual(mock_write_shard_regions.call_count, 1)
+    mock_run_job.assert_called_once_with(
+        _HasAllOf('SHARD_REGIONS=gs://bucket/staging/shard_regions/*',
+                  'EXAMPLES=gs://bucket/staging/examples/0/*'),
+        'gs://bucket/staging/logs/make_examples/0')
+    with open(new_json_files[0]) as json_file:
+      command = json.load(json_file)[0]['commands'][1]
+    # Each shard runs unsharded on its own regions.
+    self.assertNotIn('--task', command)
+    self.assertIn('--regions "$SHARD_REGIONS"/{}.bed', command)
+    shard_suffix = '-\'$(printf %05d {})\'-of-00002.gz'
+    self.assertIn('"$EXAMPLES"/examples_output.tfrecord' + shard_suffix,
+                  command)
+    self.assertIn('"$GVCF"/gvcf_output.tfrecord' + shard_suffix, command)
+
+  @mock.patch.object(gcs_client, 'get_client')
+  def testWriteShardRegions(self, mock_client):
+    window_size = 1 << 14
+    # chr1 spans 3 windows, where the first one holds most reads.
+    bai = b'BAI\x01' + struct.pack('<i', 1)
+    bai += struct.pack('<iIi4Q', 1, 37450, 2, 100 << 16, 400 << 16, 0, 0)
+    bai += struct.pack('<i3Q', 3, 100 << 16, 300 << 16, 350 << 16)
+    blobs = {
+        'gs://bucket/bam.bai': bai,
+        'gs://bucket/ref.fai': b'chr1\t%d\t6\t60\t61\n' % (3 * window_size),
+    }
+    mock_client.return_value = _FakeStorageClient(blobs)
+    self._argv.extend(['--shards', '2', '--coverage_balanced_regions'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    pipeline_args.bai = 'gs://bucket/bam.bai'
+    pipeline_args.ref_fai = 'gs://bucket/ref.fai'
+    gcp_deepvariant_runner._write_shard_regions(pipeline_args)
+
+    self.assertEqual(blobs['gs://bucket/staging/shard_regions/0.bed'],
+                     'chr1\t0\t%d\n' % window_size)
+    self.assertEqual(blobs['gs://bucket/staging/shard_regions/1.bed'],
+                     'chr1\t%d\t%d\n' % (window_size, 3 * window_size))
+
+  @mock.patch.object(gcs_client, 'get_client')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPlan(self, mock_can_write_to_bucket, mock_obj_exist,
+                  mock_run_job, mock_client):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    mock_client.return_value = _FakeStorageClient({
+        'gs://bucket/bam': b'x' * 1000,
+        'gs://bucket/ref.fai': b'chr1\t1000\t6\t60\t61\n',
+    })
+    self._argv.extend([
+        '--plan', '--plan_target_hours', '10', '--plan_max_workers', '4',
+        '--regions', 'chr1:1-500'
+    ])
+    with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+      gcp_deepvariant_runner.run(self._argv)
+
+    mock_run_job.assert_not_called()
+    plan = json.loads(stdout.getvalue())
+    self.assertLessEqual(plan['hours'], 10)
+    flags = gcp_deepvariant_runner._parse_args(self._argv + plan['flags'])
+    gcp_deepvariant_runner._validate_and_complete_args(flags)
+    self.assertEqual(flags.shards,
+                     flags.make_examples_workers *
+                     flags.make_examples_cores_per_worker)
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  def testRunDryRun(self, mock_obj_exist, mock_run_job):
+    dry_run_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, dry_run_dir)
+    self._argv.extend([
+        '--dry_run', dry_run_dir, '--make_examples_workers', '2', '--shards',
+        '4', '--call_variants_workers', '2'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+
+    mock_obj_exist.assert_not_called()
+    mock_run_job.assert_not_called()
+    self.assertEqual(
+        sorted(os.listdir(os.path.join(dry_run_dir, 'make_examples'))), [
+            '0.actions.json', '0.argv.json', '1.actions.json', '1.argv.json'
+        ])
+    with open(os.path.join(dry_run_dir, 'make_examples',
+                           '1.argv.json')) as f:
+      argv = json.load(f)
+    self.assertEqual(argv[-1],
+                     os.path.join(dry_run_dir, 'make_examples',
+                                  '1.actions.json'))
+    self.assertIn('EXAMPLES=gs://bucket/staging/examples/1/*',
+                  argv[argv.index('--outputs') + 1])
+    self.assertEqual(
+        sorted(os.listdir(os.path.join(dry_run_dir, 'call_variants'))),
+        ['0.argv.json', '1.argv.json'])
+    self.assertEqual(
+        os.listdir(os.path.join(dry_run_dir, 'postprocess_variants')),
+        ['0.argv.json'])
+    with open(os.path.join(dry_run_dir, 'timings.json')) as f:
+      timings = json.load(f)
+    self.assertEqual(
+        [(stage, timing['jobs']) for stage, timing in
+         sorted(timings['stages'].items())],
+        [('call_variants', 2), ('make_examples', 2),
+         ('postprocess_variants', 1)])
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(gke_cluster, 'GkeCluster')
+  def testRunDryRun_TPU(self, mock_gke_cluster, mock_run_job):
+    dry_run_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, dry_run_dir)
+    self._argv.extend([
+        '--dry_run', dry_run_dir, '--jobs_to_run', 'call_variants', '--tpu',
+        '--gke_cluster_name', 'foo-cluster', '--gke_cluster_zone',
+        'us-central1-c'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+
+    mock_gke_cluster.assert_not_called()
+    mock_run_job.assert_not_called()
+    with open(os.path.join(dry_run_dir, 'call_variants', 'pod.json')) as f:
+      pod = json.load(f)
+    self.assertEqual(pod['metadata']['name'], 'deepvariant-dry-run')
+    self.assertEqual(
+        sorted(os.listdir(dry_run_dir)), ['call_variants', 'timings.json'])
+
+  def testValidateArgs_PlanWithoutTarget(self):
+    self._argv.extend(['--plan'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError, '--plan requires'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testValidateArgs_BaiWithoutBamSuffix(self, mock_can_write_to_bucket,
+                                           mock_obj_exist):
+    mock_obj_exist.side_effect = lambda paths: {
+        path: path != 'gs://bucket/x.bam.bai' for path in paths
+    }
+    mock_can_write_to_bucket.return_value = True
+    self._argv[self._argv.index('--bam') + 1] = 'gs://bucket/x.bam'
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    self.assertEqual(pipeline_args.bai, 'gs://bucket/x.bai')
+    # Both .bai candidates are checked along with the other inputs.
+    self.assertIn('gs://bucket/x.bam.bai', mock_obj_exist.call_args[0][0])
+    self.assertIn('gs://bucket/x.bai', mock_obj_exist.call_args[0][0])
+
+  @mock.patch('process_util.run_command')
+  @mock.patch.object(gcs_client, 'list_blobs')
+  @mock.patch.object(gcs_client, 'get_metadata')
+  def testGetStageKeys(self, mock_get_metadata, mock_list_blobs,
+                       mock_run_command):
+    generations = {'gs://bucket/bam': 1, 'gs://bucket/model/model.ckpt': 1}
+    mock_get_metadata.side_effect = lambda paths, use_cache: {
+        path: metadata_cache.ObjectMetadata(10, generations.get(path, 1))
+        for path in paths
+    }
+
+    def list_blobs(unused_prefix):
+      blob = mock.Mock(generation=generations['gs://bucket/model/model.ckpt'])
+      blob.name = 'model/model.ckpt'
+      return [blob]
+
+    mock_list_blobs.side_effect = list_blobs
+    mock_run_command.return_value = 'sha256:abc\n'
+
+    def get_stage_keys(*extra_argv):
+      pipeline_args = gcp_deepvariant_runner._parse_args(
+          self._argv + ['--content_addressed_staging'] + list(extra_argv))
+      pipeline_args.bai = 'gs://bucket/bam.bai'
+      pipeline_args.ref_fai = 'gs://bucket/ref.fai'
+      return gcp_deepvariant_runner._get_stage_keys(pipeline_args)
+
+    keys = get_stage_keys()
+    self.assertEqual(sorted(keys), ['call_variants', 'make_examples'])
+    mock_list_blobs.assert_called_with('gs://bucket/model/')
+    self.assertEqual(
+        get_stage_keys('--outfile', 'gs://bucket/other.vcf',
+                       '--postprocess_variants_cores', '2'), keys)
+    self.assertNotEqual(
+        get_stage_keys('--sample_name', 'sample')['make_examples'],
+        keys['make_examples'])
+    generations['gs://bucket/model/model.ckpt'] = 2
+    model_keys = get_stage_keys()
+    self.assertEqual(model_keys['make_examples'], keys['make_examples'])
+    self.assertNotEqual(model_keys['call_variants'], keys['call_variants'])
+    generations['gs://bucket/bam'] = 2
+    bam_keys = get_stage_keys()
+    self.assertNotEqual(bam_keys['make_examples'], keys['make_examples'])
+    self.assertNotEqual(bam_keys['call_variants'], model_keys['call_variants'])
+
+  @mock.patch('process_util.run_command')
+  def testGetDockerImageDigest(self, mock_run_command):
+    self.assertEqual(
+        gcp_deepvariant_runner._get_docker_image_digest(
+            'gcr.io/image@sha256:abc'), 'sha256:abc')
+    mock_run_command.assert_not_called()
+    mock_run_command.side_effect = RuntimeError('not found')
+    with self.assertRaisesRegex(ValueError, 'Cannot resolve the digest'):
+      gcp_deepvariant_runner._get_docker_image_digest('gcr.io/image:latest')
+
+  @mock.patch.object(gcs_client, 'objects_exist')
+  @mock.patch('gcp_deepvariant_runner._get_stage_keys')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_ContentAddressedStagingReusesStages(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_run_job,
+      mock_get_stage_keys, mock_objects_exist):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    mock_get_stage_keys.return_value = {
+        'make_examples': 'mekey',
+        'call_variants': 'cvkey'
+    }
+    mock_objects_exist.side_effect = lambda paths: {
+        path: True for path in paths
+    }
+    self._argv.extend([
+        '--content_addressed_staging', '--gvcf_outfile', 'gs://bucket/gvcf'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+
+    mock_objects_exist.assert_called_once_with([
+        'gs://bucket/staging/stages/make_examples/mekey/COMPLETE',
+        'gs://bucket/staging/stages/call_variants/cvkey/COMPLETE'
+    ])
+    mock_run_job.assert_called_once_with(
+        _HasAllOf(
+            'postprocess_variants', 'CALLED_VARIANTS=gs://bucket/staging/'
+            'stages/call_variants/cvkey/called_variants/*',
+            'GVCF=gs://bucket/staging/stages/make_examples/mekey/gvcf/*'),
+        'gs://bucket/staging/logs/postprocess_variants')
+
+  @mock.patch.object(gcs_client, 'upload')
+  @mock.patch.object(gcs_client, 'objects_exist')
+  @mock.patch('gcp_deepvariant_runner._get_stage_keys')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunPipeline_ContentAddressedStagingMarksStagesComplete(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_run_job,
+      mock_get_stage_keys, mock_objects_exist, mock_upload):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    mock_get_stage_keys.return_value = {
+        'make_examples': 'mekey',
+        'call_variants': 'cvkey'
+    }
+    mock_objects_exist.side_effect = lambda paths: {
+        path: False for path in paths
+    }
+    self._argv.extend([
+        '--content_addressed_staging', '--make_examples_workers', '1',
+        '--call_variants_workers', '1', '--shards', '2'
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+
+    self.assertEqual(mock_run_job.call_count, 3)
+    mock_run_job.assert_any_call(
+        _HasAllOf('make_examples',
+                  'EXAMPLES=gs://bucket/staging/stages/make_examples/mekey/'
+                  'examples/0/*'), 'gs://bucket/staging/logs/make_examples/0')
+    self.assertEqual(
+        [call[0][0] for call in mock_upload.call_args_list], [
+            'gs://bucket/staging/stages/make_examples/mekey/COMPLETE',
+            'gs://bucket/staging/stages/call_variants/cvkey/COMPLETE'
+        ])
+
+  def testValidateArgs_ContentAddressedStagingWithDryRun(self):
+    self._argv.extend(['--content_addressed_staging', '--dry_run', '/tmp'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError, 'cannot be used with --dry_run'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testBuildJobGraph_Resources(self, mock_can_write_to_bucket,
+                                  mock_obj_exist):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--make_examples_workers', '2', '--make_examples_cores_per_worker',
+        '4', '--make_examples_ram_per_worker_gb', '16', '--gpu',
+        '--docker_image_gpu', 'gcr.io/dockerimage_gpu'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+    graph = gcp_deepvariant_runner._build_job_graph(pipeline_args)
+
+    self.assertEqual(
+        graph.get_job('make_examples/1').resources, {
+            'instances': 1,
+            'cpus': 4,
+            'memory_gb': 16,
+            'gpus': 0
+        })
+    self.assertEqual(graph.get_job('call_variants/0').resources['gpus'], 1)
+
+  def testGetAdmissionController(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    quota_file = os.path.join(temp_dir, 'quota.json')
+    with open(quota_file, 'w') as f:
+      json.dump({'cpus': 100, 'gpus': 4}, f)
+    pipeline_args = gcp_deepvariant_runner._parse_args(
+        self._argv + ['--quota_file', quota_file, '--quota_gpus', '2'])
+    controller = gcp_deepvariant_runner._get_admission_controller(
+        pipeline_args)
+    self.assertEqual(controller.limits, {'cpus': 100, 'gpus': 2})
+
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    self.assertIsNone(
+        gcp_deepvariant_runner._get_admission_controller(pipeline_args))
+
+  def _write_batch_manifest(self, rows):
+    """Writes a TSV batch manifest and returns the run's argv."""
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    path = os.path.join(temp_dir, 'samples.tsv')
+    with open(path, 'w') as f:
+      f.write('bam\toutfile\n')
+      for row in rows:
+        f.write('\t'.join(row) + '\n')
+    argv = list(self._argv)
+    for flag in ('--bam', '--outfile'):
+      index = argv.index(flag)
+      del argv[index:index + 2]
+    return argv + ['--batch_manifest', path]
+
+  @mock.patch.object(gcs_client, 'upload')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunBatch(self, mock_can_write_to_bucket, mock_obj_exist,
+                   mock_run_job, mock_upload):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    argv = self._write_batch_manifest([
+        ('gs://bucket/s1.bam', 'gs://bucket/s1.vcf'),
+        ('gs://bucket/s2.bam', 'gs://bucket/s2.vcf'),
+    ])
+    gcp_deepvariant_runner.run(argv)
+
+    self.assertEqual(mock_run_job.call_count, 6)
+    self.assertEqual(
+        sorted(call[0][1] for call in mock_run_job.call_args_list), [
+            'gs://bucket/staging/samples/s1/logs/call_variants/0',
+            'gs://bucket/staging/samples/s1/logs/make_examples/0',
+            'gs://bucket/staging/samples/s1/logs/postprocess_variants',
+            'gs://bucket/staging/samples/s2/logs/call_variants/0',
+            'gs://bucket/staging/samples/s2/logs/make_examples/0',
+            'gs://bucket/staging/samples/s2/logs/postprocess_variants',
+        ])
+    mock_run_job.assert_any_call(
+        _HasAllOf('INPUT_BAM=gs://bucket/s2.bam',
+                  'EXAMPLES=gs://bucket/staging/samples/s2/examples/0/*'),
+        mock.ANY)
+    mock_run_job.assert_any_call(
+        _HasAllOf('OUTFILE=gs://bucket/s1.vcf'), mock.ANY)
+    summary_path, summary = mock_upload.call_args[0][:2]
+    self.assertEqual(summary_path, 'gs://bucket/staging/batch_summary.json')
+    self.assertEqual(
+        [(sample['sample_id'], sample['status'])
+         for sample in json.loads(summary)],
+        [('s1', 'SUCCEEDED'), ('s2', 'SUCCEEDED')])
+
+  @mock.patch.object(gcs_client, 'upload')
+  @mock.patch.object(gke_cluster.GkeCluster, '__init__', return_value=None)
+  @mock.patch.object(gke_cluster.GkeCluster, 'deploy_pod')
+  @mock.patch.object(gke_cluster.GkeCluster, 'delete_cluster')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunBatch_TPUClusterCreatedDuringMakeExamples(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_delete_cluster,
+      mock_deploy_pod, mock_init, unused_mock_upload):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    make_examples_started = threading.Event()
+    created_during_make_examples = []
+    mock_init.side_effect = lambda *args, **kwargs: (
+        created_during_make_examples.append(make_examples_started.wait(10)))
+    argv = self._write_batch_manifest([
+        ('gs://bucket/s1.bam', 'gs://bucket/s1.vcf'),
+        ('gs://bucket/s2.bam', 'gs://bucket/s2.vcf'),
+    ]) + [
+        '--jobs_to_run', 'make_examples', 'call_variants', '--tpu',
+        '--gke_cluster_zone', 'us-central1-c', '--docker_image',
+        'gcr.io/dockerimage'
+    ]
+    with mock.patch('gcp_deepvariant_runner._run_job') as mock_run_job:
+      mock_run_job.side_effect = lambda *args: make_examples_started.set()
+      gcp_deepvariant_runner.run(argv)
+
+    # Both samples' pods run on one cluster, created once make_examples runs.
+    self.assertEqual(created_during_make_examples, [True])
+    self.assertEqual(mock_deploy_pod.call_count, 2)
+    mock_delete_cluster.assert_called_once_with(wait=False)
+
+  @mock.patch.object(gcs_client, 'upload')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunBatch_SampleFails(self, mock_can_write_to_bucket, mock_obj_exist,
+                               mock_run_job, mock_upload):
+    mock_obj_exist.side_effect = lambda paths: {
+        path: 'missing' not in path for path in paths
+    }
+    mock_can_write_to_bucket.return_value = True
+    argv = self._write_batch_manifest([
+        ('gs://bucket/missing.bam', 'gs://bucket/s1.vcf'),
+        ('gs://bucket/s2.bam', 'gs://bucket/s2.vcf'),
+    ])
+    with self.assertRaisesRegex(RuntimeError, '1 of 2 samples failed'):
+      gcp_deepvariant_runner.run(argv)
+
+    # The other sample still runs.
+    self.assertEqual(mock_run_job.call_count, 3)
+    summary = json.loads(mock_upload.call_args[0][1])
+    self.assertEqual([sample['status'] for sample in summary],
+                     ['FAILED', 'SUCCEEDED'])
+    self.assertIn('BAM file via --bam does not exist', summary[0]['error'])
+
+  def testRunBatch_ConflictingFlags(self):
+    argv = self._write_batch_manifest([('gs://bucket/s1.bam',
+                                        'gs://bucket/s1.vcf')])
+    with self.assertRaisesRegex(ValueError,
+                                '--outfile cannot be used with --batch'):
+      gcp_deepvariant_runner.run(argv + ['--outfile', 'gs://bucket/out.vcf'])
+
+  def testValidateArgs_CoverageBalancedRegionsWithRegions(self):
+    self._argv.extend(
+        ['--coverage_balanced_regions', '--regions', 'chr1:1-100'])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError, 'cannot be used with --regions'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunMakeExamples_WithGcsfuse(self, mock_can_write_to_bucket,
-                                      mock_obj_exist, mock_pool):
-    mock_apply_async = mock_pool.return_value.apply_async
-    mock_apply_async.return_value = None
-    mock_obj_exist.return_value = True
+                                      mock_obj_exist, mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend([
         '--jobs_to_run',
@@ -353,48 +1367,46 @@ class DeepvariantRunnerTest(unittest.TestCase):
     new_json_files.sort()
     self.assertEqual(len(new_json_files), 4)  # One json file per worker
     # Verifying Pipeline's API commands
-    mock_apply_async.assert_has_calls([
-        mock.call(mock.ANY, [
+    mock_run_job.assert_has_calls([
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       'INPUT_REF=gs://bucket/ref',
                       'INPUT_BAI=gs://bucket/bam.bai',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[0]),
-            'gs://bucket/staging/logs/make_examples/0'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/make_examples/0'),
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/0/*',
                       'INPUT_REF=gs://bucket/ref',
                       'INPUT_BAI=gs://bucket/bam.bai',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[1]),
-            'gs://bucket/staging/logs/make_examples/1'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/make_examples/1'),
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/1/*',
                       'INPUT_REF=gs://bucket/ref',
                       'INPUT_BAI=gs://bucket/bam.bai',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[2]),
-            'gs://bucket/staging/logs/make_examples/2'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/make_examples/2'),
+        mock.call(
             _HasAllOf('prefix_make_examples', 'gcr.io/dockerimage',
                       'EXAMPLES=gs://bucket/staging/examples/1/*',
                       'INPUT_REF=gs://bucket/ref',
                       'INPUT_BAI=gs://bucket/bam.bai',
                       '--attempts', '2', '--pvm-attempts', '0',
                       new_json_files[3]),
-            'gs://bucket/staging/logs/make_examples/3'
-        ]),
+            'gs://bucket/staging/logs/make_examples/3'),
     ])
-    self.assertEqual(mock_apply_async.call_count, 4)
+    self.assertEqual(mock_run_job.call_count, 4)
     # Verify json files contain correct actions_list.
     command_template = gcp_deepvariant_runner._MAKE_EXAMPLES_COMMAND.format(
-        NUM_SHARDS='32', EXTRA_ARGS='')
+        NUM_SHARDS='32', SHARD_TRIES='2',
+        EXAMPLES_OUTPUT='examples_output.tfrecord@32.gz',
+        SHARDING_ARGS='--task {TASK_INDEX}', EXTRA_ARGS='')
     shards_per_worker = int(32 / 4)
     for worker_index in range(4):
       with open(new_json_files[worker_index]) as json_file:
@@ -403,8 +1415,8 @@ class DeepvariantRunnerTest(unittest.TestCase):
       shard_start_index = worker_index * shards_per_worker
       shard_end_index = (worker_index + 1) * shards_per_worker - 1
       expected_command = command_template.format(
-          SHARD_START_INDEX=shard_start_index,
-          SHARD_END_INDEX=shard_end_index,
+          SHARD_INDICES=' '.join(
+              str(k) for k in range(shard_start_index, shard_end_index + 1)),
           TASK_INDEX='{}',
           INPUT_BAM='/mnt/google/input-gcsfused-{}/bam')
       expected_actions_list = []
@@ -440,14 +1452,13 @@ class DeepvariantRunnerTest(unittest.TestCase):
         self.assertEqual(sorted(expected_actions_list[i].items()),
                          sorted(recieved_actions_list[i].items()))
 
-  @mock.patch.object(multiprocessing, 'Pool')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunCallVariants(self, mock_can_write_to_bucket, mock_obj_exist,
-                          mock_pool):
-    mock_apply_async = mock_pool.return_value.apply_async
-    mock_apply_async.return_value = None
-    mock_obj_exist.return_value = True
+                          mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend([
         '--make_examples_workers',
@@ -463,36 +1474,32 @@ class DeepvariantRunnerTest(unittest.TestCase):
     ])
     gcp_deepvariant_runner.run(self._argv)
 
-    mock_apply_async.assert_has_calls([
-        mock.call(mock.ANY, [
+    mock_run_job.assert_has_calls([
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'CALL_VARIANTS_SHARD_INDEX=0'),
-            'gs://bucket/staging/logs/call_variants/0'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/call_variants/0'),
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'CALL_VARIANTS_SHARD_INDEX=1'),
-            'gs://bucket/staging/logs/call_variants/1'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/call_variants/1'),
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'CALL_VARIANTS_SHARD_INDEX=2'),
-            'gs://bucket/staging/logs/call_variants/2'
-        ]),
+            'gs://bucket/staging/logs/call_variants/2'),
     ])
-    self.assertEqual(mock_apply_async.call_count, 3)
+    self.assertEqual(mock_run_job.call_count, 3)
 
-  @mock.patch.object(multiprocessing, 'Pool')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch('gcp_deepvariant_runner._run_job')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunCallVariants_GPU(self, mock_can_write_to_bucket, mock_obj_exist,
-                              mock_pool):
-    mock_apply_async = mock_pool.return_value.apply_async
-    mock_apply_async.return_value = None
-    mock_obj_exist.return_value = True
+                              mock_run_job):
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend([
         '--make_examples_workers',
@@ -511,36 +1518,34 @@ class DeepvariantRunnerTest(unittest.TestCase):
     ])
     gcp_deepvariant_runner.run(self._argv)
 
-    mock_apply_async.assert_has_calls([
-        mock.call(mock.ANY, [
+    mock_run_job.assert_has_calls([
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage_gpu',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'nvidia-tesla-k80', 'CALL_VARIANTS_SHARD_INDEX=0'),
-            'gs://bucket/staging/logs/call_variants/0'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/call_variants/0'),
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage_gpu',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'nvidia-tesla-k80', 'CALL_VARIANTS_SHARD_INDEX=1'),
-            'gs://bucket/staging/logs/call_variants/1'
-        ]),
-        mock.call(mock.ANY, [
+            'gs://bucket/staging/logs/call_variants/1'),
+        mock.call(
             _HasAllOf('call_variants', 'gcr.io/dockerimage_gpu',
                       '--attempts', '2', '--pvm-attempts', '0',
                       'nvidia-tesla-k80', 'CALL_VARIANTS_SHARD_INDEX=2'),
-            'gs://bucket/staging/logs/call_variants/2'
-        ]),
+            'gs://bucket/staging/logs/call_variants/2'),
     ])
-    self.assertEqual(mock_apply_async.call_count, 3)
+    self.assertEqual(mock_run_job.call_count, 3)
 
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
   @mock.patch.object(gke_cluster.GkeCluster, '__init__', return_value=None)
   @mock.patch.object(gke_cluster.GkeCluster, 'deploy_pod')
   @mock.patch.object(gke_cluster.GkeCluster, '_cluster_exists')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunCallVariants_TPU(self, mock_can_write_to_bucket, mock_obj_exist,
                               mock_cluster_exists, mock_deploy_pod, mock_init):
-    mock_obj_exist.return_value = True
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     mock_cluster_exists.return_value = True
     self._argv.extend([
@@ -562,7 +1567,8 @@ class DeepvariantRunnerTest(unittest.TestCase):
     mock_init.assert_has_calls([
         mock.call(
             'foo-cluster', None, 'us-central1-c', create_if_not_exist=False),
-        mock.call('foo-cluster', None, 'us-central1-c')
+        mock.call(
+            'foo-cluster', None, 'us-central1-c', use_kubernetes_api=False)
     ])
     self.assertEqual(mock_init.call_count, 2)
 
@@ -572,6 +1578,218 @@ class DeepvariantRunnerTest(unittest.TestCase):
         retries=1,
         wait=True)
 
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch.object(gke_cluster.GkeCluster, '__init__', return_value=None)
+  @mock.patch.object(gke_cluster.GkeCluster, 'deploy_pod')
+  @mock.patch.object(gke_cluster.GkeCluster, 'delete_cluster')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunCallVariants_MultipleTPUs(self, mock_can_write_to_bucket,
+                                       mock_obj_exist, mock_delete_cluster,
+                                       mock_deploy_pod, mock_init):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    self._argv.extend([
+        '--jobs_to_run', 'call_variants', 'postprocess_variants',
+        '--make_examples_workers', '3', '--call_variants_workers', '3',
+        '--shards', '15', '--tpu', '--gke_cluster_zone', 'us-central1-c',
+        '--docker_image', 'gcr.io/dockerimage'
+    ])
+    with mock.patch('gcp_deepvariant_runner._run_job') as mock_run_job:
+      gcp_deepvariant_runner.run(self._argv)
+
+    # A single cluster is created for all pods, and deleted once.
+    mock_init.assert_called_once_with(
+        AnyStringWith('deepvariant-'),
+        None,
+        'us-central1-c',
+        alpha_cluster=False,
+        extra_create_args=mock.ANY,
+        use_kubernetes_api=False)
+    mock_delete_cluster.assert_called_once_with(wait=False)
+    self.assertEqual(mock_deploy_pod.call_count, 3)
+    for i, deploy_call in enumerate(mock_deploy_pod.call_args_list):
+      pod = json.loads(deploy_call[1]['pod_config'])
+      self.assertEqual(pod['metadata']['name'], deploy_call[1]['pod_name'])
+      self.assertTrue(pod['metadata']['name'].endswith('-%d' % i))
+      command = pod['spec']['containers'][0]['command']
+      self.assertIn(
+          '--examples=gs://bucket/staging/examples/%d/'
+          'examples_output.tfrecord@15.gz' % i, command)
+      self.assertIn(
+          '--outfile=gs://bucket/staging/called_variants/'
+          'call_variants_output.tfrecord-%05d-of-00003.gz' % i, command)
+    # postprocess_variants reads the outputs of the pods as 3 shards.
+    self.assertIn('CALL_VARIANTS_SHARDS=3', mock_run_job.call_args[0][0])
+
+  @mock.patch('process_util.run_command')
+  @mock.patch.object(gke_cluster.GkeCluster, '_cluster_exists',
+                     return_value=True)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunCallVariants_MoreTPUsThanKubernetesConnections(
+      self, mock_can_write_to_bucket, mock_obj_exist, unused_mock_exists,
+      unused_mock_run_command):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    num_pods = kubernetes_client.MAX_CONNECTIONS + 2
+    server = fake_kubernetes_server.FakeKubernetesServer()
+    server.start()
+    self.addCleanup(server.stop)
+
+    all_pods_watched = []
+
+    def run_pods():
+      # Pods keep pending until all of them are watched at once (or a timeout,
+      # so that the run still ends).
+      deadline = time.time() + 10
+      while server.watches < num_pods and time.time() < deadline:
+        time.sleep(0.01)
+      all_pods_watched.append(server.watches == num_pods)
+      for pod_name in server.get_pod_names():
+        server.set_pod_status(pod_name, 'Running')
+        server.set_pod_status(pod_name, 'Succeeded')
+
+    pods_thread = threading.Thread(target=run_pods)
+    pods_thread.daemon = True
+    pods_thread.start()
+    self._argv.extend([
+        '--jobs_to_run', 'call_variants', '--make_examples_workers',
+        str(num_pods), '--call_variants_workers',
+        str(num_pods), '--shards',
+        str(num_pods), '--tpu', '--gke_cluster_zone', 'us-central1-c',
+        '--docker_image', 'gcr.io/dockerimage', '--kubernetes_api'
+    ])
+    with mock.patch(
+        'kubernetes_client.KubernetesClient.from_kubectl_config',
+        side_effect=lambda: kubernetes_client.KubernetesClient(server.url)):
+      run_thread = threading.Thread(
+          target=gcp_deepvariant_runner.run, args=(self._argv,))
+      run_thread.daemon = True
+      run_thread.start()
+      run_thread.join(30)
+
+    self.assertFalse(run_thread.is_alive())
+    self.assertEqual(all_pods_watched, [True])
+    # All pods succeeded and were deleted.
+    self.assertEqual(server.get_pod_names(), [])
+
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch.object(gke_cluster.GkeCluster, '__init__', return_value=None)
+  @mock.patch.object(gke_cluster.GkeCluster, 'deploy_pod')
+  @mock.patch.object(gke_cluster.GkeCluster, 'delete_cluster')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunCallVariants_TPUClusterCreatedDuringMakeExamples(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_delete_cluster,
+      mock_deploy_pod, mock_init):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    created = threading.Event()
+    mock_init.side_effect = lambda *args, **kwargs: created.set()
+    self._argv.extend([
+        '--jobs_to_run', 'make_examples', 'call_variants', '--tpu',
+        '--gke_cluster_zone', 'us-central1-c', '--docker_image',
+        'gcr.io/dockerimage'
+    ])
+    make_examples_saw_cluster = []
+    with mock.patch('gcp_deepvariant_runner._run_job') as mock_run_job:
+      mock_run_job.side_effect = (
+          lambda *args: make_examples_saw_cluster.append(created.wait(10)))
+      gcp_deepvariant_runner.run(self._argv)
+
+    self.assertTrue(make_examples_saw_cluster)
+    self.assertTrue(all(make_examples_saw_cluster))
+    mock_init.assert_called_once()
+    mock_deploy_pod.assert_called_once()
+    mock_delete_cluster.assert_called_once_with(wait=False)
+
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch.object(gke_cluster.GkeCluster, '__init__', return_value=None)
+  @mock.patch.object(gke_cluster.GkeCluster, 'deploy_pod')
+  @mock.patch.object(gke_cluster.GkeCluster, 'delete_cluster')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunFailMakeExamples_TPUDeletesPendingCluster(
+      self, mock_can_write_to_bucket, mock_obj_exist, mock_delete_cluster,
+      mock_deploy_pod, mock_init):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    creating = threading.Event()
+    create = threading.Event()
+
+    def create_cluster(*unused_args, **unused_kwargs):
+      creating.set()
+      create.wait(10)
+
+    mock_init.side_effect = create_cluster
+    self._argv.extend([
+        '--jobs_to_run', 'make_examples', 'call_variants', '--tpu',
+        '--gke_cluster_zone', 'us-central1-c', '--docker_image',
+        'gcr.io/dockerimage'
+    ])
+
+    def fail_make_examples(*unused_args):
+      creating.wait(10)
+      # The cluster is still being created when make_examples fails.
+      threading.Timer(0.1, create.set).start()
+      raise RuntimeError('make_examples failed')
+
+    with mock.patch('gcp_deepvariant_runner._run_job',
+                    side_effect=fail_make_examples):
+      with self.assertRaisesRegex(RuntimeError, 'make_examples failed'):
+        gcp_deepvariant_runner.run(self._argv)
+
+    mock_deploy_pod.assert_not_called()
+    mock_delete_cluster.assert_called_once_with(wait=False)
+
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch.object(gke_cluster, 'GkeCluster')
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
+  @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
+  def testRunCallVariants_TPUClusterPool(self, mock_can_write_to_bucket,
+                                         mock_obj_exist, mock_gke_cluster):
+    mock_obj_exist.side_effect = _all_objects_exist
+    mock_can_write_to_bucket.return_value = True
+    pool_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, pool_dir)
+    self._argv.extend([
+        '--jobs_to_run', 'call_variants', '--tpu', '--gke_cluster_zone',
+        'us-central1-c', '--docker_image', 'gcr.io/dockerimage',
+        '--gke_cluster_pool', pool_dir
+    ])
+    gcp_deepvariant_runner.run(self._argv)
+    cluster_name = mock_gke_cluster.call_args[0][0]
+    self.assertTrue(cluster_name.startswith('dvpool-'))
+    self.assertIn('extra_create_args', mock_gke_cluster.call_args[1])
+
+    # The next run leases the warm cluster, and deletes it once idle.
+    mock_gke_cluster.reset_mock()
+    gcp_deepvariant_runner.run(self._argv +
+                               ['--gke_cluster_idle_ttl_hours', '0'])
+    self.assertEqual(
+        [call[0][0] for call in mock_gke_cluster.call_args_list],
+        [cluster_name, cluster_name])
+    mock_gke_cluster.assert_called_with(
+        cluster_name, None, 'us-central1-c', create_if_not_exist=False)
+    mock_gke_cluster.return_value.deploy_pod.assert_called_once_with(
+        pod_config=mock.ANY,
+        pod_name=AnyStringWith('deepvariant-'),
+        retries=1,
+        wait=True)
+    mock_gke_cluster.return_value.delete_cluster.assert_called_once_with(
+        wait=False)
+    self.assertEqual(os.listdir(pool_dir), ['.lock'])
+
+  def testValidateArgs_ClusterPoolWithClusterName(self):
+    self._argv.extend([
+        '--tpu', '--gke_cluster_zone', 'us-central1-c', '--gke_cluster_name',
+        'foo-cluster', '--gke_cluster_pool', 'gs://bucket/pool'
+    ])
+    pipeline_args = gcp_deepvariant_runner._parse_args(self._argv)
+    with self.assertRaisesRegex(ValueError, '--gke_cluster_pool'):
+      gcp_deepvariant_runner._validate_and_complete_args(pipeline_args)
+
   def testRunFailCallVariants_TPU(self):
     self._argv.extend([
         '--jobs_to_run',
@@ -592,11 +1810,12 @@ class DeepvariantRunnerTest(unittest.TestCase):
       gcp_deepvariant_runner.run(self._argv)
 
   @mock.patch('gcp_deepvariant_runner._run_job')
-  @mock.patch('gcp_deepvariant_runner._gcs_object_exist')
+  @mock.patch.object(multiprocessing.pool, 'ThreadPool', new=_SynchronousPool)
+  @mock.patch('gcp_deepvariant_runner._gcs_objects_exist')
   @mock.patch('gcp_deepvariant_runner._can_write_to_bucket')
   def testRunPostProcessVariants(self, mock_can_write_to_bucket, mock_obj_exist,
                                  mock_run_job):
-    mock_obj_exist.return_value = True
+    mock_obj_exist.side_effect = _all_objects_exist
     mock_can_write_to_bucket.return_value = True
     self._argv.extend([
         '--jobs_to_run',
@@ -619,6 +1838,38 @@ class DeepvariantRunnerTest(unittest.TestCase):
                   'OUTFILE=gs://bucket/output.vcf'),
         'gs://bucket/staging/logs/postprocess_variants')
 
+  def testRunJob_AdaptiveZones(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    args_file = os.path.join(temp_dir, 'args')
+    pipelines = os.path.join(temp_dir, 'pipelines')
+    with open(pipelines, 'w') as f:
+      f.write('#!/bin/bash\n'
+              'echo "$@" > %s\n'
+              'echo \'Worker "w" assigned in "us-east1-c"\'\n'
+              'echo \'Execution failed: worker was preempted\' >&2\n'
+              'exit 1\n' % args_file)
+    os.chmod(pipelines, os.stat(pipelines).st_mode | stat.S_IEXEC)
+    health = zone_health.ZoneHealth(os.path.join(temp_dir, 'zones.sqlite'))
+    self.addCleanup(health.close)
+    health.record(
+        [zone_health.ZoneEvent(zone_health.STOCKOUT, 'us-east1-b')] * 4)
+
+    path = temp_dir + os.pathsep + os.environ['PATH']
+    with mock.patch.object(gcp_deepvariant_runner, '_zone_health', health):
+      with mock.patch.dict(os.environ, {'PATH': path}):
+        with self.assertRaisesRegex(RuntimeError, 'worker was preempted'):
+          gcp_deepvariant_runner._run_job([
+              'pipelines', 'run', '--zones', 'us-east1-b', 'us-east1-c',
+              '--name', 'job'
+          ], 'gs://bucket/staging/logs/job')
+
+    with open(args_file) as f:
+      self.assertEqual(f.read(), 'run --zones us-east1-c --name job\n')
+    stats = health.get_stats('us-east1-c')
+    self.assertAlmostEqual(stats.launches, 1, places=3)
+    self.assertAlmostEqual(stats.preemptions, 1, places=3)
+
   @mock.patch.object(storage.bucket.Bucket, 'test_iam_permissions')
   def testRunFailsMissingInput(self, mock_bucket_iam):
     mock_bucket_iam.return_value = (
@@ -707,9 +1958,10 @@ class UtilsTest(unittest.TestCase):
 
   def testGenerateActionsForMakeExample(self):
     command_template = gcp_deepvariant_runner._MAKE_EXAMPLES_COMMAND.format(
-        NUM_SHARDS='6', EXTRA_ARGS=' --extra-args')
-    expected_command = command_template.format(SHARD_START_INDEX=1,
-                                               SHARD_END_INDEX=4,
+        NUM_SHARDS='6', SHARD_TRIES='2',
+        EXAMPLES_OUTPUT='examples_output.tfrecord@6.gz',
+        SHARDING_ARGS='--task {TASK_INDEX}', EXTRA_ARGS=' --extra-args')
+    expected_command = command_template.format(SHARD_INDICES='1 2 3 4',
                                                TASK_INDEX='{}',
                                                INPUT_BAM='$INPUT_BAM')
     expected_actions_list = [
@@ -720,16 +1972,19 @@ class UtilsTest(unittest.TestCase):
          'imageUri': 'gcr.io/temp/image'}]
 
     actions_list = gcp_deepvariant_runner._generate_actions_for_make_example(
-        1, 4, 'gs://temp-bucket/path/input.bam', False, 'gcr.io/temp/image',
+        [1, 2, 3, 4], 'gs://temp-bucket/path/input.bam', False,
+        'gcr.io/temp/image',
         command_template)
     self.assertListEqual(actions_list, expected_actions_list)
     gcp_deepvariant_runner._write_actions_to_temp_file(actions_list)
 
   def testGenerateActionsForMakeExampleGcsfuse(self):
     command_template = gcp_deepvariant_runner._MAKE_EXAMPLES_COMMAND.format(
-        NUM_SHARDS='6', EXTRA_ARGS=' --extra-args')
+        NUM_SHARDS='6', SHARD_TRIES='2',
+        EXAMPLES_OUTPUT='examples_output.tfrecord@6.gz',
+        SHARDING_ARGS='--task {TASK_INDEX}', EXTRA_ARGS=' --extra-args')
     expected_command = command_template.format(
-        SHARD_START_INDEX=2, SHARD_END_INDEX=4, TASK_INDEX='{}',
+        SHARD_INDICES='2 3 4', TASK_INDEX='{}',
         INPUT_BAM='/mnt/google/input-gcsfused-{}/path/input.bam')
     expected_actions_list = []
     for shard_index in range(2, 4 + 1):
@@ -761,9 +2016,8 @@ class UtilsTest(unittest.TestCase):
          'imageUri': 'gcr.io/temp/image'})
 
     actions_list = gcp_deepvariant_runner._generate_actions_for_make_example(
-        2, 4, 'gs://temp-bucket/path/input.bam', True, 'gcr.io/temp/image',
-        gcp_deepvariant_runner._MAKE_EXAMPLES_COMMAND.format(
-            NUM_SHARDS='6', EXTRA_ARGS=' --extra-args'))
+        [2, 3, 4], 'gs://temp-bucket/path/input.bam', True,
+        'gcr.io/temp/image', command_template)
     self.assertListEqual(actions_list, expected_actions_list)
     gcp_deepvariant_runner._write_actions_to_temp_file(actions_list)
 
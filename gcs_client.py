@@ -0,0 +1,227 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Shared, pooled access to GCS.
+
+All GCS requests of the runner go through a single storage.Client, created on
+first use by get_client(). Its HTTP session keeps up to
+MAX_CONCURRENT_REQUESTS connections open, so connections and auth tokens are
+reused, and blocks further requests until a connection is free, which bounds
+the number of concurrent requests.
+
+The helpers below operate on gs://bucket/path paths. Checking or reading the
+metadata of many objects is done with batch requests of up to 100 calls each
+(a single HTTP round trip per batch).
+
+get_metadata() answers from a metadata_cache.MetadataCache, if one is set with
+set_metadata_cache(), and only requests the metadata of objects that are not
+in the cache.
+
+Clients created while STORAGE_EMULATOR_HOST is set send their requests to that
+host instead of GCS, e.g. a fake_gcs_server.FakeGcsServer in tests.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing.pool
+import threading
+import urllib
+
+import metadata_cache
+from google.cloud import storage
+import requests
+
+
+# Maximum number of concurrent HTTP requests (and open connections) to GCS.
+MAX_CONCURRENT_REQUESTS = 32
+
+# Maximum number of calls in a batch request, as allowed by GCS.
+_MAX_BATCH_SIZE = 100
+
+_client = None
+_client_lock = threading.Lock()
+
+# Set by set_metadata_cache.
+_metadata_cache = None
+
+
+def get_client():
+  """Returns the storage.Client shared by all GCS helpers."""
+  global _client
+  with _client_lock:
+    if _client is None:
+      client = storage.Client()
+      adapter = requests.adapters.HTTPAdapter(
+          pool_maxsize=MAX_CONCURRENT_REQUESTS, pool_block=True)
+      for prefix in ('https://', 'http://'):
+        client._http.mount(prefix, adapter)  # pylint: disable=protected-access
+      _client = client
+    return _client
+
+
+def split_path(gcs_path):
+  """Returns the (bucket name, object name) of a gs://bucket/path path."""
+  parsed_path = urllib.parse.urlparse(gcs_path)
+  return parsed_path.netloc, parsed_path.path.lstrip('/')
+
+
+def get_blob(gcs_path):
+  """Returns the storage.Blob (with metadata) of an object, or None."""
+  bucket_name, name = split_path(gcs_path)
+  return get_client().bucket(bucket_name).get_blob(name)
+
+
+def get_blobs(gcs_paths):
+  """Returns the metadata of several objects, using batch requests.
+
+  Batches are sent concurrently.
+
+  Args:
+    gcs_paths: (list) paths of the objects.
+
+  Returns:
+    A dict of storage.Blob (or None if the object does not exist or cannot be
+    read) by path.
+  """
+  client = get_client()
+  blobs = {}
+  for gcs_path in gcs_paths:
+    bucket_name, name = split_path(gcs_path)
+    blobs[gcs_path] = client.bucket(bucket_name).blob(name)
+  paths = sorted(blobs)
+
+  def reload_batch(start):
+    # A failed call leaves the error (instead of the object resource) as the
+    # blob's properties; it has no generation.
+    with client.batch(raise_exception=False):
+      for gcs_path in paths[start:start + _MAX_BATCH_SIZE]:
+        blobs[gcs_path].reload()
+
+  starts = range(0, len(paths), _MAX_BATCH_SIZE)
+  if len(starts) == 1:
+    reload_batch(0)
+  elif starts:
+    threads = multiprocessing.pool.ThreadPool(
+        min(len(starts), MAX_CONCURRENT_REQUESTS))
+    try:
+      threads.map(reload_batch, starts)
+    finally:
+      threads.close()
+      threads.join()
+  return {
+      gcs_path: blob if blob.generation is not None else None
+      for gcs_path, blob in blobs.items()
+  }
+
+
+def objects_exist(gcs_paths, use_cache=False):
+  """Returns a dict of whether each object exists, by path.
+
+  Args:
+    gcs_paths: (list) paths of the objects.
+    use_cache: (bool) whether objects in the metadata cache (if set) are known
+      to exist without checking them. See get_metadata.
+  """
+  if use_cache:
+    return {
+        gcs_path: metadata is not None
+        for gcs_path, metadata in get_metadata(gcs_paths).items()
+    }
+  return {
+      gcs_path: blob is not None
+      for gcs_path, blob in get_blobs(gcs_paths).items()
+  }
+
+
+def set_metadata_cache(cache):
+  """Sets the metadata_cache.MetadataCache used by get_metadata (or None)."""
+  global _metadata_cache
+  _metadata_cache = cache
+
+
+def get_metadata(gcs_paths, use_cache=True):
+  """Returns the metadata of several objects, from the metadata cache if set.
+
+  Objects that are not in the cache are checked with a single request, or with
+  batch requests if there are several.
+
+  Args:
+    gcs_paths: (list) paths of the objects.
+    use_cache: (bool) whether cached metadata may be returned. If not, all
+      objects are checked, and the cache (if set) is refreshed.
+
+  Returns:
+    A dict of metadata_cache.ObjectMetadata (or None if the object does not
+    exist) by path.
+  """
+  metadata = {}
+  paths_to_check = []
+  for gcs_path in set(gcs_paths):
+    metadata[gcs_path] = (
+        _metadata_cache.get(gcs_path)
+        if _metadata_cache and use_cache else None)
+    if metadata[gcs_path] is None:
+      paths_to_check.append(gcs_path)
+  if len(paths_to_check) == 1:
+    blobs = {paths_to_check[0]: get_blob(paths_to_check[0])}
+  else:
+    blobs = get_blobs(paths_to_check)
+  for gcs_path, blob in blobs.items():
+    if blob is None:
+      if _metadata_cache:
+        _metadata_cache.delete(gcs_path)
+      continue
+    metadata[gcs_path] = metadata_cache.ObjectMetadata.from_blob(blob)
+    if _metadata_cache:
+      _metadata_cache.put(gcs_path, metadata[gcs_path])
+  return metadata
+
+
+def list_blobs(gcs_prefix):
+  """Returns the storage.Blob of all objects whose path starts with a prefix."""
+  bucket_name, prefix = split_path(gcs_prefix)
+  return list(get_client().list_blobs(bucket_name, prefix=prefix))
+
+
+def download(gcs_path):
+  """Returns the content (bytes) of an object.
+
+  Raises:
+    google.api_core.exceptions.NotFound: if the object does not exist.
+  """
+  bucket_name, name = split_path(gcs_path)
+  return get_client().bucket(bucket_name).blob(name).download_as_bytes()
+
+
+def upload(gcs_path, content, content_type=None):
+  """Writes (or replaces) an object with content (str or bytes)."""
+  bucket_name, name = split_path(gcs_path)
+  get_client().bucket(bucket_name).blob(name).upload_from_string(
+      content, content_type=content_type)
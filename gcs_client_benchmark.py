@@ -0,0 +1,148 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+r"""Benchmarks checking the existence of N GCS objects.
+
+The checks are made against a local fake_gcs_server.FakeGcsServer that adds a
+fixed latency to every HTTP request, to simulate the round trip to GCS. For
+each method, reports:
+  - wall_sec: time to check all objects.
+  - http_requests: number of HTTP requests received by the server.
+Methods:
+  - new_client: one check at a time, each with a new storage.Client (as the
+    runner used to do).
+  - shared_client: concurrent checks (one request each) with the client
+    shared by gcs_client.
+  - batch: gcs_client.objects_exist, i.e. batch requests of 100 checks.
+
+Sample run command:
+$ python gcs_client_benchmark.py --objects 10 100 1000 --latency_sec 0.02
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing.pool
+import os
+import time
+
+import fake_gcs_server
+import gcs_client
+from google.cloud import storage
+
+
+def _check_with_new_client(paths):
+  for path in paths:
+    bucket_name, name = gcs_client.split_path(path)
+    storage.Client().bucket(bucket_name).blob(name).exists()
+
+
+def _check_with_shared_client(paths):
+  threads = multiprocessing.pool.ThreadPool(gcs_client.MAX_CONCURRENT_REQUESTS)
+  try:
+    threads.map(gcs_client.get_blob, paths)
+  finally:
+    threads.close()
+    threads.join()
+
+
+_METHODS = {
+    'new_client': _check_with_new_client,
+    'shared_client': _check_with_shared_client,
+    'batch': gcs_client.objects_exist,
+}
+
+
+def _benchmark(server, method, num_objects):
+  """Checks num_objects objects (half of which exist) with method."""
+  paths = ['gs://bucket/obj%d' % i for i in range(num_objects)]
+  for i in range(0, num_objects, 2):
+    server.add_object('bucket', 'obj%d' % i, b'')
+  # Each method starts without connections.
+  gcs_client._client = None  # pylint: disable=protected-access
+  server.http_requests = 0
+  start_time = time.time()
+  _METHODS[method](paths)
+  return {
+      'method': method,
+      'objects': num_objects,
+      'wall_sec': round(time.time() - start_time, 3),
+      'http_requests': server.http_requests,
+  }
+
+
+def run(argv=None):
+  """Runs the benchmark."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--objects',
+      type=int,
+      nargs='+',
+      default=[10, 100, 1000],
+      help='Number of objects to check.')
+  parser.add_argument(
+      '--methods',
+      nargs='+',
+      default=sorted(_METHODS),
+      choices=sorted(_METHODS),
+      help='Methods to benchmark.')
+  parser.add_argument(
+      '--latency_sec',
+      type=float,
+      default=0.02,
+      help='Time (in seconds) each HTTP request to the fake server takes.')
+  parser.add_argument(
+      '--output', help='Optional path to write the results to as JSON.')
+  args = parser.parse_args(argv)
+
+  results = []
+  with fake_gcs_server.FakeGcsServer(args.latency_sec) as server:
+    old_host = os.environ.get('STORAGE_EMULATOR_HOST')
+    os.environ['STORAGE_EMULATOR_HOST'] = server.url
+    try:
+      for num_objects in args.objects:
+        for method in args.methods:
+          result = _benchmark(server, method, num_objects)
+          print(json.dumps(result, sort_keys=True))
+          results.append(result)
+    finally:
+      if old_host is None:
+        del os.environ['STORAGE_EMULATOR_HOST']
+      else:
+        os.environ['STORAGE_EMULATOR_HOST'] = old_host
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,214 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for gcs_client.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python gcs_client_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fake_gcs_server
+import gcs_client
+import metadata_cache
+import mock
+from google.api_core import exceptions as google_exceptions
+
+
+class GcsClientTest(unittest.TestCase):
+  """Tests gcs_client against a local fake GCS server."""
+
+  def setUp(self):
+    super(GcsClientTest, self).setUp()
+    self._server = fake_gcs_server.FakeGcsServer()
+    self._server.start()
+    self.addCleanup(self._server.stop)
+    for patcher in (mock.patch.dict(
+        os.environ, {'STORAGE_EMULATOR_HOST': self._server.url}),
+                    mock.patch.object(gcs_client, '_client', None)):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def test_get_client(self):
+    client = gcs_client.get_client()
+    self.assertIs(gcs_client.get_client(), client)
+    adapter = client._http.get_adapter(self._server.url)
+    self.assertEqual(adapter._pool_maxsize,
+                     gcs_client.MAX_CONCURRENT_REQUESTS)
+    self.assertTrue(adapter._pool_block)
+
+  def test_split_path(self):
+    self.assertEqual(gcs_client.split_path('gs://bucket/a/b'),
+                     ('bucket', 'a/b'))
+    self.assertEqual(gcs_client.split_path('gs://bucket'), ('bucket', ''))
+
+  def test_get_blob(self):
+    self._server.add_object('bucket', 'a/b', b'abc')
+    self.assertEqual(gcs_client.get_blob('gs://bucket/a/b').size, 3)
+    self.assertIsNone(gcs_client.get_blob('gs://bucket/a/c'))
+
+  def test_get_blobs(self):
+    paths = ['gs://bucket/obj%d' % i for i in range(250)]
+    for i in range(0, 250, 2):
+      self._server.add_object('bucket', 'obj%d' % i, b'x' * i)
+    blobs = gcs_client.get_blobs(paths + ['gs://other/obj0'])
+
+    self.assertEqual(len(blobs), 251)
+    for i in range(250):
+      if i % 2:
+        self.assertIsNone(blobs['gs://bucket/obj%d' % i])
+      else:
+        self.assertEqual(blobs['gs://bucket/obj%d' % i].size, i)
+    self.assertIsNone(blobs['gs://other/obj0'])
+    # One batch request per 100 objects.
+    self.assertEqual(self._server.http_requests, 3)
+
+  def test_get_blobs_empty(self):
+    self.assertEqual(gcs_client.get_blobs([]), {})
+    self.assertEqual(self._server.http_requests, 0)
+
+  def test_objects_exist(self):
+    self._server.add_object('bucket', 'a', b'')
+    self.assertEqual(
+        gcs_client.objects_exist(['gs://bucket/a', 'gs://bucket/b']), {
+            'gs://bucket/a': True,
+            'gs://bucket/b': False
+        })
+
+  def test_objects_exist_with_cache(self):
+    cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, cache_dir)
+    cache = metadata_cache.MetadataCache(
+        os.path.join(cache_dir, 'metadata.sqlite'), ttl_sec=60)
+    self.addCleanup(cache.close)
+    gcs_client.set_metadata_cache(cache)
+    self.addCleanup(gcs_client.set_metadata_cache, None)
+    for name in ('a', 'b'):
+      self._server.add_object('bucket', name, b'')
+    paths = ['gs://bucket/a', 'gs://bucket/b', 'gs://bucket/c']
+    gcs_client.get_metadata(['gs://bucket/a'])
+
+    self.assertEqual(
+        gcs_client.objects_exist(paths, use_cache=True), {
+            'gs://bucket/a': True,
+            'gs://bucket/b': True,
+            'gs://bucket/c': False
+        })
+    self.assertEqual(cache.hits, 1)
+    # The other objects are checked with one batch request.
+    self.assertEqual(self._server.http_requests, 2)
+
+  def test_get_metadata(self):
+    self._server.add_object('bucket', 'a', b'abc')
+    metadata = gcs_client.get_metadata(['gs://bucket/a', 'gs://bucket/b'])
+    self.assertEqual(metadata['gs://bucket/a'].size, 3)
+    self.assertEqual(metadata['gs://bucket/a'].generation, 1)
+    self.assertIsNone(metadata['gs://bucket/b'])
+
+  def test_get_metadata_with_cache(self):
+    cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, cache_dir)
+    cache = metadata_cache.MetadataCache(
+        os.path.join(cache_dir, 'metadata.sqlite'), ttl_sec=60)
+    self.addCleanup(cache.close)
+    gcs_client.set_metadata_cache(cache)
+    self.addCleanup(gcs_client.set_metadata_cache, None)
+    self._server.add_object('bucket', 'a', b'abc')
+    paths = ['gs://bucket/a', 'gs://bucket/b']
+
+    with mock.patch('time.time', return_value=1000):
+      gcs_client.get_metadata(paths)
+      self.assertEqual(self._server.http_requests, 1)
+      # Only the missing object is checked again.
+      metadata = gcs_client.get_metadata(paths)
+      self.assertEqual(self._server.http_requests, 2)
+    self.assertEqual(metadata['gs://bucket/a'].generation, 1)
+    self.assertIsNone(metadata['gs://bucket/b'])
+    self.assertEqual(cache.hits, 1)
+
+    self._server.add_object('bucket', 'a', b'abcd')
+    with mock.patch('time.time', return_value=1061):
+      metadata = gcs_client.get_metadata(['gs://bucket/a'])
+    self.assertEqual(metadata['gs://bucket/a'].generation, 2)
+    self.assertEqual(metadata['gs://bucket/a'].size, 4)
+
+  def test_get_metadata_without_cache(self):
+    cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, cache_dir)
+    cache = metadata_cache.MetadataCache(
+        os.path.join(cache_dir, 'metadata.sqlite'), ttl_sec=60)
+    self.addCleanup(cache.close)
+    gcs_client.set_metadata_cache(cache)
+    self.addCleanup(gcs_client.set_metadata_cache, None)
+    self._server.add_object('bucket', 'a', b'abc')
+    gcs_client.get_metadata(['gs://bucket/a'])
+
+    # The object is overwritten within the TTL of its cached metadata.
+    self._server.add_object('bucket', 'a', b'abcd')
+    metadata = gcs_client.get_metadata(['gs://bucket/a'], use_cache=False)
+    self.assertEqual(metadata['gs://bucket/a'].generation, 2)
+    self.assertEqual(cache.hits, 0)
+    # The cache is refreshed.
+    self.assertEqual(
+        gcs_client.get_metadata(['gs://bucket/a'])['gs://bucket/a'].generation,
+        2)
+
+  def test_list_blobs(self):
+    for name in ('a/1', 'a/2', 'ab', 'b/1'):
+      self._server.add_object('bucket', name, b'')
+    self.assertEqual(
+        [blob.name for blob in gcs_client.list_blobs('gs://bucket/a/')],
+        ['a/1', 'a/2'])
+    self.assertEqual(
+        [blob.name for blob in gcs_client.list_blobs('gs://bucket/a')],
+        ['a/1', 'a/2', 'ab'])
+
+  def test_upload_and_download(self):
+    gcs_client.upload('gs://bucket/a/b', 'content')
+    self.assertEqual(self._server.get_object('bucket', 'a/b'), b'content')
+    self.assertEqual(gcs_client.download('gs://bucket/a/b'), b'content')
+    with self.assertRaises(google_exceptions.NotFound):
+      gcs_client.download('gs://bucket/a/c')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -32,9 +32,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import json
 import logging
+import math
+import subprocess
 import time
 import enum
+import kubernetes_client
 import process_util
 import retrying
 
@@ -54,6 +59,9 @@ _KUBECTL_RETRY_DELAY_SEC = 1
 # Time we allow a pod stays in initial pending (scheduling) state.
 _PENDING_STATE_TIMEOUT_SEC = 20 * 60
 
+# Reasons of a waiting container that mean its docker image cannot be pulled.
+_PULL_IMAGE_ERRORS = ('ImagePullBackOff', 'ErrImagePull')
+
 
 @enum.unique
 class ClusterStatus(enum.Enum):
@@ -103,6 +111,56 @@ def _is_runtime_exception(exception):
   return isinstance(exception, RuntimeError)
 
 
+def get_pod_object_status(pod):
+  """Returns the status of a pod given its Kubernetes API object.
+
+  When pod fails due to a failure in pulling docker image, we get misleading
+  pending status (see https://github.com/kubernetes/kubernetes/issues/66828),
+  so a pending pod with a container that cannot pull its image is reported as
+  failed.
+
+  Args:
+    pod: (dict) pod object, e.g. as output by `kubectl get pods -o json`.
+  """
+  status = pod.get('status') or {}
+  phase = status.get('phase')
+  if phase == 'Pending':
+    for container_status in status.get('containerStatuses') or []:
+      waiting = (container_status.get('state') or {}).get('waiting') or {}
+      if (not container_status.get('ready') and
+          waiting.get('reason') in _PULL_IMAGE_ERRORS):
+        return PodStatus.FAILED
+  return _POD_STATUS_MAP.get(phase, PodStatus.UNKNOWN)
+
+
+def parse_watch_events(stream):
+  """Yields the pod objects written to a `kubectl get -w -o json` stream.
+
+  kubectl writes one (indented) JSON object per event, without separators.
+
+  Args:
+    stream: file object (text) to read the events from. It is read line by
+      line, so that events are yielded as soon as they are written.
+
+  Raises:
+    ValueError: if the stream ends with an incomplete object.
+  """
+  decoder = json.JSONDecoder()
+  buf = ''
+  for line in stream:
+    buf += line
+    # Only try to decode once the buffer may hold a complete object.
+    while buf.rstrip().endswith('}'):
+      try:
+        pod, end = decoder.raw_decode(buf.lstrip())
+      except ValueError:
+        break
+      yield pod
+      buf = buf.lstrip()[end:]
+  if buf.strip():
+    raise ValueError('Incomplete event in watch stream: %s' % buf.strip())
+
+
 class GkeCluster(object):
   """Helper for provisioning GKE cluster."""
 
@@ -112,12 +170,16 @@ class GkeCluster(object):
                cluster_zone=None,
                alpha_cluster=False,
                create_if_not_exist=True,
-               extra_create_args=None):
+               extra_create_args=None,
+               use_kubernetes_api=False):
     """Helper for provisioning GKE cluster.
 
     On initialization, creates a new cluster or reuses if already exists. Uses
     gcloud's config file implicitly (for determining project, account, and etc).
 
+    Pods are managed with kubectl, or over a kubernetes_client.KubernetesClient
+    if use_kubernetes_api is set and the cluster's API server can be reached.
+
     Args:
       cluster_name: (str) GKE cluster name. Must be unique within a project.
       cluster_region: (str) GCP region.
@@ -126,6 +188,9 @@ class GkeCluster(object):
       create_if_not_exist: (bool) whether to create the cluster if not exists.
       extra_create_args: (list) list of additional args (type str) to be used
           when creating a new cluster. E.g. --num-nodes=1, --enable-tpu, etc.
+      use_kubernetes_api: (bool) whether to send requests to the Kubernetes
+          API directly (reusing connections), instead of running kubectl for
+          each of them.
 
     Raises:
       ValueError: if both or neither of cluster region and zone is provided.
@@ -145,6 +210,7 @@ class GkeCluster(object):
     self._cluster_zone = cluster_zone
     self._alpha_cluster = alpha_cluster
     self._extra_create_args = extra_create_args
+    self._kubernetes_client = None
 
     if self._cluster_exists():
       self._reuse_cluster()
@@ -154,6 +220,23 @@ class GkeCluster(object):
       raise ValueError(
           'Cannot create GkeCluster object. GKE cluster %s does not exist, '
           'cannot create GkeCluster object.' % self._cluster_name)
+    if use_kubernetes_api:
+      self._connect_kubernetes_api()
+
+  def _connect_kubernetes_api(self):
+    """Sets up the client of the cluster's Kubernetes API.
+
+    Falls back to kubectl if the API server cannot be reached.
+    """
+    try:
+      client = kubernetes_client.KubernetesClient.from_kubectl_config()
+      client.get_version()
+    except RuntimeError as e:
+      logging.warning(
+          'Cannot connect to the Kubernetes API of GKE cluster %s, using '
+          'kubectl instead: %s', self._cluster_name, str(e))
+      return
+    self._kubernetes_client = client
 
   def _create_cluster(self):
     """Creates a kubernetes cluster.
@@ -315,7 +398,12 @@ class GkeCluster(object):
                  self._cluster_name)
     for i in range(retries + 1):
       is_first_try = (i == 0)
-      self._kubectl_call(get_args(is_first_try), std_input=pod_config)
+      if self._kubernetes_client:
+        if not is_first_try:
+          self._kubernetes_client.delete_pod(pod_name, wait=True)
+        self._kubernetes_client.create_pod(json.loads(pod_config))
+      else:
+        self._kubectl_call(get_args(is_first_try), std_input=pod_config)
       if not wait and not retries:
         return
       curr_pod_status = self._wait_on_state(pod_name, PodStatus.PENDING,
@@ -337,6 +425,11 @@ class GkeCluster(object):
   def _wait_on_state(self, pod_name, state_to_wait_on, timeout=None):
     """Waits as long as the pod is in the given state or timeout reaches.
 
+    Pod changes are received as events from a `kubectl get -w` watch, rather
+    than by polling. If the watch ends (e.g. the connection to the API server is
+    dropped), the status is read once, which surfaces an unreachable pod, and
+    the watch is restarted.
+
     Args:
       pod_name: (str) name of the pod.
       state_to_wait_on: (PodStatus) pod's state to wait on.
@@ -350,13 +443,63 @@ class GkeCluster(object):
       RuntimeError if the pod becomes unreachable.
     """
     start_time = time.time()
-    state = self.get_pod_status(pod_name)
-    while state == state_to_wait_on:
-      time.sleep(_KUBECTL_RETRY_DELAY_SEC)
+    state = PodStatus.UNKNOWN
+    while True:
+      remaining_sec = None
+      if timeout:
+        remaining_sec = timeout - (time.time() - start_time)
+        if remaining_sec <= 0:
+          return state
+      with contextlib.closing(self._watch_pod(pod_name,
+                                              remaining_sec)) as pods:
+        for pod in pods:
+          state = get_pod_object_status(pod)
+          if state != state_to_wait_on:
+            return state
       state = self.get_pod_status(pod_name)
-      if timeout and (time.time() - start_time) > timeout:
-        break
-    return state
+      if state != state_to_wait_on:
+        return state
+      time.sleep(_KUBECTL_RETRY_DELAY_SEC)
+
+  def _watch_pod(self, pod_name, timeout=None):
+    """Yields the pod's object on start and on each change of the pod.
+
+    Args:
+      pod_name: (str) name of the pod.
+      timeout: (float) stop watching after this many seconds. None means no
+        timeout (the API server may still end the watch).
+    """
+    if self._kubernetes_client:
+      events = self._kubernetes_client.watch_pod(pod_name, timeout)
+      try:
+        for _, pod in events:
+          yield pod
+      except kubernetes_client.KubernetesApiError as e:
+        logging.warning('Watching pod %s failed: %s', pod_name, str(e))
+      finally:
+        events.close()
+      return
+    args = ['kubectl', 'get', 'pods', pod_name, '--watch', '-o', 'json']
+    if timeout:
+      args.append('--request-timeout=%ds' % math.ceil(timeout))
+    logging.debug('Calling command: %s', ' '.join(args))
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True)
+    try:
+      for pod in parse_watch_events(process.stdout):
+        yield pod
+    except ValueError as e:
+      logging.warning('Watching pod %s failed: %s', pod_name, str(e))
+    finally:
+      if process.poll() is None:
+        process.kill()
+      process.stdout.close()
+      if process.wait():
+        logging.debug('%s exited with code %d.', ' '.join(args),
+                      process.returncode)
 
   # Retry with a delay between 1 to 10 seconds for at most 100 seconds.
   @retrying.retry(
@@ -370,16 +513,19 @@ class GkeCluster(object):
     Args:
       pod_name: (str) name of pod.
     """
-    args = [
-        'kubectl', 'get', 'pods', pod_name, '-o', 'jsonpath={.status.phase}'
-    ]
+    if self._kubernetes_client:
+      pod = self._kubernetes_client.get_pod(pod_name)
+      if pod is None:
+        raise RuntimeError('Pod %s does not exist.' % pod_name)
+      return get_pod_object_status(pod)
+    args = ['kubectl', 'get', 'pods', pod_name, '-o', 'json']
     # Retry is done by retry decorator.
-    status_str = self._kubectl_call(args, retries=0).strip()
-    # When pod fails due to a failure in pulling docker image, we get misleading
-    # pending status. See https://github.com/kubernetes/kubernetes/issues/66828
-    if status_str == 'Pending' and self._pulling_images_failed(pod_name):
-      return PodStatus.FAILED
-    return _POD_STATUS_MAP.get(status_str, PodStatus.UNKNOWN)
+    pod_json = self._kubectl_call(args, retries=0)
+    try:
+      pod = json.loads(pod_json)
+    except ValueError:
+      return PodStatus.UNKNOWN
+    return get_pod_object_status(pod)
 
   def delete_pod(self, pod_name, wait=True):
     """Deletes the given pod.
@@ -388,6 +534,9 @@ class GkeCluster(object):
       pod_name: (str) pod's name.
       wait: (bool) whether to wait on completion.
     """
+    if self._kubernetes_client:
+      self._kubernetes_client.delete_pod(pod_name, wait=wait)
+      return
     if not self._pod_exists(pod_name):
       return
     args = ['kubectl', 'delete', 'pod', pod_name]
@@ -398,23 +547,10 @@ class GkeCluster(object):
     else:
       self._kubectl_call(args)
 
-  def _pulling_images_failed(self, pod_name):
-    """Returns true if there was a failure in pulling docker images.
-
-    Args:
-      pod_name: (str) name of pod.
-    """
-    args = [
-        'kubectl', 'get', 'pods', pod_name, '-o',
-        'go-template="{{range .status.containerStatuses}}{{if not '
-        '.ready}}{{.state.waiting.reason}}{{end}}{{end}}"'
-    ]
-    containers_status = self._kubectl_call(args, retries=0)
-    pull_images_err = ['ImagePullBackOff', 'ErrImagePull']
-    return any(err in containers_status for err in pull_images_err)
-
   def _pod_exists(self, pod_name):
     """Returns true iff the pod exists (not deleted)."""
+    if self._kubernetes_client:
+      return self._kubernetes_client.get_pod(pod_name) is not None
     args = [
         'kubectl', 'get', 'pods', '-o',
         'jsonpath={.items[*].spec.containers[*].name}'
@@ -43,11 +43,37 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
+import json
 import unittest
+import fake_kubernetes_server
 import gke_cluster
+import kubernetes_client
 import mock
 
 
+def _pod(phase, waiting_reason=None):
+  """Returns a pod object with the given phase and container waiting reason."""
+  pod = {'metadata': {'name': 'foo-pod'}, 'status': {'phase': phase}}
+  if waiting_reason:
+    pod['status']['containerStatuses'] = [{
+        'name': 'foo-pod',
+        'ready': False,
+        'state': {'waiting': {'reason': waiting_reason}}
+    }]
+  return pod
+
+
+def _watch(*pods):
+  """Returns a fake GkeCluster._watch_pod generator of the given pods."""
+  return (pod for pod in pods)
+
+
+def _watch_stream(*pods):
+  """Returns a fake `kubectl get -w -o json` stream of the given pods."""
+  return io.StringIO(''.join(json.dumps(pod, indent=4) for pod in pods))
+
+
 class GkeClusterTest(unittest.TestCase):
   """Tests for GkeCluster class."""
 
@@ -188,11 +214,11 @@ class GkeClusterTest(unittest.TestCase):
   @mock.patch('time.sleep')
   @mock.patch('process_util.run_command')
   @mock.patch(
-      'gke_cluster.GkeCluster.get_pod_status',
-      return_value=gke_cluster.PodStatus.SUCCEEDED)
+      'gke_cluster.GkeCluster._watch_pod',
+      side_effect=lambda *args: _watch(_pod('Pending'), _pod('Succeeded')))
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
   def test_deploy_pod(self, unused_mock_cluster_exists,
-                      unused_mock_get_pod_status, mock_call, unused_mock_sleep):
+                      unused_mock_watch_pod, mock_call, unused_mock_sleep):
     gke_cluster.GkeCluster(
         'foo-cluster', cluster_zone='foo-zone').deploy_pod(
             pod_config='foo-config', pod_name='foo-pod')
@@ -205,11 +231,11 @@ class GkeClusterTest(unittest.TestCase):
   @mock.patch('time.sleep')
   @mock.patch('process_util.run_command')
   @mock.patch(
-      'gke_cluster.GkeCluster.get_pod_status',
-      return_value=gke_cluster.PodStatus.FAILED)
+      'gke_cluster.GkeCluster._watch_pod',
+      side_effect=lambda *args: _watch(_pod('Running'), _pod('Failed')))
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
   def test_deploy_pod_fails(self, unused_mock_cluster_exists,
-                            unused_mock_get_pod_status, unused_mock_call,
+                            unused_mock_watch_pod, unused_mock_call,
                             unused_mock_sleep):
     with self.assertRaises(RuntimeError):
       gke_cluster.GkeCluster(
@@ -218,30 +244,120 @@ class GkeClusterTest(unittest.TestCase):
 
   @mock.patch('time.sleep')
   @mock.patch(
-      'time.time', side_effect=(0, gke_cluster._PENDING_STATE_TIMEOUT_SEC + 1))
+      'time.time',
+      side_effect=(0, 0, gke_cluster._PENDING_STATE_TIMEOUT_SEC + 1))
   @mock.patch('process_util.run_command')
   @mock.patch(
       'gke_cluster.GkeCluster.get_pod_status',
       return_value=gke_cluster.PodStatus.PENDING)
+  @mock.patch(
+      'gke_cluster.GkeCluster._watch_pod',
+      side_effect=lambda *args: _watch(_pod('Pending')))
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
   def test_deploy_pod_timeout_in_pending_state(
-      self, unused_mock_cluster_exists, unused_mock_get_pod_status,
-      unused_mock_call, unused_mock_time, unused_mock_sleep):
+      self, unused_mock_cluster_exists, mock_watch_pod,
+      unused_mock_get_pod_status, unused_mock_call, unused_mock_time,
+      unused_mock_sleep):
     with self.assertRaises(RuntimeError):
       gke_cluster.GkeCluster(
           'foo-cluster', cluster_zone='foo-zone').deploy_pod(
               pod_config='foo-config', pod_name='foo-pod')
+    mock_watch_pod.assert_called_once_with(
+        'foo-pod', gke_cluster._PENDING_STATE_TIMEOUT_SEC)
 
   @mock.patch('time.sleep')
   @mock.patch('process_util.run_command')
   @mock.patch('gke_cluster.GkeCluster.get_pod_status')
+  @mock.patch('gke_cluster.GkeCluster._watch_pod')
+  @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
+  def test_deploy_pod_restarts_ended_watch(
+      self, unused_mock_cluster_exists, mock_watch_pod, mock_get_pod_status,
+      unused_mock_call, unused_mock_sleep):
+    mock_watch_pod.side_effect = [
+        _watch(_pod('Pending')),
+        _watch(_pod('Running')),
+        _watch(_pod('Succeeded')),
+    ]
+    mock_get_pod_status.return_value = gke_cluster.PodStatus.PENDING
+    gke_cluster.GkeCluster(
+        'foo-cluster', cluster_zone='foo-zone').deploy_pod(
+            pod_config='foo-config', pod_name='foo-pod')
+    self.assertEqual(mock_watch_pod.call_count, 3)
+    mock_get_pod_status.assert_called_once_with('foo-pod')
+
+  @mock.patch('time.sleep')
+  @mock.patch('process_util.run_command')
+  @mock.patch(
+      'gke_cluster.GkeCluster._watch_pod',
+      side_effect=lambda *args: _watch(
+          _pod('Pending'), _pod('Pending', 'ImagePullBackOff')))
+  @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
+  def test_deploy_pod_pulling_image_failed(self, unused_mock_cluster_exists,
+                                           mock_watch_pod, unused_mock_call,
+                                           unused_mock_sleep):
+    with self.assertRaises(RuntimeError):
+      gke_cluster.GkeCluster(
+          'foo-cluster', cluster_zone='foo-zone').deploy_pod(
+              pod_config='foo-config', pod_name='foo-pod')
+    self.assertEqual(mock_watch_pod.call_count, 1)
+
+  @mock.patch('subprocess.Popen')
+  @mock.patch('process_util.run_command')
+  @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
+  def test_watch_pod(self, unused_mock_cluster_exists, unused_mock_call,
+                     mock_popen):
+    process = mock_popen.return_value
+    process.stdout = _watch_stream(_pod('Pending'), _pod('Running'))
+    process.poll.return_value = 0
+    process.wait.return_value = 0
+    pods = list(
+        gke_cluster.GkeCluster('foo-cluster',
+                               cluster_zone='foo-zone')._watch_pod(
+                                   'foo-pod', timeout=9.5))
+    self.assertEqual(pods, [_pod('Pending'), _pod('Running')])
+    self.assertEqual(mock_popen.call_args[0][0], [
+        'kubectl', 'get', 'pods', 'foo-pod', '--watch', '-o', 'json',
+        '--request-timeout=10s'
+    ])
+    self.assertTrue(process.stdout.closed)
+
+  def test_parse_watch_events(self):
+    self.assertEqual(
+        list(
+            gke_cluster.parse_watch_events(
+                _watch_stream(_pod('Pending'), {'a': {'b': '}'}},
+                              _pod('Running')))),
+        [_pod('Pending'), {'a': {'b': '}'}}, _pod('Running')])
+
+  def test_parse_watch_events_incomplete(self):
+    events = gke_cluster.parse_watch_events(io.StringIO('{"a": 1}\n{"b": '))
+    self.assertEqual(next(events), {'a': 1})
+    with self.assertRaises(ValueError):
+      next(events)
+
+  def test_get_pod_object_status(self):
+    self.assertEqual(
+        gke_cluster.get_pod_object_status(_pod('Running')),
+        gke_cluster.PodStatus.RUNNING)
+    self.assertEqual(
+        gke_cluster.get_pod_object_status(_pod('Pending', 'ContainerCreating')),
+        gke_cluster.PodStatus.PENDING)
+    self.assertEqual(
+        gke_cluster.get_pod_object_status(_pod('Pending', 'ErrImagePull')),
+        gke_cluster.PodStatus.FAILED)
+    self.assertEqual(
+        gke_cluster.get_pod_object_status({}), gke_cluster.PodStatus.UNKNOWN)
+
+  @mock.patch('time.sleep')
+  @mock.patch('process_util.run_command')
+  @mock.patch('gke_cluster.GkeCluster._watch_pod')
   @mock.patch('gke_cluster.GkeCluster.delete_pod')
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
   def test_deploy_pod_retries(self, unused_mock_cluster_exists,
-                              unused_mock_delete_pod, mock_get_pod_status,
+                              unused_mock_delete_pod, mock_watch_pod,
                               mock_call, unused_mock_sleep):
-    mock_get_pod_status.side_effect = [
-        gke_cluster.PodStatus.FAILED, gke_cluster.PodStatus.SUCCEEDED
+    mock_watch_pod.side_effect = [
+        _watch(_pod('Failed')), _watch(_pod('Succeeded'))
     ]
     gke_cluster.GkeCluster(
         'foo-cluster', cluster_zone='foo-zone').deploy_pod(
@@ -257,7 +373,8 @@ class GkeClusterTest(unittest.TestCase):
         retries=1,
         retry_delay_sec=1)
 
-  @mock.patch('process_util.run_command', return_value='Succeeded')
+  @mock.patch(
+      'process_util.run_command', return_value=json.dumps(_pod('Succeeded')))
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
   def test_get_pod_status(self, unused_mock_cluster_exists, mock_call):
     self.assertEqual(
@@ -266,7 +383,7 @@ class GkeClusterTest(unittest.TestCase):
             cluster_zone='foo-zone').get_pod_status(pod_name='foo-pod'),
         gke_cluster.PodStatus.SUCCEEDED)
     mock_call.assert_any_call(
-        ['kubectl', 'get', 'pods', 'foo-pod', '-o', 'jsonpath={.status.phase}'],
+        ['kubectl', 'get', 'pods', 'foo-pod', '-o', 'json'],
         std_input=None,
         retries=0,
         retry_delay_sec=1)
@@ -275,7 +392,8 @@ class GkeClusterTest(unittest.TestCase):
   # needed but irrelevant to this test.
   @mock.patch(
       'process_util.run_command',
-      side_effect=('foo-cluster', 'RUNNING', 'Pending', 'ImagePullBackOff'))
+      side_effect=('foo-cluster', 'RUNNING',
+                   json.dumps(_pod('Pending', 'ImagePullBackOff'))))
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
   def test_get_pod_status_pulling_image_failed(self, unused_mock_cluster_exists,
                                                mock_call):
@@ -285,18 +403,10 @@ class GkeClusterTest(unittest.TestCase):
             cluster_zone='foo-zone').get_pod_status(pod_name='foo-pod'),
         gke_cluster.PodStatus.FAILED)
     mock_call.assert_any_call(
-        ['kubectl', 'get', 'pods', 'foo-pod', '-o', 'jsonpath={.status.phase}'],
+        ['kubectl', 'get', 'pods', 'foo-pod', '-o', 'json'],
         std_input=None,
         retries=0,
         retry_delay_sec=1)
-    mock_call.assert_any_call([
-        'kubectl', 'get', 'pods', 'foo-pod', '-o',
-        'go-template="{{range .status.containerStatuses}}{{if not .ready}}'
-        '{{.state.waiting.reason}}{{end}}{{end}}"'
-    ],
-                              std_input=None,
-                              retries=0,
-                              retry_delay_sec=1)
 
   @mock.patch('process_util.run_command', return_value='foo-status')
   @mock.patch('gke_cluster.GkeCluster._cluster_exists', return_value=True)
@@ -307,7 +417,7 @@ class GkeClusterTest(unittest.TestCase):
             cluster_zone='foo-zone').get_pod_status(pod_name='foo-pod'),
         gke_cluster.PodStatus.UNKNOWN)
     mock_call.assert_any_call(
-        ['kubectl', 'get', 'pods', 'foo-pod', '-o', 'jsonpath={.status.phase}'],
+        ['kubectl', 'get', 'pods', 'foo-pod', '-o', 'json'],
         std_input=None,
         retries=0,
         retry_delay_sec=1)
@@ -327,5 +437,81 @@ class GkeClusterTest(unittest.TestCase):
         retry_delay_sec=0)
 
 
+
+_POD_CONFIG = json.dumps({
+    'kind': 'Pod',
+    'apiVersion': 'v1',
+    'metadata': {'name': 'foo-pod'},
+    'spec': {'containers': [{'name': 'foo', 'image': 'foo-image'}]},
+})
+
+
+class GkeClusterKubernetesApiTest(unittest.TestCase):
+  """Tests GkeCluster with a Kubernetes API client of a fake API server."""
+
+  def setUp(self):
+    super(GkeClusterKubernetesApiTest, self).setUp()
+    self._server = fake_kubernetes_server.FakeKubernetesServer(phase_sec=0.01)
+    self._server.start()
+    self.addCleanup(self._server.stop)
+    for patcher in (
+        mock.patch('process_util.run_command'),
+        mock.patch(
+            'gke_cluster.GkeCluster._cluster_exists', return_value=True),
+        mock.patch(
+            'kubernetes_client.KubernetesClient.from_kubectl_config',
+            side_effect=lambda: kubernetes_client.KubernetesClient(
+                self._server.url))):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self._cluster = gke_cluster.GkeCluster(
+        'foo-cluster', cluster_zone='foo-zone', use_kubernetes_api=True)
+
+  def test_deploy_pod(self):
+    self._cluster.deploy_pod(
+        pod_config=_POD_CONFIG, pod_name='foo-pod')
+    self.assertIsNone(self._server.get_pod('foo-pod'))
+
+  def test_deploy_pod_retries(self):
+    self._server.pod_phases = ('Pending', 'Running', 'Failed')
+    with mock.patch.object(
+        kubernetes_client.KubernetesClient,
+        'create_pod',
+        autospec=True,
+        side_effect=kubernetes_client.KubernetesClient.create_pod
+    ) as mock_create_pod:
+      with self.assertRaises(RuntimeError):
+        self._cluster.deploy_pod(
+            pod_config=_POD_CONFIG, pod_name='foo-pod', retries=1)
+    self.assertEqual(mock_create_pod.call_count, 2)
+    self.assertIsNone(self._server.get_pod('foo-pod'))
+
+  def test_get_pod_status(self):
+    self._server.phase_sec = None
+    self._cluster.deploy_pod(
+        pod_config=_POD_CONFIG, pod_name='foo-pod', wait=False)
+    self._server.set_pod_status('foo-pod', 'Pending', 'ImagePullBackOff')
+    self.assertEqual(
+        self._cluster.get_pod_status('foo-pod'), gke_cluster.PodStatus.FAILED)
+    self.assertTrue(self._cluster._pod_exists('foo-pod'))
+    self._cluster.delete_pod('foo-pod')
+    self.assertFalse(self._cluster._pod_exists('foo-pod'))
+
+  @mock.patch('process_util.run_command')
+  @mock.patch(
+      'kubernetes_client.KubernetesClient.from_kubectl_config',
+      side_effect=kubernetes_client.KubernetesApiError('foo-error'))
+  def test_falls_back_to_kubectl(self, unused_mock_from_kubectl_config,
+                                 mock_call):
+    cluster = gke_cluster.GkeCluster(
+        'foo-cluster', cluster_zone='foo-zone', use_kubernetes_api=True)
+    cluster.deploy_pod(pod_config='foo-config', pod_name='foo-pod', wait=False)
+    mock_call.assert_any_call(
+        ['kubectl', 'create', '-f', '-'],
+        std_input='foo-config',
+        retries=1,
+        retry_delay_sec=1)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,211 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+r"""Compares process and thread pools for supervising pipelines workers.
+
+Runs N workers through JobScheduler and gcp_deepvariant_runner._run_job, where
+the pipelines tool is replaced by a script that sleeps, and reports for each
+pool type:
+  - pool_startup_sec: time to create the pool.
+  - launch_latency_sec: time until the last worker subprocess started.
+  - wall_sec: time until all workers finished.
+  - peak_pss_mb: peak proportional set size (resident memory with shared pages
+    split between processes) of the Python processes of the run, i.e.
+    excluding the fake pipelines subprocesses. Linux only.
+
+Sample run command:
+$ python job_pool_benchmark.py --workers 10 100 1000 --output results.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+import gcp_deepvariant_runner
+import job_scheduler
+
+
+_FAKE_PIPELINES_SCRIPT = r"""#!/bin/bash
+date +%s.%N >> "{STARTED_FILE}"
+sleep {JOB_SEC}
+"""
+
+_POOL_TYPES = {
+    'process': multiprocessing.Pool,
+    'thread': multiprocessing.pool.ThreadPool,
+}
+
+
+class _PssSampler(threading.Thread):
+  """Samples the total PSS of this process and its Python children."""
+
+  def __init__(self, interval_sec=0.05):
+    super(_PssSampler, self).__init__()
+    self.daemon = True
+    self.peak_pss_kb = 0
+    self._interval_sec = interval_sec
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.is_set():
+      self.peak_pss_kb = max(self.peak_pss_kb, _get_python_tree_pss_kb())
+      self._stopped.wait(self._interval_sec)
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+
+def _read_proc_file(pid, name):
+  try:
+    with open(os.path.join('/proc', str(pid), name)) as f:
+      return f.read()
+  except (IOError, OSError):
+    return ''
+
+
+def _get_python_tree_pss_kb():
+  """Returns the PSS (in KB) of this process and its Python descendants."""
+  total_kb = 0
+  pids = [os.getpid()]
+  while pids:
+    pid = pids.pop()
+    if 'python' in _read_proc_file(pid, 'comm'):
+      for line in _read_proc_file(pid, 'smaps_rollup').splitlines():
+        if line.startswith('Pss:'):
+          total_kb += int(line.split()[1])
+    for task in os.listdir(os.path.join('/proc', str(pid), 'task')) if (
+        os.path.isdir(os.path.join('/proc', str(pid), 'task'))) else []:
+      pids.extend(
+          int(child)
+          for child in _read_proc_file(pid, 'task/%s/children' % task).split())
+  return total_kb
+
+
+def _write_fake_pipelines(bin_dir, started_file, job_sec):
+  path = os.path.join(bin_dir, 'pipelines')
+  with open(path, 'w') as f:
+    f.write(
+        _FAKE_PIPELINES_SCRIPT.format(STARTED_FILE=started_file,
+                                      JOB_SEC=job_sec))
+  os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def _benchmark(pool_type, num_workers, job_sec, work_dir):
+  """Runs num_workers fake workers and returns the measurements."""
+  started_file = os.path.join(work_dir, '%s-%d.started' % (pool_type,
+                                                           num_workers))
+  _write_fake_pipelines(work_dir, started_file, job_sec)
+
+  graph = job_scheduler.JobGraph()
+  for i in range(num_workers):
+    graph.add_job(
+        str(i), gcp_deepvariant_runner._run_job,
+        [['pipelines', 'run', str(i)], 'log-%d' % i])
+
+  sampler = _PssSampler()
+  sampler.start()
+  start_time = time.time()
+  pool = _POOL_TYPES[pool_type](processes=num_workers)
+  pool_startup_sec = time.time() - start_time
+  try:
+    job_scheduler.JobScheduler(graph, pool).run()
+  finally:
+    pool.close()
+    pool.join()
+  wall_sec = time.time() - start_time
+  sampler.stop()
+
+  with open(started_file) as f:
+    last_started = max(float(line) for line in f if line.strip())
+  return {
+      'pool_type': pool_type,
+      'workers': num_workers,
+      'pool_startup_sec': round(pool_startup_sec, 3),
+      'launch_latency_sec': round(last_started - start_time, 3),
+      'wall_sec': round(wall_sec, 3),
+      'peak_pss_mb': round(sampler.peak_pss_kb / 1024, 1),
+  }
+
+
+def run(argv=None):
+  """Runs the benchmark."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--workers',
+      type=int,
+      nargs='+',
+      default=[10, 100, 1000],
+      help='Number of workers to benchmark.')
+  parser.add_argument(
+      '--pool_types',
+      nargs='+',
+      default=sorted(_POOL_TYPES),
+      choices=sorted(_POOL_TYPES),
+      help='Pool types to benchmark.')
+  parser.add_argument(
+      '--job_sec',
+      type=float,
+      default=2,
+      help='Time (in seconds) each fake pipelines job runs for.')
+  parser.add_argument(
+      '--output', help='Optional path to write the results to as JSON.')
+  args = parser.parse_args(argv)
+
+  work_dir = tempfile.mkdtemp()
+  old_path = os.environ['PATH']
+  os.environ['PATH'] = work_dir + os.pathsep + old_path
+  results = []
+  try:
+    for num_workers in args.workers:
+      for pool_type in args.pool_types:
+        result = _benchmark(pool_type, num_workers, args.job_sec, work_dir)
+        print(json.dumps(result, sort_keys=True))
+        results.append(result)
+  finally:
+    os.environ['PATH'] = old_path
+    shutil.rmtree(work_dir)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  run()
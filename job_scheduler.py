@@ -0,0 +1,537 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Dependency-graph scheduler for running pipeline jobs concurrently.
+
+Each job in a JobGraph is a single unit of work (e.g. one worker of a pipeline
+stage) and may depend on other jobs, e.g. because it reads their outputs. The
+JobScheduler dispatches a job as soon as all of its dependencies succeeded.
+
+Speculative jobs that straggle behind the other jobs of their stage may be run
+a second time concurrently. The job succeeds with the first of its attempts
+to succeed, and the other one is cancelled through the callbacks registered
+by the job function with add_cancel_callback.
+
+Jobs may also run in a process pool (e.g. multiprocessing.Pool), as long as
+their functions and arguments can be pickled. Their attempts are then only
+tracked by the scheduler, so they are neither run speculatively nor cancelled
+through callbacks.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import enum
+import itertools
+import logging
+import statistics
+import threading
+import time
+
+
+# Maximum time (in seconds) the scheduler blocks before re-checking job states.
+_WAIT_TIMEOUT_SEC = 1
+# Minimum fraction (and number) of the jobs of a stage that must have
+# succeeded before stragglers of the stage are run speculatively.
+_SPECULATION_MIN_SUCCEEDED_FRACTION = 0.5
+_SPECULATION_MIN_SUCCEEDED_JOBS = 2
+
+# Attempt run by the current thread.
+_local = threading.local()
+# Attempts that were started but are not done yet, by id. Pool workers look up
+# the attempt they run here, so that only picklable arguments are sent to the
+# pool. Workers of a process pool do not find it.
+_attempts = {}
+_attempt_ids = itertools.count()
+
+
+def add_cancel_callback(callback):
+  """Registers a callback cancelling the work of the current job attempt.
+
+  Must be called from within a job function. The callback is called (from
+  another thread) if the attempt is cancelled, e.g. because another attempt of
+  the same job succeeded first, and should make the job function return or
+  raise soon.
+
+  Returns:
+    A function unregistering the callback, to call once the work it cancels
+    is done.
+  """
+  attempt = getattr(_local, 'attempt', None)
+  if attempt is None:
+    return lambda: None
+  return attempt.add_cancel_callback(callback)
+
+
+def get_attempt_index():
+  """Returns the index of the current job attempt (0 unless speculative)."""
+  attempt = getattr(_local, 'attempt', None)
+  return attempt.index if attempt else 0
+
+
+def _run_attempt(attempt_id, func, args):
+  """Runs the function of a job in a pool worker."""
+  attempt = _attempts.get(attempt_id)
+  if attempt is None:
+    # Run by a process pool.
+    return func(*args)
+  attempt.start_time = time.time()
+  _local.attempt = attempt
+  try:
+    return func(*args)
+  finally:
+    _local.attempt = None
+
+
+class _Attempt(object):
+  """A single run of the function of a job."""
+
+  def __init__(self, index):
+    self.id = next(_attempt_ids)
+    self.index = index
+    self.start_time = None
+    self.resources_acquired = False
+    self.done = False
+    self.cancelled = False
+    self._cancel_callbacks = []
+    self._lock = threading.Lock()
+
+  def add_cancel_callback(self, callback):
+    with self._lock:
+      if not self.cancelled:
+        self._cancel_callbacks.append(callback)
+        return lambda: self._remove_cancel_callback(callback)
+    callback()
+    return lambda: None
+
+  def _remove_cancel_callback(self, callback):
+    with self._lock:
+      if callback in self._cancel_callbacks:
+        self._cancel_callbacks.remove(callback)
+
+  def cancel(self):
+    with self._lock:
+      self.cancelled = True
+      callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+    for callback in callbacks:
+      try:
+        callback()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error('Failed to cancel attempt: %s', e)
+
+
+@enum.unique
+class JobState(enum.Enum):
+  """Enums for job states."""
+  PENDING = 0
+  RUNNING = 1
+  SUCCEEDED = 2
+  FAILED = 3
+  CANCELLED = 4
+
+
+class Job(object):
+  """A single node of a JobGraph."""
+
+  def __init__(self, name, func, args, dependencies, stage, cancel_func,
+               resources=None, speculative=False):
+    """A single node of a JobGraph.
+
+    Args:
+      name: (str) unique name of the job.
+      func: (callable) function that runs the job. Its return value is ignored
+        and the job fails if it raises.
+      args: (list) arguments to pass to func.
+      dependencies: (list) names of the jobs that must succeed first.
+      stage: (str) name of the pipeline stage the job belongs to.
+      cancel_func: (callable) if set, called with args when the run is
+        cancelled while the job is running, e.g. to release its resources.
+      resources: (dict) if set, resources (see admission_control.RESOURCES)
+        the job uses while running.
+      speculative: (bool) whether the job may be run twice concurrently if
+        it straggles. Its function must then be idempotent.
+    """
+    self.name = name
+    self.func = func
+    self.args = args
+    self.dependencies = dependencies
+    self.stage = stage
+    self.cancel_func = cancel_func
+    self.resources = resources
+    self.speculative = speculative
+    self.attempts = []
+    self.state = JobState.PENDING
+    self.error = None
+    self.start_time = None
+    self.end_time = None
+
+  def to_dict(self):
+    """Returns a JSON serializable description of the job."""
+    return {
+        'name': self.name,
+        'stage': self.stage,
+        'state': self.state.name,
+        'dependencies': list(self.dependencies),
+        'start_time': self.start_time,
+        'end_time': self.end_time,
+        'error': str(self.error) if self.error else None,
+        'attempts': len(self.attempts),
+    }
+
+
+class JobGraph(object):
+  """A directed acyclic graph of jobs."""
+
+  def __init__(self):
+    self._jobs = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._jobs)
+
+  def add_job(self,
+              name,
+              func,
+              args=None,
+              dependencies=None,
+              stage=None,
+              cancel_func=None,
+              resources=None,
+              speculative=False):
+    """Adds a job to the graph.
+
+    Dependencies must be added before the jobs depending on them, which
+    guarantees the graph is acyclic.
+
+    Args:
+      name: (str) unique name of the job.
+      func: (callable) function that runs the job.
+      args: (list) arguments to pass to func.
+      dependencies: (list) names of the jobs that must succeed first.
+      stage: (str) name of the pipeline stage the job belongs to.
+      cancel_func: (callable) if set, called with args when the run is
+        cancelled while the job is running.
+      resources: (dict) if set, resources the job uses while running.
+      speculative: (bool) whether the job may be run twice concurrently if
+        it straggles.
+
+    Returns:
+      The added Job.
+
+    Raises:
+      ValueError: if the name is already used or a dependency does not exist.
+    """
+    if name in self._jobs:
+      raise ValueError('Duplicate job name: %s' % name)
+    dependencies = list(dependencies or [])
+    for dependency in dependencies:
+      if dependency not in self._jobs:
+        raise ValueError(
+            'Job %s depends on unknown job %s.' % (name, dependency))
+    job = Job(name, func, list(args or []), dependencies, stage, cancel_func,
+              resources, speculative)
+    self._jobs[name] = job
+    return job
+
+  def get_job(self, name):
+    """Returns the job with the given name."""
+    return self._jobs[name]
+
+  def get_jobs(self, stage=None, state=None):
+    """Returns jobs (in insertion order), optionally filtered.
+
+    Args:
+      stage: (str) if set, only returns jobs of this stage.
+      state: (JobState) if set, only returns jobs in this state.
+    """
+    return [
+        job for job in self._jobs.values()
+        if (stage is None or job.stage == stage) and
+        (state is None or job.state == state)
+    ]
+
+  def get_ready_jobs(self):
+    """Returns pending jobs whose dependencies have all succeeded."""
+    return [
+        job for job in self.get_jobs(state=JobState.PENDING) if all(
+            self._jobs[dependency].state == JobState.SUCCEEDED
+            for dependency in job.dependencies)
+    ]
+
+  def max_width(self):
+    """Returns the largest number of jobs sharing the same depth.
+
+    The depth of a job is the length of the longest dependency chain leading to
+    it. This is the number of jobs that can run concurrently when all jobs of
+    the same depth take the same time.
+    """
+    depths = {}
+    for job in self._jobs.values():
+      depths[job.name] = 1 + max(
+          [depths[dependency] for dependency in job.dependencies] or [0])
+    return max(collections.Counter(depths.values()).values() or [0])
+
+  def add_subgraph(self, graph, prefix):
+    """Adds all jobs of another graph, with prefix added to their names.
+
+    Jobs keep their state, so that jobs already known to be complete stay
+    skipped. The stage of each job is prefixed too.
+
+    Args:
+      graph: (JobGraph) graph whose jobs to add.
+      prefix: (str) prefix of the names and stages of the added jobs.
+    """
+    for job in graph.get_jobs():
+      added_job = self.add_job(
+          prefix + job.name,
+          job.func,
+          job.args,
+          dependencies=[prefix + dependency for dependency in job.dependencies],
+          stage=prefix + job.stage if job.stage else job.stage,
+          cancel_func=job.cancel_func,
+          resources=job.resources,
+          speculative=job.speculative)
+      added_job.state = job.state
+
+  def to_dict(self):
+    """Returns a JSON serializable description of the graph."""
+    return {'jobs': [job.to_dict() for job in self._jobs.values()]}
+
+
+class JobScheduler(object):
+  """Runs the jobs of a JobGraph as soon as their dependencies succeed."""
+
+  def __init__(self,
+               graph,
+               pool,
+               fail_fast=True,
+               admission_controller=None,
+               speculation_factor=0):
+    """Runs the jobs of a JobGraph as soon as their dependencies succeed.
+
+    Args:
+      graph: (JobGraph) jobs to run.
+      pool: pool used to run jobs. Must provide the apply_async method of
+        multiprocessing.Pool (with callback and error_callback).
+      fail_fast: (bool) whether to stop dispatching jobs once a job fails.
+        Otherwise, only the jobs depending on a failed job are cancelled.
+      admission_controller: (admission_control.AdmissionController) if set,
+        jobs with resources are only dispatched once they fit its quota. Ready
+        jobs are admitted in order, so that large jobs are not starved by
+        smaller ones.
+      speculation_factor: (float) if positive, a speculative job running for
+        longer than this many times the median duration of the succeeded jobs
+        of its stage (once at least half of them succeeded) is run a second
+        time, unless the pool is busy.
+    """
+    self._graph = graph
+    self._pool = pool
+    self._fail_fast = fail_fast
+    self._admission_controller = admission_controller
+    self._speculation_factor = speculation_factor
+    self._waiting_jobs = set()
+    # Durations of the succeeded attempts of each stage.
+    self._durations = collections.defaultdict(list)
+    # Callbacks may be invoked from within apply_async, hence the RLock.
+    self._condition = threading.Condition(threading.RLock())
+    self._started_stages = set()
+
+  def run(self):
+    """Runs all jobs in the graph and blocks until they are finished.
+
+    Once a job fails, no new jobs are dispatched (unless fail_fast is False,
+    in which case the jobs not depending on it still are), the already running
+    ones are waited on, and the remaining jobs are cancelled.
+
+    Raises:
+      RuntimeError: if a job fails or the run is cancelled by the user.
+      ValueError: if a job needs more resources than the whole quota.
+    """
+    if self._admission_controller:
+      for job in self._graph.get_jobs(state=JobState.PENDING):
+        if job.resources:
+          self._admission_controller.check(job.resources)
+    with self._condition:
+      try:
+        while True:
+          if not self._should_stop():
+            self._dispatch_ready_jobs()
+            if self._speculation_factor > 0:
+              self._speculate_stragglers()
+          if not self._graph.get_jobs(state=JobState.RUNNING):
+            break
+          self._condition.wait(_WAIT_TIMEOUT_SEC)
+      except KeyboardInterrupt:
+        self._cancel_pending_jobs()
+        self._cancel_running_jobs()
+        raise RuntimeError('Cancelled')
+
+      self._cancel_pending_jobs()
+      failed_jobs = self._graph.get_jobs(state=JobState.FAILED)
+    if failed_jobs:
+      raise RuntimeError('Job %s failed with error: %s' %
+                         (failed_jobs[0].name, failed_jobs[0].error))
+
+  def _dispatch_ready_jobs(self):
+    """Dispatches all jobs whose dependencies have succeeded."""
+    ready_jobs = self._graph.get_ready_jobs()
+    while ready_jobs:
+      for job in ready_jobs:
+        if not self._admit(job):
+          # Dispatched again once a running job releases its resources.
+          return
+        if job.stage not in self._started_stages:
+          self._started_stages.add(job.stage)
+          logging.info('Running %s...', job.stage)
+        job.state = JobState.RUNNING
+        job.start_time = time.time()
+        logging.debug('Dispatching job %s.', job.name)
+        self._start_attempt(job, resources_acquired=bool(job.resources))
+      # Jobs may complete synchronously and unblock others.
+      ready_jobs = [] if self._should_stop() else self._graph.get_ready_jobs()
+
+  def _start_attempt(self, job, resources_acquired):
+    attempt = _Attempt(len(job.attempts))
+    attempt.resources_acquired = (
+        resources_acquired and self._admission_controller is not None)
+    job.attempts.append(attempt)
+    _attempts[attempt.id] = attempt
+    self._pool.apply_async(
+        _run_attempt, [attempt.id, job.func, job.args],
+        callback=lambda _, job=job, attempt=attempt: self._on_job_succeeded(
+            job, attempt),
+        error_callback=lambda e, job=job, attempt=attempt: self._on_job_failed(
+            job, attempt, e))
+
+  def _speculate_stragglers(self):
+    """Runs a second attempt of the speculative jobs that straggle."""
+    running_jobs = self._graph.get_jobs(state=JobState.RUNNING)
+    if any(attempt.start_time is None
+           for job in running_jobs
+           for attempt in job.attempts):
+      # The pool has no idle thread (or runs jobs in other processes).
+      return
+    now = time.time()
+    for job in running_jobs:
+      if not job.speculative or len(job.attempts) > 1:
+        continue
+      durations = self._durations[job.stage]
+      num_jobs = len(self._graph.get_jobs(stage=job.stage))
+      if (len(durations) < _SPECULATION_MIN_SUCCEEDED_JOBS or
+          len(durations) < _SPECULATION_MIN_SUCCEEDED_FRACTION * num_jobs):
+        continue
+      median_sec = statistics.median(durations)
+      elapsed_sec = now - job.attempts[0].start_time
+      if elapsed_sec <= self._speculation_factor * median_sec:
+        continue
+      resources_acquired = False
+      if self._admission_controller and job.resources:
+        if not self._admission_controller.try_acquire(job.resources):
+          continue
+        resources_acquired = True
+      logging.info(
+          'Job %s is straggling (%.0f seconds vs. a median of %.0f seconds); '
+          'running it speculatively.', job.name, elapsed_sec, median_sec)
+      self._start_attempt(job, resources_acquired)
+
+  def _admit(self, job):
+    """Returns whether the resources of a job were reserved."""
+    if not self._admission_controller or not job.resources:
+      return True
+    if self._admission_controller.try_acquire(job.resources):
+      self._waiting_jobs.discard(job.name)
+      return True
+    if job.name not in self._waiting_jobs:
+      self._waiting_jobs.add(job.name)
+      logging.info('Job %s waits for quota (in use: %s).', job.name,
+                   self._admission_controller.get_in_use())
+    return False
+
+  def _finish_attempt(self, job, attempt):
+    attempt.done = True
+    _attempts.pop(attempt.id, None)
+    if attempt.resources_acquired:
+      self._admission_controller.release(job.resources)
+
+  def _should_stop(self):
+    return self._fail_fast and self._graph.get_jobs(state=JobState.FAILED)
+
+  def _on_job_succeeded(self, job, attempt):
+    with self._condition:
+      self._finish_attempt(job, attempt)
+      if job.state != JobState.RUNNING:
+        # Another attempt already finished the job.
+        self._condition.notify_all()
+        return
+      job.state = JobState.SUCCEEDED
+      job.end_time = time.time()
+      # Attempts run by a process pool have no start time of their own.
+      self._durations[job.stage].append(
+          job.end_time - (attempt.start_time or job.start_time))
+      for other_attempt in job.attempts:
+        if not other_attempt.done:
+          logging.info('Cancelling the other attempt of job %s.', job.name)
+          other_attempt.cancel()
+      logging.debug('Job %s succeeded in %.1f seconds.', job.name,
+                    job.end_time - job.start_time)
+      if all(j.state == JobState.SUCCEEDED
+             for j in self._graph.get_jobs(stage=job.stage)):
+        logging.info('%s is done!', job.stage)
+      self._condition.notify_all()
+
+  def _on_job_failed(self, job, attempt, error):
+    with self._condition:
+      self._finish_attempt(job, attempt)
+      if job.state != JobState.RUNNING or attempt.cancelled:
+        self._condition.notify_all()
+        return
+      if not all(other_attempt.done for other_attempt in job.attempts):
+        logging.warning('Attempt %d of job %s failed: %s', attempt.index,
+                        job.name, error)
+        self._condition.notify_all()
+        return
+      job.state = JobState.FAILED
+      job.end_time = time.time()
+      job.error = error
+      logging.error('Job %s failed: %s', job.name, error)
+      self._condition.notify_all()
+
+  def _cancel_pending_jobs(self):
+    for job in self._graph.get_jobs(state=JobState.PENDING):
+      job.state = JobState.CANCELLED
+
+  def _cancel_running_jobs(self):
+    """Calls the cancel_func of all running jobs."""
+    for job in self._graph.get_jobs(state=JobState.RUNNING):
+      if job.cancel_func:
+        logging.info('Cancelling job %s...', job.name)
+        try:
+          job.cancel_func(*job.args)
+        except Exception as e:  # pylint: disable=broad-except
+          logging.error('Failed to cancel job %s: %s', job.name, e)
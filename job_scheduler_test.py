@@ -0,0 +1,321 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for job_scheduler.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python job_scheduler_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import _thread
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+import unittest
+
+import admission_control
+import job_scheduler
+import mock
+
+
+class _RecordingFunc(object):
+  """Helper class that records the order in which jobs are run."""
+
+  def __init__(self):
+    self.calls = []
+    self._lock = threading.Lock()
+
+  def __call__(self, name, fail=False):
+    with self._lock:
+      self.calls.append(name)
+    if fail:
+      raise RuntimeError('%s failed' % name)
+
+
+class JobGraphTest(unittest.TestCase):
+  """Tests for JobGraph class."""
+
+  def test_add_job_duplicate_name(self):
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', len)
+    with self.assertRaisesRegex(ValueError, 'Duplicate job name: a'):
+      graph.add_job('a', len)
+
+  def test_add_job_unknown_dependency(self):
+    graph = job_scheduler.JobGraph()
+    with self.assertRaisesRegex(ValueError, 'unknown job b'):
+      graph.add_job('a', len, dependencies=['b'])
+
+  def test_get_ready_jobs(self):
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', len)
+    graph.add_job('b', len)
+    graph.add_job('c', len, dependencies=['a'])
+    self.assertEqual([job.name for job in graph.get_ready_jobs()], ['a', 'b'])
+    graph.get_job('a').state = job_scheduler.JobState.SUCCEEDED
+    self.assertEqual([job.name for job in graph.get_ready_jobs()], ['b', 'c'])
+
+  def test_max_width(self):
+    graph = job_scheduler.JobGraph()
+    self.assertEqual(graph.max_width(), 0)
+    for i in range(3):
+      graph.add_job('me/%d' % i, len)
+    graph.add_job('cv/0', len, dependencies=['me/0', 'me/1'])
+    graph.add_job('cv/1', len, dependencies=['me/2'])
+    graph.add_job('pp', len, dependencies=['cv/0', 'cv/1'])
+    self.assertEqual(graph.max_width(), 3)
+
+  def test_add_subgraph(self):
+    subgraph = job_scheduler.JobGraph()
+    subgraph.add_job('a', len, stage='foo')
+    subgraph.add_job('b', len, dependencies=['a'], stage='bar')
+    subgraph.get_job('a').state = job_scheduler.JobState.SUCCEEDED
+    graph = job_scheduler.JobGraph()
+    graph.add_subgraph(subgraph, 's1/')
+    graph.add_subgraph(subgraph, 's2/')
+    self.assertEqual(
+        [(job.name, job.stage, job.state, job.dependencies)
+         for job in graph.get_jobs()][:2],
+        [('s1/a', 's1/foo', job_scheduler.JobState.SUCCEEDED, []),
+         ('s1/b', 's1/bar', job_scheduler.JobState.PENDING, ['s1/a'])])
+    self.assertEqual(len(graph), 4)
+
+  def test_to_dict(self):
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', len, stage='foo')
+    graph.add_job('b', len, dependencies=['a'], stage='bar')
+    self.assertEqual(
+        [(job['name'], job['stage'], job['state'], job['dependencies'])
+         for job in graph.to_dict()['jobs']],
+        [('a', 'foo', 'PENDING', []), ('b', 'bar', 'PENDING', ['a'])])
+
+
+class JobSchedulerTest(unittest.TestCase):
+  """Tests for JobScheduler class."""
+
+  def setUp(self):
+    super(JobSchedulerTest, self).setUp()
+    self._pool = multiprocessing.pool.ThreadPool(4)
+
+  def tearDown(self):
+    self._pool.close()
+    self._pool.join()
+    super(JobSchedulerTest, self).tearDown()
+
+  def test_run_respects_dependencies(self):
+    func = _RecordingFunc()
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', func, ['a'], stage='first')
+    graph.add_job('b', func, ['b'], stage='first')
+    graph.add_job('c', func, ['c'], dependencies=['a'], stage='second')
+    graph.add_job('d', func, ['d'], dependencies=['b', 'c'], stage='third')
+    job_scheduler.JobScheduler(graph, self._pool).run()
+
+    self.assertEqual(sorted(func.calls), ['a', 'b', 'c', 'd'])
+    self.assertLess(func.calls.index('a'), func.calls.index('c'))
+    self.assertEqual(func.calls[-1], 'd')
+    for job in graph.get_jobs():
+      self.assertEqual(job.state, job_scheduler.JobState.SUCCEEDED)
+      self.assertIsNotNone(job.end_time)
+
+  def test_run_failure_cancels_pending_jobs(self):
+    func = _RecordingFunc()
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', func, ['a', True])
+    graph.add_job('b', func, ['b'], dependencies=['a'])
+    graph.add_job('c', func, ['c'], dependencies=['b'])
+    with self.assertRaisesRegex(RuntimeError, 'Job a failed'):
+      job_scheduler.JobScheduler(graph, self._pool).run()
+
+    self.assertEqual(func.calls, ['a'])
+    self.assertEqual(graph.get_job('a').state, job_scheduler.JobState.FAILED)
+    self.assertEqual(graph.get_job('b').state, job_scheduler.JobState.CANCELLED)
+    self.assertEqual(graph.get_job('c').state, job_scheduler.JobState.CANCELLED)
+
+  def test_run_failure_without_fail_fast(self):
+    func = _RecordingFunc()
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', func, ['a', True])
+    graph.add_job('b', func, ['b'], dependencies=['a'])
+    graph.add_job('c', func, ['c'])
+    graph.add_job('d', func, ['d'], dependencies=['c'])
+    with self.assertRaisesRegex(RuntimeError, 'Job a failed'):
+      job_scheduler.JobScheduler(graph, self._pool, fail_fast=False).run()
+
+    self.assertEqual(sorted(func.calls), ['a', 'c', 'd'])
+    self.assertEqual(graph.get_job('b').state, job_scheduler.JobState.CANCELLED)
+    self.assertEqual(graph.get_job('d').state, job_scheduler.JobState.SUCCEEDED)
+
+  def test_run_waits_on_running_jobs_after_failure(self):
+    release = threading.Event()
+    graph = job_scheduler.JobGraph()
+    graph.add_job('slow', release.wait)
+    graph.add_job('fail', _RecordingFunc(), ['fail', True])
+    graph.add_job('unblock', release.set, dependencies=['fail'])
+    threading.Timer(0.5, release.set).start()
+    with self.assertRaises(RuntimeError):
+      job_scheduler.JobScheduler(graph, self._pool).run()
+
+    self.assertEqual(
+        graph.get_job('slow').state, job_scheduler.JobState.SUCCEEDED)
+    self.assertEqual(
+        graph.get_job('unblock').state, job_scheduler.JobState.CANCELLED)
+
+  def test_run_cancelled_by_user(self):
+    cancelled = threading.Event()
+
+    def run_job(unused_arg):
+      _thread.interrupt_main()
+      cancelled.wait()
+
+    def cancel_job(arg):
+      self.assertEqual(arg, 'foo')
+      cancelled.set()
+
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', run_job, ['foo'], cancel_func=cancel_job)
+    graph.add_job('b', len, ['foo'], dependencies=['a'])
+    with self.assertRaisesRegex(RuntimeError, 'Cancelled'):
+      job_scheduler.JobScheduler(graph, self._pool).run()
+
+    self.assertTrue(cancelled.is_set())
+    self.assertEqual(graph.get_job('b').state, job_scheduler.JobState.CANCELLED)
+
+  def test_run_with_admission_controller(self):
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def run_job(name):
+      with lock:
+        running.append(name)
+        max_running.append(len(running))
+      time.sleep(0.05)
+      with lock:
+        running.remove(name)
+
+    controller = admission_control.AdmissionController(
+        admission_control.StaticQuotaSource({'cpus': 8}))
+    graph = job_scheduler.JobGraph()
+    for i in range(6):
+      graph.add_job(str(i), run_job, [str(i)], resources={'cpus': 4})
+    graph.add_job('free', run_job, ['free'])
+    job_scheduler.JobScheduler(graph, self._pool,
+                               admission_controller=controller).run()
+
+    self.assertEqual(
+        len(graph.get_jobs(state=job_scheduler.JobState.SUCCEEDED)), 7)
+    # At most two jobs of 4 cpus, plus the job without resources, at a time.
+    self.assertLessEqual(max(max_running), 3)
+    self.assertEqual(controller.get_in_use()['cpus'], 0)
+
+  def test_run_job_exceeds_quota(self):
+    controller = admission_control.AdmissionController(
+        admission_control.StaticQuotaSource({'gpus': 0}))
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', len, ['a'], resources={'gpus': 1})
+    with self.assertRaisesRegex(ValueError, 'more than the quota'):
+      job_scheduler.JobScheduler(graph, self._pool,
+                                 admission_controller=controller).run()
+    self.assertEqual(graph.get_job('a').state, job_scheduler.JobState.PENDING)
+
+  def test_run_speculates_stragglers(self):
+    cancelled = threading.Event()
+    attempts = []
+
+    def run_straggler():
+      attempts.append(len(attempts))
+      if len(attempts) == 1:
+        unregister = job_scheduler.add_cancel_callback(cancelled.set)
+        cancelled.wait(10)
+        unregister()
+        raise RuntimeError('cancelled')
+
+    graph = job_scheduler.JobGraph()
+    for i in range(3):
+      graph.add_job('me/%d' % i, time.sleep, [0.01], stage='me',
+                    speculative=True)
+    graph.add_job('me/3', run_straggler, stage='me', speculative=True)
+    graph.add_job('pp', len, ['pp'], dependencies=['me/3'], stage='pp')
+    job_scheduler.JobScheduler(graph, self._pool, speculation_factor=2).run()
+
+    self.assertTrue(cancelled.is_set())
+    self.assertEqual(attempts, [0, 1])
+    self.assertEqual(len(graph.get_job('me/3').attempts), 2)
+    for job in graph.get_jobs():
+      self.assertEqual(job.state, job_scheduler.JobState.SUCCEEDED)
+
+  def test_run_does_not_speculate_non_speculative_jobs(self):
+    release = threading.Event()
+    graph = job_scheduler.JobGraph()
+    for i in range(3):
+      graph.add_job('me/%d' % i, time.sleep, [0.01], stage='me')
+    graph.add_job('me/3', release.wait, [10], stage='me')
+    threading.Timer(1.5, release.set).start()
+    job_scheduler.JobScheduler(graph, self._pool, speculation_factor=2).run()
+
+    self.assertEqual(len(graph.get_job('me/3').attempts), 1)
+
+  def test_add_cancel_callback_outside_job(self):
+    callback = mock.Mock()
+    job_scheduler.add_cancel_callback(callback)()
+    callback.assert_not_called()
+
+  def test_run_with_process_pool(self):
+    pool = multiprocessing.Pool(2)
+    self.addCleanup(pool.join)
+    self.addCleanup(pool.close)
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', len, ['a'], speculative=True)
+    graph.add_job('b', abs, [-1], dependencies=['a'])
+    job_scheduler.JobScheduler(graph, pool, speculation_factor=2).run()
+    for job in graph.get_jobs():
+      self.assertEqual(job.state, job_scheduler.JobState.SUCCEEDED)
+
+    graph = job_scheduler.JobGraph()
+    graph.add_job('a', int, ['x'])
+    with self.assertRaisesRegex(RuntimeError, 'Job a failed'):
+      job_scheduler.JobScheduler(graph, pool).run()
+
+  def test_run_empty_graph(self):
+    job_scheduler.JobScheduler(job_scheduler.JobGraph(), self._pool).run()
+
+
+if __name__ == '__main__':
+  unittest.main()
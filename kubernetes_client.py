@@ -0,0 +1,324 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""A client of the Kubernetes API of a GKE cluster, for managing pods.
+
+Unlike kubectl, which reloads its config and opens a new TLS connection on
+every call, a KubernetesClient sends all requests through a single
+requests.Session that keeps up to MAX_CONNECTIONS connections open and reuses
+them. Watches hold their connection until they end, which for a running pod
+can take hours, so they use a second session that opens as many connections
+as there are watches instead of waiting for a free one.
+
+KubernetesClient.from_kubectl_config() connects to the cluster of the current
+kubectl context, i.e. the one whose credentials were stored by
+`gcloud container clusters get-credentials`. Requests are authenticated with
+the application default credentials, as done by GKE's kubectl auth plugin.
+
+Clients can also be created for any URL, e.g. that of a
+fake_kubernetes_server.FakeKubernetesServer in tests.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import json
+import math
+import os
+import tempfile
+import time
+
+import google.auth
+import google.auth.exceptions
+import google.auth.transport.requests
+import process_util
+import requests
+
+
+# Maximum number of concurrent HTTP requests (and open connections) to the API
+# server, not counting watches. Up to as many idle watch connections are kept
+# open for reuse.
+MAX_CONNECTIONS = 8
+
+# Timeout (in seconds) of connecting to the API server, and of requests other
+# than watches.
+_REQUEST_TIMEOUT_SEC = 60
+
+_API_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+# Status code of a watch whose resource version is too old.
+_GONE = 410
+
+
+class KubernetesApiError(RuntimeError):
+  """Raised when a request to the Kubernetes API fails."""
+
+  def __init__(self, message, status=None):
+    super(KubernetesApiError, self).__init__(message)
+    # HTTP status code of the response, or None if there was no response.
+    self.status = status
+
+
+class KubernetesClient(object):
+  """Manages the pods of a namespace over the Kubernetes API."""
+
+  def __init__(self,
+               server,
+               session=None,
+               watch_session=None,
+               verify=True,
+               namespace='default'):
+    """Creates a client of the given API server.
+
+    Args:
+      server: (str) URL of the API server, e.g. https://1.2.3.4.
+      session: (requests.Session) session used for all requests but watches,
+        e.g. one that adds auth headers. A new session is used if None.
+      watch_session: (requests.Session) session used for watches. It must
+        authenticate like session. A new session is used if None.
+      verify: (bool or str) whether to verify the server's certificate, or the
+        path of the CA bundle to verify it with.
+      namespace: (str) namespace of the pods.
+    """
+    self._server = server.rstrip('/')
+    self._session = session or requests.Session()
+    self._watch_session = watch_session or requests.Session()
+    # Requests wait for a free connection, but a watch must never wait for
+    # other watches to end.
+    for http_session, block in ((self._session, True),
+                                (self._watch_session, False)):
+      adapter = requests.adapters.HTTPAdapter(
+          pool_maxsize=MAX_CONNECTIONS, pool_block=block)
+      for prefix in ('https://', 'http://'):
+        http_session.mount(prefix, adapter)
+      http_session.verify = verify
+    self._pods_url = '%s/api/v1/namespaces/%s/pods' % (self._server, namespace)
+    self._ca_cert_file = None
+
+  @classmethod
+  def from_kubectl_config(cls):
+    """Returns a client of the cluster of the current kubectl context.
+
+    Raises:
+      KubernetesApiError: if the config or the credentials cannot be read.
+    """
+    args = ['kubectl', 'config', 'view', '--minify', '--raw', '-o', 'json']
+    try:
+      config = json.loads(process_util.run_command(args))
+      cluster = config['clusters'][0]['cluster']
+      credentials, _ = google.auth.default(scopes=_API_SCOPES)
+    except (RuntimeError, ValueError, KeyError, IndexError,
+            google.auth.exceptions.GoogleAuthError) as e:
+      raise KubernetesApiError(
+          'Cannot read the config of the current kubectl context: %s' % str(e))
+
+    ca_cert_file = None
+    if cluster.get('certificate-authority-data'):
+      with tempfile.NamedTemporaryFile(suffix='.crt', delete=False) as f:
+        f.write(base64.b64decode(cluster['certificate-authority-data']))
+      ca_cert_file = f.name
+      verify = ca_cert_file
+    elif cluster.get('certificate-authority'):
+      verify = cluster['certificate-authority']
+    else:
+      verify = not cluster.get('insecure-skip-tls-verify', False)
+    client = cls(
+        cluster['server'],
+        session=google.auth.transport.requests.AuthorizedSession(credentials),
+        watch_session=google.auth.transport.requests.AuthorizedSession(
+            credentials),
+        verify=verify)
+    client._ca_cert_file = ca_cert_file  # pylint: disable=protected-access
+    return client
+
+  def close(self):
+    """Closes the open connections."""
+    self._session.close()
+    self._watch_session.close()
+    if self._ca_cert_file:
+      os.remove(self._ca_cert_file)
+      self._ca_cert_file = None
+
+  def _request(self,
+               method,
+               url,
+               allow_missing=False,
+               timeout=None,
+               session=None,
+               **kwargs):
+    """Sends a request and returns its response.
+
+    Args:
+      method: (str) HTTP method.
+      url: (str) URL of the request.
+      allow_missing: (bool) whether to return None if the resource does not
+        exist, instead of raising an error.
+      timeout: (float or tuple) requests timeout. Defaults to
+        _REQUEST_TIMEOUT_SEC.
+      session: (requests.Session) session to send the request with. Defaults
+        to the session of all requests but watches.
+      **kwargs: additional arguments of requests.Session.request.
+
+    Raises:
+      KubernetesApiError: if the request fails.
+    """
+    try:
+      response = (session or self._session).request(
+          method, url, timeout=timeout or _REQUEST_TIMEOUT_SEC, **kwargs)
+    except requests.RequestException as e:
+      raise KubernetesApiError('%s %s failed: %s' % (method, url, str(e)))
+    if response.status_code == 404 and allow_missing:
+      response.close()
+      return None
+    if response.status_code >= 400:
+      try:
+        message = response.json().get('message', response.text)
+      except ValueError:
+        message = response.text
+      raise KubernetesApiError(
+          '%s %s failed with status %d: %s' % (method, url,
+                                               response.status_code, message),
+          response.status_code)
+    return response
+
+  def get_version(self):
+    """Returns the version info of the API server."""
+    return self._request('GET', self._server + '/version').json()
+
+  def create_pod(self, pod):
+    """Creates a pod and returns its object.
+
+    Args:
+      pod: (dict) pod object.
+    """
+    return self._request('POST', self._pods_url, json=pod).json()
+
+  def get_pod(self, pod_name):
+    """Returns the object of a pod, or None if it does not exist."""
+    response = self._request(
+        'GET', self._pods_url + '/' + pod_name, allow_missing=True)
+    return response.json() if response is not None else None
+
+  def delete_pod(self, pod_name, wait=False, timeout=None):
+    """Deletes a pod.
+
+    Args:
+      pod_name: (str) name of the pod.
+      wait: (bool) whether to wait until the pod is gone.
+      timeout: (float) wait at most this many seconds. None means forever.
+
+    Returns:
+      False if the pod did not exist, True otherwise.
+
+    Raises:
+      KubernetesApiError: if the request fails or the wait times out.
+    """
+    response = self._request(
+        'DELETE', self._pods_url + '/' + pod_name, allow_missing=True)
+    if response is None:
+      return False
+    response.close()
+    if wait:
+      self._wait_for_deletion(pod_name, timeout)
+    return True
+
+  def _wait_for_deletion(self, pod_name, timeout):
+    """Waits until the pod does not exist."""
+    start_time = time.time()
+    while True:
+      remaining_sec = None
+      if timeout:
+        remaining_sec = timeout - (time.time() - start_time)
+        if remaining_sec <= 0:
+          raise KubernetesApiError(
+              'Timed out waiting for pod %s to be deleted.' % pod_name)
+      # Watch from the version of the list, so that no deletion is missed.
+      pods = self._request(
+          'GET',
+          self._pods_url,
+          params={'fieldSelector': 'metadata.name=' + pod_name}).json()
+      if not pods.get('items'):
+        return
+      try:
+        for event_type, _ in self.watch_pod(
+            pod_name, remaining_sec, pods['metadata']['resourceVersion']):
+          if event_type == 'DELETED':
+            return
+      except KubernetesApiError as e:
+        if e.status != _GONE:
+          raise
+
+  def watch_pod(self, pod_name, timeout=None, resource_version=None):
+    """Yields the (event type, pod object) of each change of a pod.
+
+    Unless resource_version is set, the first event is an ADDED event with the
+    current object of the pod (if it exists). The watch may end before the
+    timeout, e.g. if the API server closes the connection.
+
+    Args:
+      pod_name: (str) name of the pod.
+      timeout: (float) stop watching after this many seconds. None means no
+        timeout.
+      resource_version: (str) only yield changes after this resource version.
+
+    Raises:
+      KubernetesApiError: if the request fails or the server sends an error
+        event.
+    """
+    params = {'fieldSelector': 'metadata.name=' + pod_name, 'watch': 'true'}
+    if timeout:
+      params['timeoutSeconds'] = str(int(math.ceil(timeout)))
+    if resource_version:
+      params['resourceVersion'] = resource_version
+    # The server sends nothing while the pod does not change.
+    read_timeout_sec = timeout + _REQUEST_TIMEOUT_SEC if timeout else None
+    response = self._request(
+        'GET',
+        self._pods_url,
+        params=params,
+        stream=True,
+        timeout=(_REQUEST_TIMEOUT_SEC, read_timeout_sec),
+        session=self._watch_session)
+    try:
+      for line in response.iter_lines(chunk_size=None):
+        if not line:
+          continue
+        event = json.loads(line.decode('utf-8'))
+        if event['type'] == 'ERROR':
+          raise KubernetesApiError(
+              'Watching pod %s failed: %s' %
+              (pod_name, event['object'].get('message')),
+              event['object'].get('code'))
+        yield event['type'], event['object']
+    except requests.RequestException as e:
+      raise KubernetesApiError('Watching pod %s failed: %s' % (pod_name,
+                                                               str(e)))
+    finally:
+      response.close()
@@ -0,0 +1,167 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+r"""Benchmarks managing pods with kubectl and with kubernetes_client.
+
+The requests are sent to a local fake_kubernetes_server.FakeKubernetesServer
+that adds a fixed latency to every HTTP request, to simulate the round trip to
+the API server. For each method, N pods are created, their status is read
+--status_checks times, and they are deleted, one call at a time. Reports:
+  - wall_sec: time to make all calls.
+  - mean_call_sec: mean time of a call.
+  - http_requests: number of HTTP requests received by the server.
+  - connections: number of connections opened to the server.
+Methods:
+  - kubectl: one kubectl process per call (as GkeCluster does by default).
+    Only available if kubectl is on the PATH.
+  - api_client: a single KubernetesClient (as GkeCluster does with
+    use_kubernetes_api).
+
+Sample run command:
+$ python kubernetes_client_benchmark.py --pods 10 100 --latency_sec 0.02
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import fake_kubernetes_server
+import kubernetes_client
+import process_util
+
+
+def _get_pod_config(pod_name):
+  return json.dumps({
+      'kind': 'Pod',
+      'apiVersion': 'v1',
+      'metadata': {'name': pod_name},
+      'spec': {'containers': [{'name': 'foo', 'image': 'foo-image'}]},
+  })
+
+
+def _run_with_kubectl(server, pod_names, status_checks):
+  kubectl = ['kubectl', '--kubeconfig', os.devnull, '--server', server.url]
+  for pod_name in pod_names:
+    process_util.run_command(
+        kubectl + ['create', '-f', '-'], std_input=_get_pod_config(pod_name))
+    for _ in range(status_checks):
+      process_util.run_command(
+          kubectl + ['get', 'pods', pod_name, '-o', 'json'])
+    process_util.run_command(kubectl + ['delete', 'pod', pod_name])
+
+
+def _run_with_api_client(server, pod_names, status_checks):
+  client = kubernetes_client.KubernetesClient(server.url)
+  try:
+    for pod_name in pod_names:
+      client.create_pod(json.loads(_get_pod_config(pod_name)))
+      for _ in range(status_checks):
+        client.get_pod(pod_name)
+      client.delete_pod(pod_name)
+  finally:
+    client.close()
+
+
+_METHODS = {
+    'kubectl': _run_with_kubectl,
+    'api_client': _run_with_api_client,
+}
+
+
+def _benchmark(server, method, num_pods, status_checks):
+  """Creates, checks and deletes num_pods pods with method."""
+  pod_names = ['%s-pod-%d' % (method.replace('_', '-'), i)
+               for i in range(num_pods)]
+  server.http_requests = 0
+  server.connections = 0
+  start_time = time.time()
+  _METHODS[method](server, pod_names, status_checks)
+  wall_sec = time.time() - start_time
+  return {
+      'method': method,
+      'pods': num_pods,
+      'wall_sec': round(wall_sec, 3),
+      'mean_call_sec': round(wall_sec / (num_pods * (status_checks + 2)), 4),
+      'http_requests': server.http_requests,
+      'connections': server.connections,
+  }
+
+
+def run(argv=None):
+  """Runs the benchmark."""
+  available_methods = sorted(
+      method for method in _METHODS
+      if method != 'kubectl' or shutil.which('kubectl'))
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--pods',
+      type=int,
+      nargs='+',
+      default=[10, 100],
+      help='Number of pods to create.')
+  parser.add_argument(
+      '--status_checks',
+      type=int,
+      default=10,
+      help='Number of times the status of each pod is read.')
+  parser.add_argument(
+      '--methods',
+      nargs='+',
+      default=available_methods,
+      choices=available_methods,
+      help='Methods to benchmark.')
+  parser.add_argument(
+      '--latency_sec',
+      type=float,
+      default=0.02,
+      help='Time (in seconds) each HTTP request to the fake server takes.')
+  parser.add_argument(
+      '--output', help='Optional path to write the results to as JSON.')
+  args = parser.parse_args(argv)
+
+  results = []
+  with fake_kubernetes_server.FakeKubernetesServer(args.latency_sec) as server:
+    for num_pods in args.pods:
+      for method in args.methods:
+        result = _benchmark(server, method, num_pods, args.status_checks)
+        print(json.dumps(result, sort_keys=True))
+        results.append(result)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,202 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for kubernetes_client.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+
+Then run:
+$ python kubernetes_client_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import json
+import os
+import threading
+import unittest
+
+import fake_kubernetes_server
+import kubernetes_client
+import mock
+
+
+def _pod(name):
+  return {
+      'kind': 'Pod',
+      'apiVersion': 'v1',
+      'metadata': {'name': name},
+      'spec': {'containers': [{'name': 'foo', 'image': 'foo-image'}]},
+  }
+
+
+class KubernetesClientTest(unittest.TestCase):
+  """Tests KubernetesClient against a local fake Kubernetes API server."""
+
+  def setUp(self):
+    super(KubernetesClientTest, self).setUp()
+    self._server = fake_kubernetes_server.FakeKubernetesServer()
+    self._server.start()
+    self.addCleanup(self._server.stop)
+    self._client = kubernetes_client.KubernetesClient(self._server.url)
+    self.addCleanup(self._client.close)
+
+  def testCreateGetAndDeletePod(self):
+    self.assertEqual(
+        self._client.create_pod(_pod('foo-pod'))['status']['phase'],
+        'Pending')
+    self.assertEqual(self._client.get_pod('foo-pod')['metadata']['name'],
+                     'foo-pod')
+    self.assertTrue(self._client.delete_pod('foo-pod', wait=True))
+    self.assertIsNone(self._client.get_pod('foo-pod'))
+    self.assertFalse(self._client.delete_pod('foo-pod'))
+
+  def testCreatePod_AlreadyExists(self):
+    self._client.create_pod(_pod('foo-pod'))
+    with self.assertRaisesRegex(kubernetes_client.KubernetesApiError,
+                                'already exists') as context:
+      self._client.create_pod(_pod('foo-pod'))
+    self.assertEqual(context.exception.status, 409)
+
+  def testRequestsReuseConnection(self):
+    self._client.create_pod(_pod('foo-pod'))
+    for _ in range(10):
+      self._client.get_pod('foo-pod')
+    self.assertEqual(self._server.http_requests, 11)
+    self.assertEqual(self._server.connections, 1)
+
+  def testServerUnreachable(self):
+    client = kubernetes_client.KubernetesClient('http://127.0.0.1:1')
+    with self.assertRaises(kubernetes_client.KubernetesApiError):
+      client.get_version()
+
+  def testWatchPod(self):
+    self._client.create_pod(_pod('foo-pod'))
+    self._client.create_pod(_pod('bar-pod'))
+    events = self._client.watch_pod('foo-pod', timeout=10)
+    event_type, pod = next(events)
+    self.assertEqual((event_type, pod['status']['phase']), ('ADDED', 'Pending'))
+
+    self._server.set_pod_status('bar-pod', 'Running')
+    self._server.set_pod_status('foo-pod', 'Pending', 'ErrImagePull')
+    event_type, pod = next(events)
+    self.assertEqual(event_type, 'MODIFIED')
+    self.assertEqual(
+        pod['status']['containerStatuses'][0]['state']['waiting']['reason'],
+        'ErrImagePull')
+
+    threading.Thread(
+        target=self._server.set_pod_status, args=('foo-pod', 'Failed')).start()
+    event_type, pod = next(events)
+    self.assertEqual((event_type, pod['status']['phase']),
+                     ('MODIFIED', 'Failed'))
+    events.close()
+
+  def testWatchPod_MoreWatchesThanConnections(self):
+    num_pods = kubernetes_client.MAX_CONNECTIONS + 2
+    watches = []
+    pods = []
+
+    def open_watches_and_get_pod():
+      for i in range(num_pods):
+        self._client.create_pod(_pod('foo-pod-%d' % i))
+        events = self._client.watch_pod('foo-pod-%d' % i, timeout=10)
+        next(events)
+        watches.append(events)
+      pods.append(self._client.get_pod('foo-pod-0'))
+
+    # Neither watches nor other requests wait for the open watches to end.
+    thread = threading.Thread(target=open_watches_and_get_pod)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    self.assertEqual(len(watches), num_pods)
+    self.assertEqual(len(pods), 1)
+
+    for i, events in enumerate(watches):
+      self._server.set_pod_status('foo-pod-%d' % i, 'Succeeded')
+      event_type, pod = next(events)
+      self.assertEqual((event_type, pod['status']['phase']),
+                       ('MODIFIED', 'Succeeded'))
+      events.close()
+
+  def testWatchPod_Timeout(self):
+    self._client.create_pod(_pod('foo-pod'))
+    self.assertEqual(
+        [event_type for event_type, _ in self._client.watch_pod(
+            'foo-pod', timeout=0.1)], ['ADDED'])
+
+  def testWatchPod_PhasesAdvance(self):
+    self._server.phase_sec = 0.01
+    self._client.create_pod(_pod('foo-pod'))
+    phases = []
+    for _, pod in self._client.watch_pod('foo-pod', timeout=10):
+      phases.append(pod['status']['phase'])
+      if phases[-1] == 'Succeeded':
+        break
+    self.assertEqual(phases[-1], 'Succeeded')
+    self.assertEqual(sorted(set(phases)), ['Pending', 'Running', 'Succeeded'])
+
+  @mock.patch('google.auth.default', return_value=(mock.Mock(), 'project'))
+  @mock.patch('process_util.run_command')
+  def testFromKubectlConfig(self, mock_run_command, unused_mock_auth_default):
+    mock_run_command.return_value = json.dumps({
+        'clusters': [{
+            'name': 'foo-cluster',
+            'cluster': {
+                'server': 'https://1.2.3.4',
+                'certificate-authority-data': base64.b64encode(
+                    b'foo-cert').decode('utf-8')
+            }
+        }]
+    })
+    client = kubernetes_client.KubernetesClient.from_kubectl_config()
+    ca_cert_file = client._ca_cert_file
+    with open(ca_cert_file, 'rb') as f:
+      self.assertEqual(f.read(), b'foo-cert')
+    client.close()
+    self.assertFalse(os.path.exists(ca_cert_file))
+    mock_run_command.assert_called_once_with(
+        ['kubectl', 'config', 'view', '--minify', '--raw', '-o', 'json'])
+
+  @mock.patch('process_util.run_command', return_value='{}')
+  def testFromKubectlConfig_NoCluster(self, unused_mock_run_command):
+    with self.assertRaises(kubernetes_client.KubernetesApiError):
+      kubernetes_client.KubernetesClient.from_kubectl_config()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,308 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Stores of named, expiring leases shared by several processes.
+
+A lease is held by a single owner until it expires, is released, or is marked
+as done (after which it can never be acquired again). A lease may also carry
+JSON serializable data, which is kept across owners. Leases are kept either in
+GCS objects (updated with generation preconditions) or, e.g. for tests, in
+local files.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fcntl
+import json
+import os
+import posixpath
+import time
+import urllib
+
+import gcs_client
+from google.api_core import exceptions as google_exceptions
+
+
+_LOCK_FILE_NAME = '.lock'
+_RECORD_SUFFIX = '.json'
+
+
+class LeaseStore(object):
+  """Base class of lease stores.
+
+  Subclasses only implement the _read, _write, _delete and _list primitives.
+  """
+
+  def _read(self, name):
+    """Returns the (record, generation) of a lease, or (None, None)."""
+    raise NotImplementedError
+
+  def _write(self, name, record, generation):
+    """Writes a lease record if its generation did not change.
+
+    Args:
+      name: (str) name of the lease.
+      record: (dict) JSON serializable record to write.
+      generation: generation returned by _read, or None if the lease must not
+        exist yet.
+
+    Returns:
+      True if the record was written.
+    """
+    raise NotImplementedError
+
+  def _delete(self, name, generation):
+    """Deletes a lease record if its generation did not change."""
+    raise NotImplementedError
+
+  def _list(self):
+    """Returns the names of all leases in the store."""
+    raise NotImplementedError
+
+  def try_acquire(self, name, owner, ttl_sec, data=None):
+    """Acquires a lease unless another owner holds it or it is done.
+
+    Args:
+      name: (str) name of the lease.
+      owner: (str) unique identifier of the caller.
+      ttl_sec: (int) time (in seconds) after which the lease expires unless it
+        is renewed.
+      data: (dict) if set, replaces the data of the lease.
+
+    Returns:
+      True if the lease is now held by owner.
+    """
+    record, generation = self._read(name)
+    if record and (record.get('done') or
+                   (record['owner'] != owner and
+                    record['expiration_time'] > time.time())):
+      return False
+    return self._write(
+        name,
+        _get_record(owner, record, data, expiration_time=time.time() + ttl_sec),
+        generation)
+
+  def renew(self, name, owner, ttl_sec):
+    """Extends a lease held by owner. Returns False if it is not held."""
+    record, generation = self._read(name)
+    if not record or record.get('done') or record['owner'] != owner:
+      return False
+    return self._write(
+        name,
+        _get_record(owner, record, expiration_time=time.time() + ttl_sec),
+        generation)
+
+  def release(self, name, owner):
+    """Releases a lease held by owner, so that others can acquire it."""
+    record, generation = self._read(name)
+    if record and not record.get('done') and record['owner'] == owner:
+      # The record is kept (as expired) so that generations keep increasing.
+      self._write(
+          name,
+          _get_record(owner, record, expiration_time=0,
+                      release_time=time.time()), generation)
+
+  def mark_done(self, name, owner):
+    """Marks a lease as done. Returns False if owner does not hold it."""
+    record, generation = self._read(name)
+    if not record or record.get('done') or record['owner'] != owner:
+      return False
+    return self._write(name, _get_record(owner, record, done=True), generation)
+
+  def delete(self, name, owner):
+    """Deletes a lease held by owner. Returns False if it is not held."""
+    record, generation = self._read(name)
+    if not record or record.get('done') or record['owner'] != owner:
+      return False
+    self._delete(name, generation)
+    return True
+
+  def get_record(self, name):
+    """Returns the record of a lease, or None if it does not exist.
+
+    The record is a dict with the owner, and either whether the lease is done
+    or its expiration_time (and release_time if it was released). It also has
+    the data of the lease, if any.
+    """
+    record, _ = self._read(name)
+    return record
+
+  def is_done(self, name):
+    """Returns true if the lease is marked as done."""
+    record, _ = self._read(name)
+    return bool(record and record.get('done'))
+
+  def get_owner(self, name):
+    """Returns the owner of an unexpired (or done) lease, or None."""
+    record, _ = self._read(name)
+    if record and (record.get('done') or
+                   record['expiration_time'] > time.time()):
+      return record['owner']
+    return None
+
+  def list_names(self):
+    """Returns the names of all leases in the store."""
+    return sorted(self._list())
+
+  def clear(self):
+    """Deletes all leases in the store."""
+    for name in self._list():
+      _, generation = self._read(name)
+      if generation is not None:
+        self._delete(name, generation)
+
+
+def _get_record(owner, old_record, data=None, **fields):
+  """Returns a new lease record, keeping the data of the old one by default."""
+  record = dict(fields, owner=owner)
+  if data is None and old_record:
+    data = old_record.get('data')
+  if data is not None:
+    record['data'] = data
+  return record
+
+
+class GcsLeaseStore(LeaseStore):
+  """Lease store that keeps each lease in a GCS object under a root folder."""
+
+  def __init__(self, root, storage_client=None):
+    """Lease store that keeps each lease in a GCS object under a root folder.
+
+    Args:
+      root: (str) GCS folder of the leases (gs://bucket/path).
+      storage_client: (storage.Client) client to use. The client shared by
+        gcs_client is used if not set.
+    """
+    parsed_root = urllib.parse.urlparse(root)
+    self._bucket_name = parsed_root.netloc
+    self._prefix = parsed_root.path.strip('/') + '/'
+    self._storage_client = storage_client or gcs_client.get_client()
+    self._bucket = self._storage_client.bucket(self._bucket_name)
+
+  def _get_object_name(self, name):
+    return posixpath.join(self._prefix, name + _RECORD_SUFFIX)
+
+  def _read(self, name):
+    while True:
+      blob = self._bucket.get_blob(self._get_object_name(name))
+      if blob is None:
+        return None, None
+      try:
+        data = blob.download_as_bytes(if_generation_match=blob.generation)
+      except google_exceptions.NotFound:
+        return None, None
+      except google_exceptions.PreconditionFailed:
+        continue  # The object changed since it was listed; read it again.
+      return json.loads(data), blob.generation
+
+  def _write(self, name, record, generation):
+    blob = self._bucket.blob(self._get_object_name(name))
+    try:
+      blob.upload_from_string(
+          json.dumps(record, sort_keys=True),
+          content_type='application/json',
+          if_generation_match=generation or 0)
+    except google_exceptions.PreconditionFailed:
+      return False
+    return True
+
+  def _delete(self, name, generation):
+    try:
+      self._bucket.blob(self._get_object_name(name)).delete(
+          if_generation_match=generation)
+    except (google_exceptions.NotFound, google_exceptions.PreconditionFailed):
+      pass
+
+  def _list(self):
+    return [
+        blob.name[len(self._prefix):-len(_RECORD_SUFFIX)]
+        for blob in self._storage_client.list_blobs(
+            self._bucket_name, prefix=self._prefix)
+        if blob.name.endswith(_RECORD_SUFFIX)
+    ]
+
+
+class LocalLeaseStore(LeaseStore):
+  """Lease store that keeps each lease in a file of a local directory.
+
+  All operations hold an exclusive lock on the directory, so the store can be
+  shared by threads and processes of the same machine.
+  """
+
+  def __init__(self, directory):
+    self._directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _get_path(self, name):
+    return os.path.join(self._directory,
+                        urllib.parse.quote(name, safe='') + _RECORD_SUFFIX)
+
+  def _locked(self):
+    """Returns an open lock file, which is unlocked once closed."""
+    lock_file = open(os.path.join(self._directory, _LOCK_FILE_NAME), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+  def _read_unlocked(self, name):
+    try:
+      with open(self._get_path(name)) as f:
+        content = json.load(f)
+    except (IOError, OSError):
+      return None, None
+    return content['record'], content['generation']
+
+  def _read(self, name):
+    with self._locked():
+      return self._read_unlocked(name)
+
+  def _write(self, name, record, generation):
+    with self._locked():
+      _, current_generation = self._read_unlocked(name)
+      if current_generation != generation:
+        return False
+      path = self._get_path(name)
+      with open(path + '.tmp', 'w') as f:
+        json.dump({'record': record, 'generation': (generation or 0) + 1}, f)
+      os.rename(path + '.tmp', path)
+      return True
+
+  def _delete(self, name, generation):
+    with self._locked():
+      _, current_generation = self._read_unlocked(name)
+      if current_generation is not None and current_generation == generation:
+        os.remove(self._get_path(name))
+
+  def _list(self):
+    return [
+        urllib.parse.unquote(file_name[:-len(_RECORD_SUFFIX)])
+        for file_name in os.listdir(self._directory)
+        if file_name.endswith(_RECORD_SUFFIX)
+    ]
@@ -0,0 +1,229 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for lease_store.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python lease_store_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+import lease_store
+import mock
+from google.api_core import exceptions as google_exceptions
+
+
+class _FakeBlob(object):
+  """Helper class that keeps a GCS object and its generation in a dict."""
+
+  def __init__(self, name, objects):
+    self.name = name
+    self._objects = objects
+
+  @property
+  def generation(self):
+    return self._objects[self.name][1] if self.name in self._objects else 0
+
+  def _check_generation(self, if_generation_match):
+    if self.generation != if_generation_match:
+      raise google_exceptions.PreconditionFailed('Generation mismatch')
+
+  def download_as_bytes(self, if_generation_match=None):
+    if self.name not in self._objects:
+      raise google_exceptions.NotFound('Not found')
+    self._check_generation(if_generation_match)
+    return self._objects[self.name][0]
+
+  def upload_from_string(self, data, content_type=None,
+                         if_generation_match=None):
+    del content_type  # Unused.
+    self._check_generation(if_generation_match)
+    self._objects[self.name] = (data, self.generation + 1)
+
+  def delete(self, if_generation_match=None):
+    if self.name not in self._objects:
+      raise google_exceptions.NotFound('Not found')
+    self._check_generation(if_generation_match)
+    del self._objects[self.name]
+
+
+def _get_fake_storage_client(objects):
+  """Returns a mock storage client that keeps objects in a dict."""
+  client = mock.Mock()
+  bucket = client.bucket.return_value
+  bucket.blob.side_effect = lambda name: _FakeBlob(name, objects)
+  bucket.get_blob.side_effect = lambda name: (
+      _FakeBlob(name, objects) if name in objects else None)
+  client.list_blobs.side_effect = lambda bucket_name, prefix: [
+      _FakeBlob(name, objects)
+      for name in sorted(objects)
+      if name.startswith(prefix)
+  ]
+  return client
+
+
+class _LeaseStoreTestMixin(object):
+  """Tests shared by all lease stores. Subclasses set self._store."""
+
+  def test_acquire(self):
+    self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    self.assertEqual(self._store.get_owner('a'), 'owner1')
+    # The lease is held by owner1, but owner1 can acquire it again.
+    self.assertFalse(self._store.try_acquire('a', 'owner2', 60))
+    self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    # Other leases are independent.
+    self.assertTrue(self._store.try_acquire('b', 'owner2', 60))
+
+  def test_acquire_expired(self):
+    with mock.patch('time.time', return_value=1000):
+      self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    with mock.patch('time.time', return_value=1061):
+      self.assertIsNone(self._store.get_owner('a'))
+      self.assertFalse(self._store.renew('a', 'owner2', 60))
+      self.assertTrue(self._store.try_acquire('a', 'owner2', 60))
+      self.assertFalse(self._store.renew('a', 'owner1', 60))
+      self.assertEqual(self._store.get_owner('a'), 'owner2')
+
+  def test_renew(self):
+    with mock.patch('time.time', return_value=1000):
+      self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    with mock.patch('time.time', return_value=1050):
+      self.assertTrue(self._store.renew('a', 'owner1', 60))
+    with mock.patch('time.time', return_value=1100):
+      self.assertFalse(self._store.try_acquire('a', 'owner2', 60))
+
+  def test_release(self):
+    self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    self._store.release('a', 'owner2')
+    self.assertEqual(self._store.get_owner('a'), 'owner1')
+    self._store.release('a', 'owner1')
+    self.assertIsNone(self._store.get_owner('a'))
+    self.assertTrue(self._store.try_acquire('a', 'owner2', 60))
+
+  def test_mark_done(self):
+    self.assertFalse(self._store.mark_done('a', 'owner1'))
+    self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    self.assertFalse(self._store.mark_done('a', 'owner2'))
+    self.assertTrue(self._store.mark_done('a', 'owner1'))
+    self.assertTrue(self._store.is_done('a'))
+    self.assertFalse(self._store.try_acquire('a', 'owner1', 60))
+    self._store.release('a', 'owner1')
+    self.assertTrue(self._store.is_done('a'))
+
+  def test_data_and_release_time(self):
+    self.assertIsNone(self._store.get_record('a'))
+    with mock.patch('time.time', return_value=1000):
+      self.assertTrue(self._store.try_acquire('a', 'owner1', 60, {'x': 1}))
+    with mock.patch('time.time', return_value=1010):
+      self.assertTrue(self._store.renew('a', 'owner1', 60))
+      self._store.release('a', 'owner1')
+    self.assertEqual(self._store.get_record('a'), {
+        'owner': 'owner1',
+        'expiration_time': 0,
+        'release_time': 1010,
+        'data': {'x': 1}
+    })
+    # The data is kept across owners unless replaced.
+    self.assertTrue(self._store.try_acquire('a', 'owner2', 60))
+    self.assertEqual(self._store.get_record('a')['data'], {'x': 1})
+    self.assertTrue(self._store.try_acquire('a', 'owner2', 60, {'x': 2}))
+    self.assertEqual(self._store.get_record('a')['data'], {'x': 2})
+
+  def test_delete(self):
+    self.assertTrue(self._store.try_acquire('a', 'owner1', 60))
+    self.assertFalse(self._store.delete('a', 'owner2'))
+    self.assertTrue(self._store.delete('a', 'owner1'))
+    self.assertIsNone(self._store.get_record('a'))
+    self.assertEqual(self._store.list_names(), [])
+
+  def test_list_names_and_clear(self):
+    self.assertTrue(self._store.try_acquire('task-1', 'owner', 60))
+    self.assertTrue(self._store.try_acquire('task-0', 'owner', 60))
+    self.assertEqual(self._store.list_names(), ['task-0', 'task-1'])
+    self._store.clear()
+    self.assertEqual(self._store.list_names(), [])
+    self.assertTrue(self._store.try_acquire('task-0', 'other_owner', 60))
+
+
+class LocalLeaseStoreTest(_LeaseStoreTestMixin, unittest.TestCase):
+  """Tests for LocalLeaseStore class."""
+
+  def setUp(self):
+    super(LocalLeaseStoreTest, self).setUp()
+    self._directory = tempfile.mkdtemp()
+    self._store = lease_store.LocalLeaseStore(self._directory)
+
+  def tearDown(self):
+    shutil.rmtree(self._directory)
+    super(LocalLeaseStoreTest, self).tearDown()
+
+
+class GcsLeaseStoreTest(_LeaseStoreTestMixin, unittest.TestCase):
+  """Tests for GcsLeaseStore class."""
+
+  def setUp(self):
+    super(GcsLeaseStoreTest, self).setUp()
+    self._objects = {}
+    self._store = lease_store.GcsLeaseStore(
+        'gs://bucket/staging/leases',
+        storage_client=_get_fake_storage_client(self._objects))
+
+  def test_object_names(self):
+    self.assertTrue(self._store.try_acquire('task-0', 'owner', 60))
+    self.assertEqual(list(self._objects), ['staging/leases/task-0.json'])
+
+  def test_concurrent_acquire(self):
+    # Another process acquires the lease between our read and write.
+    original_read = self._store._read
+
+    def read_then_acquire(name):
+      result = original_read(name)
+      self._store._write(name, {'owner': 'other', 'expiration_time': 2e9},
+                         result[1])
+      return result
+
+    with mock.patch.object(self._store, '_read', side_effect=read_then_acquire):
+      self.assertFalse(self._store.try_acquire('a', 'owner', 60))
+    self.assertEqual(self._store.get_owner('a'), 'other')
+
+
+if __name__ == '__main__':
+  unittest.main()
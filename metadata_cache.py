@@ -0,0 +1,154 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""A local, persistent cache of the metadata of GCS objects.
+
+The same inputs (reference, indices, models) are used by many runs, each of
+which checks that they exist. The cache keeps the size, generation and CRC32C
+of existing objects in a SQLite database (by default under ~/.cache), shared by
+all runs of the user:
+  - An entry is used for ttl_sec after the object was last checked. After that,
+    the object's metadata is requested again and the entry is replaced, so a
+    new generation of the object is picked up.
+  - Beyond max_entries, the least recently used entries are evicted.
+Missing objects are never cached, so a missing input is always checked again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'gcp_deepvariant_runner', 'gcs_metadata.sqlite')
+DEFAULT_TTL_SEC = 3600
+DEFAULT_MAX_ENTRIES = 10000
+
+# Time (in seconds) to wait for another process to release the database.
+_LOCK_TIMEOUT_SEC = 30
+
+
+class ObjectMetadata(object):
+  """Metadata of a GCS object."""
+
+  def __init__(self, size, generation, crc32c=None):
+    self.size = size
+    self.generation = generation
+    self.crc32c = crc32c
+
+  @classmethod
+  def from_blob(cls, blob):
+    return cls(blob.size, blob.generation, blob.crc32c)
+
+  def __eq__(self, other):
+    return ((self.size, self.generation, self.crc32c) ==
+            (other.size, other.generation, other.crc32c))
+
+  def __repr__(self):
+    return 'ObjectMetadata(%r, %r, %r)' % (self.size, self.generation,
+                                           self.crc32c)
+
+
+class MetadataCache(object):
+  """Cache of the metadata of GCS objects, kept in a SQLite database."""
+
+  def __init__(self,
+               path=DEFAULT_PATH,
+               ttl_sec=DEFAULT_TTL_SEC,
+               max_entries=DEFAULT_MAX_ENTRIES):
+    """Opens (and creates if needed) the cache.
+
+    Args:
+      path: (str) local path of the database.
+      ttl_sec: (int) time (in seconds) after which an entry must be checked
+        again.
+      max_entries: (int) maximum number of entries kept.
+    """
+    if not os.path.isdir(os.path.dirname(path) or '.'):
+      os.makedirs(os.path.dirname(path))
+    self._ttl_sec = ttl_sec
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(
+        path, timeout=_LOCK_TIMEOUT_SEC, check_same_thread=False)
+    with self._connection:
+      self._connection.execute(
+          'CREATE TABLE IF NOT EXISTS objects ('
+          'path TEXT PRIMARY KEY, size INTEGER, generation INTEGER, '
+          'crc32c TEXT, checked_time REAL, used_time REAL)')
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, path):
+    """Returns the cached ObjectMetadata of an object, or None."""
+    now = time.time()
+    with self._lock, self._connection:
+      row = self._connection.execute(
+          'SELECT size, generation, crc32c FROM objects '
+          'WHERE path = ? AND checked_time > ?',
+          (path, now - self._ttl_sec)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self._connection.execute(
+          'UPDATE objects SET used_time = ? WHERE path = ?', (now, path))
+    return ObjectMetadata(*row)
+
+  def put(self, path, metadata):
+    """Records the ObjectMetadata of an object that was just checked."""
+    now = time.time()
+    with self._lock, self._connection:
+      row = self._connection.execute(
+          'SELECT generation FROM objects WHERE path = ?', (path,)).fetchone()
+      if row and row[0] != metadata.generation:
+        logging.info('%s changed (generation %s -> %s).', path, row[0],
+                     metadata.generation)
+      self._connection.execute(
+          'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+          (path, metadata.size, metadata.generation, metadata.crc32c, now,
+           now))
+      self._connection.execute(
+          'DELETE FROM objects WHERE path NOT IN ('
+          'SELECT path FROM objects ORDER BY used_time DESC LIMIT ?)',
+          (self._max_entries,))
+
+  def delete(self, path):
+    """Removes the entry of an object, e.g. because it no longer exists."""
+    with self._lock, self._connection:
+      self._connection.execute('DELETE FROM objects WHERE path = ?', (path,))
+
+  def close(self):
+    self._connection.close()
@@ -0,0 +1,116 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for metadata_cache.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python metadata_cache_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import metadata_cache
+import mock
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super(MetadataCacheTest, self).setUp()
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'cache', 'metadata.sqlite')
+    self._cache = metadata_cache.MetadataCache(self._path, ttl_sec=60,
+                                               max_entries=2)
+
+  def tearDown(self):
+    self._cache.close()
+    shutil.rmtree(self._dir)
+    super(MetadataCacheTest, self).tearDown()
+
+  def test_get_put(self):
+    metadata = metadata_cache.ObjectMetadata(10, 1, 'crc')
+    self.assertIsNone(self._cache.get('gs://bucket/a'))
+    self._cache.put('gs://bucket/a', metadata)
+    self.assertEqual(self._cache.get('gs://bucket/a'), metadata)
+    self.assertIsNone(self._cache.get('gs://bucket/b'))
+    self.assertEqual((self._cache.hits, self._cache.misses), (1, 2))
+
+  def test_persistent(self):
+    metadata = metadata_cache.ObjectMetadata(10, 1, 'crc')
+    self._cache.put('gs://bucket/a', metadata)
+    other_cache = metadata_cache.MetadataCache(self._path)
+    self.assertEqual(other_cache.get('gs://bucket/a'), metadata)
+    other_cache.close()
+
+  def test_ttl(self):
+    with mock.patch('time.time', return_value=1000):
+      self._cache.put('gs://bucket/a', metadata_cache.ObjectMetadata(10, 1))
+    with mock.patch('time.time', return_value=1059):
+      self.assertIsNotNone(self._cache.get('gs://bucket/a'))
+    with mock.patch('time.time', return_value=1061):
+      self.assertIsNone(self._cache.get('gs://bucket/a'))
+      # A new generation replaces the expired entry.
+      self._cache.put('gs://bucket/a', metadata_cache.ObjectMetadata(12, 2))
+      self.assertEqual(
+          self._cache.get('gs://bucket/a'), metadata_cache.ObjectMetadata(
+              12, 2))
+
+  def test_lru_eviction(self):
+    with mock.patch('time.time', return_value=1000):
+      self._cache.put('gs://bucket/a', metadata_cache.ObjectMetadata(1, 1))
+    with mock.patch('time.time', return_value=1001):
+      self._cache.put('gs://bucket/b', metadata_cache.ObjectMetadata(1, 1))
+    with mock.patch('time.time', return_value=1002):
+      self._cache.get('gs://bucket/a')
+    with mock.patch('time.time', return_value=1003):
+      self._cache.put('gs://bucket/c', metadata_cache.ObjectMetadata(1, 1))
+      self.assertIsNotNone(self._cache.get('gs://bucket/a'))
+      self.assertIsNone(self._cache.get('gs://bucket/b'))
+      self.assertIsNotNone(self._cache.get('gs://bucket/c'))
+
+  def test_delete(self):
+    self._cache.put('gs://bucket/a', metadata_cache.ObjectMetadata(1, 1))
+    self._cache.delete('gs://bucket/a')
+    self.assertIsNone(self._cache.get('gs://bucket/a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
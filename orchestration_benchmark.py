@@ -0,0 +1,382 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+r"""Measures the orchestration overhead of the runner at different scales.
+
+Fake pipelines, gcloud and kubectl executables are put on PATH. Each call
+sleeps for --latency_sec and fails with probability --failure_rate. Fake pods
+run for --pod_sec. GCS is not used. Inputs are assumed to exist, and
+completion and failed-shards records are skipped.
+
+For each number of workers, the following scenarios are timed:
+  - run_command: concurrent process_util.run_command calls of the fake
+    pipelines (with --retries).
+  - make_examples: gcp_deepvariant_runner.run with only make_examples, one
+    shard per worker.
+  - run: gcp_deepvariant_runner.run with all stages, as many call_variants as
+    make_examples workers.
+  - deploy_pod: concurrent GkeCluster.deploy_pod calls (one pod per worker)
+    on one cluster, which watches the pods with kubectl.
+
+Each result holds:
+  - wall_sec: time until the scenario finished.
+  - submit_latency_sec: time until the last fake pipelines or kubectl create
+    call started, i.e. until all workers were submitted.
+  - peak_rss_mb: peak resident memory of this process. Linux only.
+  - subprocesses: number of calls of each fake executable.
+  - error: error of the scenario, if any (e.g. due to --failure_rate).
+
+Sample run command:
+$ python orchestration_benchmark.py --workers 1 10 100 --output results.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import multiprocessing.pool
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+import gcp_deepvariant_runner
+import gke_cluster
+import process_util
+
+import mock
+
+
+# The runner only passes PATH to pipelines, so the settings of the fake
+# executables are written into them, after the first line.
+# Every call is recorded as "<executable> <start time> <first arg>" in
+# $FAKE_CALLS_FILE.
+_FAKE_SCRIPT_HEADER = r"""
+echo "$(basename "$0") $(date +%s.%N) $1" >> "$FAKE_CALLS_FILE"
+sleep "$FAKE_LATENCY_SEC"
+if (( RANDOM % 10000 < FAKE_FAILURE_BP )); then
+  echo "Fake failure" >&2
+  exit 1
+fi
+"""
+
+_FAKE_SCRIPTS = {
+    'pipelines': '',
+    'gcloud': r"""
+case "$*" in
+  *"clusters list"*) echo "$FAKE_CLUSTER_NAME" ;;
+  *"clusters describe"*) echo RUNNING ;;
+esac
+""",
+    # Pods are files in $FAKE_PODS_DIR holding their creation time. They are
+    # printed as JSON objects, which a watch prints on start and again once
+    # the pod succeeds (unless the request times out first).
+    'kubectl': r"""
+pod_age() {
+  awk -v created="$(cat "$FAKE_PODS_DIR/$1")" -v now="$(date +%s.%N)" \
+    'BEGIN { print now - created }'
+}
+print_pod() {
+  awk -v name="$1" -v age="$(pod_age "$1")" -v pod_sec="$FAKE_POD_SEC" \
+    'BEGIN { printf "{\n  \"metadata\": {\"name\": \"%s\"},\n" \
+                    "  \"status\": {\"phase\": \"%s\"}\n}\n", \
+                    name, (age < pod_sec) ? "Running" : "Succeeded" }'
+}
+case "$1" in
+  create|replace)
+    name="$(sed -n 's/.*"name": *"\([^"]*\)".*/\1/p' | head -n 1)"
+    date +%s.%N > "$FAKE_PODS_DIR/$name"
+    ;;
+  get)
+    if [[ "$3" == "-o" ]]; then
+      ls "$FAKE_PODS_DIR" | tr '\n' ' '
+    elif [[ ! -f "$FAKE_PODS_DIR/$3" ]]; then
+      exit 1
+    elif [[ "$4" == "--watch" ]]; then
+      print_pod "$3"
+      wait_sec="$(awk -v age="$(pod_age "$3")" -v pod_sec="$FAKE_POD_SEC" \
+        'BEGIN { print (age < pod_sec) ? pod_sec - age : 0 }')"
+      [[ "$wait_sec" == 0 ]] && exit 0
+      for arg in "$@"; do
+        if [[ "$arg" == --request-timeout=* ]]; then
+          timeout_sec="${arg#--request-timeout=}"
+          timeout_sec="${timeout_sec%s}"
+          if awk -v t="$timeout_sec" -v w="$wait_sec" 'BEGIN { exit !(t < w) }'
+          then
+            sleep "$timeout_sec"
+            exit 0
+          fi
+        fi
+      done
+      sleep "$wait_sec"
+      [[ -f "$FAKE_PODS_DIR/$3" ]] && print_pod "$3"
+    else
+      print_pod "$3"
+    fi
+    ;;
+  delete) rm -f "$FAKE_PODS_DIR/$3" ;;
+esac
+""",
+}
+
+_CLUSTER_NAME = 'benchmark-cluster'
+
+# (executable, first arg) of calls that submit a worker. Pipelines are always
+# run, as the runner passes --project first.
+_SUBMIT_CALLS = (('pipelines', None), ('kubectl', 'create'))
+
+_RUNNER_ARGV = [
+    '--project', 'project', '--docker_image', 'gcr.io/dockerimage', '--zones',
+    'zone-a', '--outfile', 'gs://bucket/output.vcf', '--staging',
+    'gs://bucket/staging', '--model', 'gs://bucket/model', '--bam',
+    'gs://bucket/bam', '--ref', 'gs://bucket/ref', '--attempts', '1',
+    '--max_preemptible_tries', '0', '--max_non_preemptible_tries', '0'
+]
+
+
+class _RssSampler(threading.Thread):
+  """Samples the resident memory of this process."""
+
+  def __init__(self, interval_sec=0.05):
+    super(_RssSampler, self).__init__()
+    self.daemon = True
+    self.peak_rss_kb = 0
+    self._interval_sec = interval_sec
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.is_set():
+      self.peak_rss_kb = max(self.peak_rss_kb, _get_rss_kb())
+      self._stopped.wait(self._interval_sec)
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+
+def _get_rss_kb():
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1])
+  except (IOError, OSError):
+    pass
+  return 0
+
+
+def _write_fake_executables(bin_dir, settings):
+  """Writes the fake executables with the given FAKE_* variables."""
+  variables = ''.join(
+      "%s='%s'\n" % (name, value) for name, value in sorted(settings.items()))
+  for name, body in _FAKE_SCRIPTS.items():
+    path = os.path.join(bin_dir, name)
+    with open(path, 'w') as f:
+      f.write('#!/bin/bash\n' + variables + _FAKE_SCRIPT_HEADER + body)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def _run_in_threads(func, num_workers):
+  """Calls func(i) for each worker in its own thread."""
+  pool = multiprocessing.pool.ThreadPool(processes=num_workers)
+  try:
+    pool.map(func, range(num_workers))
+  finally:
+    pool.close()
+    pool.join()
+
+
+def _run_commands(num_workers, args):
+  _run_in_threads(
+      lambda i: process_util.run_command(
+          ['pipelines', 'run', str(i)], retry_delay_sec=0,
+          retries=args.retries), num_workers)
+
+
+def _run_runner(num_workers, jobs_to_run):
+  """Runs gcp_deepvariant_runner.run without GCS."""
+  argv = _RUNNER_ARGV + [
+      '--jobs_to_run'
+  ] + jobs_to_run + [
+      '--shards', str(num_workers), '--make_examples_workers',
+      str(num_workers), '--call_variants_workers',
+      str(num_workers)
+  ]
+  with mock.patch.object(gcp_deepvariant_runner, '_gcs_objects_exist',
+                         side_effect=lambda paths: dict.fromkeys(
+                             paths, True)), \
+       mock.patch.object(gcp_deepvariant_runner, '_can_write_to_bucket',
+                         return_value=True), \
+       mock.patch.object(gcp_deepvariant_runner, '_get_failed_shards',
+                         return_value=[]), \
+       mock.patch.object(gcp_deepvariant_runner.completion_manifest,
+                         'CompletionManifest'):
+    gcp_deepvariant_runner.run(argv)
+
+
+def _deploy_pods(num_workers, unused_args):
+  cluster = gke_cluster.GkeCluster(_CLUSTER_NAME, cluster_zone='zone-a')
+  _run_in_threads(
+      lambda i: cluster.deploy_pod(
+          '{"metadata": {"name": "pod-%d"}}' % i, 'pod-%d' % i, wait=True),
+      num_workers)
+
+
+_SCENARIOS = collections.OrderedDict([
+    ('run_command', _run_commands),
+    ('make_examples',
+     lambda num_workers, unused_args: _run_runner(num_workers,
+                                                  ['make_examples'])),
+    ('run', lambda num_workers, unused_args: _run_runner(
+        num_workers, ['make_examples', 'call_variants',
+                      'postprocess_variants'])),
+    ('deploy_pod', _deploy_pods),
+])
+
+
+def _read_calls(calls_file):
+  """Returns the (executable, start time, first arg) of each fake call."""
+  if not os.path.isfile(calls_file):
+    return []
+  calls = []
+  with open(calls_file) as f:
+    for line in f:
+      fields = line.split()
+      if len(fields) >= 2:
+        calls.append((fields[0], float(fields[1]),
+                      fields[2] if len(fields) > 2 else ''))
+  return calls
+
+
+def _benchmark(scenario, num_workers, args, work_dir):
+  """Runs a scenario and returns the measurements."""
+  calls_file = os.path.join(work_dir, '%s-%d.calls' % (scenario, num_workers))
+  _write_fake_executables(
+      work_dir, {
+          'FAKE_CALLS_FILE': calls_file,
+          'FAKE_PODS_DIR': tempfile.mkdtemp(dir=work_dir),
+          'FAKE_LATENCY_SEC': args.latency_sec,
+          'FAKE_FAILURE_BP': int(args.failure_rate * 10000),
+          'FAKE_POD_SEC': args.pod_sec,
+          'FAKE_CLUSTER_NAME': _CLUSTER_NAME,
+      })
+
+  error = None
+  sampler = _RssSampler()
+  sampler.start()
+  start_time = time.time()
+  try:
+    _SCENARIOS[scenario](num_workers, args)
+  except Exception as e:  # pylint: disable=broad-except
+    error = str(e)
+  wall_sec = time.time() - start_time
+  sampler.stop()
+
+  calls = _read_calls(calls_file)
+  submit_times = [
+      call_time for name, call_time, first_arg in calls
+      if (name, None) in _SUBMIT_CALLS or (name, first_arg) in _SUBMIT_CALLS
+  ]
+  return {
+      'scenario': scenario,
+      'workers': num_workers,
+      'wall_sec': round(wall_sec, 3),
+      'submit_latency_sec': (round(max(submit_times) - start_time, 3)
+                             if submit_times else None),
+      'peak_rss_mb': round(sampler.peak_rss_kb / 1024, 1),
+      'subprocesses': dict(
+          collections.Counter(name for name, _, _ in calls)),
+      'error': error,
+  }
+
+
+def run(argv=None):
+  """Runs the benchmark."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--workers',
+      type=int,
+      nargs='+',
+      default=[1, 10, 100, 1000],
+      help='Number of workers to benchmark.')
+  parser.add_argument(
+      '--scenarios',
+      nargs='+',
+      default=list(_SCENARIOS),
+      choices=list(_SCENARIOS),
+      help='Scenarios to benchmark.')
+  parser.add_argument(
+      '--latency_sec',
+      type=float,
+      default=0.1,
+      help='Time (in seconds) each fake pipelines/gcloud/kubectl call takes.')
+  parser.add_argument(
+      '--failure_rate',
+      type=float,
+      default=0,
+      help='Probability that a fake call fails.')
+  parser.add_argument(
+      '--pod_sec',
+      type=float,
+      default=2,
+      help='Time (in seconds) each fake pod runs for.')
+  parser.add_argument(
+      '--retries',
+      type=int,
+      default=2,
+      help='Retries of each call in the run_command scenario.')
+  parser.add_argument(
+      '--output', help='Optional path to write the results to as JSON.')
+  args = parser.parse_args(argv)
+
+  work_dir = tempfile.mkdtemp()
+  old_path = os.environ['PATH']
+  os.environ['PATH'] = work_dir + os.pathsep + old_path
+  results = []
+  try:
+    for num_workers in args.workers:
+      for scenario in args.scenarios:
+        result = _benchmark(scenario, num_workers, args, work_dir)
+        print(json.dumps(result, sort_keys=True))
+        results.append(result)
+  finally:
+    os.environ['PATH'] = old_path
+    shutil.rmtree(work_dir)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  run()
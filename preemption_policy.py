@@ -0,0 +1,126 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Moves workers from preemptible to regular VMs when a deadline is at risk.
+
+Workers that run on preemptible VMs are cheaper, but may have to be restarted
+from scratch. Once the deadline of a run is at risk, the workers launched from
+then on (including re-runs) skip their preemptible attempts.
+
+A worker is at risk if the time left until the deadline is less than
+safety_factor times the longest successful run of the same pipelines job (by
+--name) so far. Until a job has succeeded once, it is at risk once less than
+unknown_duration_fraction of the run's time budget is left.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import threading
+import time
+
+
+DEFAULT_SAFETY_FACTOR = 1.5
+DEFAULT_UNKNOWN_DURATION_FRACTION = 0.25
+
+
+def _get_arg(run_args, name):
+  return run_args[run_args.index(name) + 1] if name in run_args else None
+
+
+def get_on_demand_args(run_args):
+  """Returns pipelines run_args with all attempts on regular VMs.
+
+  The preemptible attempts (--pvm-attempts) are turned into regular attempts
+  (--attempts), so that the total number of attempts is unchanged.
+  """
+  pvm_attempts = int(_get_arg(run_args, '--pvm-attempts') or 0)
+  if not pvm_attempts:
+    return run_args
+  attempts = int(_get_arg(run_args, '--attempts') or 0)
+  run_args = list(run_args)
+  run_args[run_args.index('--pvm-attempts') + 1] = '0'
+  if '--attempts' in run_args:
+    run_args[run_args.index('--attempts') + 1] = str(attempts + pvm_attempts)
+  else:
+    run_args.extend(['--attempts', str(pvm_attempts)])
+  return run_args
+
+
+class DeadlinePolicy(object):
+  """Decides whether a pipelines job may still use preemptible VMs."""
+
+  def __init__(self,
+               deadline_time,
+               start_time=None,
+               safety_factor=DEFAULT_SAFETY_FACTOR,
+               unknown_duration_fraction=DEFAULT_UNKNOWN_DURATION_FRACTION):
+    """Decides whether a pipelines job may still use preemptible VMs.
+
+    Args:
+      deadline_time: (float) time (since the epoch) the run must end by.
+      start_time: (float) time the run started, now by default.
+      safety_factor: (float) margin, relative to the job's longest duration,
+        to keep before the deadline.
+      unknown_duration_fraction: (float) fraction of the run's time budget
+        that must be left for a job that has not succeeded yet.
+    """
+    self._deadline_time = deadline_time
+    self._start_time = start_time if start_time is not None else time.time()
+    self._safety_factor = safety_factor
+    self._unknown_duration_fraction = unknown_duration_fraction
+    self._durations = {}
+    self._lock = threading.Lock()
+
+  def record_duration(self, run_args, duration_sec):
+    """Records the duration of a successful pipelines job."""
+    name = _get_arg(run_args, '--name')
+    with self._lock:
+      self._durations[name] = max(self._durations.get(name, 0), duration_sec)
+
+  def is_at_risk(self, run_args):
+    """Returns whether a job launched now risks missing the deadline."""
+    time_left = self._deadline_time - time.time()
+    with self._lock:
+      duration_sec = self._durations.get(_get_arg(run_args, '--name'))
+    if duration_sec is None:
+      return time_left < self._unknown_duration_fraction * (
+          self._deadline_time - self._start_time)
+    return time_left < self._safety_factor * duration_sec
+
+  def apply(self, run_args):
+    """Returns the run_args of a job to launch now."""
+    if not self.is_at_risk(run_args):
+      return run_args
+    on_demand_args = get_on_demand_args(run_args)
+    if on_demand_args != run_args:
+      logging.info('Deadline at risk: running %s on regular VMs.',
+                   _get_arg(run_args, '--name'))
+    return on_demand_args
@@ -0,0 +1,103 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for preemption_policy.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python preemption_policy_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import mock
+import preemption_policy
+
+
+_RUN_ARGS = [
+    'pipelines', 'run', '--attempts', '1', '--pvm-attempts', '3', '--name',
+    'make_examples'
+]
+
+
+class PreemptionPolicyTest(unittest.TestCase):
+
+  def test_get_on_demand_args(self):
+    self.assertEqual(
+        preemption_policy.get_on_demand_args(_RUN_ARGS), [
+            'pipelines', 'run', '--attempts', '4', '--pvm-attempts', '0',
+            '--name', 'make_examples'
+        ])
+    on_demand_args = ['pipelines', 'run', '--attempts', '2', '--pvm-attempts',
+                      '0']
+    self.assertEqual(
+        preemption_policy.get_on_demand_args(on_demand_args), on_demand_args)
+
+  @mock.patch('time.time')
+  def test_is_at_risk_unknown_duration(self, mock_time):
+    policy = preemption_policy.DeadlinePolicy(1000, start_time=0)
+    mock_time.return_value = 700
+    self.assertFalse(policy.is_at_risk(_RUN_ARGS))
+    mock_time.return_value = 800
+    self.assertTrue(policy.is_at_risk(_RUN_ARGS))
+
+  @mock.patch('time.time')
+  def test_is_at_risk_known_duration(self, mock_time):
+    policy = preemption_policy.DeadlinePolicy(1000, start_time=0)
+    policy.record_duration(_RUN_ARGS, 100)
+    policy.record_duration(_RUN_ARGS, 50)
+    mock_time.return_value = 800
+    self.assertFalse(policy.is_at_risk(_RUN_ARGS))
+    mock_time.return_value = 900
+    self.assertTrue(policy.is_at_risk(_RUN_ARGS))
+    # Other jobs are still unknown.
+    mock_time.return_value = 700
+    self.assertFalse(policy.is_at_risk(['--name', 'call_variants']))
+
+  @mock.patch('time.time')
+  def test_apply(self, mock_time):
+    policy = preemption_policy.DeadlinePolicy(1000, start_time=0)
+    mock_time.return_value = 100
+    self.assertEqual(policy.apply(_RUN_ARGS), _RUN_ARGS)
+    mock_time.return_value = 990
+    self.assertEqual(
+        policy.apply(_RUN_ARGS),
+        preemption_policy.get_on_demand_args(_RUN_ARGS))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -47,7 +47,7 @@ def run_command(args, std_input=None, retry_delay_sec=1, retries=0):
     retries: (int) number of retries.
 
   Returns:
-    stdout.
+    stdout (type str).
 
   Raises:
     ValueError: if number of retries is less than zero.
@@ -63,11 +63,15 @@ def run_command(args, std_input=None, retry_delay_sec=1, retries=0):
           args,
           stdin=subprocess.PIPE,
           stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE)
+          stderr=subprocess.PIPE,
+          universal_newlines=True)
       stdout, stderr = process.communicate(input=std_input)
     else:
       process = subprocess.Popen(
-          args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+          args,
+          stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE,
+          universal_newlines=True)
       stdout, stderr = process.communicate()
     if process.returncode == 0:
       if stderr:
@@ -0,0 +1,225 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Partitions a genome into regions of roughly equal work using a BAM index.
+
+The work of a region is estimated from the linear index of the BAI file: it
+stores the file offset of the first read of each 16kb window, so the distance
+between the offsets of consecutive windows is the (compressed) size of the
+reads in a window. Reference names and lengths are read from the FAI file,
+whose sequences must be in the same order as in the BAM header.
+
+The genome is then cut into contiguous regions of roughly equal work. Cuts are
+made at window boundaries, so a single window is never split.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+
+
+_BAI_MAGIC = b'BAI\x01'
+
+# Size (in bases) of the windows of the BAI linear index.
+WINDOW_SIZE = 1 << 14
+
+# Bin number of the pseudo-bin that holds per-reference metadata.
+_PSEUDO_BIN = 37450
+
+
+class Reference(object):
+  """Name and length of a reference sequence."""
+
+  def __init__(self, name, length):
+    self.name = name
+    self.length = length
+
+  def __eq__(self, other):
+    return (self.name, self.length) == (other.name, other.length)
+
+  def __repr__(self):
+    return 'Reference(%r, %d)' % (self.name, self.length)
+
+
+def read_fai(fai_file):
+  """Returns the references of a FAI index.
+
+  Args:
+    fai_file: file object (text) of the FAI index.
+  """
+  references = []
+  for line in fai_file:
+    if line.strip():
+      fields = line.split('\t')
+      references.append(Reference(fields[0], int(fields[1])))
+  return references
+
+
+def _read(bai_file, fmt):
+  size = struct.calcsize(fmt)
+  data = bai_file.read(size)
+  if len(data) != size:
+    raise ValueError('Truncated BAI file.')
+  return struct.unpack(fmt, data)
+
+
+def read_bai_window_work(bai_file):
+  """Returns the estimated work of each linear index window of each reference.
+
+  The work of a window is the number of compressed BAM bytes between the first
+  read of the window and the first read of the next window (or the end of the
+  reference's reads).
+
+  Args:
+    bai_file: file object (binary) of the BAI index.
+
+  Returns:
+    A list (one item per reference) of lists of window work.
+
+  Raises:
+    ValueError: if the file is not a valid BAI index.
+  """
+  if bai_file.read(4) != _BAI_MAGIC:
+    raise ValueError('Invalid BAI file: wrong magic number.')
+  num_references, = _read(bai_file, '<i')
+  window_offsets = []
+  end_offsets = []
+  for _ in range(num_references):
+    end_offset = None
+    num_bins, = _read(bai_file, '<i')
+    for _ in range(num_bins):
+      bin_number, num_chunks = _read(bai_file, '<Ii')
+      chunks = _read(bai_file, '<%dQ' % (2 * num_chunks))
+      if bin_number == _PSEUDO_BIN and num_chunks >= 1:
+        end_offset = chunks[1] >> 16
+    num_intervals, = _read(bai_file, '<i')
+    # Empty windows may have a zero offset; they start where the previous
+    # window ends.
+    offsets = []
+    for offset in _read(bai_file, '<%dQ' % num_intervals):
+      offsets.append(max(offset >> 16, offsets[-1] if offsets else 0))
+    window_offsets.append(offsets)
+    end_offsets.append(end_offset)
+
+  window_work = []
+  for i, offsets in enumerate(window_offsets):
+    end_offset = end_offsets[i]
+    if end_offset is None:
+      # Fall back to the first read of the next reference with reads.
+      end_offset = next(
+          (other[0] for other in window_offsets[i + 1:] if other),
+          offsets[-1] if offsets else 0)
+    boundaries = offsets + [max(end_offset, offsets[-1] if offsets else 0)]
+    window_work.append([
+        boundaries[k + 1] - boundaries[k] for k in range(len(offsets))
+    ])
+  return window_work
+
+
+def partition_regions(references, window_work, num_partitions):
+  """Cuts the genome into contiguous partitions of roughly equal work.
+
+  Args:
+    references: (list) Reference of each sequence, in BAM header order.
+    window_work: (list) estimated work of the windows of each reference, as
+      returned by read_bai_window_work. References without an entry have no
+      reads.
+    num_partitions: (int) number of partitions.
+
+  Returns:
+    A list of num_partitions non-empty lists of (name, start, end) regions
+    (0-based, end exclusive) that together cover all references.
+
+  Raises:
+    ValueError: if num_partitions is not positive or larger than the number of
+      windows.
+  """
+  if num_partitions <= 0:
+    raise ValueError('Number of partitions must be positive.')
+  # (reference index, start, end, work) of every window.
+  windows = []
+  for i, reference in enumerate(references):
+    work = window_work[i] if i < len(window_work) else []
+    for start in range(0, reference.length, WINDOW_SIZE):
+      window_index = start // WINDOW_SIZE
+      windows.append((i, start, min(start + WINDOW_SIZE, reference.length),
+                      work[window_index] if window_index < len(work) else 0))
+  if len(windows) < num_partitions:
+    raise ValueError('Cannot cut %d windows into %d partitions.' %
+                     (len(windows), num_partitions))
+  total_work = sum(window[3] for window in windows)
+
+  partitions = [[] for _ in range(num_partitions)]
+  cumulative_work = 0
+  partition_index = -1
+  for k, (i, start, end, work) in enumerate(windows):
+    # Assign by the midpoint of the window's work, so that a heavy window goes
+    # to the partition covering most of it. Without reads, fall back to an
+    # even split of the windows.
+    if total_work:
+      midpoint = (cumulative_work + work / 2) / total_work
+    else:
+      midpoint = (k + 0.5) / len(windows)
+    cumulative_work += work
+    # Partitions are not skipped, and enough windows are left for the
+    # remaining ones, so that no partition is empty.
+    partition_index = min(
+        max(int(midpoint * num_partitions), partition_index,
+            num_partitions - (len(windows) - k)), partition_index + 1,
+        num_partitions - 1)
+    partition = partitions[partition_index]
+    name = references[i].name
+    if partition and partition[-1][0] == name and partition[-1][2] == start:
+      partition[-1] = (name, partition[-1][1], end)
+    else:
+      partition.append((name, start, end))
+  return partitions
+
+
+def get_partition_work(references, window_work, partitions):
+  """Returns the estimated work of each partition."""
+  reference_indices = {
+      reference.name: i for i, reference in enumerate(references)
+  }
+  partition_work = []
+  for partition in partitions:
+    work = 0
+    for name, start, end in partition:
+      index = reference_indices[name]
+      windows = window_work[index] if index < len(window_work) else []
+      work += sum(windows[start // WINDOW_SIZE:-(-end // WINDOW_SIZE)])
+    partition_work.append(work)
+  return partition_work
+
+
+def to_bed(regions):
+  """Returns the content of a BED file with the given regions."""
+  return ''.join(
+      '%s\t%d\t%d\n' % (name, start, end) for name, start, end in regions)
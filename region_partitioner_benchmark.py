@@ -0,0 +1,214 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+r"""Reports shard work imbalance of region partitioning on synthetic indexes.
+
+Builds a synthetic BAI index for a genome whose coverage has hotspots (e.g.
+amplified or collapsed repeat regions) and gaps (e.g. centromeres), and reports
+for each number of shards the imbalance (max / mean shard work) of:
+  - round_robin: the default make_examples sharding, i.e. 1kb regions assigned
+    round-robin to shards (with the work of a 16kb window spread evenly over
+    its regions, which is as fine as the index can tell).
+  - equal_length: contiguous regions of equal genome length.
+  - coverage_balanced: region_partitioner.partition_regions.
+It also reports the time taken to parse the index and partition the genome.
+
+Sample run command:
+$ python region_partitioner_benchmark.py --shards 64 512 --output results.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import random
+import struct
+import time
+
+import region_partitioner
+
+
+# Size (in bases) of the regions make_examples assigns round-robin to shards.
+_MAKE_EXAMPLES_REGION_SIZE = 1000
+
+
+def _get_synthetic_genome(num_references, reference_length, hotspots, seed):
+  """Returns the references and per-window work of a synthetic genome."""
+  rand = random.Random(seed)
+  references = []
+  window_work = []
+  for i in range(num_references):
+    # Decreasing lengths, like human chromosomes.
+    length = int(reference_length * (1 - 0.5 * i / num_references))
+    references.append(region_partitioner.Reference('chr%d' % (i + 1), length))
+    num_windows = -(-length // region_partitioner.WINDOW_SIZE)
+    work = [max(0, int(rand.gauss(1000, 100))) for _ in range(num_windows)]
+    gap_start = rand.randrange(num_windows)
+    for k in range(gap_start, min(num_windows, gap_start + num_windows // 20)):
+      work[k] = 0
+    window_work.append(work)
+  for _ in range(hotspots):
+    work = window_work[rand.randrange(num_references)]
+    start = rand.randrange(len(work))
+    for k in range(start, min(len(work), start + rand.randint(1, 50))):
+      work[k] *= rand.randint(10, 100)
+  return references, window_work
+
+
+def _get_bai(window_work):
+  """Returns the content of a BAI file with the given window work."""
+  data = io.BytesIO()
+  data.write(b'BAI\x01' + struct.pack('<i', len(window_work)))
+  offset = 0
+  for work in window_work:
+    offsets = []
+    for window in work:
+      offsets.append(offset)
+      offset += window
+    data.write(struct.pack('<iIi', 1, 37450, 2))
+    data.write(struct.pack('<4Q', offsets[0] << 16, offset << 16, 0, 0))
+    data.write(struct.pack('<i', len(offsets)))
+    data.write(struct.pack('<%dQ' % len(offsets),
+                           *[o << 16 for o in offsets]))
+  return data.getvalue()
+
+
+def _get_imbalance(shard_work):
+  mean = sum(shard_work) / len(shard_work)
+  return round(max(shard_work) / mean, 3) if mean else None
+
+
+def _get_round_robin_work(references, window_work, num_shards):
+  """Returns the shard work of make_examples' round-robin sharding."""
+  shard_work = [0] * num_shards
+  region_index = 0
+  for reference, work in zip(references, window_work):
+    for start in range(0, reference.length, _MAKE_EXAMPLES_REGION_SIZE):
+      end = min(start + _MAKE_EXAMPLES_REGION_SIZE, reference.length)
+      window = work[start // region_partitioner.WINDOW_SIZE]
+      shard_work[region_index % num_shards] += (
+          window * (end - start) / region_partitioner.WINDOW_SIZE)
+      region_index += 1
+  return shard_work
+
+
+def _get_equal_length_partitions(references, num_shards):
+  """Returns contiguous partitions of equal genome length."""
+  genome_length = sum(reference.length for reference in references)
+  partitions = [[] for _ in range(num_shards)]
+  offset = 0
+  for reference in references:
+    start = 0
+    while start < reference.length:
+      shard = min(num_shards - 1,
+                  (offset + start) * num_shards // genome_length)
+      shard_end = -(-(shard + 1) * genome_length // num_shards) - offset
+      # Cuts are rounded to windows, like partition_regions.
+      end = min(reference.length,
+                -(-shard_end // region_partitioner.WINDOW_SIZE) *
+                region_partitioner.WINDOW_SIZE)
+      partitions[shard].append((reference.name, start, end))
+      start = end
+    offset += reference.length
+  return partitions
+
+
+def _benchmark(references, bai, num_shards):
+  """Returns the imbalance of each sharding strategy."""
+  start_time = time.time()
+  window_work = region_partitioner.read_bai_window_work(io.BytesIO(bai))
+  read_sec = time.time() - start_time
+  start_time = time.time()
+  partitions = region_partitioner.partition_regions(references, window_work,
+                                                    num_shards)
+  partition_sec = time.time() - start_time
+  return {
+      'shards': num_shards,
+      'round_robin_imbalance': _get_imbalance(
+          _get_round_robin_work(references, window_work, num_shards)),
+      'equal_length_imbalance': _get_imbalance(
+          region_partitioner.get_partition_work(
+              references, window_work,
+              _get_equal_length_partitions(references, num_shards))),
+      'coverage_balanced_imbalance': _get_imbalance(
+          region_partitioner.get_partition_work(references, window_work,
+                                                partitions)),
+      'read_bai_sec': round(read_sec, 3),
+      'partition_sec': round(partition_sec, 3),
+  }
+
+
+def run(argv=None):
+  """Runs the benchmark."""
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--shards',
+      type=int,
+      nargs='+',
+      default=[16, 64, 256, 1024],
+      help='Number of shards to benchmark.')
+  parser.add_argument(
+      '--references',
+      type=int,
+      default=24,
+      help='Number of reference sequences of the synthetic genome.')
+  parser.add_argument(
+      '--reference_length',
+      type=int,
+      default=250000000,
+      help='Length of the longest reference sequence.')
+  parser.add_argument(
+      '--hotspots',
+      type=int,
+      default=50,
+      help='Number of high coverage regions.')
+  parser.add_argument(
+      '--seed', type=int, default=0, help='Seed of the synthetic genome.')
+  parser.add_argument(
+      '--output', help='Optional path to write the results to as JSON.')
+  args = parser.parse_args(argv)
+
+  references, window_work = _get_synthetic_genome(
+      args.references, args.reference_length, args.hotspots, args.seed)
+  bai = _get_bai(window_work)
+  results = []
+  for num_shards in args.shards:
+    result = _benchmark(references, bai, num_shards)
+    print(json.dumps(result, sort_keys=True))
+    results.append(result)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  run()
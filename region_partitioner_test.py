@@ -0,0 +1,149 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for region_partitioner.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python region_partitioner_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import struct
+import unittest
+
+import region_partitioner
+
+
+def _get_bai(window_offsets, end_offsets):
+  """Returns the content of a BAI file with the given linear indices.
+
+  Args:
+    window_offsets: (list) compressed offsets of the windows of each reference.
+    end_offsets: (list) compressed offset of the end of each reference's reads
+      (stored in the pseudo-bin), or None.
+  """
+  data = b'BAI\x01' + struct.pack('<i', len(window_offsets))
+  for offsets, end_offset in zip(window_offsets, end_offsets):
+    if end_offset is None:
+      data += struct.pack('<i', 1)
+      data += struct.pack('<Ii', 4681, 1) + struct.pack('<2Q', 0, 0)
+    else:
+      data += struct.pack('<i', 1)
+      data += struct.pack('<Ii', 37450, 2)
+      data += struct.pack('<4Q', offsets[0] << 16, end_offset << 16, 10, 0)
+    data += struct.pack('<i', len(offsets))
+    data += struct.pack('<%dQ' % len(offsets),
+                        *[offset << 16 for offset in offsets])
+  return data
+
+
+class RegionPartitionerTest(unittest.TestCase):
+  """Tests for region_partitioner."""
+
+  def test_read_fai(self):
+    fai = io.StringIO(u'chr1\t100\t6\t60\t61\nchr2\t50\t200\t60\t61\n')
+    self.assertEqual(
+        region_partitioner.read_fai(fai), [
+            region_partitioner.Reference('chr1', 100),
+            region_partitioner.Reference('chr2', 50)
+        ])
+
+  def test_read_bai_window_work(self):
+    bai = _get_bai([[100, 0, 150, 400], [500, 600], []], [450, None, None])
+    self.assertEqual(
+        region_partitioner.read_bai_window_work(io.BytesIO(bai)),
+        [[0, 50, 250, 50], [100, 0], []])
+
+  def test_read_bai_invalid(self):
+    with self.assertRaisesRegex(ValueError, 'wrong magic number'):
+      region_partitioner.read_bai_window_work(io.BytesIO(b'BAM\x01'))
+    with self.assertRaisesRegex(ValueError, 'Truncated'):
+      region_partitioner.read_bai_window_work(io.BytesIO(b'BAI\x01\x01'))
+
+  def test_partition_regions(self):
+    window_size = region_partitioner.WINDOW_SIZE
+    references = [
+        region_partitioner.Reference('chr1', 4 * window_size),
+        region_partitioner.Reference('chr2', 2 * window_size + 10),
+    ]
+    # Most of the work is in the first window of chr2.
+    window_work = [[10, 10, 10, 10], [60, 0, 0]]
+    partitions = region_partitioner.partition_regions(references, window_work,
+                                                      2)
+    self.assertEqual(partitions, [
+        [('chr1', 0, 4 * window_size)],
+        [('chr2', 0, 2 * window_size + 10)],
+    ])
+    self.assertEqual(
+        region_partitioner.get_partition_work(references, window_work,
+                                              partitions), [40, 60])
+
+  def test_partition_regions_no_empty_partitions(self):
+    window_size = region_partitioner.WINDOW_SIZE
+    references = [region_partitioner.Reference('chr1', 3 * window_size)]
+    # All work is in the first window, but every partition gets a window.
+    partitions = region_partitioner.partition_regions(references, [[90, 0, 0]],
+                                                      3)
+    self.assertEqual(partitions, [[('chr1', 0, window_size)],
+                                  [('chr1', window_size, 2 * window_size)],
+                                  [('chr1', 2 * window_size, 3 * window_size)]])
+
+  def test_partition_regions_without_reads(self):
+    window_size = region_partitioner.WINDOW_SIZE
+    references = [
+        region_partitioner.Reference('chr1', 3 * window_size),
+        region_partitioner.Reference('chr2', window_size),
+    ]
+    partitions = region_partitioner.partition_regions(references, [], 2)
+    self.assertEqual(partitions, [[('chr1', 0, 2 * window_size)],
+                                  [('chr1', 2 * window_size, 3 * window_size),
+                                   ('chr2', 0, window_size)]])
+
+  def test_partition_regions_too_many_partitions(self):
+    references = [region_partitioner.Reference('chr1', 10)]
+    with self.assertRaisesRegex(ValueError, 'Cannot cut 1 windows'):
+      region_partitioner.partition_regions(references, [], 2)
+
+  def test_to_bed(self):
+    self.assertEqual(
+        region_partitioner.to_bed([('chr1', 0, 10), ('chr2', 5, 20)]),
+        'chr1\t0\t10\nchr2\t5\t20\n')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,398 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Plans the sharding and machine shapes of a DeepVariant run.
+
+Given the size of the input BAM file and the fraction of the genome to call,
+the planner picks --shards, the number of workers and the machine shape of
+each stage such that the run meets a target wall-clock time at the lowest
+cost, or is as fast as possible within a budget. Runtimes are predicted by a
+throughput model, which can be calibrated from past runs, and costs are
+computed from per-resource prices.
+
+Stages are assumed to run one after the other, and make_examples to run one
+shard per core.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import re
+
+
+MAKE_EXAMPLES = 'make_examples'
+CALL_VARIANTS = 'call_variants'
+POSTPROCESS_VARIANTS = 'postprocess_variants'
+
+_GB = 1 << 30
+
+# Default throughput of each stage, per GB of BAM reads in the called regions.
+# These are rough figures for 30x whole genomes on n1 machines, and are best
+# replaced by calibrating the model on past runs.
+#   core_hours_per_gb: CPU time of the stage's work.
+#   gpu_hours_per_gb: GPU time of the stage's work, if it runs on GPUs.
+#   overhead_hours: fixed time of each worker (VM startup, image pull, etc.).
+#   localization_hours_per_gb: time to copy one GB of the BAM file to a worker.
+_DEFAULT_PARAMETERS = {
+    MAKE_EXAMPLES: {
+        'core_hours_per_gb': 2.5,
+        'overhead_hours': 0.1,
+        'localization_hours_per_gb': 0.0015,
+    },
+    CALL_VARIANTS: {
+        'core_hours_per_gb': 3.2,
+        'gpu_hours_per_gb': 0.05,
+        'overhead_hours': 0.1,
+        'localization_hours_per_gb': 0,
+    },
+    POSTPROCESS_VARIANTS: {
+        'core_hours_per_gb': 0.01,
+        'overhead_hours': 0.1,
+        'localization_hours_per_gb': 0,
+    },
+}
+
+# Default on-demand and preemptible prices (in USD per hour) of Compute Engine
+# resources.
+DEFAULT_PRICES = {
+    'core_hour': 0.033174,
+    'ram_gb_hour': 0.004446,
+    'gpu_hour': 0.45,
+    'disk_gb_hour': 0.000055,
+    'preemptible_core_hour': 0.00698,
+    'preemptible_ram_gb_hour': 0.00094,
+    'preemptible_gpu_hour': 0.135,
+}
+
+# Candidate number of cores of make_examples and call_variants workers.
+_CORES_PER_WORKER = (4, 8, 16, 32, 64)
+
+# RAM (in GB) per core of planned machines, as in n1-standard machines.
+_RAM_GB_PER_CORE = 3.75
+
+_REGION_LITERAL_PATTERN = re.compile(r'^(.+):([0-9,]+)-([0-9,]+)$')
+
+
+class LinearThroughputModel(object):
+  """Predicts stage runtimes from work linear in the size of the input."""
+
+  def __init__(self, parameters=None):
+    """Predicts stage runtimes from work linear in the size of the input.
+
+    Args:
+      parameters: (dict) parameters of each stage, overriding the defaults.
+        See _DEFAULT_PARAMETERS for the parameters of a stage.
+    """
+    self.parameters = copy.deepcopy(_DEFAULT_PARAMETERS)
+    for stage, stage_parameters in (parameters or {}).items():
+      if stage not in self.parameters:
+        raise ValueError('Unknown stage in throughput model: %s' % stage)
+      self.parameters[stage].update(stage_parameters)
+
+  def predict_hours(self, stage, bam_bytes, region_fraction, workers, cores,
+                    gpus):
+    """Returns the predicted wall-clock time (in hours) of a stage.
+
+    Args:
+      stage: (str) name of the stage.
+      bam_bytes: (int) size of the BAM file.
+      region_fraction: (float) fraction of the genome that is called.
+      workers: (int) number of workers the work is split between.
+      cores: (int) number of cores of each worker.
+      gpus: (int) number of GPUs of each worker. If set, the stage runs on
+        GPUs.
+    """
+    parameters = self.parameters[stage]
+    bam_gb = bam_bytes / _GB
+    if gpus:
+      work_hours = (bam_gb * region_fraction * parameters['gpu_hours_per_gb'] /
+                    (workers * gpus))
+    else:
+      work_hours = (bam_gb * region_fraction * parameters['core_hours_per_gb'] /
+                    (workers * cores))
+    return (parameters['overhead_hours'] +
+            bam_gb * parameters['localization_hours_per_gb'] + work_hours)
+
+  def calibrate(self, runs):
+    """Returns a copy of the model fitted to past runs.
+
+    The work rate (core or GPU hours per GB) of each stage is fitted by least
+    squares to the stage runtimes, after subtracting the fixed overheads.
+    Stages (and GPU or CPU rates) without runs keep their current parameters.
+
+    Args:
+      runs: (list) dicts describing a stage of a past run, with keys: stage,
+        bam_bytes, region_fraction, workers, cores_per_worker,
+        gpus_per_worker (optional) and hours (wall-clock time of the stage).
+    """
+    # (stage, rate name) -> [sum of x * y, sum of x * x].
+    sums = {}
+    for run in runs:
+      parameters = self.parameters[run['stage']]
+      gpus = run.get('gpus_per_worker', 0)
+      bam_gb = run['bam_bytes'] / _GB
+      x = bam_gb * run['region_fraction'] / (
+          run['workers'] * (gpus or run['cores_per_worker']))
+      y = (run['hours'] - parameters['overhead_hours'] -
+           bam_gb * parameters['localization_hours_per_gb'])
+      key = (run['stage'], 'gpu_hours_per_gb' if gpus else 'core_hours_per_gb')
+      stage_sums = sums.setdefault(key, [0, 0])
+      stage_sums[0] += x * y
+      stage_sums[1] += x * x
+
+    model = LinearThroughputModel(self.parameters)
+    for (stage, rate_name), (sum_xy, sum_xx) in sums.items():
+      if sum_xx > 0 and sum_xy > 0:
+        model.parameters[stage][rate_name] = sum_xy / sum_xx
+    return model
+
+
+class StagePlan(object):
+  """Workers, machine shape and predictions of a stage."""
+
+  def __init__(self, stage, workers, cores, ram_gb, disk_gb, gpus, hours,
+               cost):
+    self.stage = stage
+    self.workers = workers
+    self.cores = cores
+    self.ram_gb = ram_gb
+    self.disk_gb = disk_gb
+    self.gpus = gpus
+    self.hours = hours
+    self.cost = cost
+
+  def to_dict(self):
+    """Returns a JSON serializable description of the stage plan."""
+    return {
+        'stage': self.stage,
+        'workers': self.workers,
+        'cores_per_worker': self.cores,
+        'ram_per_worker_gb': self.ram_gb,
+        'gpus_per_worker': self.gpus,
+        'hours': round(self.hours, 3),
+        'cost_usd': round(self.cost, 2),
+    }
+
+
+class Plan(object):
+  """A planned run."""
+
+  def __init__(self, shards, stage_plans):
+    self.shards = shards
+    self.stage_plans = stage_plans
+    self.hours = sum(stage_plan.hours for stage_plan in stage_plans)
+    self.cost = sum(stage_plan.cost for stage_plan in stage_plans)
+
+  def get_flags(self):
+    """Returns the runner flags of the plan."""
+    make_examples, call_variants = self.stage_plans[:2]
+    return [
+        '--shards', str(self.shards),
+        '--make_examples_workers', str(make_examples.workers),
+        '--make_examples_cores_per_worker', str(make_examples.cores),
+        '--make_examples_ram_per_worker_gb', str(make_examples.ram_gb),
+        '--call_variants_workers', str(call_variants.workers),
+        '--call_variants_cores_per_worker', str(call_variants.cores),
+        '--call_variants_ram_per_worker_gb', str(call_variants.ram_gb),
+    ]
+
+  def to_dict(self):
+    """Returns a JSON serializable description of the plan."""
+    return {
+        'flags': self.get_flags(),
+        'stages': [stage_plan.to_dict() for stage_plan in self.stage_plans],
+        'hours': round(self.hours, 3),
+        'cost_usd': round(self.cost, 2),
+    }
+
+
+class ResourcePlanner(object):
+  """Picks the sharding and machine shapes of a run."""
+
+  def __init__(self,
+               model=None,
+               prices=None,
+               preemptible=False,
+               gpu=False,
+               max_workers=128):
+    """Picks the sharding and machine shapes of a run.
+
+    Args:
+      model: throughput model of the stages. Must provide the predict_hours
+        method of LinearThroughputModel. Defaults to LinearThroughputModel().
+      prices: (dict) prices overriding DEFAULT_PRICES.
+      preemptible: (bool) whether workers run on preemptible VMs.
+      gpu: (bool) whether call_variants runs on GPUs (one per worker).
+      max_workers: (int) maximum number of workers of a stage.
+    """
+    self._model = model or LinearThroughputModel()
+    self._prices = dict(DEFAULT_PRICES)
+    self._prices.update(prices or {})
+    self._preemptible = preemptible
+    self._gpu = gpu
+    self._max_workers = max_workers
+
+  def _get_price(self, resource):
+    if self._preemptible:
+      return self._prices['preemptible_' + resource]
+    return self._prices[resource]
+
+  def _get_stage_plan(self, stage, bam_bytes, region_fraction, workers, cores,
+                      ram_gb, disk_gb, gpus, work_cores=None):
+    hours = self._model.predict_hours(stage, bam_bytes, region_fraction,
+                                      workers, work_cores or cores, gpus)
+    hourly_cost = (
+        cores * self._get_price('core_hour') +
+        ram_gb * self._get_price('ram_gb_hour') +
+        gpus * self._get_price('gpu_hour') +
+        disk_gb * self._prices['disk_gb_hour'])
+    return StagePlan(stage, workers, cores, ram_gb, disk_gb, gpus, hours,
+                     workers * hours * hourly_cost)
+
+  def plan(self,
+           bam_bytes,
+           region_fraction=1.0,
+           target_hours=None,
+           budget_usd=None,
+           disk_gb=None,
+           postprocess_cores=8,
+           postprocess_ram_gb=30):
+    """Returns the best Plan of a run.
+
+    With target_hours, the cheapest plan meeting it (and the budget, if set)
+    is returned. Otherwise, the fastest plan within the budget is returned.
+
+    Args:
+      bam_bytes: (int) size of the BAM file.
+      region_fraction: (float) fraction of the genome that is called.
+      target_hours: (float) maximum wall-clock time of the run.
+      budget_usd: (float) maximum cost of the run.
+      disk_gb: (dict) disk size (in GB) of the workers of each stage.
+      postprocess_cores: (int) cores of the postprocess_variants worker.
+      postprocess_ram_gb: (int) RAM (in GB) of the postprocess_variants worker.
+
+    Raises:
+      ValueError: if neither target_hours nor budget_usd is set, or if no plan
+        meets them.
+    """
+    if target_hours is None and budget_usd is None:
+      raise ValueError('A target time or a budget is required to plan a run.')
+    disk_gb = disk_gb or {}
+    postprocess = self._get_stage_plan(
+        POSTPROCESS_VARIANTS, bam_bytes, region_fraction, 1, postprocess_cores,
+        postprocess_ram_gb, disk_gb.get(POSTPROCESS_VARIANTS, 0), 0,
+        work_cores=1)
+
+    best_plan = None
+    closest_plan = None
+    for make_examples_cores in _CORES_PER_WORKER:
+      for make_examples_workers in range(1, self._max_workers + 1):
+        shards = make_examples_workers * make_examples_cores
+        make_examples = self._get_stage_plan(
+            MAKE_EXAMPLES, bam_bytes, region_fraction, make_examples_workers,
+            make_examples_cores, int(make_examples_cores * _RAM_GB_PER_CORE),
+            disk_gb.get(MAKE_EXAMPLES, 0), 0)
+        for call_variants in self._get_call_variants_plans(
+            bam_bytes, region_fraction, shards, make_examples_workers,
+            disk_gb.get(CALL_VARIANTS, 0)):
+          plan = Plan(shards, [make_examples, call_variants, postprocess])
+          if self._is_better(plan, closest_plan, None, None):
+            closest_plan = plan
+          if self._is_better(plan, best_plan, target_hours, budget_usd):
+            best_plan = plan
+    if best_plan is None:
+      raise ValueError(
+          'No plan meets the target time or budget. The fastest plan takes '
+          '%.2f hours and costs %.2f USD.' %
+          (closest_plan.hours, closest_plan.cost))
+    return best_plan
+
+  def _get_call_variants_plans(self, bam_bytes, region_fraction, shards,
+                               max_workers, disk_gb):
+    """Yields the call_variants options for the given number of shards."""
+    # Workers must divide the shards, and not outnumber make_examples workers.
+    for workers in range(1, min(max_workers, self._max_workers) + 1):
+      if shards % workers:
+        continue
+      if self._gpu:
+        yield self._get_stage_plan(CALL_VARIANTS, bam_bytes, region_fraction,
+                                   workers, 8, 30, disk_gb, 1)
+        continue
+      for cores in _CORES_PER_WORKER:
+        yield self._get_stage_plan(CALL_VARIANTS, bam_bytes, region_fraction,
+                                   workers, cores,
+                                   int(cores * _RAM_GB_PER_CORE), disk_gb, 0)
+
+  @staticmethod
+  def _is_better(plan, best_plan, target_hours, budget_usd):
+    """Returns whether plan meets the constraints and beats best_plan."""
+    if target_hours is not None and plan.hours > target_hours:
+      return False
+    if budget_usd is not None and plan.cost > budget_usd:
+      return False
+    if best_plan is None:
+      return True
+    if target_hours is not None:
+      return (plan.cost, plan.hours) < (best_plan.cost, best_plan.hours)
+    return (plan.hours, plan.cost) < (best_plan.hours, best_plan.cost)
+
+
+def get_region_bases(regions, references, bed_contents=None):
+  """Returns the number of bases in the given regions.
+
+  Overlapping regions are counted multiple times.
+
+  Args:
+    regions: (list) region literals, either a reference name (chr20) or a range
+      (chr20:10,000-20,000, 1-based and inclusive).
+    references: (list) region_partitioner.Reference of the genome.
+    bed_contents: (list) contents of BED files with additional regions.
+
+  Raises:
+    ValueError: if a region literal is invalid.
+  """
+  lengths = {reference.name: reference.length for reference in references}
+  bases = 0
+  for region in regions:
+    match = _REGION_LITERAL_PATTERN.match(region)
+    if match:
+      start = int(match.group(2).replace(',', ''))
+      end = int(match.group(3).replace(',', ''))
+      bases += max(0, end - start + 1)
+    elif region in lengths:
+      bases += lengths[region]
+    else:
+      raise ValueError('Invalid region: %s' % region)
+  for content in bed_contents or []:
+    for line in content.splitlines():
+      fields = line.split('\t')
+      if len(fields) >= 3 and not line.startswith(('#', 'track', 'browser')):
+        bases += max(0, int(fields[2]) - int(fields[1]))
+  return bases
@@ -0,0 +1,199 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for resource_planner.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python resource_planner_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import region_partitioner
+import resource_planner
+
+_GB = 1 << 30
+
+
+class _ConstantModel(object):
+  """Throughput model where sharded stages do 64 core-hours of work.
+
+  Each worker also takes half an hour to start.
+  """
+
+  def predict_hours(self, stage, bam_bytes, region_fraction, workers, cores,
+                    gpus):
+    del bam_bytes, region_fraction, gpus  # Unused.
+    if stage == resource_planner.POSTPROCESS_VARIANTS:
+      return 0
+    return 0.5 + 64 / (workers * cores)
+
+
+class LinearThroughputModelTest(unittest.TestCase):
+  """Tests for LinearThroughputModel class."""
+
+  def test_predict_hours(self):
+    model = resource_planner.LinearThroughputModel({
+        'make_examples': {
+            'core_hours_per_gb': 2,
+            'overhead_hours': 0.5,
+            'localization_hours_per_gb': 0.1
+        },
+        'call_variants': {
+            'gpu_hours_per_gb': 0.25,
+            'overhead_hours': 0
+        },
+    })
+    self.assertAlmostEqual(
+        model.predict_hours('make_examples', 10 * _GB, 0.5, 2, 5, 0),
+        0.5 + 1 + 1)
+    self.assertAlmostEqual(
+        model.predict_hours('call_variants', 10 * _GB, 1, 5, 8, 1), 0.5)
+
+  def test_unknown_stage(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown stage'):
+      resource_planner.LinearThroughputModel({'foo': {}})
+
+  def test_calibrate(self):
+    model = resource_planner.LinearThroughputModel({
+        'make_examples': {
+            'overhead_hours': 0.5,
+            'localization_hours_per_gb': 0
+        }
+    })
+    runs = [
+        {'stage': 'make_examples', 'bam_bytes': 10 * _GB,
+         'region_fraction': 1, 'workers': 1, 'cores_per_worker': 10,
+         'hours': 4.5},
+        {'stage': 'make_examples', 'bam_bytes': 20 * _GB,
+         'region_fraction': 0.5, 'workers': 2, 'cores_per_worker': 5,
+         'hours': 4.5},
+        {'stage': 'call_variants', 'bam_bytes': 10 * _GB,
+         'region_fraction': 1, 'workers': 1, 'cores_per_worker': 8,
+         'gpus_per_worker': 1, 'hours': 0.1 + 10 * 0.2},
+    ]
+    calibrated = model.calibrate(runs)
+    self.assertAlmostEqual(
+        calibrated.parameters['make_examples']['core_hours_per_gb'], 4)
+    self.assertAlmostEqual(
+        calibrated.parameters['call_variants']['gpu_hours_per_gb'], 0.2)
+    # Rates without runs, and the original model, are unchanged.
+    self.assertEqual(
+        calibrated.parameters['call_variants']['core_hours_per_gb'],
+        model.parameters['call_variants']['core_hours_per_gb'])
+    self.assertNotEqual(
+        model.parameters['make_examples']['core_hours_per_gb'], 4)
+
+
+class ResourcePlannerTest(unittest.TestCase):
+  """Tests for ResourcePlanner class."""
+
+  def test_plan_target_hours(self):
+    planner = resource_planner.ResourcePlanner(
+        _ConstantModel(), max_workers=16)
+    plan = planner.plan(10 * _GB, target_hours=6)
+
+    self.assertLessEqual(plan.hours, 6)
+    make_examples, call_variants, _ = plan.stage_plans
+    self.assertEqual(plan.shards,
+                     make_examples.workers * make_examples.cores)
+    self.assertEqual(plan.shards % call_variants.workers, 0)
+    self.assertLessEqual(call_variants.workers, make_examples.workers)
+    # Workers cost their startup time, so the cheapest plan is not much faster
+    # than the target.
+    self.assertGreater(plan.hours, 5)
+
+  def test_plan_budget(self):
+    planner = resource_planner.ResourcePlanner(
+        _ConstantModel(), max_workers=16)
+    cheap_plan = planner.plan(10 * _GB, budget_usd=20)
+    expensive_plan = planner.plan(10 * _GB, budget_usd=1000)
+
+    self.assertLessEqual(cheap_plan.cost, 20)
+    self.assertLess(expensive_plan.hours, cheap_plan.hours)
+
+  def test_plan_gpu(self):
+    planner = resource_planner.ResourcePlanner(gpu=True, max_workers=8)
+    plan = planner.plan(10 * _GB, target_hours=100)
+    self.assertEqual(plan.stage_plans[1].gpus, 1)
+    self.assertIn('--call_variants_workers', plan.get_flags())
+
+  def test_plan_preemptible_is_cheaper(self):
+    plan = resource_planner.ResourcePlanner(max_workers=8).plan(
+        10 * _GB, target_hours=100)
+    preemptible_plan = resource_planner.ResourcePlanner(
+        preemptible=True, max_workers=8).plan(10 * _GB, target_hours=100)
+    self.assertLess(preemptible_plan.cost, plan.cost)
+
+  def test_plan_infeasible(self):
+    planner = resource_planner.ResourcePlanner(max_workers=2)
+    with self.assertRaisesRegex(ValueError, 'No plan meets'):
+      planner.plan(100 * _GB, target_hours=0.1)
+    with self.assertRaisesRegex(ValueError, 'target time or a budget'):
+      planner.plan(100 * _GB)
+
+  def test_to_dict(self):
+    plan = resource_planner.ResourcePlanner(max_workers=4).plan(
+        _GB, target_hours=100)
+    plan_dict = plan.to_dict()
+    self.assertEqual(plan_dict['flags'][:2], ['--shards', str(plan.shards)])
+    self.assertEqual(
+        [stage['stage'] for stage in plan_dict['stages']],
+        ['make_examples', 'call_variants', 'postprocess_variants'])
+
+
+class GetRegionBasesTest(unittest.TestCase):
+
+  def test_get_region_bases(self):
+    references = [
+        region_partitioner.Reference('chr1', 1000),
+        region_partitioner.Reference('chr2', 500)
+    ]
+    self.assertEqual(
+        resource_planner.get_region_bases(
+            ['chr1:1-100', 'chr2', 'chr1:1,001-1,010'], references,
+            ['track name=foo\nchr1\t0\t50\nchr2\t10\t20\textra\n']),
+        100 + 500 + 10 + 50 + 10)
+
+  def test_invalid_region(self):
+    with self.assertRaisesRegex(ValueError, 'Invalid region: chr3'):
+      resource_planner.get_region_bases(['chr3'], [])
+
+
+if __name__ == '__main__':
+  unittest.main()
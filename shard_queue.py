@@ -0,0 +1,179 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Queue of shard batches that workers pull from until it is empty.
+
+Each task of the queue is a batch of shards and is claimed by taking a lease on
+it in a lease_store.LeaseStore. While a task runs, its lease is renewed in the
+background, so that tasks of crashed workers become claimable again once their
+lease expires.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import threading
+
+
+# Time (in seconds) after which the lease of a task expires unless renewed.
+_DEFAULT_LEASE_SEC = 10 * 60
+
+# Prefix of the lease names of tasks.
+_TASK_LEASE_PREFIX = 'task-'
+
+
+class _LeaseRenewer(threading.Thread):
+  """Renews the lease of a task until stopped."""
+
+  def __init__(self, queue, task_index, owner):
+    super(_LeaseRenewer, self).__init__()
+    self.daemon = True
+    self._queue = queue
+    self._task_index = task_index
+    self._owner = owner
+    self._stopped = threading.Event()
+
+  def run(self):
+    while not self._stopped.wait(self._queue.lease_sec / 3):
+      if not self._queue.renew(self._task_index, self._owner):
+        logging.warning('Lost the lease of task %d.', self._task_index)
+        return
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
+
+
+class ShardQueue(object):
+  """Queue of shard batches backed by a lease store."""
+
+  def __init__(self, lease_store, shards, batch_size,
+               lease_sec=_DEFAULT_LEASE_SEC):
+    """Queue of shard batches backed by a lease store.
+
+    Args:
+      lease_store: (lease_store.LeaseStore) store of the task leases.
+      shards: (int) total number of shards.
+      batch_size: (int) number of consecutive shards in each task.
+      lease_sec: (int) time (in seconds) after which the lease of a task
+        expires unless renewed.
+
+    Raises:
+      ValueError: if shards is not divisible by batch_size.
+    """
+    if batch_size <= 0 or shards % batch_size != 0:
+      raise ValueError('Number of shards must be divisible by batch size.')
+    self.num_tasks = shards // batch_size
+    self.batch_size = batch_size
+    self.lease_sec = lease_sec
+    self._lease_store = lease_store
+    self._lock = threading.Lock()
+    self._done_tasks = set()
+
+  def _get_lease_name(self, task_index):
+    return '%s%d' % (_TASK_LEASE_PREFIX, task_index)
+
+  def get_shards(self, task_index):
+    """Returns the shard indices of a task."""
+    return list(
+        range(task_index * self.batch_size,
+              (task_index + 1) * self.batch_size))
+
+  def reset(self):
+    """Removes all leases, i.e. marks all tasks as not done."""
+    self._lease_store.clear()
+    with self._lock:
+      self._done_tasks.clear()
+
+  def claim(self, owner):
+    """Claims the first task that is neither done nor leased by others.
+
+    Args:
+      owner: (str) unique identifier of the caller.
+
+    Returns:
+      The index of the claimed task, or None if no task can be claimed.
+    """
+    for task_index in range(self.num_tasks):
+      with self._lock:
+        if task_index in self._done_tasks:
+          continue
+      lease_name = self._get_lease_name(task_index)
+      if self._lease_store.try_acquire(lease_name, owner, self.lease_sec):
+        return task_index
+      if self._lease_store.is_done(lease_name):
+        with self._lock:
+          self._done_tasks.add(task_index)
+    return None
+
+  def renew(self, task_index, owner):
+    """Extends the lease of a claimed task. Returns False if it was lost."""
+    return self._lease_store.renew(
+        self._get_lease_name(task_index), owner, self.lease_sec)
+
+  def complete(self, task_index, owner):
+    """Marks a claimed task as done."""
+    if not self._lease_store.mark_done(self._get_lease_name(task_index), owner):
+      logging.warning('Task %d was completed without holding its lease.',
+                      task_index)
+    with self._lock:
+      self._done_tasks.add(task_index)
+
+  def release(self, task_index, owner):
+    """Releases a claimed task, so that other workers can claim it."""
+    self._lease_store.release(self._get_lease_name(task_index), owner)
+
+  def is_done(self):
+    """Returns true if all tasks are done."""
+    return all(
+        self._lease_store.is_done(self._get_lease_name(task_index))
+        for task_index in range(self.num_tasks))
+
+  def run_task(self, task_index, owner, func, *args):
+    """Runs func while renewing the lease of a claimed task.
+
+    The task is marked as done if func succeeds, and released otherwise.
+
+    Args:
+      task_index: (int) index of a task claimed by owner.
+      owner: (str) unique identifier of the caller.
+      func: (callable) function that runs the task.
+      *args: arguments to pass to func.
+    """
+    renewer = _LeaseRenewer(self, task_index, owner)
+    renewer.start()
+    try:
+      func(*args)
+    except:
+      renewer.stop()
+      self.release(task_index, owner)
+      raise
+    renewer.stop()
+    self.complete(task_index, owner)
@@ -0,0 +1,157 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for shard_queue.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python shard_queue_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing.pool
+import shutil
+import tempfile
+import threading
+import unittest
+
+import lease_store
+import mock
+import shard_queue
+
+
+class ShardQueueTest(unittest.TestCase):
+  """Tests for ShardQueue class."""
+
+  def setUp(self):
+    super(ShardQueueTest, self).setUp()
+    self._directory = tempfile.mkdtemp()
+    self._store = lease_store.LocalLeaseStore(self._directory)
+
+  def tearDown(self):
+    shutil.rmtree(self._directory)
+    super(ShardQueueTest, self).tearDown()
+
+  def test_invalid_batch_size(self):
+    with self.assertRaisesRegex(ValueError, 'divisible by batch size'):
+      shard_queue.ShardQueue(self._store, 10, 3)
+
+  def test_get_shards(self):
+    queue = shard_queue.ShardQueue(self._store, 6, 2)
+    self.assertEqual(queue.num_tasks, 3)
+    self.assertEqual(queue.get_shards(1), [2, 3])
+
+  def test_claim_and_complete(self):
+    queue = shard_queue.ShardQueue(self._store, 3, 1)
+    self.assertEqual(queue.claim('a'), 0)
+    self.assertEqual(queue.claim('b'), 1)
+    queue.complete(0, 'a')
+    self.assertEqual(queue.claim('a'), 2)
+    self.assertIsNone(queue.claim('c'))
+    self.assertFalse(queue.is_done())
+    queue.complete(1, 'b')
+    queue.complete(2, 'a')
+    self.assertTrue(queue.is_done())
+
+  def test_claim_expired_lease(self):
+    queue = shard_queue.ShardQueue(self._store, 2, 1, lease_sec=60)
+    with mock.patch('time.time', return_value=1000):
+      self.assertEqual(queue.claim('a'), 0)
+      self.assertEqual(queue.claim('b'), 1)
+    # Worker a crashed, and its lease expired.
+    with mock.patch('time.time', return_value=1050):
+      self.assertTrue(queue.renew(1, 'b'))
+    with mock.patch('time.time', return_value=1100):
+      self.assertEqual(queue.claim('c'), 0)
+
+  def test_run_task(self):
+    queue = shard_queue.ShardQueue(self._store, 2, 1)
+    func = mock.Mock()
+    self.assertEqual(queue.claim('a'), 0)
+    queue.run_task(0, 'a', func, 'foo')
+    func.assert_called_once_with('foo')
+    self.assertEqual(queue.claim('a'), 1)
+    func.side_effect = RuntimeError('failed')
+    with self.assertRaises(RuntimeError):
+      queue.run_task(1, 'a', func, 'foo')
+    # The failed task is released and can be claimed by another worker.
+    self.assertEqual(queue.claim('b'), 1)
+
+  def test_run_task_renews_lease(self):
+    queue = shard_queue.ShardQueue(self._store, 1, 1, lease_sec=0.3)
+    self.assertEqual(queue.claim('a'), 0)
+    blocked = threading.Event()
+
+    def func():
+      # Sleeps for longer than the lease.
+      blocked.wait(0.6)
+      self.assertIsNone(queue.claim('b'))
+
+    queue.run_task(0, 'a', func)
+    self.assertTrue(queue.is_done())
+
+  def test_reset(self):
+    queue = shard_queue.ShardQueue(self._store, 1, 1)
+    queue.claim('a')
+    queue.complete(0, 'a')
+    queue.reset()
+    self.assertFalse(queue.is_done())
+    self.assertEqual(queue.claim('a'), 0)
+
+  def test_concurrent_workers(self):
+    queue = shard_queue.ShardQueue(self._store, 20, 1)
+    ran_tasks = []
+    lock = threading.Lock()
+
+    def run_worker(owner):
+      while True:
+        task_index = queue.claim(owner)
+        if task_index is None:
+          return
+        with lock:
+          ran_tasks.append(task_index)
+        queue.complete(task_index, owner)
+
+    pool = multiprocessing.pool.ThreadPool(4)
+    pool.map(run_worker, ['worker-%d' % i for i in range(4)])
+    pool.close()
+    pool.join()
+    self.assertEqual(sorted(ran_tasks), list(range(20)))
+    self.assertTrue(queue.is_done())
+
+
+if __name__ == '__main__':
+  unittest.main()
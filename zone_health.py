@@ -0,0 +1,248 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tracks the health of Compute Engine zones to route workers to.
+
+The outcome of each worker launch is parsed from the output of the pipelines
+tool: the zone a worker was assigned to (and how long that took), stockouts
+(the zone has no resources left for the machine type) and preemptions. The
+outcomes are kept per zone in a SQLite database (by default under ~/.cache),
+shared by all runs of the user, as counts that decay with a half-life so that
+old outcomes are eventually forgotten.
+
+The score of a zone is the smoothed fraction of its launches that neither
+stocked out nor were preempted. A zone without outcomes scores 0.5.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import fnmatch
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'gcp_deepvariant_runner', 'zone_health.sqlite')
+DEFAULT_HALF_LIFE_SEC = 24 * 3600
+# Zones scoring less than this fraction of the best zone's score are avoided.
+DEFAULT_MIN_RELATIVE_SCORE = 0.75
+
+ASSIGNED = 'assigned'
+STOCKOUT = 'stockout'
+PREEMPTED = 'preempted'
+
+# Time (in seconds) to wait for another process to release the database.
+_LOCK_TIMEOUT_SEC = 30
+
+_ZONE = r'[a-z]+-[a-z]+[0-9]+-[a-z]'
+_ASSIGNED_PATTERN = re.compile(r'assigned in "?(%s)\b' % _ZONE)
+_ZONE_PATTERN = re.compile(r'\b(%s)\b' % _ZONE)
+_STOCKOUT_PATTERN = re.compile(
+    r'ZONE_RESOURCE_POOL_EXHAUSTED|does not have enough resources|stockout',
+    re.IGNORECASE)
+_PREEMPTED_PATTERN = re.compile(r'preempted', re.IGNORECASE)
+
+
+class ZoneEvent(object):
+  """An outcome of a worker launch in a zone."""
+
+  def __init__(self, kind, zone, elapsed_sec=None):
+    self.kind = kind
+    self.zone = zone
+    self.elapsed_sec = elapsed_sec
+
+  def __eq__(self, other):
+    return ((self.kind, self.zone, self.elapsed_sec) ==
+            (other.kind, other.zone, other.elapsed_sec))
+
+  def __repr__(self):
+    return 'ZoneEvent(%r, %r, %r)' % (self.kind, self.zone, self.elapsed_sec)
+
+
+def parse_events(lines):
+  """Returns the ZoneEvents in the output of a pipelines job.
+
+  A preemption or stockout without a zone of its own is attributed to the zone
+  the worker was last assigned to.
+
+  Args:
+    lines: (list) (elapsed_sec, line) of each output line, where elapsed_sec
+      is the time from the start of the job to the line being printed.
+  """
+  events = []
+  zone = None
+  for elapsed_sec, line in lines:
+    match = _ASSIGNED_PATTERN.search(line)
+    if match:
+      zone = match.group(1)
+      events.append(ZoneEvent(ASSIGNED, zone, elapsed_sec))
+      continue
+    match = _ZONE_PATTERN.search(line)
+    line_zone = match.group(1) if match else zone
+    if not line_zone:
+      continue
+    if _STOCKOUT_PATTERN.search(line):
+      events.append(ZoneEvent(STOCKOUT, line_zone, elapsed_sec))
+    elif _PREEMPTED_PATTERN.search(line):
+      events.append(ZoneEvent(PREEMPTED, line_zone, elapsed_sec))
+  return events
+
+
+class ZoneStats(object):
+  """Decayed outcome counts of a zone."""
+
+  def __init__(self, launches=0, stockouts=0, preemptions=0,
+               latency_sec_sum=0):
+    self.launches = launches
+    self.stockouts = stockouts
+    self.preemptions = preemptions
+    self.latency_sec_sum = latency_sec_sum
+
+  @property
+  def score(self):
+    """Smoothed fraction of launches neither stocked out nor preempted."""
+    healthy = max(self.launches - self.preemptions, 0)
+    return (healthy + 1) / (self.launches + self.stockouts + 2)
+
+  @property
+  def mean_latency_sec(self):
+    """Mean time for a worker to be assigned to the zone, or None."""
+    if not self.launches:
+      return None
+    return self.latency_sec_sum / self.launches
+
+  def __repr__(self):
+    return ('ZoneStats(launches=%.1f, stockouts=%.1f, preemptions=%.1f, '
+            'score=%.2f)' % (self.launches, self.stockouts, self.preemptions,
+                             self.score))
+
+
+class ZoneHealth(object):
+  """Outcomes of worker launches per zone, kept in a SQLite database."""
+
+  def __init__(self, path=DEFAULT_PATH, half_life_sec=DEFAULT_HALF_LIFE_SEC):
+    """Opens (and creates if needed) the database.
+
+    Args:
+      path: (str) local path of the database.
+      half_life_sec: (int) time (in seconds) after which an outcome counts
+        half as much.
+    """
+    if not os.path.isdir(os.path.dirname(path) or '.'):
+      os.makedirs(os.path.dirname(path))
+    self._half_life_sec = half_life_sec
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(
+        path, timeout=_LOCK_TIMEOUT_SEC, check_same_thread=False)
+    with self._connection:
+      self._connection.execute(
+          'CREATE TABLE IF NOT EXISTS zones ('
+          'zone TEXT PRIMARY KEY, launches REAL, stockouts REAL, '
+          'preemptions REAL, latency_sec_sum REAL, updated_time REAL)')
+
+  def _get_stats(self, zone, now):
+    row = self._connection.execute(
+        'SELECT launches, stockouts, preemptions, latency_sec_sum, '
+        'updated_time FROM zones WHERE zone = ?', (zone,)).fetchone()
+    if row is None:
+      return ZoneStats()
+    decay = 0.5**(max(now - row[4], 0) / self._half_life_sec)
+    return ZoneStats(*[value * decay for value in row[:4]])
+
+  def get_stats(self, zone):
+    """Returns the ZoneStats of a zone, decayed to now."""
+    with self._lock:
+      return self._get_stats(zone, time.time())
+
+  def record(self, events):
+    """Records the ZoneEvents of a job."""
+    now = time.time()
+    with self._lock, self._connection:
+      for event in events:
+        stats = self._get_stats(event.zone, now)
+        if event.kind == ASSIGNED:
+          stats.launches += 1
+          stats.latency_sec_sum += event.elapsed_sec or 0
+        elif event.kind == STOCKOUT:
+          stats.stockouts += 1
+        elif event.kind == PREEMPTED:
+          stats.preemptions += 1
+        self._connection.execute(
+            'INSERT OR REPLACE INTO zones VALUES (?, ?, ?, ?, ?, ?)',
+            (event.zone, stats.launches, stats.stockouts, stats.preemptions,
+             stats.latency_sec_sum, now))
+
+  def select_zones(self, zones, min_relative_score=DEFAULT_MIN_RELATIVE_SCORE):
+    """Returns the healthiest of the given zones, best first.
+
+    Zones are ranked by score, then by mean launch latency. Zones scoring less
+    than min_relative_score of the best zone are left out. A wildcard (e.g.
+    "us-central1-*") is expanded to the zones with outcomes matching it, and
+    is itself kept as a candidate that scores like a zone without outcomes.
+
+    Args:
+      zones: (list) candidate zones.
+      min_relative_score: (float) minimum score, relative to the best one, of
+        the returned zones.
+    """
+    now = time.time()
+    with self._lock:
+      known_zones = [
+          row[0] for row in self._connection.execute(
+              'SELECT zone FROM zones ORDER BY zone')
+      ]
+      candidates = []
+      for zone in zones:
+        if '*' in zone:
+          candidates.extend(
+              known_zone for known_zone in known_zones
+              if fnmatch.fnmatchcase(known_zone, zone))
+        candidates.append(zone)
+      candidates = list(collections.OrderedDict.fromkeys(candidates))
+      stats = {
+          zone: ZoneStats() if '*' in zone else self._get_stats(zone, now)
+          for zone in candidates
+      }
+    ranked_zones = sorted(
+        candidates,
+        key=lambda zone: (-stats[zone].score, stats[zone].mean_latency_sec or 0)
+    )
+    if not ranked_zones:
+      return []
+    min_score = stats[ranked_zones[0]].score * min_relative_score
+    return [zone for zone in ranked_zones if stats[zone].score >= min_score]
+
+  def close(self):
+    self._connection.close()
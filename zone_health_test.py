@@ -0,0 +1,142 @@
+# Copyright 2018 Google LLC.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Tests for zone_health.py.
+
+To run the tests, first activate virtualenv and install required packages:
+$ virtualenv venv
+$ . venv/bin/activate
+$ pip install -r requirements.txt
+$ pip install mock
+
+Then run:
+$ python zone_health_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import zone_health
+
+
+class ParseEventsTest(unittest.TestCase):
+
+  def test_parse_events(self):
+    lines = [
+        (1, 'Pipeline running as "projects/p/operations/1"'),
+        (40, 'Worker "google-pipelines-worker-1" assigned in "us-east1-b"'),
+        (300, 'Execution failed: the worker was preempted'),
+        (310, 'Error: ZONE_RESOURCE_POOL_EXHAUSTED: The zone '
+              '\'projects/p/zones/us-east1-c\' does not have enough '
+              'resources available to fulfill the request.'),
+        (350, 'Worker "google-pipelines-worker-2" assigned in "us-east1-d"'),
+    ]
+    self.assertEqual(
+        zone_health.parse_events(lines), [
+            zone_health.ZoneEvent(zone_health.ASSIGNED, 'us-east1-b', 40),
+            zone_health.ZoneEvent(zone_health.PREEMPTED, 'us-east1-b', 300),
+            zone_health.ZoneEvent(zone_health.STOCKOUT, 'us-east1-c', 310),
+            zone_health.ZoneEvent(zone_health.ASSIGNED, 'us-east1-d', 350),
+        ])
+
+  def test_parse_events_without_zone(self):
+    self.assertEqual(
+        zone_health.parse_events([(1, 'Worker was preempted')]), [])
+
+
+class ZoneHealthTest(unittest.TestCase):
+
+  def setUp(self):
+    super(ZoneHealthTest, self).setUp()
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'health', 'zones.sqlite')
+    self._health = zone_health.ZoneHealth(self._path, half_life_sec=100)
+
+  def tearDown(self):
+    self._health.close()
+    shutil.rmtree(self._dir)
+    super(ZoneHealthTest, self).tearDown()
+
+  def _record(self, kind, zone, count=1, elapsed_sec=None):
+    self._health.record(
+        [zone_health.ZoneEvent(kind, zone, elapsed_sec)] * count)
+
+  def test_get_stats(self):
+    self.assertEqual(self._health.get_stats('us-east1-b').score, 0.5)
+    self._record(zone_health.ASSIGNED, 'us-east1-b', 2, elapsed_sec=30)
+    self._record(zone_health.PREEMPTED, 'us-east1-b')
+    stats = self._health.get_stats('us-east1-b')
+    self.assertAlmostEqual(stats.launches, 2, places=3)
+    self.assertAlmostEqual(stats.score, 0.5, places=3)
+    self.assertAlmostEqual(stats.mean_latency_sec, 30, places=3)
+
+  @mock.patch('time.time')
+  def test_get_stats_decays(self, mock_time):
+    mock_time.return_value = 1000
+    self._record(zone_health.STOCKOUT, 'us-east1-b', 4)
+    mock_time.return_value = 1200
+    self.assertAlmostEqual(self._health.get_stats('us-east1-b').stockouts, 1)
+
+  def test_select_zones(self):
+    self._record(zone_health.ASSIGNED, 'us-east1-b', 4, elapsed_sec=100)
+    self._record(zone_health.ASSIGNED, 'us-east1-c', 4, elapsed_sec=10)
+    self._record(zone_health.STOCKOUT, 'us-east1-d', 4)
+    self.assertEqual(
+        self._health.select_zones(['us-east1-b', 'us-east1-c', 'us-east1-d']),
+        ['us-east1-c', 'us-east1-b'])
+    # Without outcomes, zones are kept in order.
+    self.assertEqual(
+        self._health.select_zones(['us-west1-a', 'us-west1-b']),
+        ['us-west1-a', 'us-west1-b'])
+
+  def test_select_zones_wildcard(self):
+    self._record(zone_health.ASSIGNED, 'us-east1-b', 4)
+    self._record(zone_health.STOCKOUT, 'us-east1-c', 4)
+    self._record(zone_health.ASSIGNED, 'us-west1-a', 4)
+    self.assertEqual(self._health.select_zones(['us-east1-*']),
+                     ['us-east1-b'])
+    self._record(zone_health.STOCKOUT, 'us-east1-b', 8)
+    self.assertEqual(self._health.select_zones(['us-east1-*']),
+                     ['us-east1-*'])
+
+  def test_persists_across_instances(self):
+    self._record(zone_health.STOCKOUT, 'us-east1-b', 3)
+    other_health = zone_health.ZoneHealth(self._path, half_life_sec=100)
+    self.assertLess(other_health.get_stats('us-east1-b').score, 0.5)
+    other_health.close()
+
+
+if __name__ == '__main__':
+  unittest.main()